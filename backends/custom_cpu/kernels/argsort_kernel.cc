@@ -15,6 +15,7 @@
 #include "kernels/kernels.h"
 #include "kernels/phi_funcs.h"
 #include "paddle/phi/capi/all.h"
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -83,6 +84,7 @@ void ArgsortKernel(const phi::Context& dev_ctx,
                    bool stable,
                    phi::DenseTensor* output,
                    phi::DenseTensor* indices) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto in_dims = input.dims();
   auto rank = in_dims.size();
   axis = (axis < 0) ? (in_dims.size() + axis) : axis;
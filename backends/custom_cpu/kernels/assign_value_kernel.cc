@@ -16,6 +16,7 @@
 
 #include "paddle/phi/capi/all.h"
 #include "phi_funcs.h"  //NOLINT
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -25,6 +26,7 @@ void AssignValueKernel(const phi::Context& dev_ctx,
                        phi::DataType dtype,
                        const std::vector<phi::Scalar>& values,
                        phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto template_dtype = phi::capi::CppTypeToPDType<T>::Type();
   PD_CHECK(dtype == template_dtype,
            "Argument dtype mismatch for kernel dtype, "
@@ -42,6 +44,7 @@ template <typename T>
 void AssignKernel(const phi::Context& dev_ctx,
                   const phi::DenseTensor& x,
                   phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto out_data = dev_ctx.template Alloc<T>(out);
   auto x_data = x.data<T>();
   std::memcpy(out_data, x_data, sizeof(T) * x.numel());
@@ -14,6 +14,7 @@
 
 #include "paddle/phi/capi/all.h"
 #include "phi_funcs.h"  //NOLINT
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -22,6 +23,7 @@ void CastKernel(const phi::Context& dev_ctx,
                 const phi::DenseTensor& x,
                 phi::DataType out_dtype,
                 phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_data = x.data<T>();
   out->Resize(x.dims());
   auto numel = x.numel();
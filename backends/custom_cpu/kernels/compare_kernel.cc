@@ -16,6 +16,7 @@
 
 #include "paddle/phi/capi/all.h"
 #include "phi_funcs.h"  //NOLINT
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -25,6 +26,7 @@ void NotEqualRawKernel(const phi::Context& dev_ctx,
                        const phi::DenseTensor& y,
                        int axis,
                        phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
   auto y_dims = y.dims();
   auto dst_dims = phi::BroadcastDims(axis, x_dims, y_dims);
@@ -52,6 +54,7 @@ void NotEqualKernel(const phi::Context& dev_ctx,
                     const phi::DenseTensor& x,
                     const phi::DenseTensor& y,
                     phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   custom_kernel::NotEqualRawKernel<T>(dev_ctx, x, y, -1, out);
 }
 
@@ -61,6 +64,7 @@ void EqualRawKernel(const phi::Context& dev_ctx,
                     const phi::DenseTensor& y,
                     int axis,
                     phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
   auto y_dims = y.dims();
   auto dst_dims = phi::BroadcastDims(axis, x_dims, y_dims);
@@ -88,6 +92,7 @@ void EqualKernel(const phi::Context& dev_ctx,
                  const phi::DenseTensor& x,
                  const phi::DenseTensor& y,
                  phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   custom_kernel::EqualRawKernel<T>(dev_ctx, x, y, -1, out);
 }
 
@@ -97,6 +102,7 @@ void LessThanRawKernel(const phi::Context& dev_ctx,
                        const phi::DenseTensor& y,
                        int axis,
                        phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
   auto y_dims = y.dims();
   auto dst_dims = phi::BroadcastDims(axis, x_dims, y_dims);
@@ -118,6 +124,7 @@ void LessThanKernel(const phi::Context& dev_ctx,
                     const phi::DenseTensor& x,
                     const phi::DenseTensor& y,
                     phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   custom_kernel::LessThanRawKernel<T>(dev_ctx, x, y, -1, out);
 }
 
@@ -127,6 +134,7 @@ void LessEqualRawKernel(const phi::Context& dev_ctx,
                         const phi::DenseTensor& y,
                         int axis,
                         phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
   auto y_dims = y.dims();
   auto dst_dims = phi::BroadcastDims(axis, x_dims, y_dims);
@@ -148,6 +156,7 @@ void LessEqualKernel(const phi::Context& dev_ctx,
                      const phi::DenseTensor& x,
                      const phi::DenseTensor& y,
                      phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   custom_kernel::LessEqualRawKernel<T>(dev_ctx, x, y, -1, out);
 }
 
@@ -157,6 +166,7 @@ void GreaterThanRawKernel(const phi::Context& dev_ctx,
                           const phi::DenseTensor& y,
                           int axis,
                           phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
   auto y_dims = y.dims();
   auto dst_dims = phi::BroadcastDims(axis, x_dims, y_dims);
@@ -178,6 +188,7 @@ void GreaterThanKernel(const phi::Context& dev_ctx,
                        const phi::DenseTensor& x,
                        const phi::DenseTensor& y,
                        phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   custom_kernel::GreaterThanRawKernel<T>(dev_ctx, x, y, -1, out);
 }
 
@@ -187,6 +198,7 @@ void GreaterEqualRawKernel(const phi::Context& dev_ctx,
                            const phi::DenseTensor& y,
                            int axis,
                            phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
   auto y_dims = y.dims();
   auto dst_dims = phi::BroadcastDims(axis, x_dims, y_dims);
@@ -208,6 +220,7 @@ void GreaterEqualKernel(const phi::Context& dev_ctx,
                         const phi::DenseTensor& x,
                         const phi::DenseTensor& y,
                         phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   custom_kernel::GreaterEqualRawKernel<T>(dev_ctx, x, y, -1, out);
 }
 
@@ -14,6 +14,8 @@
 
 #include "paddle/phi/capi/all.h"
 #include "phi_funcs.h"  //NOLINT
+#include "runtime/stream.h"
+#include "strided_copy_funcs.h"  //NOLINT
 
 namespace custom_kernel {
 
@@ -22,6 +24,7 @@ void ConcatKernel(const phi::Context& dev_ctx,
                   const std::vector<const phi::DenseTensor*>& x,
                   const phi::Scalar& axis_scalar,
                   phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   int64_t axis = axis_scalar.to<int64_t>();
   if (axis < 0) {
     axis = axis + x[0]->dims().size();
@@ -39,18 +42,26 @@ void ConcatKernel(const phi::Context& dev_ctx,
   out->Resize(out_dims);
   dev_ctx.template Alloc<T>(out);
 
-  auto M = std::accumulate(
-      out_dims.cbegin(), out_dims.cbegin() + axis, 1, std::multiplies<int>());
-  auto N = std::accumulate(
-      out_dims.cbegin() + axis + 1, out_dims.cend(), 1, std::multiplies<int>());
-  auto out_offset = 0;
-  for (auto i = 0; i < M; ++i) {
-    for (auto j = 0; j < x.size(); ++j) {
-      memcpy(out->data<T>() + out_offset,
-             x[j]->data<T>() + i * N * x[j]->dims()[axis],
-             (N * x[j]->dims()[axis]) * sizeof(T));
-      out_offset += N * x[j]->dims()[axis];
-    }
+  // Viewed as [M, K * N] matrices, every input fills a column band of
+  // the output.
+  auto M = std::accumulate(out_dims.cbegin(),
+                           out_dims.cbegin() + axis,
+                           int64_t(1),
+                           std::multiplies<int64_t>());
+  auto N = std::accumulate(out_dims.cbegin() + axis + 1,
+                           out_dims.cend(),
+                           int64_t(1),
+                           std::multiplies<int64_t>());
+  const int64_t out_cols = N * out_dims[axis];
+  int64_t col_offset = 0;
+  for (auto j = 0; j < x.size(); ++j) {
+    const int64_t cols = N * x[j]->dims()[axis];
+    funcs::StridedCopy(x[j]->data<T>(),
+                       {cols, 1},
+                       out->data<T>() + col_offset,
+                       {out_cols, 1},
+                       {M, cols});
+    col_offset += cols;
   }
 }
 
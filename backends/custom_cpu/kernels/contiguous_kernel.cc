@@ -13,7 +13,9 @@
 // limitations under the License.
 
 #include "kernels/phi_funcs.h"
+#include "kernels/strided_copy_funcs.h"
 #include "paddle/phi/capi/all.h"
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -21,27 +23,17 @@ template <typename T>
 void ContiguousKernel(const phi::Context& dev_ctx,
                       const phi::DenseTensor& input,
                       phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   out->set_strides(phi::CalcStrides(input.dims()));
   out->set_offset(0);
 
   const T* input_data = input.data<T>();
   T* output_data = dev_ctx.template Alloc<T>(out);
-  int rank = input.dims().size();
-  auto dims = input.dims();
-  auto input_stride = input.strides();
-  auto numel = input.numel();
-
-  for (int64_t i = 0; i < numel; i++) {
-    int64_t input_offset = 0;
-    int64_t index_tmp = i;
-    for (int dim = rank - 1; dim >= 0; --dim) {
-      int64_t mod = index_tmp % dims[dim];
-      index_tmp = index_tmp / dims[dim];
-      input_offset += mod * input_stride[dim];
-    }
-
-    output_data[i] = input_data[input_offset];
-  }
+  funcs::StridedCopy(input_data,
+                     input.strides(),
+                     output_data,
+                     funcs::ContiguousStrides(input.dims()),
+                     input.dims());
 }
 }  // namespace custom_kernel
 
@@ -15,6 +15,8 @@
 #include "kernels.h"  //NOLINT
 #include "paddle/phi/capi/all.h"
 #include "phi_funcs.h"  //NOLINT
+#include "runtime/stream.h"
+#include "softmax_funcs.h"  //NOLINT
 
 namespace custom_kernel {
 
@@ -155,6 +157,64 @@ void CrossEntropyKernel(const phi::Context& dev_ctx,
   }
 }
 
+template <typename T, typename LabelT>
+void SoftmaxWithCrossEntropyImpl(const phi::Context& dev_ctx,
+                                 const phi::DenseTensor& logits,
+                                 const phi::DenseTensor& label,
+                                 bool soft_label,
+                                 int ignore_index,
+                                 int axis,
+                                 phi::DenseTensor* softmax,
+                                 phi::DenseTensor* loss) {
+  auto logits_dims = logits.dims();
+  const int rank = logits_dims.size();
+  const int axis_v = phi::funcs::CanonicalAxis(axis, rank);
+  int axis_dim = logits_dims[axis_v];
+  PD_CHECK(axis_dim > 0,
+           "The axis dimention should be larger than 0, but received "
+           "axis dimention is %d.",
+           axis_dim);
+
+  auto softmax_data = dev_ctx.template Alloc<T>(softmax);
+  auto loss_data = dev_ctx.template Alloc<T>(loss);
+  if (logits.numel() == 0) {
+    return;
+  }
+
+  const int n = phi::funcs::SizeToAxis(axis_v, logits_dims);
+  const int d = phi::funcs::SizeFromAxis(axis_v, logits_dims);
+  const int remain = d / axis_dim;
+  auto label_data = label.data<LabelT>();
+  if (!soft_label) {
+    for (int64_t i = 0; i < static_cast<int64_t>(n) * remain; ++i) {
+      int lbl = static_cast<int>(label_data[i]);
+      if (lbl != ignore_index) {
+        PD_CHECK(lbl >= 0,
+                 "label value should >= 0 when label "
+                 "value(%f) not equal to ignore_index(%f)",
+                 lbl,
+                 ignore_index);
+        PD_CHECK(lbl < axis_dim,
+                 "label value should less than the shape of axis dimension "
+                 "when label value(%f) not equal to ignore_index(%f), But "
+                 "received label value as %ld and shape of axis dimension "
+                 "is %d",
+                 lbl,
+                 ignore_index,
+                 lbl,
+                 axis_dim);
+      }
+    }
+  }
+  funcs::SoftmaxWithCrossEntropy<T, LabelT>(logits.data<T>(),
+                                            label_data,
+                                            soft_label,
+                                            ignore_index,
+                                            {n, axis_dim, remain},
+                                            softmax_data,
+                                            loss_data);
+}
+
 template <typename T>
 void CrossEntropyWithSoftmaxKernel(const phi::Context& dev_ctx,
                                    const phi::DenseTensor& logits,
@@ -166,6 +226,7 @@ void CrossEntropyWithSoftmaxKernel(const phi::Context& dev_ctx,
                                    int axis,
                                    phi::DenseTensor* softmax,
                                    phi::DenseTensor* loss) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   // do not with softmax op, and input is softmax
   if (!use_softmax) {
     auto softmax_data = dev_ctx.template Alloc<T>(softmax);
@@ -175,9 +236,29 @@ void CrossEntropyWithSoftmaxKernel(const phi::Context& dev_ctx,
     return;
   }
 
-  custom_kernel::SoftmaxKernel<T>(dev_ctx, logits, axis, softmax);
-  CrossEntropyKernel<T>(
-      dev_ctx, *softmax, label, soft_label, ignore_index, axis, loss);
+  // softmax and loss are computed together from the logits, the loss
+  // uses log-sum-exp instead of taking the log of the probabilities.
+  if (soft_label) {
+    SoftmaxWithCrossEntropyImpl<T, T>(
+        dev_ctx, logits, label, soft_label, ignore_index, axis, softmax, loss);
+  } else if (label.dtype() == phi::DataType::INT32) {
+    SoftmaxWithCrossEntropyImpl<T, int32_t>(
+        dev_ctx, logits, label, soft_label, ignore_index, axis, softmax, loss);
+  } else if (label.dtype() == phi::DataType::INT64) {
+    SoftmaxWithCrossEntropyImpl<T, int64_t>(
+        dev_ctx, logits, label, soft_label, ignore_index, axis, softmax, loss);
+  } else if (label.dtype() == phi::DataType::INT16) {
+    SoftmaxWithCrossEntropyImpl<T, int16_t>(
+        dev_ctx, logits, label, soft_label, ignore_index, axis, softmax, loss);
+  } else if (label.dtype() == phi::DataType::INT8) {
+    SoftmaxWithCrossEntropyImpl<T, int8_t>(
+        dev_ctx, logits, label, soft_label, ignore_index, axis, softmax, loss);
+  } else if (label.dtype() == phi::DataType::UINT8) {
+    SoftmaxWithCrossEntropyImpl<T, uint8_t>(
+        dev_ctx, logits, label, soft_label, ignore_index, axis, softmax, loss);
+  } else {
+    PD_CHECK(false, "The dtype of label must be int.");
+  }
 }
 
 template <typename T, typename LabelT>
@@ -198,7 +279,7 @@ void CrossEntropyWithSoftmaxGradCPUKernel(const phi::Context& dev_ctx,
   auto logits_grad_data = logits_grad->data<T>();
   auto softmax_data = softmax.data<T>();
 
-  if (logit_grad != &softmax || !use_softmax) {
+  if (!use_softmax) {
     memcpy(logits_grad_data, softmax_data, softmax.numel() * sizeof(T));
   }
 
@@ -266,68 +347,15 @@ void CrossEntropyWithSoftmaxGradCPUKernel(const phi::Context& dev_ctx,
     }
     return;
   }
-  // for use_softmax=False, continue
-
-  if (soft_label) {
-    // when soft_label = True, ignore_index is not supported
-    for (auto i = 0; i < n; ++i) {
-      for (auto j = 0; j < axis_dim; ++j) {
-        for (auto k = 0; k < remain; ++k) {
-          auto index = i * d + j * remain + k;
-          auto l_index = i * remain + k;
-          logit_grad_data[index] = out_grad_data[l_index] *
-                                   (logit_grad_data[index] - label_data[index]);
-        }
-      }
-    }
-
-    // for each sample, i is sample id
-    // 1) compute dy/dx by p_j - y_j or P-Y, where j is class id,
-    // P=logit_grad_mat[i] is all class's probs, Y=lbl_mat[i] is
-    // all class's label
-    // 2) compute dy * dy/dx by   Chain rule, dy=out_grad_mat[i]
-    // for high dims, e.g. (n,c) or (n,d1,...,dm, c), compute grad by matrix
-    // operation
-
-  } else {
-    for (auto i = 0; i < n; ++i) {
-      for (auto j = 0; j < axis_dim; ++j) {
-        for (auto k = 0; k < remain; ++k) {
-          auto index = i * d + j * remain + k;
-          auto l_index = i * remain + k;
-
-          logit_grad_data[index] =
-              out_grad_data[l_index] * logit_grad_data[index];
-        }
-      }
-    }
-    for (int i = 0; i < n; ++i) {         // for each sample_1_dim
-      for (int j = 0; j < remain; j++) {  // for each sample_other_dims
-        int idx = i * remain + j;  // this sample's label_idx. for 1d case,
-                                   // remain=1 and j=0, so, idx = i
-        auto lbl = static_cast<int64_t>(label_data[idx]);
-        if (lbl == ignore_index) {
-          for (int k = 0; k < axis_dim; ++k) {  // for each class id's label
-            logit_grad_data[i * d + k * remain + j] = 0;
-          }
-        } else {
-          // only for this sample's label_idx, the label is 1, others is 0,
-          // so, only compute this label_idx's class
-          // for 1d case, remain=1 and j=0, so, [i * d + label_data[idx] *
-          // remain + j] = [i * d + label_data[idx]]
-          // let idx_x = i * d + label_data[idx] * remain + j,
-          //   logit_grad_data[idx_x] = logit_grad_data[idx_x] -
-          //   out_grad_data[idx]
-          // note: logit_grad_mat = logit_grad_mat * out_grad_mat
-          // so: logit_grad_data[idx_x] =  (logit_grad_data[idx_x] - 1) *
-          // out_grad_data[idx]
-          // means:           dy/dp * dy=   ( p - y ) * dy
-
-          logit_grad_data[i * d + lbl * remain + j] -= out_grad_data[idx];
-        }
-      }
-    }
-  }
+  // logits_grad = loss_grad * (softmax - label), computed in one pass
+  // straight from the saved probabilities.
+  funcs::SoftmaxWithCrossEntropyGrad<T, LabelT>(softmax_data,
+                                                label_data,
+                                                soft_label,
+                                                ignore_index,
+                                                {n, axis_dim, remain},
+                                                out_grad_data,
+                                                logit_grad_data);
 }
 
 template <typename T>
@@ -341,6 +369,7 @@ void CrossEntropyWithSoftmaxGradKernel(const phi::Context& dev_ctx,
                                        int ignore_index,
                                        int axis,
                                        phi::DenseTensor* logits_grad) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   if (soft_label) {
     CrossEntropyWithSoftmaxGradCPUKernel<T, T>(dev_ctx,
                                                label,
@@ -0,0 +1,204 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <algorithm>
+#include <cstdint>
+#include <cstdlib>
+#include <vector>
+
+#include "thread_pool.h"  // NOLINT
+
+namespace custom_kernel {
+namespace funcs {
+
+// Iteration space of a binary broadcast. The output is contiguous with
+// shape `dims`, the inputs are read in place through `x_strides` and
+// `y_strides`, which are 0 along broadcast dimensions. Size-1 dimensions
+// are dropped and adjacent dimensions that are contiguous for all
+// operands are merged, so the common cases collapse to rank 1 or 2:
+//
+//   same shape      -> [n]        x: [1]     y: [1]
+//   tensor + scalar -> [n]        x: [1]     y: [0]
+//   [m, n] + [n]    -> [m, n]     x: [n, 1]  y: [0, 1]
+//   [m, n] + [m, 1] -> [m, n]     x: [n, 1]  y: [1, 0]
+struct BroadcastLayout {
+  std::vector<int64_t> dims;
+  std::vector<int64_t> x_strides;
+  std::vector<int64_t> y_strides;
+};
+
+namespace broadcast_detail {
+
+// Aligns in_dims to out_dims the same way phi::BroadcastTo does and
+// returns the strides used to read the input along every output axis.
+inline std::vector<int64_t> BroadcastStrides(
+    const std::vector<int64_t>& in_dims,
+    const std::vector<int64_t>& out_dims,
+    int axis) {
+  const int out_rank = static_cast<int>(out_dims.size());
+  const int in_rank = static_cast<int>(in_dims.size());
+  axis = axis == -1 ? std::abs(in_rank - out_rank) : axis;
+  if (in_rank == out_rank) {
+    axis = 0;
+  }
+  std::vector<int64_t> padded(out_rank, 1);
+  for (int i = 0; i < in_rank; ++i) {
+    padded[axis + i] = in_dims[i];
+  }
+  std::vector<int64_t> strides(out_rank, 0);
+  int64_t stride = 1;
+  for (int i = out_rank - 1; i >= 0; --i) {
+    strides[i] = padded[i] == 1 && out_dims[i] != 1 ? 0 : stride;
+    stride *= padded[i];
+  }
+  return strides;
+}
+
+}  // namespace broadcast_detail
+
+inline BroadcastLayout MakeBroadcastLayout(const std::vector<int64_t>& x_dims,
+                                           const std::vector<int64_t>& y_dims,
+                                           const std::vector<int64_t>& out_dims,
+                                           int axis) {
+  auto x_strides = broadcast_detail::BroadcastStrides(x_dims, out_dims, axis);
+  auto y_strides = broadcast_detail::BroadcastStrides(y_dims, out_dims, axis);
+
+  BroadcastLayout layout;
+  for (size_t i = 0; i < out_dims.size(); ++i) {
+    if (out_dims[i] == 1) {
+      continue;
+    }
+    if (!layout.dims.empty()) {
+      int64_t d = out_dims[i];
+      if (layout.x_strides.back() == x_strides[i] * d &&
+          layout.y_strides.back() == y_strides[i] * d) {
+        layout.dims.back() *= d;
+        layout.x_strides.back() = x_strides[i];
+        layout.y_strides.back() = y_strides[i];
+        continue;
+      }
+    }
+    layout.dims.push_back(out_dims[i]);
+    layout.x_strides.push_back(x_strides[i]);
+    layout.y_strides.push_back(y_strides[i]);
+  }
+  if (layout.dims.empty()) {
+    layout.dims.push_back(1);
+    layout.x_strides.push_back(0);
+    layout.y_strides.push_back(0);
+  }
+  return layout;
+}
+
+namespace broadcast_detail {
+
+// Innermost loop, specialized on the two strides so the contiguous and
+// scalar cases become simple loops the compiler can vectorize.
+template <typename T, typename OutT, typename Functor>
+inline void BroadcastInnerLoop(const T* __restrict__ x,
+                               int64_t sx,
+                               const T* __restrict__ y,
+                               int64_t sy,
+                               OutT* __restrict__ out,
+                               int64_t n,
+                               Functor func) {
+  if (sx == 1 && sy == 1) {
+    for (int64_t i = 0; i < n; ++i) {
+      out[i] = func(x[i], y[i]);
+    }
+  } else if (sx == 1 && sy == 0) {
+    const T b = *y;
+    for (int64_t i = 0; i < n; ++i) {
+      out[i] = func(x[i], b);
+    }
+  } else if (sx == 0 && sy == 1) {
+    const T a = *x;
+    for (int64_t i = 0; i < n; ++i) {
+      out[i] = func(a, y[i]);
+    }
+  } else {
+    for (int64_t i = 0; i < n; ++i) {
+      out[i] = func(x[i * sx], y[i * sy]);
+    }
+  }
+}
+
+}  // namespace broadcast_detail
+
+// out = func(x, y) with numpy style broadcasting, reading both inputs in
+// place. Rows of the collapsed iteration space are split across the
+// custom_cpu thread pool.
+template <typename T, typename OutT, typename Functor>
+void BroadcastCompute(const T* x,
+                      const std::vector<int64_t>& x_dims,
+                      const T* y,
+                      const std::vector<int64_t>& y_dims,
+                      const std::vector<int64_t>& out_dims,
+                      int axis,
+                      OutT* out,
+                      Functor func) {
+  constexpr int64_t kMinElementsPerThread = 1 << 15;
+
+  const BroadcastLayout layout =
+      MakeBroadcastLayout(x_dims, y_dims, out_dims, axis);
+  const int rank = static_cast<int>(layout.dims.size());
+  const int64_t inner = layout.dims.back();
+  const int64_t sx = layout.x_strides.back();
+  const int64_t sy = layout.y_strides.back();
+  int64_t rows = 1;
+  for (int i = 0; i < rank - 1; ++i) {
+    rows *= layout.dims[i];
+  }
+  if (rows * inner == 0) {
+    return;
+  }
+
+  const int64_t grain =
+      std::max<int64_t>(1, kMinElementsPerThread / std::max<int64_t>(inner, 1));
+  ParallelFor(rows, grain, [&](int64_t begin, int64_t end) {
+    // Decompose the first row into outer coordinates once, then advance
+    // them like an odometer.
+    std::vector<int64_t> index(std::max(rank - 1, 0), 0);
+    int64_t x_offset = 0;
+    int64_t y_offset = 0;
+    int64_t rem = begin;
+    for (int i = rank - 2; i >= 0; --i) {
+      index[i] = rem % layout.dims[i];
+      rem /= layout.dims[i];
+      x_offset += index[i] * layout.x_strides[i];
+      y_offset += index[i] * layout.y_strides[i];
+    }
+
+    for (int64_t row = begin; row < end; ++row) {
+      broadcast_detail::BroadcastInnerLoop(
+          x + x_offset, sx, y + y_offset, sy, out + row * inner, inner, func);
+      for (int i = rank - 2; i >= 0; --i) {
+        ++index[i];
+        x_offset += layout.x_strides[i];
+        y_offset += layout.y_strides[i];
+        if (index[i] < layout.dims[i]) {
+          break;
+        }
+        x_offset -= index[i] * layout.x_strides[i];
+        y_offset -= index[i] * layout.y_strides[i];
+        index[i] = 0;
+      }
+    }
+  });
+}
+
+}  // namespace funcs
+}  // namespace custom_kernel
@@ -12,8 +12,10 @@
 // See the License for the specific language governing permissions and
 // limitations under the License.
 
+#include "elementwise_funcs.h"  //NOLINT
 #include "paddle/phi/capi/all.h"
 #include "phi_funcs.h"  //NOLINT
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -23,20 +25,17 @@ void MultiplyRawKernel(const phi::Context& dev_ctx,
                        const phi::DenseTensor& y,
                        int axis,
                        phi::DenseTensor* out) {
-  auto x_dims = x.dims();
-  auto y_dims = y.dims();
-  auto dst_dims = phi::BroadcastDims(axis, x_dims, y_dims);
-  phi::DenseTensor tmp_x, tmp_y;
-  phi::BroadcastTo<T>(dev_ctx, x, dst_dims, axis, &tmp_x);
-  phi::BroadcastTo<T>(dev_ctx, y, dst_dims, axis, &tmp_y);
-
-  auto x_data = tmp_x.data<T>();
-  auto y_data = tmp_y.data<T>();
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
+  auto dst_dims = phi::BroadcastDims(axis, x.dims(), y.dims());
   auto out_data = dev_ctx.template Alloc<T>(out);
-  auto numel = out->numel();
-  for (auto i = 0; i < numel; ++i) {
-    out_data[i] = x_data[i] * y_data[i];
-  }
+  funcs::BroadcastCompute(x.data<T>(),
+                          x.dims(),
+                          y.data<T>(),
+                          y.dims(),
+                          dst_dims,
+                          axis,
+                          out_data,
+                          [](T a, T b) { return a * b; });
 }
 
 template <typename T>
@@ -44,6 +43,7 @@ void MultiplyKernel(const phi::Context& dev_ctx,
                     const phi::DenseTensor& x,
                     const phi::DenseTensor& y,
                     phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   int axis = -1;
   MultiplyRawKernel<T>(dev_ctx, x, y, axis, out);
 }
@@ -54,21 +54,17 @@ void AddRawKernel(const phi::Context& dev_ctx,
                   const phi::DenseTensor& y,
                   int axis,
                   phi::DenseTensor* out) {
-  dev_ctx.template Alloc<T>(out);
-  auto x_dims = x.dims();
-  auto y_dims = y.dims();
-  auto dst_dims = phi::BroadcastDims(axis, x_dims, y_dims);
-  phi::DenseTensor tmp_x, tmp_y;
-  phi::BroadcastTo<T>(dev_ctx, x, dst_dims, axis, &tmp_x);
-  phi::BroadcastTo<T>(dev_ctx, y, dst_dims, axis, &tmp_y);
-
-  auto x_data = tmp_x.data<T>();
-  auto y_data = tmp_y.data<T>();
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
+  auto dst_dims = phi::BroadcastDims(axis, x.dims(), y.dims());
   auto out_data = dev_ctx.template Alloc<T>(out);
-  auto numel = out->numel();
-  for (auto i = 0; i < numel; ++i) {
-    out_data[i] = x_data[i] + y_data[i];
-  }
+  funcs::BroadcastCompute(x.data<T>(),
+                          x.dims(),
+                          y.data<T>(),
+                          y.dims(),
+                          dst_dims,
+                          axis,
+                          out_data,
+                          [](T a, T b) { return a + b; });
 }
 
 template <typename T>
@@ -76,6 +72,7 @@ void AddKernel(const phi::Context& dev_ctx,
                const phi::DenseTensor& x,
                const phi::DenseTensor& y,
                phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   int axis = -1;
   custom_kernel::AddRawKernel<T>(dev_ctx, x, y, axis, out);
 }
@@ -86,21 +83,17 @@ void MaxRawKernel(const phi::Context& dev_ctx,
                   const phi::DenseTensor& y,
                   int axis,
                   phi::DenseTensor* out) {
-  dev_ctx.template Alloc<T>(out);
-  auto x_dims = x.dims();
-  auto y_dims = y.dims();
-  auto dst_dims = phi::BroadcastDims(axis, x_dims, y_dims);
-  phi::DenseTensor tmp_x, tmp_y;
-  phi::BroadcastTo<T>(dev_ctx, x, dst_dims, axis, &tmp_x);
-  phi::BroadcastTo<T>(dev_ctx, y, dst_dims, axis, &tmp_y);
-
-  auto x_data = tmp_x.data<T>();
-  auto y_data = tmp_y.data<T>();
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
+  auto dst_dims = phi::BroadcastDims(axis, x.dims(), y.dims());
   auto out_data = dev_ctx.template Alloc<T>(out);
-  auto numel = out->numel();
-  for (auto i = 0; i < numel; ++i) {
-    out_data[i] = std::max(x_data[i], y_data[i]);
-  }
+  funcs::BroadcastCompute(x.data<T>(),
+                          x.dims(),
+                          y.data<T>(),
+                          y.dims(),
+                          dst_dims,
+                          axis,
+                          out_data,
+                          [](T a, T b) { return std::max(a, b); });
 }
 
 template <typename T>
@@ -108,6 +101,7 @@ void MaxKernel(const phi::Context& dev_ctx,
                const phi::DenseTensor& x,
                const phi::DenseTensor& y,
                phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   int axis = -1;
   custom_kernel::MaxRawKernel<T>(dev_ctx, x, y, axis, out);
 }
@@ -14,6 +14,7 @@
 
 #include "kernels/phi_funcs.h"
 #include "paddle/phi/capi/all.h"
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -21,6 +22,7 @@ template <typename T>
 void FillKernel(const phi::Context& dev_ctx,
                 const phi::Scalar& value,
                 phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   double fill_var = value.to<double>();
   PD_CHECK(std::isnan(fill_var) == false,
            "fill value should not be NaN, but received NaN");
@@ -13,6 +13,7 @@
 // limitations under the License.
 
 #include "paddle/phi/capi/all.h"
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -32,6 +33,7 @@ void FullKernel(const phi::Context& dev_ctx,
                 const phi::Scalar& val,
                 phi::DataType dtype,
                 phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto int_shape = shape.GetData();
   out->Resize(std::vector<int64_t>(int_shape.cbegin(), int_shape.cend()));
   FullValue<T>(dev_ctx, out, val.to<T>());
@@ -0,0 +1,346 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <algorithm>
+#include <cstdint>
+#include <vector>
+
+#include "paddle/phi/capi/all.h"
+#include "thread_pool.h"  // NOLINT
+
+namespace custom_kernel {
+namespace funcs {
+
+// Accumulation type used by the GEMM micro kernel, low precision types
+// specialize it to float.
+template <typename T>
+struct GemmAccType {
+  using type = T;
+};
+
+template <>
+struct GemmAccType<phi::dtype::float16> {
+  using type = float;
+};
+
+// A strided view of a (batched) matrix: element (b, i, j) lives at
+// data[b * batch_stride + i * row_stride + j * col_stride]. Transposed
+// operands are expressed by swapping the strides, so nothing is ever
+// materialized. A batch_stride of 0 broadcasts the matrix over the batch.
+template <typename T>
+struct MatrixDesc {
+  T* data;
+  int64_t row_stride;
+  int64_t col_stride;
+  int64_t batch_stride;
+};
+
+// Row-major [rows, cols] matrix, optionally stored transposed.
+template <typename T>
+inline MatrixDesc<T> MakeMatrixDesc(
+    T* data, int64_t rows, int64_t cols, bool trans, int64_t batch_stride) {
+  if (trans) {
+    return {data, 1, rows, batch_stride};
+  }
+  return {data, cols, 1, batch_stride};
+}
+
+namespace gemm_detail {
+
+constexpr int64_t kMR = 4;
+constexpr int64_t kNR = 8;
+constexpr int64_t kMC = 64;
+constexpr int64_t kKC = 256;
+constexpr int64_t kNC = 512;
+// Minimum number of multiply-adds handed to one thread.
+constexpr int64_t kMinWorkPerThread = 1 << 16;
+// Problems below this size skip packing altogether.
+constexpr int64_t kSmallGemmWork = 1 << 12;
+
+// Packs the mc x kc block of A into row panels of kMR rows. Within a
+// panel the kMR values of one k are adjacent; rows past mc are zero.
+template <typename T, typename AccT>
+void PackA(
+    const T* a, int64_t rs, int64_t cs, int64_t mc, int64_t kc, AccT* packed) {
+  for (int64_t i0 = 0; i0 < mc; i0 += kMR) {
+    int64_t rows = std::min(kMR, mc - i0);
+    for (int64_t p = 0; p < kc; ++p) {
+      const T* src = a + i0 * rs + p * cs;
+      int64_t i = 0;
+      for (; i < rows; ++i) {
+        packed[i] = static_cast<AccT>(src[i * rs]);
+      }
+      for (; i < kMR; ++i) {
+        packed[i] = AccT(0);
+      }
+      packed += kMR;
+    }
+  }
+}
+
+// Packs the kc x nc block of B into column panels of kNR columns.
+template <typename T, typename AccT>
+void PackB(
+    const T* b, int64_t rs, int64_t cs, int64_t kc, int64_t nc, AccT* packed) {
+  for (int64_t j0 = 0; j0 < nc; j0 += kNR) {
+    int64_t cols = std::min(kNR, nc - j0);
+    for (int64_t p = 0; p < kc; ++p) {
+      const T* src = b + p * rs + j0 * cs;
+      int64_t j = 0;
+      if (cs == 1) {
+        for (; j < cols; ++j) {
+          packed[j] = static_cast<AccT>(src[j]);
+        }
+      } else {
+        for (; j < cols; ++j) {
+          packed[j] = static_cast<AccT>(src[j * cs]);
+        }
+      }
+      for (; j < kNR; ++j) {
+        packed[j] = AccT(0);
+      }
+      packed += kNR;
+    }
+  }
+}
+
+// acc[kMR][kNR] = sum_p pa[p][:] x pb[p][:]. Fixed trip counts let the
+// compiler keep acc in registers and vectorize the inner loop.
+template <typename AccT>
+inline void MicroKernel(int64_t kc,
+                        const AccT* __restrict__ pa,
+                        const AccT* __restrict__ pb,
+                        AccT* __restrict__ acc) {
+  AccT c[kMR][kNR] = {};
+  for (int64_t p = 0; p < kc; ++p) {
+    for (int64_t i = 0; i < kMR; ++i) {
+      AccT a = pa[i];
+      for (int64_t j = 0; j < kNR; ++j) {
+        c[i][j] += a * pb[j];
+      }
+    }
+    pa += kMR;
+    pb += kNR;
+  }
+  for (int64_t i = 0; i < kMR; ++i) {
+    for (int64_t j = 0; j < kNR; ++j) {
+      acc[i * kNR + j] = c[i][j];
+    }
+  }
+}
+
+template <typename T, typename AccT>
+inline void StoreTile(const AccT* acc,
+                      int64_t rows,
+                      int64_t cols,
+                      AccT alpha,
+                      bool overwrite,
+                      T* c,
+                      int64_t rs,
+                      int64_t cs) {
+  for (int64_t i = 0; i < rows; ++i) {
+    for (int64_t j = 0; j < cols; ++j) {
+      T* dst = c + i * rs + j * cs;
+      AccT value = alpha * acc[i * kNR + j];
+      if (!overwrite) {
+        value += static_cast<AccT>(*dst);
+      }
+      *dst = static_cast<T>(value);
+    }
+  }
+}
+
+// Unpacked path for tiny problems, where packing costs more than it saves.
+template <typename T, typename AccT>
+void SmallGemm(int64_t M,
+               int64_t N,
+               int64_t K,
+               AccT alpha,
+               const T* a,
+               int64_t rsa,
+               int64_t csa,
+               const T* b,
+               int64_t rsb,
+               int64_t csb,
+               bool overwrite,
+               T* c,
+               int64_t rsc,
+               int64_t csc) {
+  for (int64_t i = 0; i < M; ++i) {
+    for (int64_t j = 0; j < N; ++j) {
+      AccT sum = AccT(0);
+      for (int64_t p = 0; p < K; ++p) {
+        sum += static_cast<AccT>(a[i * rsa + p * csa]) *
+               static_cast<AccT>(b[p * rsb + j * csb]);
+      }
+      T* dst = c + i * rsc + j * csc;
+      AccT value = alpha * sum;
+      if (!overwrite) {
+        value += static_cast<AccT>(*dst);
+      }
+      *dst = static_cast<T>(value);
+    }
+  }
+}
+
+}  // namespace gemm_detail
+
+// C[b] (+)= alpha * A[b] x B[b] for b in [0, batch_size), where A[b] is
+// M x K, B[b] is K x N and C[b] is M x N, all described by strided views.
+//
+// When c.batch_stride is 0 and batch_size > 1 the products of all batches
+// are summed into the single output matrix. Unless `accumulate` is set the
+// output is overwritten, so callers never need to clear it beforehand.
+//
+// The computation is split into kMC x kNC output tiles which are processed
+// in parallel by the custom_cpu thread pool; inside a tile the operands are
+// packed into contiguous panels and multiplied by a kMR x kNR register
+// blocked micro kernel.
+template <typename T, typename AccT = typename GemmAccType<T>::type>
+void BatchedGemm(int64_t M,
+                 int64_t N,
+                 int64_t K,
+                 int64_t batch_size,
+                 AccT alpha,
+                 MatrixDesc<const T> a,
+                 MatrixDesc<const T> b,
+                 MatrixDesc<T> c,
+                 bool accumulate = false) {
+  using gemm_detail::kKC;
+  using gemm_detail::kMC;
+  using gemm_detail::kMR;
+  using gemm_detail::kNC;
+  using gemm_detail::kNR;
+
+  if (M <= 0 || N <= 0 || batch_size <= 0) {
+    return;
+  }
+  const bool reduce_batch = c.batch_stride == 0 && batch_size > 1;
+  if (K <= 0) {
+    if (!accumulate) {
+      for (int64_t bs = 0; bs < (reduce_batch ? 1 : batch_size); ++bs) {
+        for (int64_t i = 0; i < M; ++i) {
+          for (int64_t j = 0; j < N; ++j) {
+            c.data[bs * c.batch_stride + i * c.row_stride + j * c.col_stride] =
+                T(0);
+          }
+        }
+      }
+    }
+    return;
+  }
+
+  if (M * N * K * batch_size <= gemm_detail::kSmallGemmWork) {
+    for (int64_t bs = 0; bs < batch_size; ++bs) {
+      gemm_detail::SmallGemm<T, AccT>(M,
+                                      N,
+                                      K,
+                                      alpha,
+                                      a.data + bs * a.batch_stride,
+                                      a.row_stride,
+                                      a.col_stride,
+                                      b.data + bs * b.batch_stride,
+                                      b.row_stride,
+                                      b.col_stride,
+                                      !accumulate && !(reduce_batch && bs > 0),
+                                      c.data + bs * c.batch_stride,
+                                      c.row_stride,
+                                      c.col_stride);
+    }
+    return;
+  }
+
+  const int64_t m_blocks = (M + kMC - 1) / kMC;
+  const int64_t n_blocks = (N + kNC - 1) / kNC;
+  const int64_t tile_batches = reduce_batch ? 1 : batch_size;
+  const int64_t num_tiles = tile_batches * m_blocks * n_blocks;
+  const int64_t tile_work =
+      std::min(M, kMC) * std::min(N, kNC) * K * (reduce_batch ? batch_size : 1);
+  const int64_t grain =
+      std::max<int64_t>(1, gemm_detail::kMinWorkPerThread / tile_work);
+
+  ParallelFor(num_tiles, grain, [&](int64_t begin, int64_t end) {
+    std::vector<AccT> packed_a(kMC * kKC);
+    std::vector<AccT> packed_b(kKC * ((kNC + kNR - 1) / kNR * kNR));
+    AccT acc[kMR * kNR];
+
+    for (int64_t tile = begin; tile < end; ++tile) {
+      const int64_t nb = tile % n_blocks;
+      const int64_t mb = (tile / n_blocks) % m_blocks;
+      const int64_t tb = tile / (n_blocks * m_blocks);
+      const int64_t ic = mb * kMC;
+      const int64_t jc = nb * kNC;
+      const int64_t mc = std::min(kMC, M - ic);
+      const int64_t nc = std::min(kNC, N - jc);
+      T* c_tile =
+          c.data + tb * c.batch_stride + ic * c.row_stride + jc * c.col_stride;
+
+      const int64_t bs_begin = reduce_batch ? 0 : tb;
+      const int64_t bs_end = reduce_batch ? batch_size : tb + 1;
+      for (int64_t bs = bs_begin; bs < bs_end; ++bs) {
+        const T* a_tile = a.data + bs * a.batch_stride + ic * a.row_stride;
+        const T* b_tile = b.data + bs * b.batch_stride + jc * b.col_stride;
+        for (int64_t pc = 0; pc < K; pc += kKC) {
+          const int64_t kc = std::min(kKC, K - pc);
+          const bool overwrite = !accumulate && bs == bs_begin && pc == 0;
+          gemm_detail::PackA(a_tile + pc * a.col_stride,
+                             a.row_stride,
+                             a.col_stride,
+                             mc,
+                             kc,
+                             packed_a.data());
+          gemm_detail::PackB(b_tile + pc * b.row_stride,
+                             b.row_stride,
+                             b.col_stride,
+                             kc,
+                             nc,
+                             packed_b.data());
+          for (int64_t jr = 0; jr < nc; jr += kNR) {
+            const AccT* pb = packed_b.data() + jr * kc;
+            for (int64_t ir = 0; ir < mc; ir += kMR) {
+              const AccT* pa = packed_a.data() + ir * kc;
+              gemm_detail::MicroKernel(kc, pa, pb, acc);
+              gemm_detail::StoreTile(
+                  acc,
+                  std::min(kMR, mc - ir),
+                  std::min(kNR, nc - jr),
+                  alpha,
+                  overwrite,
+                  c_tile + ir * c.row_stride + jr * c.col_stride,
+                  c.row_stride,
+                  c.col_stride);
+            }
+          }
+        }
+      }
+    }
+  });
+}
+
+template <typename T, typename AccT = typename GemmAccType<T>::type>
+void Gemm(int64_t M,
+          int64_t N,
+          int64_t K,
+          AccT alpha,
+          MatrixDesc<const T> a,
+          MatrixDesc<const T> b,
+          MatrixDesc<T> c,
+          bool accumulate = false) {
+  BatchedGemm<T, AccT>(M, N, K, 1, alpha, a, b, c, accumulate);
+}
+
+}  // namespace funcs
+}  // namespace custom_kernel
@@ -12,8 +12,10 @@
 // See the License for the specific language governing permissions and
 // limitations under the License.
 
+#include "kernels/gemm_funcs.h"
 #include "kernels/phi_funcs.h"
 #include "paddle/phi/capi/all.h"
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -27,19 +29,19 @@ void GEMM(bool trans_x,
           const T* y,
           T* out,
           bool trans_out = false) {
-  memset(out, 0, M * N * sizeof(T));
-  for (size_t m = 0; m < M; ++m) {
-    for (size_t n = 0; n < N; ++n) {
-      auto* out_data = trans_out ? &out[n * M + m] : &out[m * N + n];
-      for (size_t k = 0; k < K; ++k) {
-        auto x_dat = trans_x ? x[k * M + m] : x[m * K + k];
-        auto y_dat = trans_y ? y[n * K + k] : y[k * N + n];
-        *out_data += x_dat * y_dat;
-      }
-    }
-  }
+  using AccT = typename funcs::GemmAccType<T>::type;
+  funcs::Gemm<T>(M,
+                 N,
+                 K,
+                 static_cast<AccT>(1),
+                 funcs::MakeMatrixDesc<const T>(x, M, K, trans_x, 0),
+                 funcs::MakeMatrixDesc<const T>(y, K, N, trans_y, 0),
+                 funcs::MakeMatrixDesc<T>(out, M, N, trans_out, 0));
 }
 
+// x_is_larger selects which operand carries the batch dimension, the other
+// one is broadcast unless bs_flag is set. With reduce_bs the products of
+// all batches are summed into a single M x N output.
 template <typename T>
 void BatchedGEMM(bool trans_x,
                  bool trans_y,
@@ -55,42 +57,19 @@ void BatchedGEMM(bool trans_x,
                  bool bs_flag = false,
                  bool reduce_bs = false,
                  float alpha = 1.0) {
-  memset(out, 0, sizeof(T) * (reduce_bs ? M * N : batch_size * M * N));
-  if (x_is_larger) {
-    for (size_t bs = 0; bs < batch_size; ++bs) {
-      for (size_t m = 0; m < M; ++m) {
-        for (size_t n = 0; n < N; ++n) {
-          auto out_bs = reduce_bs ? 0 : bs * M * N;
-          auto* out_data =
-              trans_out ? &out[out_bs + n * M + m] : &out[out_bs + m * N + n];
-          for (size_t k = 0; k < K; ++k) {
-            auto x_dat =
-                trans_x ? x[bs * M * K + k * M + m] : x[bs * M * K + m * K + k];
-            auto y_bs = bs_flag ? bs * N * K : 0;
-            auto y_dat = trans_y ? y[y_bs + n * K + k] : y[y_bs + k * N + n];
-            *out_data += static_cast<T>(alpha) * (x_dat * y_dat);
-          }
-        }
-      }
-    }
-  } else {
-    for (size_t bs = 0; bs < batch_size; ++bs) {
-      for (size_t m = 0; m < M; ++m) {
-        for (size_t n = 0; n < N; ++n) {
-          auto out_bs = reduce_bs ? 0 : bs * M * N;
-          auto* out_data =
-              trans_out ? &out[out_bs + n * M + m] : &out[out_bs + m * N + n];
-          for (size_t k = 0; k < K; ++k) {
-            auto y_dat =
-                trans_y ? y[bs * K * N + n * K + k] : y[bs * K * N + k * N + n];
-            auto x_bs = bs_flag ? bs * M * K : 0;
-            auto x_dat = trans_x ? x[x_bs + k * M + m] : x[x_bs + m * K + k];
-            *out_data += static_cast<T>(alpha) * (x_dat * y_dat);
-          }
-        }
-      }
-    }
-  }
+  using AccT = typename funcs::GemmAccType<T>::type;
+  int64_t x_batch_stride = x_is_larger || bs_flag ? M * K : 0;
+  int64_t y_batch_stride = !x_is_larger || bs_flag ? K * N : 0;
+  int64_t out_batch_stride = reduce_bs ? 0 : M * N;
+  funcs::BatchedGemm<T>(
+      M,
+      N,
+      K,
+      batch_size,
+      static_cast<AccT>(alpha),
+      funcs::MakeMatrixDesc<const T>(x, M, K, trans_x, x_batch_stride),
+      funcs::MakeMatrixDesc<const T>(y, K, N, trans_y, y_batch_stride),
+      funcs::MakeMatrixDesc<T>(out, M, N, trans_out, out_batch_stride));
 }
 
 template <typename T>
@@ -100,6 +79,7 @@ void MatmulKernel(const phi::Context& dev_ctx,
                   bool transpose_x,
                   bool transpose_y,
                   phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
   auto y_dims = y.dims();
   auto x_data = x.data<T>();
@@ -303,6 +283,7 @@ void MatmulGradKernel(const phi::Context& dev_ctx,
                       bool transpose_y,
                       phi::DenseTensor* dx,
                       phi::DenseTensor* dy) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
   auto y_dims = y.dims();
   auto dout_dims = out_grad.dims();
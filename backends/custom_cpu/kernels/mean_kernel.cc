@@ -13,7 +13,9 @@
 // limitations under the License.
 
 #include "paddle/phi/capi/all.h"
-#include "phi_funcs.h"  //NOLINT
+#include "phi_funcs.h"     //NOLINT
+#include "reduce_funcs.h"  //NOLINT
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -21,15 +23,12 @@ template <typename T>
 void MeanAllKernel(const phi::Context& dev_ctx,
                    const phi::DenseTensor& x,
                    phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto out_data = dev_ctx.template Alloc<T>(out);
-  auto x_data = x.data<T>();
-  auto numel = x.numel();
-
-  *out_data = 0;
-  for (auto i = 0; i < numel; ++i) {
-    *out_data += x_data[i];
-  }
-  *out_data /= static_cast<T>(numel);
+  auto x_dims = x.dims();
+  std::vector<int64_t> reduce_dims(x_dims.size());
+  std::iota(reduce_dims.begin(), reduce_dims.end(), 0);
+  funcs::ReduceMean(x.data<T>(), x_dims, reduce_dims, out_data);
 }
 
 template <typename T>
@@ -37,6 +36,7 @@ void MeanAllGradKernel(const phi::Context& dev_ctx,
                        const phi::DenseTensor& x,
                        const phi::DenseTensor& out_grad,
                        phi::DenseTensor* x_grad) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   PD_CHECK(out_grad.numel() == 1UL,
            "Mean Gradient should be scalar. But received "
            "Out@Grad's elements num is %d.",
@@ -14,6 +14,7 @@
 
 #include "kernels/phi_funcs.h"
 #include "paddle/phi/capi/all.h"
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -22,6 +23,7 @@ void MemcpyD2HKernel(const phi::Context& dev_ctx,
                      const phi::DenseTensor& x,
                      int dst_place_type,
                      phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto out_data = dev_ctx.HostAlloc<T>(out);
   auto x_data = x.data<T>();
   memcpy(out_data, x_data, x.memory_size());
@@ -32,6 +34,7 @@ void MemcpyH2DKernel(const phi::Context& dev_ctx,
                      const phi::DenseTensor& x,
                      int dst_place_type,
                      phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto out_data = dev_ctx.Alloc<T>(out);
   auto x_data = x.data<T>();
   memcpy(out_data, x_data, x.memory_size());
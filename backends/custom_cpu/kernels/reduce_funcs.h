@@ -0,0 +1,373 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <algorithm>
+#include <cstdint>
+#include <limits>
+#include <type_traits>
+#include <vector>
+
+#include "thread_pool.h"  // NOLINT
+
+namespace custom_kernel {
+namespace funcs {
+
+// Shape of a reduction after simplification: size-1 axes are dropped and
+// runs of adjacent axes that are all kept or all reduced are merged, so
+// the groups alternate between kept and reduced. Reducing axis 1 of
+// [8, 16, 32] gives sizes {8, 16, 32} with reduced {0, 1, 0}; reducing
+// axes 1 and 2 gives {8, 512} with {0, 1}.
+struct ReduceGroups {
+  std::vector<int64_t> sizes;
+  std::vector<bool> reduced;
+};
+
+inline ReduceGroups MakeReduceGroups(const std::vector<int64_t>& dims,
+                                     const std::vector<int64_t>& reduce_dims) {
+  std::vector<bool> is_reduced(dims.size(), false);
+  for (auto d : reduce_dims) {
+    is_reduced[d] = true;
+  }
+  ReduceGroups groups;
+  for (size_t i = 0; i < dims.size(); ++i) {
+    if (dims[i] == 1) {
+      continue;
+    }
+    if (!groups.sizes.empty() && groups.reduced.back() == is_reduced[i]) {
+      groups.sizes.back() *= dims[i];
+    } else {
+      groups.sizes.push_back(dims[i]);
+      groups.reduced.push_back(is_reduced[i]);
+    }
+  }
+  return groups;
+}
+
+// Accumulation policies for ReduceImpl. A policy provides a State with
+// Init/Add/AddRun/Merge, and Finalize to turn the state into the output.
+template <typename T>
+struct SumReducer {
+  // Kahan-compensated sum; for integral types the compensation is unused.
+  struct State {
+    T sum;
+    T comp;
+  };
+
+  static constexpr bool kCompensated = std::is_floating_point<T>::value;
+
+  explicit SumReducer(T divisor = T(1)) : divisor(divisor) {}
+
+  static State Init() { return {T(0), T(0)}; }
+
+  static void Add(State* s, T value) {
+    if (kCompensated) {
+      T y = value - s->comp;
+      T t = s->sum + y;
+      s->comp = (t - s->sum) - y;
+      s->sum = t;
+    } else {
+      s->sum += value;
+    }
+  }
+
+  // Pairwise summation of a contiguous run: blocks of kBlock elements are
+  // summed with kLanes independent accumulators, larger runs are halved.
+  static T PairwiseSum(const T* x, int64_t n) {
+    constexpr int64_t kBlock = 256;
+    constexpr int64_t kLanes = 8;
+    if (n <= kBlock) {
+      T lanes[kLanes] = {};
+      int64_t i = 0;
+      for (; i + kLanes <= n; i += kLanes) {
+        for (int64_t l = 0; l < kLanes; ++l) {
+          lanes[l] += x[i + l];
+        }
+      }
+      T sum = T(0);
+      for (; i < n; ++i) {
+        sum += x[i];
+      }
+      for (int64_t l = 0; l < kLanes; ++l) {
+        sum += lanes[l];
+      }
+      return sum;
+    }
+    int64_t half = n / 2 / kLanes * kLanes;
+    return PairwiseSum(x, half) + PairwiseSum(x + half, n - half);
+  }
+
+  static void AddRun(State* s, const T* x, int64_t n) {
+    Add(s, PairwiseSum(x, n));
+  }
+
+  static void Merge(State* s, const State& other) {
+    Add(s, other.sum);
+    Add(s, -other.comp);
+  }
+
+  T Finalize(const State& s) const {
+    return divisor == T(1) ? s.sum : s.sum / divisor;
+  }
+
+  T divisor;
+};
+
+template <typename T, typename Op>
+struct SimpleReducer {
+  struct State {
+    T value;
+  };
+
+  SimpleReducer(T init, Op op) : init(init), op(op) {}
+
+  State Init() const { return {init}; }
+  void Add(State* s, T value) const { s->value = op(s->value, value); }
+  void AddRun(State* s, const T* x, int64_t n) const {
+    T value = s->value;
+    for (int64_t i = 0; i < n; ++i) {
+      value = op(value, x[i]);
+    }
+    s->value = value;
+  }
+  void Merge(State* s, const State& other) const { Add(s, other.value); }
+  T Finalize(const State& s) const { return s.value; }
+
+  T init;
+  Op op;
+};
+
+namespace reduce_detail {
+
+constexpr int64_t kMinElementsPerThread = 1 << 15;
+
+// Enumerates the reduced groups that lie outside the innermost group,
+// returning the input offset of every combination.
+inline std::vector<int64_t> OuterReduceOffsets(
+    const ReduceGroups& groups, const std::vector<int64_t>& strides) {
+  std::vector<int64_t> offsets{0};
+  const int inner = static_cast<int>(groups.sizes.size()) - 1;
+  for (int g = 0; g < inner; ++g) {
+    if (!groups.reduced[g]) {
+      continue;
+    }
+    std::vector<int64_t> next;
+    next.reserve(offsets.size() * groups.sizes[g]);
+    for (auto base : offsets) {
+      for (int64_t i = 0; i < groups.sizes[g]; ++i) {
+        next.push_back(base + i * strides[g]);
+      }
+    }
+    offsets.swap(next);
+  }
+  return offsets;
+}
+
+}  // namespace reduce_detail
+
+// Reduces x (contiguous, shape `dims`) over `reduce_dims` into out, whose
+// element order is that of the kept axes. reduce_dims must be
+// non-negative; an empty list copies x through Finalize.
+//
+// The axes are first collapsed into alternating kept/reduced groups, then:
+//  * innermost group reduced: every output reduces contiguous runs, so
+//    a full reduction is split into chunks across threads and the chunk
+//    results are merged;
+//  * innermost group kept: whole contiguous rows of the input are
+//    accumulated into a row of states, element-wise.
+template <typename T, typename Reducer>
+void ReduceImpl(const T* x,
+                const std::vector<int64_t>& dims,
+                const std::vector<int64_t>& reduce_dims,
+                const Reducer& reducer,
+                T* out) {
+  using State = typename Reducer::State;
+  using reduce_detail::kMinElementsPerThread;
+
+  int64_t numel = 1;
+  for (auto d : dims) {
+    numel *= d;
+  }
+  ReduceGroups groups = MakeReduceGroups(dims, reduce_dims);
+  if (groups.sizes.empty()) {
+    groups.sizes.push_back(1);
+    groups.reduced.push_back(true);
+  }
+  const int num_groups = static_cast<int>(groups.sizes.size());
+  std::vector<int64_t> strides(num_groups, 1);
+  for (int g = num_groups - 2; g >= 0; --g) {
+    strides[g] = strides[g + 1] * groups.sizes[g + 1];
+  }
+  int64_t num_out = 1;
+  int64_t reduce_numel = 1;
+  for (int g = 0; g < num_groups; ++g) {
+    (groups.reduced[g] ? reduce_numel : num_out) *= groups.sizes[g];
+  }
+  if (num_out == 0) {
+    return;
+  }
+  if (numel == 0) {
+    for (int64_t i = 0; i < num_out; ++i) {
+      out[i] = reducer.Finalize(reducer.Init());
+    }
+    return;
+  }
+
+  // Kept groups, outermost first, used to locate the input of an output.
+  std::vector<int64_t> kept_sizes, kept_strides;
+  for (int g = 0; g < num_groups; ++g) {
+    if (!groups.reduced[g]) {
+      kept_sizes.push_back(groups.sizes[g]);
+      kept_strides.push_back(strides[g]);
+    }
+  }
+  auto kept_offset = [&](int64_t index, int num_kept) {
+    int64_t offset = 0;
+    for (int k = num_kept - 1; k >= 0; --k) {
+      offset += (index % kept_sizes[k]) * kept_strides[k];
+      index /= kept_sizes[k];
+    }
+    return offset;
+  };
+  const std::vector<int64_t> outer_offsets =
+      reduce_detail::OuterReduceOffsets(groups, strides);
+
+  if (groups.reduced.back()) {
+    const int64_t run = groups.sizes.back();
+    const int num_kept = static_cast<int>(kept_sizes.size());
+
+    if (num_out == 1) {
+      // Full reduction of a contiguous buffer: chunk it across threads.
+      const int64_t chunk = std::max<int64_t>(kMinElementsPerThread, 1);
+      const int64_t num_chunks = (numel + chunk - 1) / chunk;
+      std::vector<State> partial(num_chunks, reducer.Init());
+      ParallelFor(num_chunks, 1, [&](int64_t begin, int64_t end) {
+        for (int64_t c = begin; c < end; ++c) {
+          int64_t start = c * chunk;
+          reducer.AddRun(
+              &partial[c], x + start, std::min(chunk, numel - start));
+        }
+      });
+      State state = reducer.Init();
+      for (const auto& p : partial) {
+        reducer.Merge(&state, p);
+      }
+      out[0] = reducer.Finalize(state);
+      return;
+    }
+
+    const int64_t grain =
+        std::max<int64_t>(1, kMinElementsPerThread / reduce_numel);
+    ParallelFor(num_out, grain, [&](int64_t begin, int64_t end) {
+      for (int64_t o = begin; o < end; ++o) {
+        const T* base = x + kept_offset(o, num_kept);
+        State state = reducer.Init();
+        for (auto offset : outer_offsets) {
+          reducer.AddRun(&state, base + offset, run);
+        }
+        out[o] = reducer.Finalize(state);
+      }
+    });
+    return;
+  }
+
+  // The innermost group is kept: outputs come in contiguous rows of
+  // `row` elements and every reduced combination adds one input row.
+  const int64_t row = groups.sizes.back();
+  const int num_outer_kept = static_cast<int>(kept_sizes.size()) - 1;
+  const int64_t num_rows = num_out / row;
+  // Split the columns too when there are fewer rows than threads.
+  const int64_t col_block =
+      num_rows >= static_cast<int64_t>(ThreadPool::Instance().NumThreads())
+          ? row
+          : std::max<int64_t>(256,
+                              row / static_cast<int64_t>(
+                                        ThreadPool::Instance().NumThreads()));
+  const int64_t col_blocks = (row + col_block - 1) / col_block;
+  const int64_t grain = std::max<int64_t>(
+      1,
+      kMinElementsPerThread / std::max<int64_t>(reduce_numel * col_block, 1));
+  ParallelFor(num_rows * col_blocks, grain, [&](int64_t begin, int64_t end) {
+    std::vector<State> states;
+    for (int64_t task = begin; task < end; ++task) {
+      const int64_t r = task / col_blocks;
+      const int64_t c0 = (task % col_blocks) * col_block;
+      const int64_t cols = std::min(col_block, row - c0);
+      const T* base = x + kept_offset(r, num_outer_kept) + c0;
+      states.assign(cols, reducer.Init());
+      for (auto offset : outer_offsets) {
+        const T* src = base + offset;
+        for (int64_t c = 0; c < cols; ++c) {
+          reducer.Add(&states[c], src[c]);
+        }
+      }
+      T* dst = out + r * row + c0;
+      for (int64_t c = 0; c < cols; ++c) {
+        dst[c] = reducer.Finalize(states[c]);
+      }
+    }
+  });
+}
+
+template <typename T>
+void ReduceSum(const T* x,
+               const std::vector<int64_t>& dims,
+               const std::vector<int64_t>& reduce_dims,
+               T* out) {
+  ReduceImpl(x, dims, reduce_dims, SumReducer<T>(), out);
+}
+
+// Mean over reduce_dims; the division is applied once per output.
+template <typename T>
+void ReduceMean(const T* x,
+                const std::vector<int64_t>& dims,
+                const std::vector<int64_t>& reduce_dims,
+                T* out) {
+  int64_t count = 1;
+  for (auto d : reduce_dims) {
+    count *= dims[d];
+  }
+  ReduceImpl(x, dims, reduce_dims, SumReducer<T>(static_cast<T>(count)), out);
+}
+
+template <typename T>
+void ReduceMax(const T* x,
+               const std::vector<int64_t>& dims,
+               const std::vector<int64_t>& reduce_dims,
+               T* out) {
+  auto op = [](T a, T b) { return a < b ? b : a; };
+  ReduceImpl(
+      x,
+      dims,
+      reduce_dims,
+      SimpleReducer<T, decltype(op)>(std::numeric_limits<T>::lowest(), op),
+      out);
+}
+
+template <typename T>
+void ReduceMin(const T* x,
+               const std::vector<int64_t>& dims,
+               const std::vector<int64_t>& reduce_dims,
+               T* out) {
+  auto op = [](T a, T b) { return b < a ? b : a; };
+  ReduceImpl(x,
+             dims,
+             reduce_dims,
+             SimpleReducer<T, decltype(op)>(std::numeric_limits<T>::max(), op),
+             out);
+}
+
+}  // namespace funcs
+}  // namespace custom_kernel
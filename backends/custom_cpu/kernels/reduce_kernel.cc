@@ -15,19 +15,16 @@
 #include <cmath>
 
 #include "kernels/phi_funcs.h"
+#include "kernels/reduce_funcs.h"
 #include "paddle/phi/capi/all.h"
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
-template <typename T>
-void MeanRawKernel(const phi::Context& dev_ctx,
-                   const phi::DenseTensor& x,
-                   const phi::IntArray& dims,
-                   bool keep_dim,
-                   bool reduce_all,
-                   phi::DenseTensor* out) {
-  auto x_dims = x.dims();
-  auto reduce_dims = dims.GetData();
+static std::vector<int64_t> GetReduceDims(const std::vector<int64_t>& x_dims,
+                                          const phi::IntArray& dims,
+                                          bool reduce_all) {
+  std::vector<int64_t> reduce_dims = dims.GetData();
   if (reduce_all) {
     reduce_dims.clear();
     for (auto i = 0; i < x_dims.size(); ++i) {
@@ -40,42 +37,21 @@ void MeanRawKernel(const phi::Context& dev_ctx,
       d = d + x_dims.size();
     }
   }
-  auto x_data = x.data<T>();
-  auto out_data = dev_ctx.template Alloc<T>(out);
+  return reduce_dims;
+}
 
-  auto numel = x.numel();
-  auto out_dims(x_dims);
-  for (auto d : reduce_dims) {
-    out_dims[d] = 1;
-  }
-  std::vector<size_t> index(x_dims.size(), 0);
-  std::vector<size_t> step(x_dims.size(), 1);
-  std::vector<size_t> dst_step = step;
-  for (auto i = x_dims.size() - 1; i > 0; --i) {
-    step[i - 1] = step[i] * x_dims[i];
-    dst_step[i - 1] = dst_step[i] * out_dims[i];
-  }
-  for (auto d : reduce_dims) {
-    dst_step[d] = 0;
-  }
-  memset(out_data, 0, sizeof(T) * out->numel());
-  size_t reduce_numel = 1;
-  for (auto d : reduce_dims) {
-    reduce_numel *= x_dims[d];
-  }
-  for (auto i = 0; i < numel; ++i) {
-    out_data[phi::vec_product(dst_step, index)] +=
-        x_data[phi::vec_product(step, index)] / reduce_numel;
-    index.back()++;
-    for (auto j = index.size() - 1; j > 0; --j) {
-      if (index[j] >= x_dims[j]) {
-        index[j] = 0;
-        index[j - 1]++;
-      } else {
-        break;
-      }
-    }
-  }
+template <typename T>
+void MeanRawKernel(const phi::Context& dev_ctx,
+                   const phi::DenseTensor& x,
+                   const phi::IntArray& dims,
+                   bool keep_dim,
+                   bool reduce_all,
+                   phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
+  auto x_dims = x.dims();
+  auto reduce_dims = GetReduceDims(x_dims, dims, reduce_all);
+  auto out_data = dev_ctx.template Alloc<T>(out);
+  funcs::ReduceMean(x.data<T>(), x_dims, reduce_dims, out_data);
 }
 
 template <typename T>
@@ -84,6 +60,7 @@ void MeanKernel(const phi::Context& dev_ctx,
                 const phi::IntArray& dims,
                 bool keep_dim,
                 phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   bool reduce_all = false;
   if (dims.size() == 0) {
     reduce_all = true;
@@ -99,57 +76,14 @@ void SumRawKernel(const phi::Context& dev_ctx,
                   bool reduce_all,
                   phi::DataType out_dtype,
                   phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
-  auto reduce_dims = dims.GetData();
-  if (reduce_dims.size() == 0) {
+  if (dims.size() == 0) {
     reduce_all = true;
   }
-  if (reduce_all) {
-    reduce_dims.clear();
-    for (auto i = 0; i < x_dims.size(); ++i) {
-      reduce_dims.push_back(i);
-    }
-  }
-
-  for (auto& d : reduce_dims) {
-    // handle negative dims, f.e. "-1" means rightmost dimension
-    if (d < 0) {
-      d = d + x_dims.size();
-    }
-  }
-  auto x_data = x.data<T>();
+  auto reduce_dims = GetReduceDims(x_dims, dims, reduce_all);
   auto out_data = dev_ctx.template Alloc<T>(out);
-
-  auto numel = x.numel();
-  auto out_dims(x_dims);
-  for (auto d : reduce_dims) {
-    out_dims[d] = 1;
-  }
-  std::vector<size_t> index(x_dims.size(), 0);
-  std::vector<size_t> step(x_dims.size(), 1);
-  std::vector<size_t> dst_step = step;
-  for (auto i = x_dims.size() - 1; i > 0; --i) {
-    step[i - 1] = step[i] * x_dims[i];
-    dst_step[i - 1] = dst_step[i] * out_dims[i];
-  }
-  for (auto d : reduce_dims) {
-    dst_step[d] = 0;
-  }
-
-  memset(out_data, 0, sizeof(T) * out->numel());
-  for (auto i = 0; i < numel; ++i) {
-    out_data[phi::vec_product(dst_step, index)] +=
-        x_data[phi::vec_product(step, index)];
-    index.back()++;
-    for (auto j = index.size() - 1; j > 0; --j) {
-      if (index[j] >= x_dims[j]) {
-        index[j] = 0;
-        index[j - 1]++;
-      } else {
-        break;
-      }
-    }
-  }
+  funcs::ReduceSum(x.data<T>(), x_dims, reduce_dims, out_data);
 }
 
 template <typename T>
@@ -159,6 +93,7 @@ void SumKernel(const phi::Context& dev_ctx,
                phi::DataType out_dtype,
                bool keep_dim,
                phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   bool reduce_all = false;
   if (dims.size() == 0) {
     reduce_all = true;
@@ -173,57 +108,14 @@ void MinRawKernel(const phi::Context& dev_ctx,
                   bool keep_dim,
                   bool reduce_all,
                   phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
-  auto reduce_dims = dims.GetData();
-  if (reduce_dims.size() == 0) {
+  if (dims.size() == 0) {
     reduce_all = true;
   }
-  if (reduce_all) {
-    reduce_dims.clear();
-    for (auto i = 0; i < x_dims.size(); ++i) {
-      reduce_dims.push_back(i);
-    }
-  }
-
-  for (auto& d : reduce_dims) {
-    // handle negative dims, f.e. "-1" means rightmost dimension
-    if (d < 0) {
-      d = d + x_dims.size();
-    }
-  }
-  auto x_data = x.data<T>();
+  auto reduce_dims = GetReduceDims(x_dims, dims, reduce_all);
   auto out_data = dev_ctx.template Alloc<T>(out);
-
-  auto numel = x.numel();
-  auto out_dims(x_dims);
-  for (auto d : reduce_dims) {
-    out_dims[d] = 1;
-  }
-  std::vector<size_t> index(x_dims.size(), 0);
-  std::vector<size_t> step(x_dims.size(), 1);
-  std::vector<size_t> dst_step = step;
-  for (auto i = x_dims.size() - 1; i > 0; --i) {
-    step[i - 1] = step[i] * x_dims[i];
-    dst_step[i - 1] = dst_step[i] * out_dims[i];
-  }
-  for (auto d : reduce_dims) {
-    dst_step[d] = 0;
-  }
-  std::fill(out_data, out_data + out->numel(), std::numeric_limits<T>::max());
-  for (auto i = 0; i < numel; ++i) {
-    out_data[phi::vec_product(dst_step, index)] =
-        std::min(out_data[phi::vec_product(dst_step, index)],
-                 x_data[phi::vec_product(step, index)]);
-    index.back()++;
-    for (auto j = index.size() - 1; j > 0; --j) {
-      if (index[j] >= x_dims[j]) {
-        index[j] = 0;
-        index[j - 1]++;
-      } else {
-        break;
-      }
-    }
-  }
+  funcs::ReduceMin(x.data<T>(), x_dims, reduce_dims, out_data);
 }
 
 template <typename T>
@@ -232,6 +124,7 @@ void MinKernel(const phi::Context& dev_ctx,
                const phi::IntArray& dims,
                bool keep_dim,
                phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   bool reduce_all = false;
   if (dims.size() == 0) {
     reduce_all = true;
@@ -246,54 +139,11 @@ void MaxRawKernel(const phi::Context& dev_ctx,
                   bool keep_dim,
                   bool reduce_all,
                   phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
-  auto reduce_dims = dims.GetData();
-  if (reduce_all) {
-    reduce_dims.clear();
-    for (auto i = 0; i < x_dims.size(); ++i) {
-      reduce_dims.push_back(i);
-    }
-  }
-  for (auto& d : reduce_dims) {
-    // handle negative dims, f.e. "-1" means rightmost dimension
-    if (d < 0) {
-      d = d + x_dims.size();
-    }
-  }
-  auto x_data = x.data<T>();
+  auto reduce_dims = GetReduceDims(x_dims, dims, reduce_all);
   auto out_data = dev_ctx.template Alloc<T>(out);
-
-  auto numel = x.numel();
-  auto out_dims(x_dims);
-  for (auto d : reduce_dims) {
-    out_dims[d] = 1;
-  }
-  std::vector<size_t> index(x_dims.size(), 0);
-  std::vector<size_t> step(x_dims.size(), 1);
-  std::vector<size_t> dst_step = step;
-  for (auto i = x_dims.size() - 1; i > 0; --i) {
-    step[i - 1] = step[i] * x_dims[i];
-    dst_step[i - 1] = dst_step[i] * out_dims[i];
-  }
-  for (auto d : reduce_dims) {
-    dst_step[d] = 0;
-  }
-  std::fill(
-      out_data, out_data + out->numel(), std::numeric_limits<T>::lowest());
-  for (auto i = 0; i < numel; ++i) {
-    out_data[phi::vec_product(dst_step, index)] =
-        std::max(out_data[phi::vec_product(dst_step, index)],
-                 x_data[phi::vec_product(step, index)]);
-    index.back()++;
-    for (auto j = index.size() - 1; j > 0; --j) {
-      if (index[j] >= x_dims[j]) {
-        index[j] = 0;
-        index[j - 1]++;
-      } else {
-        break;
-      }
-    }
-  }
+  funcs::ReduceMax(x.data<T>(), x_dims, reduce_dims, out_data);
 }
 
 template <typename T>
@@ -302,6 +152,7 @@ void MaxKernel(const phi::Context& dev_ctx,
                const phi::IntArray& dims,
                bool keep_dim,
                phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   bool reduce_all = false;
   if (dims.size() == 0) {
     reduce_all = true;
@@ -16,6 +16,7 @@
 
 #include "paddle/phi/capi/all.h"
 #include "phi_funcs.h"  //NOLINT
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -126,6 +127,7 @@ void ReshapeKernel(const phi::Context& dev_ctx,
                    const phi::DenseTensor& x,
                    const phi::IntArray& shape,
                    phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto x_dims = x.dims();
   auto out_dims = ValidateShape(shape.GetData(), x_dims);
   out->Resize(out_dims);
@@ -154,6 +156,7 @@ void ReshapeWithXShapeKernel(const phi::Context& dev_ctx,
                              const phi::IntArray& shape,
                              phi::DenseTensor* out,
                              phi::DenseTensor* xshape) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   ReshapeKernel<T>(dev_ctx, x, shape, out);
 }
 
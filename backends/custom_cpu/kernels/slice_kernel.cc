@@ -14,6 +14,8 @@
 
 #include "paddle/phi/capi/all.h"
 #include "phi_funcs.h"  //NOLINT
+#include "runtime/stream.h"
+#include "strided_copy_funcs.h"  //NOLINT
 
 namespace custom_kernel {
 
@@ -26,6 +28,7 @@ void SliceRawKernel(const phi::Context& ctx,
                     const std::vector<int64_t>& infer_flags,
                     const std::vector<int64_t>& decrease_axis,
                     phi::DenseTensor* out) {
+  custom_cpu::StreamLaunchGuard launch(ctx.stream(), __func__);
   // Step 1: Get the accurate attribute value of starts and ends
   auto starts = starts_arr.GetData();
   auto ends = ends_arr.GetData();
@@ -37,7 +40,6 @@ void SliceRawKernel(const phi::Context& ctx,
   // Step 2: Compute output
   auto in = &input;
   auto in_data = input.data<T>();
-  int rank = input.dims().size();
 
   auto in_dims = in->dims();
   auto out_dims = out->dims();
@@ -60,41 +62,19 @@ void SliceRawKernel(const phi::Context& ctx,
   out_dims = phi::funcs::GetDecreasedDims<int64_t>(slice_dims, decrease_axis);
 
   // 2.2 Get output
-  auto offsets = std::vector<size_t>(rank);
-  auto extents = std::vector<size_t>(rank);
-
-  for (size_t i = 0; i < rank; ++i) {
-    offsets[i] = 0;
-    extents[i] = slice_dims[i];
-  }
+  std::vector<int64_t> in_strides = funcs::ContiguousStrides(in_dims);
+  int64_t in_offset = 0;
   for (size_t i = 0; i < axes.size(); ++i) {
-    offsets[axes[i]] = starts[i];
+    in_offset += starts[i] * in_strides[axes[i]];
   }
 
   out->Resize(slice_dims);
   auto out_data = ctx.template Alloc<T>(out);
-
-  std::vector<size_t> in_step(rank, 1);
-  for (auto i = rank - 1; i > 0; --i) {
-    in_step[i - 1] = in_step[i] * in_dims[i];
-  }
-
-  auto numel = phi::product(slice_dims);
-  auto index = std::vector<size_t>(offsets.cbegin(), offsets.cend());
-  for (auto i = 0; i < numel; i += slice_dims.back()) {
-    memcpy(out_data + i,
-           in_data + phi::vec_product(index, in_step),
-           sizeof(T) * slice_dims.back());
-    index[index.size() - 2]++;
-    for (auto j = index.size() - 2; j > 0; --j) {
-      if (index[j] >= offsets[j] + extents[j]) {
-        index[j] = offsets[j];
-        index[j - 1] += 1;
-      } else {
-        break;
-      }
-    }
-  }
+  funcs::StridedCopy(in_data + in_offset,
+                     in_strides,
+                     out_data,
+                     funcs::ContiguousStrides(slice_dims),
+                     slice_dims);
   out->Resize(out_dims);
 }
 
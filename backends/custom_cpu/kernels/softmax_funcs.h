@@ -0,0 +1,275 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <vector>
+
+#include "reduce_funcs.h"  // NOLINT
+#include "thread_pool.h"   // NOLINT
+
+namespace custom_kernel {
+namespace funcs {
+
+// A softmax input is viewed as [n, axis_dim, remain]: n independent
+// outer slices, the softmax axis, and `remain` inner lanes that are
+// contiguous in memory. remain == 1 is the contiguous-axis case.
+struct SoftmaxShape {
+  int64_t n;
+  int64_t axis_dim;
+  int64_t remain;
+};
+
+namespace softmax_detail {
+
+constexpr int64_t kMinElementsPerThread = 1 << 14;
+constexpr int64_t kLaneBlock = 256;
+
+// exp() arguments are clipped like phi's ValueClip so that probabilities
+// never underflow to zero.
+template <typename T>
+inline T ClippedExp(T x) {
+  const T kThreshold = static_cast<T>(-64.);
+  return std::exp(x < kThreshold ? kThreshold : x);
+}
+
+// Single pass online softmax statistics: running max and the sum of
+// exp(x - max), rescaled whenever the max grows. The sum is accumulated
+// in the compensated state of SumReducer, so long axes keep the
+// precision of the reduce kernels. Computes the stats of `lanes` lanes
+// starting at x, whose axis elements are `stride` apart; `acc` is
+// scratch for the sums.
+template <typename T>
+inline void OnlineStats(const T* x,
+                        int64_t axis_dim,
+                        int64_t stride,
+                        int64_t lanes,
+                        typename SumReducer<T>::State* acc,
+                        T* max,
+                        T* sum) {
+  using Sum = SumReducer<T>;
+  for (int64_t k = 0; k < lanes; ++k) {
+    max[k] = x[k];
+    acc[k] = Sum::Init();
+    Sum::Add(&acc[k], static_cast<T>(1));
+  }
+  for (int64_t j = 1; j < axis_dim; ++j) {
+    const T* row = x + j * stride;
+    for (int64_t k = 0; k < lanes; ++k) {
+      T v = row[k];
+      if (v > max[k]) {
+        // Rescaling scales the compensation along with the sum.
+        const T scale = ClippedExp(max[k] - v);
+        acc[k].sum *= scale;
+        acc[k].comp *= scale;
+        Sum::Add(&acc[k], static_cast<T>(1));
+        max[k] = v;
+      } else {
+        Sum::Add(&acc[k], ClippedExp(v - max[k]));
+      }
+    }
+  }
+  const Sum reducer;
+  for (int64_t k = 0; k < lanes; ++k) {
+    sum[k] = reducer.Finalize(acc[k]);
+  }
+}
+
+// Runs fn(x_offset, lanes, max, sum) for every block of lanes, with the
+// online statistics of that block already computed. Blocks are spread
+// over the thread pool; max/sum are per-thread scratch buffers, so no
+// memory is allocated per row.
+template <typename T, typename Fn>
+void ForEachSoftmaxBlock(const T* x, const SoftmaxShape& shape, Fn fn) {
+  const int64_t lane_block = std::min(shape.remain, kLaneBlock);
+  const int64_t lane_blocks = (shape.remain + lane_block - 1) / lane_block;
+  const int64_t block_elems = std::max<int64_t>(lane_block * shape.axis_dim, 1);
+  const int64_t grain =
+      std::max<int64_t>(1, kMinElementsPerThread / block_elems);
+  ParallelFor(shape.n * lane_blocks, grain, [&](int64_t begin, int64_t end) {
+    std::vector<typename SumReducer<T>::State> acc(lane_block);
+    std::vector<T> max(lane_block), sum(lane_block);
+    for (int64_t task = begin; task < end; ++task) {
+      const int64_t i = task / lane_blocks;
+      const int64_t k0 = (task % lane_blocks) * lane_block;
+      const int64_t lanes = std::min(lane_block, shape.remain - k0);
+      const int64_t offset = i * shape.axis_dim * shape.remain + k0;
+      OnlineStats(x + offset,
+                  shape.axis_dim,
+                  shape.remain,
+                  lanes,
+                  &acc[0],
+                  &max[0],
+                  &sum[0]);
+      fn(offset, lanes, &max[0], &sum[0]);
+    }
+  });
+}
+
+}  // namespace softmax_detail
+
+// out = softmax(x) along the axis of `shape`. The input is read twice:
+// once for the online max/sum and once to write the probabilities.
+template <typename T>
+void SoftmaxForward(const T* x, const SoftmaxShape& shape, T* out) {
+  using softmax_detail::ClippedExp;
+  softmax_detail::ForEachSoftmaxBlock(
+      x, shape, [&](int64_t offset, int64_t lanes, const T* max, const T* sum) {
+        for (int64_t j = 0; j < shape.axis_dim; ++j) {
+          const T* src = x + offset + j * shape.remain;
+          T* dst = out + offset + j * shape.remain;
+          for (int64_t k = 0; k < lanes; ++k) {
+            dst[k] = ClippedExp(src[k] - max[k]) / sum[k];
+          }
+        }
+      });
+}
+
+// x_grad = (out_grad - sum(out_grad * out, axis)) * out, one row at a time.
+// The dot products are compensated sums, see SumReducer.
+template <typename T>
+void SoftmaxBackward(const T* out,
+                     const T* out_grad,
+                     const SoftmaxShape& shape,
+                     T* x_grad) {
+  using Sum = SumReducer<T>;
+  const int64_t row = shape.axis_dim * shape.remain;
+  const int64_t grain = std::max<int64_t>(
+      1, softmax_detail::kMinElementsPerThread / std::max<int64_t>(row, 1));
+  ParallelFor(shape.n, grain, [&](int64_t begin, int64_t end) {
+    const Sum reducer;
+    std::vector<typename Sum::State> acc(shape.remain);
+    std::vector<T> dot(shape.remain);
+    for (int64_t i = begin; i < end; ++i) {
+      const int64_t base = i * row;
+      std::fill(acc.begin(), acc.end(), Sum::Init());
+      for (int64_t j = 0; j < shape.axis_dim; ++j) {
+        const int64_t offset = base + j * shape.remain;
+        for (int64_t k = 0; k < shape.remain; ++k) {
+          Sum::Add(&acc[k], out[offset + k] * out_grad[offset + k]);
+        }
+      }
+      for (int64_t k = 0; k < shape.remain; ++k) {
+        dot[k] = reducer.Finalize(acc[k]);
+      }
+      for (int64_t j = 0; j < shape.axis_dim; ++j) {
+        const int64_t offset = base + j * shape.remain;
+        for (int64_t k = 0; k < shape.remain; ++k) {
+          x_grad[offset + k] =
+              (out_grad[offset + k] - dot[k]) * out[offset + k];
+        }
+      }
+    }
+  });
+}
+
+// Fused softmax + cross entropy over logits.
+//
+// Hard labels have shape [n, remain], soft labels the shape of the logits.
+// The loss is computed from the log-sum-exp of the logits rather than from
+// log(softmax), so the probability tensor is written only when `softmax`
+// is not null. Ignored labels give zero loss.
+template <typename T, typename LabelT>
+void SoftmaxWithCrossEntropy(const T* logits,
+                             const LabelT* label,
+                             bool soft_label,
+                             int64_t ignore_index,
+                             const SoftmaxShape& shape,
+                             T* softmax,
+                             T* loss) {
+  using softmax_detail::ClippedExp;
+  using Sum = SumReducer<T>;
+  const Sum reducer;
+  const int64_t row = shape.axis_dim * shape.remain;
+  softmax_detail::ForEachSoftmaxBlock(
+      logits,
+      shape,
+      [&](int64_t offset, int64_t lanes, const T* max, const T* sum) {
+        const int64_t i = offset / row;
+        const int64_t k0 = offset % row;
+        for (int64_t k = 0; k < lanes; ++k) {
+          const int64_t loss_idx = i * shape.remain + k0 + k;
+          const T log_sum = std::log(sum[k]);
+          int64_t lbl = -1;
+          bool ignored = false;
+          if (!soft_label) {
+            lbl = static_cast<int64_t>(label[loss_idx]);
+            ignored = lbl == ignore_index;
+          }
+          // Soft labels sum over the axis, hard labels pick one term.
+          typename Sum::State loss_value = Sum::Init();
+          for (int64_t j = 0; j < shape.axis_dim; ++j) {
+            const int64_t idx = offset + j * shape.remain + k;
+            T shifted = logits[idx] - max[k];
+            // log(softmax) with the same clipping as SoftmaxForward.
+            T log_prob = std::max(shifted, static_cast<T>(-64.)) - log_sum;
+            if (softmax != nullptr) {
+              softmax[idx] = ClippedExp(shifted) / sum[k];
+            }
+            if (soft_label) {
+              Sum::Add(&loss_value, -static_cast<T>(label[idx]) * log_prob);
+            } else if (j == lbl) {
+              Sum::Add(&loss_value, -log_prob);
+            }
+          }
+          loss[loss_idx] =
+              ignored ? static_cast<T>(0) : reducer.Finalize(loss_value);
+        }
+      });
+}
+
+// Gradient of softmax + cross entropy from the saved probabilities:
+// logits_grad = loss_grad * (softmax - label). softmax and logits_grad
+// may alias.
+template <typename T, typename LabelT>
+void SoftmaxWithCrossEntropyGrad(const T* softmax,
+                                 const LabelT* label,
+                                 bool soft_label,
+                                 int64_t ignore_index,
+                                 const SoftmaxShape& shape,
+                                 const T* loss_grad,
+                                 T* logits_grad) {
+  const int64_t row = shape.axis_dim * shape.remain;
+  const int64_t grain = std::max<int64_t>(
+      1, softmax_detail::kMinElementsPerThread / std::max<int64_t>(row, 1));
+  ParallelFor(shape.n, grain, [&](int64_t begin, int64_t end) {
+    for (int64_t i = begin; i < end; ++i) {
+      for (int64_t j = 0; j < shape.axis_dim; ++j) {
+        const int64_t offset = i * row + j * shape.remain;
+        const T* dloss = loss_grad + i * shape.remain;
+        for (int64_t k = 0; k < shape.remain; ++k) {
+          const int64_t idx = offset + k;
+          T target;
+          if (soft_label) {
+            target = static_cast<T>(label[idx]);
+          } else {
+            int64_t lbl = static_cast<int64_t>(label[i * shape.remain + k]);
+            if (lbl == ignore_index) {
+              logits_grad[idx] = static_cast<T>(0);
+              continue;
+            }
+            target = static_cast<T>(j == lbl ? 1 : 0);
+          }
+          logits_grad[idx] = dloss[k] * (softmax[idx] - target);
+        }
+      }
+    }
+  });
+}
+
+}  // namespace funcs
+}  // namespace custom_kernel
@@ -0,0 +1,170 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <numeric>
+#include <vector>
+
+#include "thread_pool.h"  // NOLINT
+
+namespace custom_kernel {
+namespace funcs {
+
+// Copies below this many bytes per thread are not worth splitting.
+constexpr int64_t kStridedCopyGrainBytes = 256 << 10;
+
+// A strided copy reduced to its simplest form: `dims` from outermost to
+// innermost, with element strides for both sides.
+struct StridedCopyPlan {
+  std::vector<int64_t> dims;
+  std::vector<int64_t> src_strides;
+  std::vector<int64_t> dst_strides;
+  int64_t src_offset = 0;  // in elements, from the given base pointer
+  int64_t dst_offset = 0;
+};
+
+// Simplifies the copy of a `dims` shaped view. Since every element is
+// copied independently the axes may be visited in any order and
+// direction:
+//  - size-1 axes are dropped,
+//  - axes the destination walks backwards are flipped, moving the base
+//    pointers to the last element,
+//  - axes are ordered by destination stride, so writes are sequential,
+//  - neighbouring axes that are contiguous in both views are merged.
+// A negative source stride survives only where the destination is
+// ascending, e.g. for a reversed view.
+inline StridedCopyPlan PlanStridedCopy(
+    const std::vector<int64_t>& dims,
+    const std::vector<int64_t>& src_strides,
+    const std::vector<int64_t>& dst_strides) {
+  StridedCopyPlan plan;
+  std::vector<int> axes;
+  for (int i = 0; i < static_cast<int>(dims.size()); ++i) {
+    if (dims[i] != 1) {
+      axes.push_back(i);
+    }
+  }
+  std::vector<int64_t> src(src_strides), dst(dst_strides);
+  for (int i : axes) {
+    if (dst[i] < 0 || (dst[i] == 0 && src[i] < 0)) {
+      plan.src_offset += (dims[i] - 1) * src[i];
+      plan.dst_offset += (dims[i] - 1) * dst[i];
+      src[i] = -src[i];
+      dst[i] = -dst[i];
+    }
+  }
+  std::stable_sort(axes.begin(), axes.end(), [&](int a, int b) {
+    return dst[a] != dst[b] ? dst[a] > dst[b] : src[a] > src[b];
+  });
+  for (int i : axes) {
+    if (!plan.dims.empty() && plan.src_strides.back() == src[i] * dims[i] &&
+        plan.dst_strides.back() == dst[i] * dims[i]) {
+      plan.dims.back() *= dims[i];
+      plan.src_strides.back() = src[i];
+      plan.dst_strides.back() = dst[i];
+      continue;
+    }
+    plan.dims.push_back(dims[i]);
+    plan.src_strides.push_back(src[i]);
+    plan.dst_strides.push_back(dst[i]);
+  }
+  return plan;
+}
+
+// Copies the `dims` shaped view of `src` with `src_strides` into the view
+// of `dst` with `dst_strides`, strides in elements and possibly negative.
+// The innermost contiguous run is moved with memcpy; the rows above it are
+// split across the thread pool when the copy is large.
+template <typename T>
+void StridedCopy(const T* src,
+                 const std::vector<int64_t>& src_strides,
+                 T* dst,
+                 const std::vector<int64_t>& dst_strides,
+                 const std::vector<int64_t>& dims) {
+  if (std::find(dims.begin(), dims.end(), 0) != dims.end()) {
+    return;
+  }
+  StridedCopyPlan plan = PlanStridedCopy(dims, src_strides, dst_strides);
+  src += plan.src_offset;
+  dst += plan.dst_offset;
+  if (plan.dims.empty()) {
+    *dst = *src;
+    return;
+  }
+
+  const int rank = static_cast<int>(plan.dims.size());
+  const int64_t inner = plan.dims.back();
+  const int64_t src_inner = plan.src_strides.back();
+  const int64_t dst_inner = plan.dst_strides.back();
+  const bool contiguous = src_inner == 1 && dst_inner == 1;
+  const int64_t rows = std::accumulate(plan.dims.begin(),
+                                       plan.dims.end() - 1,
+                                       int64_t(1),
+                                       std::multiplies<int64_t>());
+
+  auto copy_rows = [&](int64_t begin, int64_t end) {
+    // Position of row `begin` over the outer axes, then an odometer.
+    std::vector<int64_t> index(rank - 1);
+    int64_t src_pos = 0, dst_pos = 0;
+    for (int64_t d = rank - 2, rest = begin; d >= 0; --d) {
+      index[d] = rest % plan.dims[d];
+      rest /= plan.dims[d];
+      src_pos += index[d] * plan.src_strides[d];
+      dst_pos += index[d] * plan.dst_strides[d];
+    }
+    for (int64_t row = begin; row < end; ++row) {
+      if (contiguous) {
+        std::memcpy(dst + dst_pos, src + src_pos, inner * sizeof(T));
+      } else {
+        const T* s = src + src_pos;
+        T* o = dst + dst_pos;
+        for (int64_t i = 0; i < inner; ++i) {
+          o[i * dst_inner] = s[i * src_inner];
+        }
+      }
+      for (int d = rank - 2; d >= 0; --d) {
+        src_pos += plan.src_strides[d];
+        dst_pos += plan.dst_strides[d];
+        if (++index[d] < plan.dims[d]) {
+          break;
+        }
+        src_pos -= plan.dims[d] * plan.src_strides[d];
+        dst_pos -= plan.dims[d] * plan.dst_strides[d];
+        index[d] = 0;
+      }
+    }
+  };
+
+  const int64_t row_bytes = inner * static_cast<int64_t>(sizeof(T));
+  ParallelFor(rows,
+              std::max<int64_t>(1, kStridedCopyGrainBytes / row_bytes),
+              copy_rows);
+}
+
+// Row-major strides of a contiguous tensor with shape `dims`.
+inline std::vector<int64_t> ContiguousStrides(
+    const std::vector<int64_t>& dims) {
+  std::vector<int64_t> strides(dims.size(), 1);
+  for (int i = static_cast<int>(dims.size()) - 2; i >= 0; --i) {
+    strides[i] = strides[i + 1] * dims[i + 1];
+  }
+  return strides;
+}
+
+}  // namespace funcs
+}  // namespace custom_kernel
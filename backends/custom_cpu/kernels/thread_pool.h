@@ -0,0 +1,186 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <cstdint>
+#include <cstdlib>
+#include <functional>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+namespace custom_kernel {
+
+// A process wide pool of worker threads shared by all custom_cpu kernels.
+//
+// The number of threads can be set with the environment variable
+// CUSTOM_CPU_NUM_THREADS, it defaults to the number of hardware threads.
+// ParallelFor called from inside a parallel region runs serially on the
+// calling thread, so kernels built on top of each other never deadlock.
+class ThreadPool {
+ public:
+  static ThreadPool& Instance() {
+    static ThreadPool pool(DefaultNumThreads());
+    return pool;
+  }
+
+  ~ThreadPool() {
+    {
+      std::lock_guard<std::mutex> lock(mutex_);
+      stop_ = true;
+    }
+    wake_cv_.notify_all();
+    for (auto& worker : workers_) {
+      worker.join();
+    }
+  }
+
+  size_t NumThreads() const { return workers_.size() + 1; }
+
+  // Splits [0, n) into chunks of at least `grain` iterations and calls
+  // fn(begin, end) for each chunk. Blocks until every chunk is done.
+  void ParallelFor(int64_t n,
+                   int64_t grain,
+                   const std::function<void(int64_t, int64_t)>& fn) {
+    if (n <= 0) {
+      return;
+    }
+    grain = std::max<int64_t>(grain, 1);
+    int64_t max_chunks = (n + grain - 1) / grain;
+    int64_t num_chunks =
+        std::min<int64_t>(max_chunks, static_cast<int64_t>(NumThreads()));
+    if (num_chunks <= 1 || InParallelRegion()) {
+      fn(0, n);
+      return;
+    }
+
+    std::lock_guard<std::mutex> guard(run_mutex_);
+    Job job;
+    job.fn = &fn;
+    job.n = n;
+    job.chunk = (n + num_chunks - 1) / num_chunks;
+    job.num_chunks = (n + job.chunk - 1) / job.chunk;
+    job.next.store(0);
+    job.pending.store(job.num_chunks);
+    job.workers = 0;
+    {
+      std::lock_guard<std::mutex> lock(mutex_);
+      job_ = &job;
+      ++generation_;
+    }
+    wake_cv_.notify_all();
+
+    RunChunks(&job);
+    {
+      std::unique_lock<std::mutex> lock(mutex_);
+      done_cv_.wait(
+          lock, [&job] { return job.pending.load() == 0 && job.workers == 0; });
+      job_ = nullptr;
+    }
+  }
+
+ private:
+  struct Job {
+    const std::function<void(int64_t, int64_t)>* fn;
+    int64_t n;
+    int64_t chunk;
+    int64_t num_chunks;
+    std::atomic<int64_t> next;
+    std::atomic<int64_t> pending;
+    // Number of pool workers holding a pointer to this job, guarded by
+    // mutex_. The job lives on the caller's stack and must outlive them.
+    int workers;
+  };
+
+  explicit ThreadPool(size_t num_threads) {
+    for (size_t i = 1; i < num_threads; ++i) {
+      workers_.emplace_back([this] { WorkerLoop(); });
+    }
+  }
+
+  static size_t DefaultNumThreads() {
+    const char* env = std::getenv("CUSTOM_CPU_NUM_THREADS");
+    if (env != nullptr && std::atoi(env) > 0) {
+      return static_cast<size_t>(std::atoi(env));
+    }
+    return std::max<size_t>(std::thread::hardware_concurrency(), 1);
+  }
+
+  static bool& InParallelRegion() {
+    thread_local bool in_parallel_region = false;
+    return in_parallel_region;
+  }
+
+  void RunChunks(Job* job) {
+    InParallelRegion() = true;
+    for (int64_t c = job->next.fetch_add(1); c < job->num_chunks;
+         c = job->next.fetch_add(1)) {
+      int64_t begin = c * job->chunk;
+      int64_t end = std::min(begin + job->chunk, job->n);
+      (*job->fn)(begin, end);
+      if (job->pending.fetch_sub(1) == 1) {
+        std::lock_guard<std::mutex> lock(mutex_);
+        done_cv_.notify_all();
+      }
+    }
+    InParallelRegion() = false;
+  }
+
+  void WorkerLoop() {
+    uint64_t seen = 0;
+    while (true) {
+      Job* job = nullptr;
+      {
+        std::unique_lock<std::mutex> lock(mutex_);
+        wake_cv_.wait(lock, [&] { return stop_ || generation_ != seen; });
+        if (stop_) {
+          return;
+        }
+        seen = generation_;
+        job = job_;
+        if (job == nullptr) {
+          continue;
+        }
+        ++job->workers;
+      }
+      RunChunks(job);
+      {
+        std::lock_guard<std::mutex> lock(mutex_);
+        --job->workers;
+      }
+      done_cv_.notify_all();
+    }
+  }
+
+  std::vector<std::thread> workers_;
+  std::mutex run_mutex_;
+  std::mutex mutex_;
+  std::condition_variable wake_cv_;
+  std::condition_variable done_cv_;
+  Job* job_ = nullptr;
+  uint64_t generation_ = 0;
+  bool stop_ = false;
+};
+
+inline void ParallelFor(int64_t n,
+                        int64_t grain,
+                        const std::function<void(int64_t, int64_t)>& fn) {
+  ThreadPool::Instance().ParallelFor(n, grain, fn);
+}
+
+}  // namespace custom_kernel
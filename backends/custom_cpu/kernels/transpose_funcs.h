@@ -0,0 +1,222 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <vector>
+
+#include "thread_pool.h"  // NOLINT
+
+namespace custom_kernel {
+namespace funcs {
+
+// Simplifies a transpose of a contiguous tensor with shape `dims` by `perm`
+// (out axis j reads input axis perm[j]). Size-1 axes are removed and input
+// axes that stay adjacent and in order after the permutation are merged,
+// e.g. [2, 3, 4, 5] with perm (2, 3, 0, 1) becomes [6, 20] with (1, 0).
+// An identity permutation collapses to a single axis.
+inline void CoalesceTranspose(const std::vector<int64_t>& dims,
+                              const std::vector<int>& perm,
+                              std::vector<int64_t>* new_dims,
+                              std::vector<int>* new_perm) {
+  const int rank = static_cast<int>(dims.size());
+  // Drop size-1 axes, renumbering the remaining input axes.
+  std::vector<int> renumber(rank, -1);
+  std::vector<int64_t> kept_dims;
+  for (int i = 0; i < rank; ++i) {
+    if (dims[i] != 1) {
+      renumber[i] = static_cast<int>(kept_dims.size());
+      kept_dims.push_back(dims[i]);
+    }
+  }
+  std::vector<int> kept_perm;
+  for (int j = 0; j < rank; ++j) {
+    if (renumber[perm[j]] >= 0) {
+      kept_perm.push_back(renumber[perm[j]]);
+    }
+  }
+
+  // Group runs of consecutive input axes in the output order.
+  const int kept_rank = static_cast<int>(kept_dims.size());
+  std::vector<int> group_of_axis(kept_rank, -1);
+  std::vector<int> group_head;  // first input axis of each group
+  std::vector<int> out_groups;  // groups in output order
+  for (int j = 0; j < kept_rank; ++j) {
+    if (j > 0 && kept_perm[j] == kept_perm[j - 1] + 1) {
+      group_of_axis[kept_perm[j]] = group_of_axis[kept_perm[j - 1]];
+      continue;
+    }
+    group_of_axis[kept_perm[j]] = static_cast<int>(group_head.size());
+    out_groups.push_back(static_cast<int>(group_head.size()));
+    group_head.push_back(kept_perm[j]);
+  }
+
+  // Number the groups by input order and accumulate their sizes.
+  const int num_groups = static_cast<int>(group_head.size());
+  std::vector<int> input_order(num_groups, -1);
+  new_dims->clear();
+  for (int i = 0; i < kept_rank; ++i) {
+    int g = group_of_axis[i];
+    if (input_order[g] < 0) {
+      input_order[g] = static_cast<int>(new_dims->size());
+      new_dims->push_back(kept_dims[i]);
+    } else {
+      new_dims->back() *= kept_dims[i];
+    }
+  }
+  new_perm->clear();
+  for (int g : out_groups) {
+    new_perm->push_back(input_order[g]);
+  }
+  if (new_dims->empty()) {
+    new_dims->push_back(1);
+    new_perm->push_back(0);
+  }
+}
+
+namespace transpose_detail {
+
+constexpr int64_t kTile = 32;
+constexpr int64_t kMinElementsPerThread = 1 << 15;
+
+// Strides of the batch axes, i.e. every input axis except the two that
+// are tiled, in both the input and the output.
+struct BatchIndexer {
+  std::vector<int64_t> dims;
+  std::vector<int64_t> in_strides;
+  std::vector<int64_t> out_strides;
+
+  void Offsets(int64_t index, int64_t* in_off, int64_t* out_off) const {
+    *in_off = 0;
+    *out_off = 0;
+    for (int i = static_cast<int>(dims.size()) - 1; i >= 0; --i) {
+      int64_t c = index % dims[i];
+      index /= dims[i];
+      *in_off += c * in_strides[i];
+      *out_off += c * out_strides[i];
+    }
+  }
+};
+
+}  // namespace transpose_detail
+
+// out = transpose(x, perm) for contiguous x and out.
+//
+// The permutation is first coalesced, identities become a memcpy, and
+// permutations keeping the innermost axis copy contiguous rows. All other
+// cases move data through kTile x kTile blocks spanning the input's and
+// the output's contiguous axes, so reads and writes both stay in cache.
+template <typename T>
+void Transpose(const T* x,
+               const std::vector<int64_t>& x_dims,
+               const std::vector<int>& perm,
+               T* out) {
+  using transpose_detail::BatchIndexer;
+  using transpose_detail::kMinElementsPerThread;
+  using transpose_detail::kTile;
+
+  int64_t numel = 1;
+  for (auto d : x_dims) {
+    numel *= d;
+  }
+  if (numel == 0) {
+    return;
+  }
+
+  std::vector<int64_t> dims;
+  std::vector<int> axes;
+  CoalesceTranspose(x_dims, perm, &dims, &axes);
+  const int rank = static_cast<int>(dims.size());
+  if (rank == 1) {
+    std::memcpy(out, x, numel * sizeof(T));
+    return;
+  }
+
+  std::vector<int64_t> in_strides(rank, 1);
+  for (int i = rank - 2; i >= 0; --i) {
+    in_strides[i] = in_strides[i + 1] * dims[i + 1];
+  }
+  // Stride in the output of every input axis.
+  std::vector<int64_t> out_strides(rank, 1);
+  int64_t stride = 1;
+  for (int j = rank - 1; j >= 0; --j) {
+    out_strides[axes[j]] = stride;
+    stride *= dims[axes[j]];
+  }
+
+  const int a = rank - 1;     // contiguous in the input
+  const int b = axes.back();  // contiguous in the output
+  BatchIndexer batch;
+  for (int i = 0; i < rank; ++i) {
+    if (i != a && i != b) {
+      batch.dims.push_back(dims[i]);
+      batch.in_strides.push_back(in_strides[i]);
+      batch.out_strides.push_back(out_strides[i]);
+    }
+  }
+  int64_t num_batches = 1;
+  for (auto d : batch.dims) {
+    num_batches *= d;
+  }
+
+  if (a == b) {
+    // The innermost axis stays in place: copy whole rows.
+    const int64_t row = dims[a];
+    const int64_t grain =
+        std::max<int64_t>(1, kMinElementsPerThread / std::max<int64_t>(row, 1));
+    ParallelFor(num_batches, grain, [&](int64_t begin, int64_t end) {
+      for (int64_t i = begin; i < end; ++i) {
+        int64_t in_off, out_off;
+        batch.Offsets(i, &in_off, &out_off);
+        std::memcpy(out + out_off, x + in_off, row * sizeof(T));
+      }
+    });
+    return;
+  }
+
+  // Every task is a 2-D tiled transpose of kTile rows of one batch.
+  const int64_t rows = dims[b];
+  const int64_t cols = dims[a];
+  const int64_t row_blocks = (rows + kTile - 1) / kTile;
+  const int64_t in_row_stride = in_strides[b];
+  const int64_t out_col_stride = out_strides[a];
+  const int64_t grain = std::max<int64_t>(
+      1, kMinElementsPerThread / std::max<int64_t>(kTile * cols, 1));
+
+  ParallelFor(num_batches * row_blocks, grain, [&](int64_t begin, int64_t end) {
+    for (int64_t task = begin; task < end; ++task) {
+      int64_t in_off, out_off;
+      batch.Offsets(task / row_blocks, &in_off, &out_off);
+      const int64_t r0 = (task % row_blocks) * kTile;
+      const int64_t r1 = std::min(r0 + kTile, rows);
+      const T* src = x + in_off;
+      T* dst = out + out_off;
+      for (int64_t c0 = 0; c0 < cols; c0 += kTile) {
+        const int64_t c1 = std::min(c0 + kTile, cols);
+        for (int64_t r = r0; r < r1; ++r) {
+          const T* src_row = src + r * in_row_stride;
+          for (int64_t c = c0; c < c1; ++c) {
+            dst[c * out_col_stride + r] = src_row[c];
+          }
+        }
+      }
+    }
+  });
+}
+
+}  // namespace funcs
+}  // namespace custom_kernel
@@ -15,6 +15,7 @@
 #include <random>
 
 #include "paddle/phi/capi/all.h"
+#include "runtime/stream.h"
 
 namespace custom_kernel {
 
@@ -42,6 +43,7 @@ void UniformRawKernel(const phi::Context &dev_ctx,
                       int diag_step,
                       float diag_val,
                       phi::DenseTensor *out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   auto shape_data = shape.GetData();
 
   out->Resize(std::vector<int64_t>(shape_data.begin(), shape_data.end()));
@@ -78,6 +80,7 @@ void UniformKernel(const phi::Context &dev_ctx,
                    const phi::Scalar &max,
                    int seed,
                    phi::DenseTensor *out) {
+  custom_cpu::StreamLaunchGuard launch(dev_ctx.stream(), __func__);
   UniformRawKernel<T>(dev_ctx, shape, dtype, min, max, seed, 0, 0, 0.0f, out);
 }
 
@@ -0,0 +1,409 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <sys/mman.h>
+#include <unistd.h>
+
+#include <algorithm>
+#include <atomic>
+#include <cstddef>
+#include <cstdint>
+#include <cstdlib>
+#include <map>
+#include <mutex>
+#include <vector>
+
+namespace custom_cpu {
+
+// Counters of the caching allocator, in bytes.
+struct MemoryStats {
+  size_t limit;
+  // Requested sizes of the live allocations.
+  size_t allocated;
+  size_t peak_allocated;
+  // Memory obtained from the system, live or cached.
+  size_t reserved;
+  size_t peak_reserved;
+  // Reserved memory sitting in free lists.
+  size_t cached;
+  uint64_t num_allocs;
+  uint64_t num_cache_hits;
+
+  // Memory new allocations may still get: the limit caps the reserved
+  // memory, and cached blocks are reused, or unmapped when large.
+  size_t available() const {
+    const size_t used = reserved - std::min(reserved, cached);
+    return limit - std::min(limit, used);
+  }
+
+  // Share of the reserved memory that does not back a live allocation:
+  // cached blocks, size class rounding and unused arena tails.
+  double fragmentation() const {
+    return reserved == 0 ? 0.0
+                         : 1.0 - static_cast<double>(allocated) / reserved;
+  }
+};
+
+namespace allocator_detail {
+
+constexpr size_t kAlignment = 64;
+constexpr size_t kHugePageSize = size_t(2) << 20;
+// Blocks up to kMaxSmallBlock are carved from kArenaSize arenas and
+// rounded to size classes: 128 and 192 bytes, then four per power of two,
+// all multiples of kAlignment. Larger blocks are mapped on their own and
+// rounded to pages.
+constexpr size_t kMinSmallBlock = 256;
+constexpr size_t kMaxSmallBlock = size_t(256) << 10;
+constexpr size_t kArenaSize = size_t(8) << 20;
+// Bytes of every size class a thread keeps for itself before handing
+// blocks back to the shared free lists.
+constexpr size_t kThreadCacheBytes = size_t(1) << 20;
+// A cached large block is reused for requests down to 7/8 of its size.
+constexpr size_t kLargeReuseSlack = 8;
+
+// Every block starts with a header, so the user pointer stays aligned and
+// Free() does not depend on the size passed by the caller.
+struct alignas(kAlignment) BlockHeader {
+  size_t block_size;
+  size_t requested;
+  int size_class;  // -1 for large blocks
+};
+
+inline std::vector<size_t> MakeSizeClasses() {
+  std::vector<size_t> classes = {2 * kAlignment, 3 * kAlignment};
+  for (size_t base = kMinSmallBlock; base < kMaxSmallBlock; base *= 2) {
+    for (size_t step = 0; step < 4; ++step) {
+      classes.push_back(base + step * (base / 4));
+    }
+  }
+  classes.push_back(kMaxSmallBlock);
+  return classes;
+}
+
+inline size_t EnvSize(const char* name, size_t default_value) {
+  const char* env = std::getenv(name);
+  if (env == nullptr || *env == '\0') {
+    return default_value;
+  }
+  return static_cast<size_t>(std::strtoull(env, nullptr, 10));
+}
+
+inline void UpdatePeak(std::atomic<size_t>* peak, size_t value) {
+  size_t prev = peak->load(std::memory_order_relaxed);
+  while (prev < value &&
+         !peak->compare_exchange_weak(prev, value, std::memory_order_relaxed)) {
+  }
+}
+
+}  // namespace allocator_detail
+
+// Size class caching allocator behind the custom_cpu memory hooks.
+//
+// Small requests are served from per-thread free lists, so the common
+// allocate/free churn of short lived tensors takes no lock. Threads share
+// overflowing blocks through global free lists, which are refilled from
+// arenas mapped from the system. Large blocks are cached by size and only
+// returned to the system when the memory limit would be exceeded.
+//
+// Environment:
+//   CUSTOM_CPU_MEMORY_LIMIT_MB  memory cap, half of the physical memory
+//                               by default.
+//   CUSTOM_CPU_HUGE_PAGES       when set to 1, arenas and large blocks are
+//                               aligned to and advised as huge pages.
+class CachingAllocator {
+ public:
+  static CachingAllocator& Instance() {
+    // Leaked on purpose: thread caches flush into it at thread exit.
+    static CachingAllocator* allocator = new CachingAllocator();
+    return *allocator;
+  }
+
+  // Returns nullptr when the request does not fit under the limit.
+  void* Allocate(size_t size) {
+    using allocator_detail::BlockHeader;
+    const size_t needed = size + sizeof(BlockHeader);
+    BlockHeader* block = needed <= allocator_detail::kMaxSmallBlock
+                             ? AllocateSmall(SizeClassOf(needed))
+                             : AllocateLarge(needed);
+    if (block == nullptr) {
+      return nullptr;
+    }
+    block->requested = size;
+    num_allocs_.fetch_add(1, std::memory_order_relaxed);
+    size_t allocated =
+        allocated_.fetch_add(size, std::memory_order_relaxed) + size;
+    allocator_detail::UpdatePeak(&peak_allocated_, allocated);
+    return block + 1;
+  }
+
+  void Free(void* ptr) {
+    if (ptr == nullptr) {
+      return;
+    }
+    auto block = static_cast<allocator_detail::BlockHeader*>(ptr) - 1;
+    allocated_.fetch_sub(block->requested, std::memory_order_relaxed);
+    cached_.fetch_add(block->block_size, std::memory_order_relaxed);
+    if (block->size_class >= 0) {
+      FreeSmall(block);
+    } else {
+      std::lock_guard<std::mutex> lock(mutex_);
+      large_free_.emplace(block->block_size, block);
+    }
+  }
+
+  MemoryStats Stats() const {
+    MemoryStats stats;
+    stats.limit = limit_;
+    stats.allocated = allocated_.load(std::memory_order_relaxed);
+    stats.peak_allocated = peak_allocated_.load(std::memory_order_relaxed);
+    stats.reserved = reserved_.load(std::memory_order_relaxed);
+    stats.peak_reserved = peak_reserved_.load(std::memory_order_relaxed);
+    stats.cached = cached_.load(std::memory_order_relaxed);
+    stats.num_allocs = num_allocs_.load(std::memory_order_relaxed);
+    stats.num_cache_hits = num_cache_hits_.load(std::memory_order_relaxed);
+    return stats;
+  }
+
+ private:
+  using BlockHeader = allocator_detail::BlockHeader;
+
+  struct ThreadCache {
+    explicit ThreadCache(size_t num_classes) : lists(num_classes) {}
+    ~ThreadCache() { Instance().Flush(this); }
+    std::vector<std::vector<BlockHeader*>> lists;
+  };
+
+  CachingAllocator()
+      : size_classes_(allocator_detail::MakeSizeClasses()),
+        free_lists_(size_classes_.size()),
+        huge_pages_(allocator_detail::EnvSize("CUSTOM_CPU_HUGE_PAGES", 0) ==
+                    1) {
+    const size_t physical = static_cast<size_t>(sysconf(_SC_PHYS_PAGES)) *
+                            static_cast<size_t>(sysconf(_SC_PAGE_SIZE));
+    limit_ = allocator_detail::EnvSize("CUSTOM_CPU_MEMORY_LIMIT_MB", 0) << 20;
+    if (limit_ == 0) {
+      limit_ = physical / 2;
+    }
+  }
+
+  int SizeClassOf(size_t bytes) const {
+    return static_cast<int>(
+        std::lower_bound(size_classes_.begin(), size_classes_.end(), bytes) -
+        size_classes_.begin());
+  }
+
+  // Blocks a thread may keep of one class.
+  size_t ThreadCacheCapacity(int size_class) const {
+    return std::max<size_t>(
+        2, allocator_detail::kThreadCacheBytes / size_classes_[size_class]);
+  }
+
+  ThreadCache& LocalCache() {
+    static thread_local ThreadCache cache(size_classes_.size());
+    return cache;
+  }
+
+  BlockHeader* AllocateSmall(int size_class) {
+    auto& list = LocalCache().lists[size_class];
+    if (list.empty()) {
+      Refill(size_class, &list);
+      if (list.empty()) {
+        return nullptr;
+      }
+    } else {
+      num_cache_hits_.fetch_add(1, std::memory_order_relaxed);
+    }
+    BlockHeader* block = list.back();
+    list.pop_back();
+    cached_.fetch_sub(block->block_size, std::memory_order_relaxed);
+    return block;
+  }
+
+  void FreeSmall(BlockHeader* block) {
+    auto& list = LocalCache().lists[block->size_class];
+    list.push_back(block);
+    const size_t capacity = ThreadCacheCapacity(block->size_class);
+    if (list.size() > capacity) {
+      // Keep half, so a thread that frees what another one allocates does
+      // not hit the global lock on every call.
+      std::lock_guard<std::mutex> lock(mutex_);
+      auto& global = free_lists_[block->size_class];
+      global.insert(global.end(), list.begin() + capacity / 2, list.end());
+      list.resize(capacity / 2);
+    }
+  }
+
+  // Moves up to half a thread cache worth of blocks into `list`, taking
+  // them from the global free list or carving them from an arena.
+  void Refill(int size_class, std::vector<BlockHeader*>* list) {
+    const size_t batch =
+        std::max<size_t>(1, ThreadCacheCapacity(size_class) / 2);
+    const size_t block_size = size_classes_[size_class];
+    std::lock_guard<std::mutex> lock(mutex_);
+    auto& global = free_lists_[size_class];
+    if (!global.empty()) {
+      num_cache_hits_.fetch_add(1, std::memory_order_relaxed);
+      const size_t n = std::min(batch, global.size());
+      list->insert(list->end(), global.end() - n, global.end());
+      global.resize(global.size() - n);
+      return;
+    }
+    for (size_t i = 0; i < batch; ++i) {
+      if (arena_left_ < block_size) {
+        if (i > 0) {
+          break;
+        }
+        if (!NewArenaLocked()) {
+          return;
+        }
+      }
+      auto block = reinterpret_cast<BlockHeader*>(arena_ptr_);
+      arena_ptr_ += block_size;
+      arena_left_ -= block_size;
+      block->block_size = block_size;
+      block->size_class = size_class;
+      cached_.fetch_add(block_size, std::memory_order_relaxed);
+      list->push_back(block);
+    }
+  }
+
+  bool NewArenaLocked() {
+    void* arena = MapLocked(allocator_detail::kArenaSize);
+    if (arena == nullptr) {
+      return false;
+    }
+    // The tail of the previous arena stays unused and shows up as
+    // fragmentation.
+    arena_ptr_ = static_cast<char*>(arena);
+    arena_left_ = allocator_detail::kArenaSize;
+    return true;
+  }
+
+  BlockHeader* AllocateLarge(size_t needed) {
+    const size_t granularity =
+        huge_pages_ ? allocator_detail::kHugePageSize : page_size_;
+    const size_t block_size =
+        (needed + granularity - 1) / granularity * granularity;
+    std::lock_guard<std::mutex> lock(mutex_);
+    auto it = large_free_.lower_bound(block_size);
+    if (it != large_free_.end() &&
+        it->first - block_size <=
+            it->first / allocator_detail::kLargeReuseSlack) {
+      BlockHeader* block = it->second;
+      large_free_.erase(it);
+      cached_.fetch_sub(block->block_size, std::memory_order_relaxed);
+      num_cache_hits_.fetch_add(1, std::memory_order_relaxed);
+      return block;
+    }
+    auto block = static_cast<BlockHeader*>(MapLocked(block_size));
+    if (block == nullptr) {
+      return nullptr;
+    }
+    block->block_size = block_size;
+    block->size_class = -1;
+    return block;
+  }
+
+  // Maps `size` bytes from the system, releasing cached large blocks first
+  // when the limit would be exceeded.
+  void* MapLocked(size_t size) {
+    if (reserved_.load(std::memory_order_relaxed) + size > limit_) {
+      ReleaseLargeLocked();
+      if (reserved_.load(std::memory_order_relaxed) + size > limit_) {
+        return nullptr;
+      }
+    }
+    void* ptr = nullptr;
+    if (huge_pages_ && size >= allocator_detail::kHugePageSize) {
+      // Over-map and trim, so the region starts on a huge page boundary.
+      const size_t align = allocator_detail::kHugePageSize;
+      void* raw = mmap(nullptr,
+                       size + align,
+                       PROT_READ | PROT_WRITE,
+                       MAP_PRIVATE | MAP_ANONYMOUS,
+                       -1,
+                       0);
+      if (raw == MAP_FAILED) {
+        return nullptr;
+      }
+      auto addr = reinterpret_cast<uintptr_t>(raw);
+      auto aligned = (addr + align - 1) / align * align;
+      if (aligned > addr) {
+        munmap(raw, aligned - addr);
+      }
+      munmap(reinterpret_cast<void*>(aligned + size), addr + align - aligned);
+      ptr = reinterpret_cast<void*>(aligned);
+#ifdef MADV_HUGEPAGE
+      madvise(ptr, size, MADV_HUGEPAGE);
+#endif
+    } else {
+      ptr = mmap(nullptr,
+                 size,
+                 PROT_READ | PROT_WRITE,
+                 MAP_PRIVATE | MAP_ANONYMOUS,
+                 -1,
+                 0);
+      if (ptr == MAP_FAILED) {
+        return nullptr;
+      }
+    }
+    size_t reserved =
+        reserved_.fetch_add(size, std::memory_order_relaxed) + size;
+    allocator_detail::UpdatePeak(&peak_reserved_, reserved);
+    return ptr;
+  }
+
+  void ReleaseLargeLocked() {
+    for (auto& item : large_free_) {
+      munmap(item.second, item.first);
+      reserved_.fetch_sub(item.first, std::memory_order_relaxed);
+      cached_.fetch_sub(item.first, std::memory_order_relaxed);
+    }
+    large_free_.clear();
+  }
+
+  void Flush(ThreadCache* cache) {
+    std::lock_guard<std::mutex> lock(mutex_);
+    for (size_t c = 0; c < cache->lists.size(); ++c) {
+      auto& global = free_lists_[c];
+      global.insert(
+          global.end(), cache->lists[c].begin(), cache->lists[c].end());
+      cache->lists[c].clear();
+    }
+  }
+
+  const std::vector<size_t> size_classes_;
+  const size_t page_size_ = static_cast<size_t>(sysconf(_SC_PAGE_SIZE));
+  size_t limit_;
+
+  // Guards the global free lists, the arena and the large blocks.
+  std::mutex mutex_;
+  std::vector<std::vector<BlockHeader*>> free_lists_;
+  std::multimap<size_t, BlockHeader*> large_free_;
+  char* arena_ptr_ = nullptr;
+  size_t arena_left_ = 0;
+  const bool huge_pages_;
+
+  std::atomic<size_t> allocated_{0};
+  std::atomic<size_t> peak_allocated_{0};
+  std::atomic<size_t> reserved_{0};
+  std::atomic<size_t> peak_reserved_{0};
+  std::atomic<size_t> cached_{0};
+  std::atomic<uint64_t> num_allocs_{0};
+  std::atomic<uint64_t> num_cache_hits_{0};
+};
+
+}  // namespace custom_cpu
@@ -0,0 +1,826 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <fcntl.h>
+#include <sched.h>
+#include <sys/mman.h>
+#include <unistd.h>
+
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cstdint>
+#include <cstdlib>
+#include <cstring>
+#include <string>
+#include <utility>
+#include <vector>
+
+#include "paddle/phi/backends/device_ext.h"
+
+namespace custom_cpu {
+
+namespace ccl_detail {
+
+static_assert(ATOMIC_LLONG_LOCK_FREE == 2,
+              "shared memory collectives need address free atomics");
+
+// Every ordered pair of ranks owns a channel: a single producer, single
+// consumer ring of kSlots slots of kSlotBytes in shared memory. Messages
+// are streamed through it chunk by chunk, which pipelines the copy out of
+// the sender with the copy or reduction on the receiver.
+constexpr uint64_t kSlots = 4;
+constexpr size_t kSlotBytes = size_t(64) << 10;
+// All-reduces up to this size take the latency bound tree algorithm,
+// larger ones the bandwidth optimal ring.
+constexpr size_t kTreeAllReduceBytes = size_t(64) << 10;
+
+struct Channel {
+  alignas(64) std::atomic<uint64_t> head;  // slots written by the sender
+  alignas(64) std::atomic<uint64_t> tail;  // slots drained by the receiver
+  alignas(64) uint64_t sizes[kSlots];
+  alignas(64) char data[kSlots][kSlotBytes];
+};
+
+// Start of the shared segment, followed by nranks * nranks channels. The
+// segment is created zero filled, which is a valid initial state.
+struct SharedHeader {
+  alignas(64) std::atomic<uint64_t> arrived;
+  alignas(64) std::atomic<uint64_t> generation;
+};
+
+// How long a rank waits for its peers without any progress before the
+// call fails, CUSTOM_CPU_CCL_TIMEOUT seconds, 30 minutes by default. A
+// peer that died or never joined would otherwise hang the rank for good.
+inline std::chrono::steady_clock::duration PeerTimeout() {
+  static const auto timeout = [] {
+    double seconds = 1800;
+    if (const char* env = std::getenv("CUSTOM_CPU_CCL_TIMEOUT")) {
+      seconds = std::strtod(env, nullptr);
+    }
+    return std::chrono::duration_cast<std::chrono::steady_clock::duration>(
+        std::chrono::duration<double>(seconds));
+  }();
+  return timeout;
+}
+
+// Waits politely: spin a little, then give the core away, which matters
+// when ranks oversubscribe the machine. The clock is only read once the
+// spinning is over, the timeout counts from there.
+class Backoff {
+ public:
+  void Reset() { idle_ = 0; }
+  // Returns false once the peers have not moved for PeerTimeout().
+  bool Wait() {
+    if (++idle_ <= kSpins) {
+      return true;
+    }
+    const auto now = std::chrono::steady_clock::now();
+    if (idle_ == kSpins + 1) {
+      deadline_ = now + PeerTimeout();
+    } else if (now > deadline_) {
+      return false;
+    }
+    sched_yield();
+    return true;
+  }
+
+ private:
+  static constexpr int kSpins = 64;
+  int idle_ = 0;
+  std::chrono::steady_clock::time_point deadline_;
+};
+
+// dst = op(dst, src) over `bytes` bytes of elements.
+using ReduceFn = void (*)(char* dst, const char* src, size_t bytes);
+// data /= divisor over `count` elements.
+using ScaleFn = void (*)(char* data, size_t count, size_t divisor);
+
+// Element codecs: how a dtype is stored and in which type it is reduced.
+template <typename T>
+struct Codec {
+  using Storage = T;
+  using Compute = T;
+  static Compute Load(Storage v) { return v; }
+  static Storage Store(Compute v) { return v; }
+};
+
+// Bool reduces as int: SUM and MAX become a logical or, PRODUCT and MIN
+// a logical and.
+struct BoolCodec {
+  using Storage = bool;
+  using Compute = int;
+  static Compute Load(Storage v) { return v ? 1 : 0; }
+  static Storage Store(Compute v) { return v != 0; }
+};
+
+struct Float16Codec {
+  using Storage = uint16_t;
+  using Compute = float;
+  static Compute Load(Storage h) {
+    uint32_t sign = static_cast<uint32_t>(h & 0x8000) << 16;
+    uint32_t exp = (h >> 10) & 0x1f;
+    uint32_t mant = h & 0x3ff;
+    uint32_t bits;
+    if (exp == 0x1f) {
+      bits = sign | 0x7f800000 | (mant << 13);
+    } else if (exp != 0) {
+      bits = sign | ((exp + 112) << 23) | (mant << 13);
+    } else if (mant == 0) {
+      bits = sign;
+    } else {
+      // Subnormal: normalize the mantissa.
+      exp = 113;
+      while ((mant & 0x400) == 0) {
+        mant <<= 1;
+        --exp;
+      }
+      bits = sign | (exp << 23) | ((mant & 0x3ff) << 13);
+    }
+    float f;
+    std::memcpy(&f, &bits, sizeof(f));
+    return f;
+  }
+  static Storage Store(Compute f) {
+    uint32_t bits;
+    std::memcpy(&bits, &f, sizeof(bits));
+    uint16_t sign = static_cast<uint16_t>((bits >> 16) & 0x8000);
+    uint32_t abs = bits & 0x7fffffff;
+    if (abs >= 0x7f800000) {
+      return sign | 0x7c00 | (abs > 0x7f800000 ? 0x200 : 0);
+    }
+    if (abs >= 0x477ff000) {  // rounds to infinity
+      return sign | 0x7c00;
+    }
+    if (abs < 0x38800000) {  // subnormal or zero
+      if (abs < 0x33000000) {
+        return sign;
+      }
+      uint32_t exp = abs >> 23;
+      uint32_t mant = (abs & 0x7fffff) | 0x800000;
+      uint32_t shift = 126 - exp;
+      uint32_t half = mant >> shift;
+      uint32_t rem = mant & ((1u << shift) - 1);
+      uint32_t mid = 1u << (shift - 1);
+      if (rem > mid || (rem == mid && (half & 1))) {
+        ++half;
+      }
+      return sign | static_cast<uint16_t>(half);
+    }
+    uint32_t rounded = abs + 0xfff + ((abs >> 13) & 1);
+    return sign | static_cast<uint16_t>((rounded - 0x38000000) >> 13);
+  }
+};
+
+struct BFloat16Codec {
+  using Storage = uint16_t;
+  using Compute = float;
+  static Compute Load(Storage h) {
+    uint32_t bits = static_cast<uint32_t>(h) << 16;
+    float f;
+    std::memcpy(&f, &bits, sizeof(f));
+    return f;
+  }
+  static Storage Store(Compute f) {
+    uint32_t bits;
+    std::memcpy(&bits, &f, sizeof(bits));
+    if ((bits & 0x7fffffff) > 0x7f800000) {
+      return static_cast<uint16_t>((bits >> 16) | 0x40);
+    }
+    return static_cast<uint16_t>((bits + 0x7fff + ((bits >> 16) & 1)) >> 16);
+  }
+};
+
+struct SumOp {
+  template <typename T>
+  static T Apply(T a, T b) {
+    return a + b;
+  }
+};
+struct ProdOp {
+  template <typename T>
+  static T Apply(T a, T b) {
+    return a * b;
+  }
+};
+struct MaxOp {
+  template <typename T>
+  static T Apply(T a, T b) {
+    return a < b ? b : a;
+  }
+};
+struct MinOp {
+  template <typename T>
+  static T Apply(T a, T b) {
+    return b < a ? b : a;
+  }
+};
+
+template <typename C, typename Op>
+void Reduce(char* dst, const char* src, size_t bytes) {
+  using S = typename C::Storage;
+  auto d = reinterpret_cast<S*>(dst);
+  auto s = reinterpret_cast<const S*>(src);
+  const size_t n = bytes / sizeof(S);
+  for (size_t i = 0; i < n; ++i) {
+    d[i] = C::Store(Op::Apply(C::Load(d[i]), C::Load(s[i])));
+  }
+}
+
+template <typename C>
+void Scale(char* data, size_t count, size_t divisor) {
+  using S = typename C::Storage;
+  using T = typename C::Compute;
+  auto d = reinterpret_cast<S*>(data);
+  for (size_t i = 0; i < count; ++i) {
+    d[i] = C::Store(C::Load(d[i]) / static_cast<T>(divisor));
+  }
+}
+
+// Reduction kernel, division kernel and element size of a dtype.
+struct ReduceKernels {
+  ReduceFn reduce = nullptr;
+  ScaleFn scale = nullptr;
+  size_t elem_size = 0;
+};
+
+template <typename C>
+ReduceKernels MakeKernels(C_CCLReduceOp op) {
+  ReduceKernels kernels;
+  kernels.elem_size = sizeof(typename C::Storage);
+  kernels.scale = Scale<C>;
+  switch (op) {
+    case C_CCLReduceOp::SUM:
+    case C_CCLReduceOp::AVG:
+      kernels.reduce = Reduce<C, SumOp>;
+      break;
+    case C_CCLReduceOp::PRODUCT:
+      kernels.reduce = Reduce<C, ProdOp>;
+      break;
+    case C_CCLReduceOp::MAX:
+      kernels.reduce = Reduce<C, MaxOp>;
+      break;
+    case C_CCLReduceOp::MIN:
+      kernels.reduce = Reduce<C, MinOp>;
+      break;
+  }
+  return kernels;
+}
+
+// Returns zero elem_size for unsupported dtypes.
+inline ReduceKernels GetReduceKernels(C_DataType dtype, C_CCLReduceOp op) {
+  switch (dtype) {
+    case C_DataType::BOOL:
+      return MakeKernels<BoolCodec>(op);
+    case C_DataType::UINT8:
+      return MakeKernels<Codec<uint8_t>>(op);
+    case C_DataType::UINT16:
+      return MakeKernels<Codec<uint16_t>>(op);
+    case C_DataType::UINT32:
+      return MakeKernels<Codec<uint32_t>>(op);
+    case C_DataType::UINT64:
+      return MakeKernels<Codec<uint64_t>>(op);
+    case C_DataType::INT8:
+      return MakeKernels<Codec<int8_t>>(op);
+    case C_DataType::INT16:
+      return MakeKernels<Codec<int16_t>>(op);
+    case C_DataType::INT32:
+      return MakeKernels<Codec<int32_t>>(op);
+    case C_DataType::INT64:
+      return MakeKernels<Codec<int64_t>>(op);
+    case C_DataType::FLOAT16:
+      return MakeKernels<Float16Codec>(op);
+    case C_DataType::FLOAT32:
+      return MakeKernels<Codec<float>>(op);
+    case C_DataType::FLOAT64:
+      return MakeKernels<Codec<double>>(op);
+    case C_DataType::BFLOAT16:
+      return MakeKernels<BFloat16Codec>(op);
+    default:
+      return ReduceKernels();
+  }
+}
+
+// One message moving through a channel. Receives either copy or reduce
+// into `data`. A send may depend on receives that fill its source, then
+// it only forwards what those have already delivered, which pipelines
+// trees and consecutive ring steps.
+struct Transfer {
+  Channel* channel;
+  bool is_send;
+  char* data;
+  size_t bytes;
+  ReduceFn reduce;
+  std::vector<size_t> deps;  // indices of receives in the same batch
+  size_t done;
+};
+
+inline Transfer MakeSend(Channel* channel,
+                         const void* data,
+                         size_t bytes,
+                         std::vector<size_t> deps = {}) {
+  return {channel,
+          true,
+          static_cast<char*>(const_cast<void*>(data)),
+          bytes,
+          nullptr,
+          std::move(deps),
+          0};
+}
+
+inline Transfer MakeRecv(Channel* channel,
+                         void* data,
+                         size_t bytes,
+                         ReduceFn reduce = nullptr) {
+  return {channel, false, static_cast<char*>(data), bytes, reduce, {}, 0};
+}
+
+// Moves as many chunks of `t` as the channel allows, returns whether any
+// progress was made.
+inline bool Advance(Transfer* t, const std::vector<Transfer>& batch) {
+  Channel* ch = t->channel;
+  bool progressed = false;
+  if (t->is_send) {
+    size_t ready = t->bytes;
+    for (size_t dep : t->deps) {
+      ready = std::min(ready, batch[dep].done);
+    }
+    while (t->done < ready) {
+      uint64_t head = ch->head.load(std::memory_order_relaxed);
+      if (head - ch->tail.load(std::memory_order_acquire) == kSlots) {
+        break;
+      }
+      size_t n = std::min(kSlotBytes, ready - t->done);
+      std::memcpy(ch->data[head % kSlots], t->data + t->done, n);
+      ch->sizes[head % kSlots] = n;
+      ch->head.store(head + 1, std::memory_order_release);
+      t->done += n;
+      progressed = true;
+    }
+  } else {
+    while (t->done < t->bytes) {
+      uint64_t tail = ch->tail.load(std::memory_order_relaxed);
+      if (ch->head.load(std::memory_order_acquire) == tail) {
+        break;
+      }
+      size_t n = std::min<size_t>(ch->sizes[tail % kSlots], t->bytes - t->done);
+      if (t->reduce != nullptr) {
+        t->reduce(t->data + t->done, ch->data[tail % kSlots], n);
+      } else {
+        std::memcpy(t->data + t->done, ch->data[tail % kSlots], n);
+      }
+      ch->tail.store(tail + 1, std::memory_order_release);
+      t->done += n;
+      progressed = true;
+    }
+  }
+  return progressed;
+}
+
+// Drives a batch of transfers to completion. Transfers sharing a channel
+// end run in batch order, so both ends see the same message sequence.
+// Returns false when the peers stall past the timeout, the channels are
+// then left mid-message and the communicator can only be destroyed.
+inline bool RunTransfers(std::vector<Transfer>* batch) {
+  std::vector<std::pair<const Channel*, bool>> busy;
+  Backoff backoff;
+  while (true) {
+    bool pending = false;
+    bool progressed = false;
+    busy.clear();
+    for (auto& t : *batch) {
+      if (t.done == t.bytes) {
+        continue;
+      }
+      pending = true;
+      auto end =
+          std::make_pair(static_cast<const Channel*>(t.channel), t.is_send);
+      if (std::find(busy.begin(), busy.end(), end) != busy.end()) {
+        continue;
+      }
+      busy.push_back(end);
+      progressed |= Advance(&t, *batch);
+    }
+    if (!pending) {
+      return true;
+    }
+    if (progressed) {
+      backoff.Reset();
+    } else if (!backoff.Wait()) {
+      return false;
+    }
+  }
+}
+
+// Point-to-point transfers issued between GroupStart and GroupEnd.
+struct GroupState {
+  int depth = 0;
+  std::vector<Transfer> transfers;
+};
+
+inline GroupState& LocalGroup() {
+  static thread_local GroupState group;
+  return group;
+}
+
+}  // namespace ccl_detail
+
+// A communicator over POSIX shared memory, for ranks on one host.
+//
+// All ranks map the same segment, named after the unique id, and talk
+// through per pair channels (see ccl_detail::Channel). Broadcast and
+// reduce use a pipelined binary tree; all-reduce uses the tree for small
+// messages and a ring reduce-scatter + all-gather for large ones, with
+// consecutive ring steps overlapped chunk by chunk. AVG is a SUM divided
+// by the number of ranks.
+class Communicator {
+ public:
+  // Returns nullptr when the segment cannot be created or not every rank
+  // maps it within the peer timeout.
+  static Communicator* Create(const std::string& id,
+                              size_t nranks,
+                              size_t rank) {
+    const std::string name = "/paddle_custom_cpu_ccl_" + id;
+    const size_t size = sizeof(ccl_detail::SharedHeader) +
+                        nranks * nranks * sizeof(ccl_detail::Channel);
+    int fd = shm_open(name.c_str(), O_CREAT | O_RDWR, 0600);
+    if (fd < 0) {
+      return nullptr;
+    }
+    void* base = MAP_FAILED;
+    if (ftruncate(fd, size) == 0) {
+      base = mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    }
+    close(fd);
+    if (base == MAP_FAILED) {
+      return nullptr;
+    }
+    auto comm = new Communicator(base, size, nranks, rank);
+    // Once everybody has mapped the segment the name is no longer needed.
+    const bool joined = comm->Barrier();
+    shm_unlink(name.c_str());
+    if (!joined) {
+      delete comm;
+      return nullptr;
+    }
+    return comm;
+  }
+
+  ~Communicator() { munmap(base_, size_); }
+
+  Communicator(const Communicator&) = delete;
+  Communicator& operator=(const Communicator&) = delete;
+
+  size_t rank() const { return rank_; }
+  size_t nranks() const { return nranks_; }
+
+  static void GroupStart() { ++ccl_detail::LocalGroup().depth; }
+
+  static C_Status GroupEnd() {
+    auto& group = ccl_detail::LocalGroup();
+    bool done = true;
+    if (--group.depth == 0) {
+      done = ccl_detail::RunTransfers(&group.transfers);
+      group.transfers.clear();
+    }
+    return done ? C_SUCCESS : C_FAILED;
+  }
+
+  C_Status AllReduce(const void* send_buf,
+                     void* recv_buf,
+                     size_t count,
+                     C_DataType dtype,
+                     C_CCLReduceOp op) {
+    auto kernels = ccl_detail::GetReduceKernels(dtype, op);
+    if (!Supported(kernels, dtype, op)) {
+      return C_FAILED;
+    }
+    const size_t bytes = count * kernels.elem_size;
+    if (send_buf != recv_buf) {
+      std::memcpy(recv_buf, send_buf, bytes);
+    }
+    if (nranks_ > 1) {
+      const bool done =
+          bytes <= ccl_detail::kTreeAllReduceBytes
+              ? TreeReduce(recv_buf, bytes, kernels.reduce, 0) &&
+                    TreeBroadcast(recv_buf, bytes, 0)
+              : RingAllReduce(static_cast<char*>(recv_buf), count, kernels);
+      if (!done) {
+        return C_FAILED;
+      }
+    }
+    if (op == C_CCLReduceOp::AVG) {
+      kernels.scale(static_cast<char*>(recv_buf), count, nranks_);
+    }
+    return C_SUCCESS;
+  }
+
+  C_Status Broadcast(void* buf, size_t count, C_DataType dtype, size_t root) {
+    auto kernels = ccl_detail::GetReduceKernels(dtype, C_CCLReduceOp::SUM);
+    if (kernels.elem_size == 0 || root >= nranks_) {
+      return C_FAILED;
+    }
+    return TreeBroadcast(buf, count * kernels.elem_size, root) ? C_SUCCESS
+                                                               : C_FAILED;
+  }
+
+  C_Status Reduce(const void* send_buf,
+                  void* recv_buf,
+                  size_t count,
+                  C_DataType dtype,
+                  C_CCLReduceOp op,
+                  size_t root) {
+    auto kernels = ccl_detail::GetReduceKernels(dtype, op);
+    if (!Supported(kernels, dtype, op) || root >= nranks_) {
+      return C_FAILED;
+    }
+    const size_t bytes = count * kernels.elem_size;
+    // Only the root's receive buffer is valid, the others accumulate in a
+    // scratch copy.
+    std::vector<char> scratch;
+    char* acc = static_cast<char*>(recv_buf);
+    if (rank_ != root) {
+      scratch.resize(bytes);
+      acc = scratch.data();
+    }
+    if (acc != send_buf) {
+      std::memcpy(acc, send_buf, bytes);
+    }
+    if (!TreeReduce(acc, bytes, kernels.reduce, root)) {
+      return C_FAILED;
+    }
+    if (rank_ == root && op == C_CCLReduceOp::AVG) {
+      kernels.scale(acc, count, nranks_);
+    }
+    return C_SUCCESS;
+  }
+
+  // recv_buf holds nranks blocks of `count` elements, block r coming from
+  // rank r.
+  C_Status AllGather(const void* send_buf,
+                     void* recv_buf,
+                     size_t count,
+                     C_DataType dtype) {
+    auto kernels = ccl_detail::GetReduceKernels(dtype, C_CCLReduceOp::SUM);
+    if (kernels.elem_size == 0) {
+      return C_FAILED;
+    }
+    const size_t block = count * kernels.elem_size;
+    auto out = static_cast<char*>(recv_buf);
+    if (out + rank_ * block != send_buf) {
+      std::memmove(out + rank_ * block, send_buf, block);
+    }
+    std::vector<ccl_detail::Transfer> batch;
+    for (size_t s = 0; s + 1 < nranks_; ++s) {
+      const size_t send_block = Ring(rank_, -static_cast<int64_t>(s));
+      const size_t recv_block = Ring(rank_, -static_cast<int64_t>(s) - 1);
+      std::vector<size_t> deps;
+      if (s > 0) {
+        deps.push_back(batch.size() - 1);
+      }
+      batch.push_back(ccl_detail::MakeSend(
+          ToNext(), out + send_block * block, block, std::move(deps)));
+      batch.push_back(
+          ccl_detail::MakeRecv(FromPrev(), out + recv_block * block, block));
+    }
+    return ccl_detail::RunTransfers(&batch) ? C_SUCCESS : C_FAILED;
+  }
+
+  // send_buf holds nranks blocks of `count` elements; rank r receives the
+  // reduction of block r.
+  C_Status ReduceScatter(const void* send_buf,
+                         void* recv_buf,
+                         size_t count,
+                         C_DataType dtype,
+                         C_CCLReduceOp op) {
+    auto kernels = ccl_detail::GetReduceKernels(dtype, op);
+    if (!Supported(kernels, dtype, op)) {
+      return C_FAILED;
+    }
+    const size_t block = count * kernels.elem_size;
+    std::vector<char> acc(static_cast<const char*>(send_buf),
+                          static_cast<const char*>(send_buf) + block * nranks_);
+    std::vector<ccl_detail::Transfer> batch;
+    AppendReduceScatter(acc.data(), block, kernels.reduce, &batch);
+    if (!ccl_detail::RunTransfers(&batch)) {
+      return C_FAILED;
+    }
+    std::memcpy(recv_buf, acc.data() + rank_ * block, block);
+    if (op == C_CCLReduceOp::AVG) {
+      kernels.scale(static_cast<char*>(recv_buf), count, nranks_);
+    }
+    return C_SUCCESS;
+  }
+
+  C_Status Send(const void* buf, size_t count, C_DataType dtype, size_t peer) {
+    auto kernels = ccl_detail::GetReduceKernels(dtype, C_CCLReduceOp::SUM);
+    if (kernels.elem_size == 0 || peer >= nranks_) {
+      return C_FAILED;
+    }
+    return Issue(ccl_detail::MakeSend(
+        channel(rank_, peer), buf, count * kernels.elem_size));
+  }
+
+  C_Status Recv(void* buf, size_t count, C_DataType dtype, size_t peer) {
+    auto kernels = ccl_detail::GetReduceKernels(dtype, C_CCLReduceOp::SUM);
+    if (kernels.elem_size == 0 || peer >= nranks_) {
+      return C_FAILED;
+    }
+    return Issue(ccl_detail::MakeRecv(
+        channel(peer, rank_), buf, count * kernels.elem_size));
+  }
+
+ private:
+  Communicator(void* base, size_t size, size_t nranks, size_t rank)
+      : base_(base), size_(size), nranks_(nranks), rank_(rank) {}
+
+  static bool Supported(const ccl_detail::ReduceKernels& kernels,
+                        C_DataType dtype,
+                        C_CCLReduceOp op) {
+    return kernels.elem_size != 0 &&
+           !(dtype == C_DataType::BOOL && op == C_CCLReduceOp::AVG);
+  }
+
+  ccl_detail::SharedHeader* header() const {
+    return static_cast<ccl_detail::SharedHeader*>(base_);
+  }
+
+  ccl_detail::Channel* channel(size_t src, size_t dst) const {
+    auto first = reinterpret_cast<ccl_detail::Channel*>(
+        static_cast<char*>(base_) + sizeof(ccl_detail::SharedHeader));
+    return first + src * nranks_ + dst;
+  }
+
+  size_t Ring(size_t r, int64_t offset) const {
+    const int64_t n = static_cast<int64_t>(nranks_);
+    return static_cast<size_t>(((static_cast<int64_t>(r) + offset) % n + n) %
+                               n);
+  }
+
+  ccl_detail::Channel* ToNext() const { return channel(rank_, Ring(rank_, 1)); }
+  ccl_detail::Channel* FromPrev() const {
+    return channel(Ring(rank_, -1), rank_);
+  }
+
+  // Returns false when some rank does not arrive within the timeout.
+  bool Barrier() {
+    auto h = header();
+    uint64_t gen = h->generation.load(std::memory_order_acquire);
+    if (h->arrived.fetch_add(1, std::memory_order_acq_rel) + 1 == nranks_) {
+      h->arrived.store(0, std::memory_order_relaxed);
+      h->generation.fetch_add(1, std::memory_order_acq_rel);
+      return true;
+    }
+    ccl_detail::Backoff backoff;
+    while (h->generation.load(std::memory_order_acquire) == gen) {
+      if (!backoff.Wait()) {
+        return false;
+      }
+    }
+    return true;
+  }
+
+  // Runs the transfer now, or at GroupEnd inside a group.
+  C_Status Issue(ccl_detail::Transfer transfer) {
+    auto& group = ccl_detail::LocalGroup();
+    if (group.depth > 0) {
+      group.transfers.push_back(std::move(transfer));
+      return C_SUCCESS;
+    }
+    std::vector<ccl_detail::Transfer> batch;
+    batch.push_back(std::move(transfer));
+    return ccl_detail::RunTransfers(&batch) ? C_SUCCESS : C_FAILED;
+  }
+
+  // Ring reduce-scatter over nranks blocks of acc: at step s a rank sends
+  // block rank-s-1 and reduces block rank-s-2 received from its
+  // predecessor, so after nranks-1 steps block `rank` is complete. Every
+  // send forwards the block reduced by the previous step as it arrives.
+  void AppendReduceScatter(char* acc,
+                           const std::vector<size_t>& offsets,
+                           ccl_detail::ReduceFn reduce,
+                           std::vector<ccl_detail::Transfer>* batch) const {
+    for (size_t s = 0; s + 1 < nranks_; ++s) {
+      const size_t send_block = Ring(rank_, -static_cast<int64_t>(s) - 1);
+      const size_t recv_block = Ring(rank_, -static_cast<int64_t>(s) - 2);
+      std::vector<size_t> deps;
+      if (s > 0) {
+        deps.push_back(batch->size() - 1);
+      }
+      batch->push_back(
+          ccl_detail::MakeSend(ToNext(),
+                               acc + offsets[send_block],
+                               offsets[send_block + 1] - offsets[send_block],
+                               std::move(deps)));
+      batch->push_back(
+          ccl_detail::MakeRecv(FromPrev(),
+                               acc + offsets[recv_block],
+                               offsets[recv_block + 1] - offsets[recv_block],
+                               reduce));
+    }
+  }
+
+  void AppendReduceScatter(char* acc,
+                           size_t block,
+                           ccl_detail::ReduceFn reduce,
+                           std::vector<ccl_detail::Transfer>* batch) const {
+    std::vector<size_t> offsets(nranks_ + 1);
+    for (size_t r = 0; r <= nranks_; ++r) {
+      offsets[r] = r * block;
+    }
+    AppendReduceScatter(acc, offsets, reduce, batch);
+  }
+
+  // Reduce-scatter followed by an all-gather of the reduced segments, in a
+  // single batch so the all-gather starts on the chunks that are final.
+  bool RingAllReduce(char* buf,
+                     size_t count,
+                     const ccl_detail::ReduceKernels& kernels) const {
+    std::vector<size_t> offsets(nranks_ + 1);
+    for (size_t r = 0; r <= nranks_; ++r) {
+      offsets[r] = r * count / nranks_ * kernels.elem_size;
+    }
+    std::vector<ccl_detail::Transfer> batch;
+    AppendReduceScatter(buf, offsets, kernels.reduce, &batch);
+    for (size_t s = 0; s + 1 < nranks_; ++s) {
+      const size_t send_seg = Ring(rank_, -static_cast<int64_t>(s));
+      const size_t recv_seg = Ring(rank_, -static_cast<int64_t>(s) - 1);
+      // Step 0 sends the own segment, completed by the last reduce.
+      std::vector<size_t> deps = {batch.size() - 1};
+      batch.push_back(
+          ccl_detail::MakeSend(ToNext(),
+                               buf + offsets[send_seg],
+                               offsets[send_seg + 1] - offsets[send_seg],
+                               std::move(deps)));
+      batch.push_back(
+          ccl_detail::MakeRecv(FromPrev(),
+                               buf + offsets[recv_seg],
+                               offsets[recv_seg + 1] - offsets[recv_seg]));
+    }
+    return ccl_detail::RunTransfers(&batch);
+  }
+
+  // Binary tree over ranks relative to `root`.
+  size_t Relative(size_t r, size_t root) const {
+    return (r + nranks_ - root) % nranks_;
+  }
+  size_t Absolute(size_t v, size_t root) const { return (v + root) % nranks_; }
+
+  // Reduces every rank's `buf` into the root's. Each rank reduces its
+  // children's data into its own buffer and forwards the chunks that all
+  // children have delivered.
+  bool TreeReduce(void* buf,
+                  size_t bytes,
+                  ccl_detail::ReduceFn reduce,
+                  size_t root) const {
+    const size_t v = Relative(rank_, root);
+    std::vector<ccl_detail::Transfer> batch;
+    std::vector<size_t> deps;
+    for (size_t c = 2 * v + 1; c <= 2 * v + 2 && c < nranks_; ++c) {
+      deps.push_back(batch.size());
+      batch.push_back(ccl_detail::MakeRecv(
+          channel(Absolute(c, root), rank_), buf, bytes, reduce));
+    }
+    if (v > 0) {
+      batch.push_back(ccl_detail::MakeSend(
+          channel(rank_, Absolute((v - 1) / 2, root)), buf, bytes, deps));
+    }
+    return ccl_detail::RunTransfers(&batch);
+  }
+
+  bool TreeBroadcast(void* buf, size_t bytes, size_t root) const {
+    const size_t v = Relative(rank_, root);
+    std::vector<ccl_detail::Transfer> batch;
+    std::vector<size_t> deps;
+    if (v > 0) {
+      deps.push_back(batch.size());
+      batch.push_back(ccl_detail::MakeRecv(
+          channel(Absolute((v - 1) / 2, root), rank_), buf, bytes));
+    }
+    for (size_t c = 2 * v + 1; c <= 2 * v + 2 && c < nranks_; ++c) {
+      batch.push_back(ccl_detail::MakeSend(
+          channel(rank_, Absolute(c, root)), buf, bytes, deps));
+    }
+    return ccl_detail::RunTransfers(&batch);
+  }
+
+  void* base_;
+  size_t size_;
+  size_t nranks_;
+  size_t rank_;
+};
+
+}  // namespace custom_cpu
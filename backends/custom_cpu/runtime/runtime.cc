@@ -14,22 +14,44 @@
 
 #include <errno.h>
 #include <fcntl.h>
-#include <semaphore.h>
 #include <sys/types.h>
 #include <sys/wait.h>
 #include <unistd.h>
 
+#include <algorithm>
 #include <cstdint>
 #include <cstdio>
+#include <cstdlib>
 #include <cstring>
 #include <iostream>
-
+#include <memory>
+#include <mutex>
+#include <random>
+#include <string>
+#include <unordered_set>
+#include <vector>
+
+#include "paddle/phi/api/profiler/trace_event.h"
 #include "paddle/phi/backends/device_ext.h"
-
-#define MEMORY_FRACTION 0.5f
+#include "runtime/allocator.h"
+#include "runtime/ccl.h"
+#include "runtime/stream.h"
+#include "runtime/tracer.h"
 
 static int global_current_device = 0;
 
+// Every live stream, so that SyncDevice can drain the streams of a device.
+static std::mutex global_streams_mutex;
+static std::unordered_set<custom_cpu::Stream *> global_streams;
+
+static custom_cpu::Stream *ToStream(C_Stream stream) {
+  return reinterpret_cast<custom_cpu::Stream *>(stream);
+}
+
+static custom_cpu::Event *ToEvent(C_Event event) {
+  return reinterpret_cast<custom_cpu::Event *>(event);
+}
+
 C_Status Init() {
   std::cout << "custom_cpu plugin compiled with ";
 #ifdef __clang__
@@ -57,7 +79,21 @@ C_Status GetDevice(const C_Device device) {
 
 C_Status DestroyDevice(const C_Device device) { return C_SUCCESS; }
 
-C_Status Finalize() { return C_SUCCESS; }
+C_Status Finalize() {
+  // CUSTOM_CPU_MEMORY_STATS=1 prints the allocator counters at exit.
+  const char *env = std::getenv("CUSTOM_CPU_MEMORY_STATS");
+  if (env != nullptr && std::string(env) == "1") {
+    auto stats = custom_cpu::CachingAllocator::Instance().Stats();
+    std::cout << "custom_cpu memory: limit " << stats.limit << " B, allocated "
+              << stats.allocated << " B (peak " << stats.peak_allocated
+              << " B), reserved " << stats.reserved << " B (peak "
+              << stats.peak_reserved << " B), cached " << stats.cached
+              << " B, available " << stats.available() << " B, fragmentation "
+              << stats.fragmentation() << ", " << stats.num_allocs
+              << " allocations, " << stats.num_cache_hits << " cache hits\n";
+  }
+  return C_SUCCESS;
+}
 
 C_Status GetDevicesCount(size_t *count) {
   *count = 2;
@@ -70,20 +106,109 @@ C_Status GetDevicesList(size_t *devices) {
   return C_SUCCESS;
 }
 
-C_Status MemCpy(const C_Device device,
-                void *dst,
-                const void *src,
-                size_t size) {
+static uint64_t StreamId(C_Stream stream) {
+  return stream ? ToStream(stream)->id() : 0;
+}
+
+// A memcpy traced as a copy of kind `kind`, e.g. MEMCPY_HtoD.
+static void TracedCopy(
+    const char *kind,
+    int device_id,
+    uint64_t stream_id,
+    void *dst,
+    const void *src,
+    size_t size,
+    custom_cpu::TraceOrigin origin = custom_cpu::TraceOrigin()) {
+  custom_cpu::TraceScope trace(custom_cpu::TraceRecord::Kind::kMemcpy,
+                               kind,
+                               device_id,
+                               stream_id,
+                               size,
+                               origin);
   memcpy(dst, src, size);
+}
+
+C_Status MemCpyH2D(const C_Device device,
+                   void *dst,
+                   const void *src,
+                   size_t size) {
+  TracedCopy("MEMCPY_HtoD", device->id, 0, dst, src, size);
   return C_SUCCESS;
 }
 
-C_Status AsyncMemCpy(const C_Device device,
-                     C_Stream stream,
-                     void *dst,
-                     const void *src,
-                     size_t size) {
-  memcpy(dst, src, size);
+C_Status MemCpyD2H(const C_Device device,
+                   void *dst,
+                   const void *src,
+                   size_t size) {
+  TracedCopy("MEMCPY_DtoH", device->id, 0, dst, src, size);
+  return C_SUCCESS;
+}
+
+C_Status MemCpyD2D(const C_Device device,
+                   void *dst,
+                   const void *src,
+                   size_t size) {
+  TracedCopy("MEMCPY_DtoD", device->id, 0, dst, src, size);
+  return C_SUCCESS;
+}
+
+// Asynchronous copies follow the semantics of a device copying from or
+// to pageable host memory: the host source of an H2D copy is staged before
+// returning, so the caller may reuse it right away, and a D2H copy returns
+// once the data has landed. Copies between device buffers are queued.
+C_Status AsyncMemCpyH2D(const C_Device device,
+                        C_Stream stream,
+                        void *dst,
+                        const void *src,
+                        size_t size) {
+  if (stream == nullptr) {
+    TracedCopy("MEMCPY_HtoD", device->id, 0, dst, src, size);
+    return C_SUCCESS;
+  }
+  auto staging = std::make_shared<std::vector<char>>(
+      static_cast<const char *>(src), static_cast<const char *>(src) + size);
+  int device_id = device->id;
+  uint64_t stream_id = StreamId(stream);
+  auto origin = custom_cpu::TraceOrigin::Here();
+  ToStream(stream)->Enqueue([=] {
+    TracedCopy("MEMCPY_HtoD",
+               device_id,
+               stream_id,
+               dst,
+               staging->data(),
+               staging->size(),
+               origin);
+  });
+  return C_SUCCESS;
+}
+
+C_Status AsyncMemCpyD2D(const C_Device device,
+                        C_Stream stream,
+                        void *dst,
+                        const void *src,
+                        size_t size) {
+  if (stream == nullptr) {
+    TracedCopy("MEMCPY_DtoD", device->id, 0, dst, src, size);
+    return C_SUCCESS;
+  }
+  int device_id = device->id;
+  uint64_t stream_id = StreamId(stream);
+  auto origin = custom_cpu::TraceOrigin::Here();
+  ToStream(stream)->Enqueue([=] {
+    TracedCopy("MEMCPY_DtoD", device_id, stream_id, dst, src, size, origin);
+  });
+  return C_SUCCESS;
+}
+
+C_Status AsyncMemCpyD2H(const C_Device device,
+                        C_Stream stream,
+                        void *dst,
+                        const void *src,
+                        size_t size) {
+  if (stream != nullptr) {
+    ToStream(stream)->Synchronize();
+  }
+  TracedCopy("MEMCPY_DtoH", device->id, StreamId(stream), dst, src, size);
   return C_SUCCESS;
 }
 
@@ -92,7 +217,7 @@ C_Status MemCpyP2P(const C_Device dst_device,
                    void *dst,
                    const void *src,
                    size_t size) {
-  memcpy(dst, src, size);
+  TracedCopy("MEMCPY_PtoP", dst_device->id, 0, dst, src, size);
   return C_SUCCESS;
 }
 
@@ -102,12 +227,16 @@ C_Status AsyncMemCpyP2P(const C_Device dst_device,
                         void *dst,
                         const void *src,
                         size_t size) {
-  memcpy(dst, src, size);
-  return C_SUCCESS;
+  return AsyncMemCpyD2D(src_device, stream, dst, src, size);
 }
 
 C_Status Allocate(const C_Device device, void **ptr, size_t size) {
-  auto data = malloc(size);
+  custom_cpu::TraceScope trace(custom_cpu::TraceRecord::Kind::kAllocate,
+                               "Allocate",
+                               device->id,
+                               0,
+                               size);
+  auto data = custom_cpu::CachingAllocator::Instance().Allocate(size);
   if (data) {
     *ptr = data;
     return C_SUCCESS;
@@ -117,69 +246,123 @@ C_Status Allocate(const C_Device device, void **ptr, size_t size) {
   return C_FAILED;
 }
 
+// No device sync here: Paddle's stream-safe allocator frees a buffer only
+// once the streams that used it are done with it, and frees may come from
+// stream workers and callbacks, which must not wait for any stream.
 C_Status Deallocate(const C_Device device, void *ptr, size_t size) {
-  free(ptr);
+  custom_cpu::TraceScope trace(
+      custom_cpu::TraceRecord::Kind::kFree, "Free", device->id, 0, size);
+  custom_cpu::CachingAllocator::Instance().Free(ptr);
   return C_SUCCESS;
 }
 
 C_Status CreateStream(const C_Device device, C_Stream *stream) {
-  stream = nullptr;
+  auto cpu_stream = new custom_cpu::Stream(device->id);
+  {
+    std::lock_guard<std::mutex> lock(global_streams_mutex);
+    global_streams.insert(cpu_stream);
+  }
+  *stream = reinterpret_cast<C_Stream>(cpu_stream);
   return C_SUCCESS;
 }
 
 C_Status DestroyStream(const C_Device device, C_Stream stream) {
+  {
+    std::lock_guard<std::mutex> lock(global_streams_mutex);
+    global_streams.erase(ToStream(stream));
+  }
+  delete ToStream(stream);
+  return C_SUCCESS;
+}
+
+C_Status QueryStream(const C_Device device, C_Stream stream) {
+  if (stream == nullptr || ToStream(stream)->Query()) {
+    return C_SUCCESS;
+  }
+  return C_FAILED;
+}
+
+C_Status AddCallback(const C_Device device,
+                     C_Stream stream,
+                     C_Callback callback,
+                     void *user_data) {
+  if (stream == nullptr) {
+    C_Status status;
+    callback(device, stream, user_data, &status);
+    return C_SUCCESS;
+  }
+  C_Device_st callback_device = *device;
+  ToStream(stream)->Enqueue([callback_device, stream, callback, user_data] {
+    C_Device_st device = callback_device;
+    C_Status status;
+    callback(&device, stream, user_data, &status);
+  });
   return C_SUCCESS;
 }
 
 C_Status CreateEvent(const C_Device device, C_Event *event) {
+  *event = reinterpret_cast<C_Event>(new custom_cpu::Event());
   return C_SUCCESS;
 }
 
 C_Status RecordEvent(const C_Device device, C_Stream stream, C_Event event) {
+  ToEvent(event)->Record(ToStream(stream));
   return C_SUCCESS;
 }
 
 C_Status DestroyEvent(const C_Device device, C_Event event) {
+  delete ToEvent(event);
   return C_SUCCESS;
 }
 
-C_Status SyncDevice(const C_Device device) { return C_SUCCESS; }
+C_Status QueryEvent(const C_Device device, C_Event event) {
+  return ToEvent(event)->Query() ? C_SUCCESS : C_FAILED;
+}
+
+C_Status SyncDevice(const C_Device device) {
+  std::lock_guard<std::mutex> lock(global_streams_mutex);
+  for (auto stream : global_streams) {
+    if (stream->device_id() == device->id) {
+      stream->Synchronize();
+    }
+  }
+  return C_SUCCESS;
+}
 
 C_Status SyncStream(const C_Device device, C_Stream stream) {
+  if (stream != nullptr) {
+    ToStream(stream)->Synchronize();
+  }
   return C_SUCCESS;
 }
 
-C_Status SyncEvent(const C_Device device, C_Event event) { return C_SUCCESS; }
+C_Status SyncEvent(const C_Device device, C_Event event) {
+  ToEvent(event)->Synchronize();
+  return C_SUCCESS;
+}
 
 C_Status StreamWaitEvent(const C_Device device,
                          C_Stream stream,
                          C_Event event) {
+  if (stream == nullptr) {
+    ToEvent(event)->Synchronize();
+  } else {
+    ToEvent(event)->Block(ToStream(stream));
+  }
   return C_SUCCESS;
 }
 
 C_Status VisibleDevices(size_t *devices) { return C_SUCCESS; }
 
+// Both devices share the host memory behind the caching allocator, so
+// they report its limit as total memory and what is available under it as
+// free.
 C_Status DeviceMemStats(const C_Device device,
                         size_t *total_memory,
                         size_t *free_memory) {
-  float memusage;
-  FILE *fp;
-  char buffer[1024];
-  size_t byte_read;
-  char *pos;
-
-  fp = fopen("/proc/meminfo", "r");
-  byte_read = fread(buffer, 1, sizeof(buffer), fp);
-  fclose(fp);
-  buffer[byte_read] = '\0';
-  pos = strstr(buffer, "MemTotal:");
-  sscanf(pos, "MemTotal: %lu kB", total_memory);
-  pos = strstr(pos, "MemFree:");
-  sscanf(pos, "MemFree: %lu kB", free_memory);
-  *total_memory = *total_memory * 1024;
-  *free_memory = *free_memory * 1024;
-  *free_memory = *free_memory * MEMORY_FRACTION;
-
+  auto stats = custom_cpu::CachingAllocator::Instance().Stats();
+  *total_memory = stats.limit;
+  *free_memory = stats.available();
   return C_SUCCESS;
 }
 
@@ -188,25 +371,27 @@ C_Status DeviceMinChunkSize(const C_Device device, size_t *size) {
   return C_SUCCESS;
 }
 
-struct C_CCLComm_st {
-  size_t rank;
-  size_t nranks;
-  sem_t *sig;
-  sem_t *sig_2;
-  std::string sig_name;
-  std::string sig_2_name;
-};
+// Communicators live in shared memory, see runtime/ccl.h.
+static custom_cpu::Communicator *ToComm(C_CCLComm comm) {
+  return reinterpret_cast<custom_cpu::Communicator *>(comm);
+}
 
 // for unittest
 C_Status XcclGetUniqueIdSize(size_t *sz) {
-  *sz = sizeof(size_t);
+  *sz = 16;
   return C_SUCCESS;
 }
 
+// The id names the shared memory segment of the communicator, so it must
+// not repeat across jobs.
 C_Status XcclGetUniqueId(C_CCLRootId *unique_id) {
-  auto ptr = reinterpret_cast<int8_t *>(unique_id->data);
-  for (auto i = 0; i < unique_id->sz - 1; ++i) {
-    ptr[i] = static_cast<int8_t>(std::rand() % ('z' - 'a') + 'a');
+  static std::mutex mutex;
+  static std::mt19937_64 engine(std::random_device{}() ^
+                                static_cast<uint64_t>(getpid()));
+  std::lock_guard<std::mutex> lock(mutex);
+  auto ptr = reinterpret_cast<char *>(unique_id->data);
+  for (size_t i = 0; i + 1 < unique_id->sz; ++i) {
+    ptr[i] = static_cast<char>('a' + engine() % 26);
   }
   ptr[unique_id->sz - 1] = '\0';
   return C_SUCCESS;
@@ -216,28 +401,21 @@ C_Status XcclCommInitRank(size_t ranks,
                           C_CCLRootId *unique_id,
                           size_t rank,
                           C_CCLComm *comm) {
-  auto sig = sem_open(static_cast<char *>(unique_id->data), O_CREAT, 0644, 0);
-  auto sig_2 =
-      sem_open(static_cast<char *>(unique_id->data) + 1, O_CREAT, 0644, 0);
-  *comm =
-      new C_CCLComm_st({rank,
-                        ranks,
-                        sig,
-                        sig_2,
-                        std::string(static_cast<char *>(unique_id->data)),
-                        std::string(static_cast<char *>(unique_id->data) + 1)});
+  auto communicator = custom_cpu::Communicator::Create(
+      std::string(static_cast<char *>(unique_id->data)), ranks, rank);
+  if (communicator == nullptr) {
+    return C_FAILED;
+  }
+  *comm = reinterpret_cast<C_CCLComm>(communicator);
   return C_SUCCESS;
 }
 
 C_Status XcclDestroyComm(C_CCLComm comm) {
-  if (comm) {
-    sem_unlink(comm->sig_name.c_str());
-    sem_unlink(comm->sig_2_name.c_str());
-    delete comm;
-  }
+  delete ToComm(comm);
   return C_SUCCESS;
 }
 
+// Collectives run on the host, in stream order like kernels.
 C_Status XcclAllReduce(void *send_buf,
                        void *recv_buf,
                        size_t count,
@@ -245,20 +423,8 @@ C_Status XcclAllReduce(void *send_buf,
                        C_CCLReduceOp op,
                        C_CCLComm comm,
                        C_Stream stream) {
-  sem_post(comm->sig);
-
-  if (comm->rank == 0) {
-    for (auto i = 0; i < comm->nranks; ++i) {
-      sem_wait(comm->sig);
-    }
-
-    for (auto i = 0; i < comm->nranks; ++i) {
-      sem_post(comm->sig_2);
-    }
-  }
-
-  sem_wait(comm->sig_2);
-  return C_SUCCESS;
+  custom_cpu::StreamLaunchGuard launch(stream, __func__);
+  return ToComm(comm)->AllReduce(send_buf, recv_buf, count, data_type, op);
 }
 
 C_Status XcclBroadcast(void *buf,
@@ -267,39 +433,165 @@ C_Status XcclBroadcast(void *buf,
                        size_t root,
                        C_CCLComm comm,
                        C_Stream stream) {
-  sem_post(comm->sig);
+  custom_cpu::StreamLaunchGuard launch(stream, __func__);
+  return ToComm(comm)->Broadcast(buf, count, data_type, root);
+}
 
-  if (comm->rank == 0) {
-    for (auto i = 0; i < comm->nranks; ++i) {
-      sem_wait(comm->sig);
-    }
+C_Status XcclReduce(void *send_buf,
+                    void *recv_buf,
+                    size_t count,
+                    C_DataType data_type,
+                    C_CCLReduceOp op,
+                    size_t root,
+                    C_CCLComm comm,
+                    C_Stream stream) {
+  custom_cpu::StreamLaunchGuard launch(stream, __func__);
+  return ToComm(comm)->Reduce(send_buf, recv_buf, count, data_type, op, root);
+}
 
-    for (auto i = 0; i < comm->nranks; ++i) {
-      sem_post(comm->sig_2);
-    }
-  }
+C_Status XcclAllGather(void *send_buf,
+                       void *recv_buf,
+                       size_t count,
+                       C_DataType data_type,
+                       C_CCLComm comm,
+                       C_Stream stream) {
+  custom_cpu::StreamLaunchGuard launch(stream, __func__);
+  return ToComm(comm)->AllGather(send_buf, recv_buf, count, data_type);
+}
+
+C_Status XcclReduceScatter(void *send_buf,
+                           void *recv_buf,
+                           size_t count,
+                           C_DataType data_type,
+                           C_CCLReduceOp op,
+                           C_CCLComm comm,
+                           C_Stream stream) {
+  custom_cpu::StreamLaunchGuard launch(stream, __func__);
+  return ToComm(comm)->ReduceScatter(send_buf, recv_buf, count, data_type, op);
+}
 
-  sem_wait(comm->sig_2);
+// Sends and receives between group start and end are deferred and then
+// progressed together, so exchanges in both directions cannot deadlock.
+C_Status XcclGroupStart() {
+  custom_cpu::Communicator::GroupStart();
   return C_SUCCESS;
 }
 
+C_Status XcclGroupEnd() { return custom_cpu::Communicator::GroupEnd(); }
+
+C_Status XcclSend(void *send_buf,
+                  size_t count,
+                  C_DataType data_type,
+                  size_t dest_rank,
+                  C_CCLComm comm,
+                  C_Stream stream) {
+  custom_cpu::StreamLaunchGuard launch(stream, __func__);
+  return ToComm(comm)->Send(send_buf, count, data_type, dest_rank);
+}
+
+C_Status XcclRecv(void *recv_buf,
+                  size_t count,
+                  C_DataType data_type,
+                  size_t src_rank,
+                  C_CCLComm comm,
+                  C_Stream stream) {
+  custom_cpu::StreamLaunchGuard launch(stream, __func__);
+  return ToComm(comm)->Recv(recv_buf, count, data_type, src_rank);
+}
+
+// The profiler reports what the tracer (runtime/tracer.h) recorded.
+// Kernels and copies become device events on the lane of their stream,
+// paired through the correlation id with a runtime event for the launch
+// on the issuing thread; Paddle drops device events without one.
+// Allocations and frees are runtime events of their own.
 C_Status ProfilerInitialize(C_Profiler prof, void **user_data) {
+  custom_cpu::Tracer::Instance();
   return C_SUCCESS;
 }
 
 C_Status ProfilerFinalize(C_Profiler prof, void *user_data) {
+  custom_cpu::Tracer::Enable(false);
   return C_SUCCESS;
 }
 
-C_Status ProfilerPrepare(C_Profiler prof, void *user_data) { return C_SUCCESS; }
+C_Status ProfilerPrepare(C_Profiler prof, void *user_data) {
+  // Leftovers of an earlier session that was never collected.
+  custom_cpu::Tracer::Instance().Drain([](const custom_cpu::TraceRecord &) {});
+  custom_cpu::Tracer::Instance().TakeDropped();
+  return C_SUCCESS;
+}
 
-C_Status ProfilerStart(C_Profiler prof, void *user_data) { return C_SUCCESS; }
+C_Status ProfilerStart(C_Profiler prof, void *user_data) {
+  custom_cpu::Tracer::Enable(true);
+  return C_SUCCESS;
+}
 
-C_Status ProfilerStop(C_Profiler prof, void *user_data) { return C_SUCCESS; }
+C_Status ProfilerStop(C_Profiler prof, void *user_data) {
+  custom_cpu::Tracer::Enable(false);
+  return C_SUCCESS;
+}
 
 C_Status ProfilerCollectData(C_Profiler prof,
                              uint64_t start_ns,
                              void *user_data) {
+  using Kind = custom_cpu::TraceRecord::Kind;
+  static uint32_t correlation_id = 0;
+  const uint64_t pid = getpid();
+  auto &tracer = custom_cpu::Tracer::Instance();
+  tracer.Drain([&](const custom_cpu::TraceRecord &record) {
+    if (record.start_ns < start_ns) {
+      return;
+    }
+    ++correlation_id;
+    if (record.kind == Kind::kAllocate || record.kind == Kind::kFree) {
+      phi::RuntimeTraceEvent event(std::string(record.name) + " (" +
+                                       std::to_string(record.bytes) + " B)",
+                                   record.start_ns,
+                                   record.end_ns,
+                                   pid,
+                                   record.thread_id,
+                                   correlation_id,
+                                   0);
+      profiler_add_runtime_trace_event(prof, &event);
+      return;
+    }
+    // Synchronous work launches for as long as it runs, queued work only
+    // for the moment it was issued.
+    phi::RuntimeTraceEvent launch(
+        record.kind == Kind::kKernel ? "LaunchKernel" : "Memcpy",
+        record.launch_ns,
+        record.launch_ns == record.start_ns ? record.end_ns : record.launch_ns,
+        pid,
+        record.thread_id,
+        correlation_id,
+        0);
+    profiler_add_runtime_trace_event(prof, &launch);
+    phi::DeviceTraceEvent event;
+    event.name = record.name;
+    event.start_ns = record.start_ns;
+    event.end_ns = record.end_ns;
+    event.device_id = record.device_id;
+    event.context_id = 0;
+    event.stream_id = record.stream_id;
+    event.correlation_id = correlation_id;
+    if (record.kind == Kind::kKernel) {
+      event.type = phi::TracerEventType::Kernel;
+      event.kernel_info = phi::KernelEventInfo();
+      event.kernel_info.completed = record.end_ns;
+    } else {
+      event.type = phi::TracerEventType::Memcpy;
+      event.memcpy_info = phi::MemcpyEventInfo();
+      event.memcpy_info.num_bytes = record.bytes;
+      snprintf(
+          event.memcpy_info.copy_kind, phi::kMemKindMaxLen, "%s", record.name);
+    }
+    profiler_add_device_trace_event(prof, &event);
+  });
+  if (uint64_t dropped = tracer.TakeDropped()) {
+    std::cerr << "custom_cpu profiler dropped " << dropped
+              << " records, raise CUSTOM_CPU_TRACE_BUFFER_SIZE to keep them"
+              << std::endl;
+  }
   return C_SUCCESS;
 }
 
@@ -322,23 +614,26 @@ void InitPlugin(CustomRuntimeParams *params) {
 
   params->interface->create_stream = CreateStream;
   params->interface->destroy_stream = DestroyStream;
+  params->interface->query_stream = QueryStream;
+  params->interface->stream_add_callback = AddCallback;
 
   params->interface->create_event = CreateEvent;
   params->interface->destroy_event = DestroyEvent;
   params->interface->record_event = RecordEvent;
+  params->interface->query_event = QueryEvent;
 
   params->interface->synchronize_device = SyncDevice;
   params->interface->synchronize_stream = SyncStream;
   params->interface->synchronize_event = SyncEvent;
   params->interface->stream_wait_event = StreamWaitEvent;
 
-  params->interface->memory_copy_h2d = MemCpy;
-  params->interface->memory_copy_d2d = MemCpy;
-  params->interface->memory_copy_d2h = MemCpy;
+  params->interface->memory_copy_h2d = MemCpyH2D;
+  params->interface->memory_copy_d2d = MemCpyD2D;
+  params->interface->memory_copy_d2h = MemCpyD2H;
   params->interface->memory_copy_p2p = MemCpyP2P;
-  params->interface->async_memory_copy_h2d = AsyncMemCpy;
-  params->interface->async_memory_copy_d2d = AsyncMemCpy;
-  params->interface->async_memory_copy_d2h = AsyncMemCpy;
+  params->interface->async_memory_copy_h2d = AsyncMemCpyH2D;
+  params->interface->async_memory_copy_d2d = AsyncMemCpyD2D;
+  params->interface->async_memory_copy_d2h = AsyncMemCpyD2H;
   params->interface->async_memory_copy_p2p = AsyncMemCpyP2P;
   params->interface->device_memory_allocate = Allocate;
   params->interface->host_memory_allocate = Allocate;
@@ -358,6 +653,13 @@ void InitPlugin(CustomRuntimeParams *params) {
   params->interface->xccl_destroy_comm = XcclDestroyComm;
   params->interface->xccl_all_reduce = XcclAllReduce;
   params->interface->xccl_broadcast = XcclBroadcast;
+  params->interface->xccl_reduce = XcclReduce;
+  params->interface->xccl_all_gather = XcclAllGather;
+  params->interface->xccl_reduce_scatter = XcclReduceScatter;
+  params->interface->xccl_group_start = XcclGroupStart;
+  params->interface->xccl_group_end = XcclGroupEnd;
+  params->interface->xccl_send = XcclSend;
+  params->interface->xccl_recv = XcclRecv;
 
   params->interface->profiler_collect_trace_data = ProfilerCollectData;
   params->interface->profiler_initialize = ProfilerInitialize;
@@ -0,0 +1,263 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <cstdint>
+#include <deque>
+#include <functional>
+#include <memory>
+#include <mutex>
+#include <thread>
+#include <utility>
+
+#include "runtime/tracer.h"
+
+namespace custom_cpu {
+
+// A custom_cpu stream: an in-order task queue drained by a dedicated
+// worker thread, so work on different streams overlaps the same way it
+// does on a real device.
+//
+// Besides queued tasks, a host thread may claim the stream with Acquire()
+// and run work itself. The claim is granted once everything queued before
+// it has executed, and holds back later tasks until Release(). This is
+// how kernels are launched: they take their place in the stream order but
+// stay synchronous for the launching thread.
+class Stream {
+ public:
+  using Task = std::function<void()>;
+
+  explicit Stream(int device_id)
+      : device_id_(device_id), id_(NextId()), worker_([this] { Loop(); }) {}
+
+  ~Stream() {
+    {
+      std::unique_lock<std::mutex> lock(mutex_);
+      idle_cv_.wait(lock, [this] { return queue_.empty() && !busy_; });
+      stop_ = true;
+    }
+    work_cv_.notify_all();
+    worker_.join();
+  }
+
+  Stream(const Stream&) = delete;
+  Stream& operator=(const Stream&) = delete;
+
+  int device_id() const { return device_id_; }
+
+  // Process wide, nonzero; names the stream in profiler traces.
+  uint64_t id() const { return id_; }
+
+  void Enqueue(Task task) {
+    {
+      std::lock_guard<std::mutex> lock(mutex_);
+      queue_.push_back(std::move(task));
+    }
+    work_cv_.notify_one();
+  }
+
+  // Blocks until every task enqueued so far has executed. A thread that
+  // holds the stream returns at once, as all earlier work is done.
+  void Synchronize() {
+    if (ClaimedStream() == this) {
+      return;
+    }
+    std::unique_lock<std::mutex> lock(mutex_);
+    idle_cv_.wait(lock, [this] { return queue_.empty() && !busy_; });
+  }
+
+  // True when no task is queued or running.
+  bool Query() {
+    std::lock_guard<std::mutex> lock(mutex_);
+    return queue_.empty() && !busy_;
+  }
+
+  // Returns false, without claiming anything, when the calling thread
+  // already holds the stream, so kernels calling other kernels nest.
+  bool Acquire() {
+    if (ClaimedStream() == this) {
+      return false;
+    }
+    {
+      std::unique_lock<std::mutex> lock(mutex_);
+      idle_cv_.wait(lock, [this] { return queue_.empty() && !busy_; });
+      busy_ = true;
+    }
+    ClaimedStream() = this;
+    return true;
+  }
+
+  void Release() {
+    ClaimedStream() = nullptr;
+    {
+      std::lock_guard<std::mutex> lock(mutex_);
+      busy_ = false;
+    }
+    work_cv_.notify_one();
+    idle_cv_.notify_all();
+  }
+
+ private:
+  static uint64_t NextId() {
+    static std::atomic<uint64_t> next{1};
+    return next.fetch_add(1, std::memory_order_relaxed);
+  }
+
+  static Stream*& ClaimedStream() {
+    static thread_local Stream* stream = nullptr;
+    return stream;
+  }
+
+  void Loop() {
+    std::unique_lock<std::mutex> lock(mutex_);
+    while (true) {
+      work_cv_.wait(lock,
+                    [this] { return stop_ || (!queue_.empty() && !busy_); });
+      if (stop_) {
+        return;
+      }
+      Task task = std::move(queue_.front());
+      queue_.pop_front();
+      busy_ = true;
+      lock.unlock();
+      task();
+      lock.lock();
+      busy_ = false;
+      if (queue_.empty()) {
+        idle_cv_.notify_all();
+      }
+    }
+  }
+
+  const int device_id_;
+  const uint64_t id_;
+  std::mutex mutex_;
+  std::condition_variable work_cv_;
+  std::condition_variable idle_cv_;
+  std::deque<Task> queue_;
+  bool busy_ = false;
+  bool stop_ = false;
+  std::thread worker_;
+};
+
+// An event marks a point in a stream. Record() enqueues a marker that
+// completes the event when the stream reaches it; Synchronize() and
+// Block() wait for the most recent record. The state is shared with the
+// queued markers, so an event can be destroyed while they are pending.
+class Event {
+ public:
+  Event() : state_(std::make_shared<State>()) {}
+
+  void Record(Stream* stream) {
+    uint64_t seq;
+    {
+      std::lock_guard<std::mutex> lock(state_->mutex);
+      seq = ++state_->recorded;
+    }
+    if (stream == nullptr) {
+      Complete(state_, seq);
+      return;
+    }
+    auto state = state_;
+    stream->Enqueue([state, seq] { Complete(state, seq); });
+  }
+
+  bool Query() {
+    std::lock_guard<std::mutex> lock(state_->mutex);
+    return state_->completed >= state_->recorded;
+  }
+
+  void Synchronize() { Wait(state_, Target()); }
+
+  // Makes all work enqueued on `stream` from now on wait for the event.
+  void Block(Stream* stream) {
+    uint64_t target = Target();
+    auto state = state_;
+    stream->Enqueue([state, target] { Wait(state, target); });
+  }
+
+ private:
+  struct State {
+    std::mutex mutex;
+    std::condition_variable cv;
+    uint64_t recorded = 0;
+    uint64_t completed = 0;
+  };
+
+  uint64_t Target() {
+    std::lock_guard<std::mutex> lock(state_->mutex);
+    return state_->recorded;
+  }
+
+  static void Complete(const std::shared_ptr<State>& state, uint64_t seq) {
+    {
+      std::lock_guard<std::mutex> lock(state->mutex);
+      state->completed = std::max(state->completed, seq);
+    }
+    state->cv.notify_all();
+  }
+
+  static void Wait(const std::shared_ptr<State>& state, uint64_t target) {
+    std::unique_lock<std::mutex> lock(state->mutex);
+    state->cv.wait(lock, [&] { return state->completed >= target; });
+  }
+
+  std::shared_ptr<State> state_;
+};
+
+// Launches a kernel on the stream of its device context for the lifetime
+// of the guard, see Stream::Acquire(). A null stream runs immediately.
+// While profiling, the kernel is traced under `name`, which must outlive
+// the session; kernels pass __func__.
+class StreamLaunchGuard {
+ public:
+  StreamLaunchGuard(void* stream, const char* name)
+      : claim_(static_cast<Stream*>(stream)),
+        trace_(TraceRecord::Kind::kKernel,
+               name,
+               stream ? static_cast<Stream*>(stream)->device_id() : 0,
+               stream ? static_cast<Stream*>(stream)->id() : 0) {}
+
+  StreamLaunchGuard(const StreamLaunchGuard&) = delete;
+  StreamLaunchGuard& operator=(const StreamLaunchGuard&) = delete;
+
+ private:
+  // Declared before trace_, so the kernel's end is recorded before the
+  // stream is handed back.
+  class Claim {
+   public:
+    explicit Claim(Stream* stream) : stream_(stream) {
+      if (stream_ != nullptr && !stream_->Acquire()) {
+        stream_ = nullptr;
+      }
+    }
+    ~Claim() {
+      if (stream_ != nullptr) {
+        stream_->Release();
+      }
+    }
+
+   private:
+    Stream* stream_;
+  };
+
+  Claim claim_;
+  TraceScope trace_;
+};
+
+}  // namespace custom_cpu
@@ -0,0 +1,218 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#pragma once
+
+#include <sys/syscall.h>
+#include <time.h>
+#include <unistd.h>
+
+#include <algorithm>
+#include <atomic>
+#include <cstdint>
+#include <cstdlib>
+#include <memory>
+
+namespace custom_cpu {
+
+// One traced activity. `name` must point to storage that outlives the
+// profiling session, e.g. a string literal or __func__.
+struct TraceRecord {
+  enum class Kind : uint8_t { kKernel, kMemcpy, kAllocate, kFree };
+
+  Kind kind;
+  const char* name;
+  uint64_t start_ns;
+  uint64_t end_ns;
+  uint64_t device_id;
+  uint64_t stream_id;  // 0 for work that is not on a stream
+  uint64_t launch_ns;  // when the host issued the work
+  uint64_t thread_id;  // the issuing thread
+  uint64_t bytes;      // copied, allocated or freed bytes
+};
+
+// Collects TraceRecords while a profiling session runs.
+//
+// Records go into a bounded multi producer ring (Vyukov's queue): kernels
+// and copies on any thread publish with one compare-and-swap and never
+// block, and ProfilerCollectData drains the ring from a single thread.
+// When the ring is full new records are dropped and counted rather than
+// stalling the traced code. The capacity is CUSTOM_CPU_TRACE_BUFFER_SIZE
+// records, 65536 by default.
+class Tracer {
+ public:
+  static Tracer& Instance() {
+    static Tracer* tracer = new Tracer();
+    return *tracer;
+  }
+
+  // Cheap enough to guard every record site.
+  static bool Enabled() {
+    return EnabledFlag().load(std::memory_order_relaxed);
+  }
+
+  static void Enable(bool enabled) {
+    EnabledFlag().store(enabled, std::memory_order_relaxed);
+  }
+
+  // Realtime clock, the time base of Paddle's profiler.
+  static uint64_t NowNs() {
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    return static_cast<uint64_t>(ts.tv_sec) * 1000000000ULL + ts.tv_nsec;
+  }
+
+  static uint64_t ThreadId() {
+    static thread_local uint64_t tid = syscall(SYS_gettid);
+    return tid;
+  }
+
+  // Returns false when the record was dropped.
+  bool Push(const TraceRecord& record) {
+    uint64_t pos = tail_.load(std::memory_order_relaxed);
+    Slot* slot;
+    while (true) {
+      slot = &slots_[pos & mask_];
+      uint64_t seq = slot->seq.load(std::memory_order_acquire);
+      int64_t diff = static_cast<int64_t>(seq - pos);
+      if (diff == 0) {
+        if (tail_.compare_exchange_weak(
+                pos, pos + 1, std::memory_order_relaxed)) {
+          break;
+        }
+      } else if (diff < 0) {
+        dropped_.fetch_add(1, std::memory_order_relaxed);
+        return false;
+      } else {
+        pos = tail_.load(std::memory_order_relaxed);
+      }
+    }
+    slot->record = record;
+    slot->seq.store(pos + 1, std::memory_order_release);
+    return true;
+  }
+
+  // Hands every published record to `fn`, oldest first. Only one thread
+  // may drain at a time.
+  template <typename Fn>
+  void Drain(Fn fn) {
+    while (true) {
+      Slot* slot = &slots_[head_ & mask_];
+      if (slot->seq.load(std::memory_order_acquire) != head_ + 1) {
+        return;
+      }
+      fn(slot->record);
+      slot->seq.store(head_ + mask_ + 1, std::memory_order_release);
+      ++head_;
+    }
+  }
+
+  // Records dropped since the last call.
+  uint64_t TakeDropped() {
+    return dropped_.exchange(0, std::memory_order_relaxed);
+  }
+
+ private:
+  struct Slot {
+    std::atomic<uint64_t> seq;
+    TraceRecord record;
+  };
+
+  Tracer() {
+    uint64_t capacity = 1 << 16;
+    if (const char* env = std::getenv("CUSTOM_CPU_TRACE_BUFFER_SIZE")) {
+      capacity = std::max<uint64_t>(2, std::strtoull(env, nullptr, 10));
+    }
+    // Round up to a power of two so positions map to slots with a mask.
+    uint64_t size = 1;
+    while (size < capacity) {
+      size <<= 1;
+    }
+    mask_ = size - 1;
+    slots_.reset(new Slot[size]);
+    for (uint64_t i = 0; i < size; ++i) {
+      slots_[i].seq.store(i, std::memory_order_relaxed);
+    }
+  }
+
+  static std::atomic<bool>& EnabledFlag() {
+    static std::atomic<bool> enabled{false};
+    return enabled;
+  }
+
+  std::unique_ptr<Slot[]> slots_;
+  uint64_t mask_;
+  alignas(64) std::atomic<uint64_t> tail_{0};
+  alignas(64) uint64_t head_ = 0;
+  std::atomic<uint64_t> dropped_{0};
+};
+
+// Where and when work was issued, for work that runs later on a stream
+// worker.
+struct TraceOrigin {
+  static TraceOrigin Here() {
+    TraceOrigin origin;
+    if (Tracer::Enabled()) {
+      origin.launch_ns = Tracer::NowNs();
+      origin.thread_id = Tracer::ThreadId();
+    }
+    return origin;
+  }
+
+  uint64_t launch_ns = 0;
+  uint64_t thread_id = 0;
+};
+
+// Traces the enclosing scope as one activity, if a session is running
+// when the scope is entered. Without an origin the work is taken to be
+// issued by the current thread at scope entry.
+class TraceScope {
+ public:
+  TraceScope(TraceRecord::Kind kind,
+             const char* name,
+             uint64_t device_id,
+             uint64_t stream_id,
+             uint64_t bytes = 0,
+             TraceOrigin origin = TraceOrigin())
+      : active_(Tracer::Enabled()) {
+    if (active_) {
+      uint64_t now = Tracer::NowNs();
+      record_ = {kind,
+                 name,
+                 now,
+                 0,
+                 device_id,
+                 stream_id,
+                 origin.launch_ns != 0 ? origin.launch_ns : now,
+                 origin.launch_ns != 0 ? origin.thread_id : Tracer::ThreadId(),
+                 bytes};
+    }
+  }
+
+  ~TraceScope() {
+    if (active_) {
+      record_.end_ns = Tracer::NowNs();
+      Tracer::Instance().Push(record_);
+    }
+  }
+
+  TraceScope(const TraceScope&) = delete;
+  TraceScope& operator=(const TraceScope&) = delete;
+
+ private:
+  bool active_;
+  TraceRecord record_;
+};
+
+}  // namespace custom_cpu
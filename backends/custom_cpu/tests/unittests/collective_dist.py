@@ -0,0 +1,294 @@
+#   Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run on every rank by test_collective.py, through paddle.distributed.launch,
+# and alone with --missing-peer.
+
+import ctypes
+import sys
+import threading
+
+import numpy as np
+import paddle
+import paddle.distributed as dist
+
+# all_reduce takes a tree up to 64KiB and a ring above, SMALL and LARGE
+# elements fall on either side for every dtype; LARGE does not split
+# evenly over the ranks
+SMALL = 1000
+LARGE = 100003
+DTYPES = ["float32", "float16", "bfloat16", "int64"]
+# C_DataType and C_CCLReduceOp of device_ext.h
+C_DTYPES = {"int64": 9, "float16": 10, "float32": 11, "bfloat16": 13}
+C_AVG = 1
+
+
+def to_tensor(array, dtype):
+    if dtype == "bfloat16":
+        return paddle.to_tensor(array.astype("float32")).astype("bfloat16")
+    return paddle.to_tensor(array.astype(dtype))
+
+
+def to_numpy(tensor):
+    if tensor.dtype == paddle.bfloat16:
+        tensor = tensor.astype("float32")
+    return tensor.numpy().astype("float64")
+
+
+def to_array(array, dtype):
+    # bfloat16 travels as the upper half of float32
+    if dtype == "bfloat16":
+        return (array.astype("float32").view("uint32") >> 16).astype("uint16")
+    return array.astype(dtype)
+
+
+def from_array(array, dtype):
+    if dtype == "bfloat16":
+        array = (array.astype("uint32") << 16).view("float32")
+    return array.astype("float64")
+
+
+def rank_input(rank, numel):
+    # small integers, exact in every dtype even once reduced
+    return np.arange(numel) % 7 + 1 + rank
+
+
+class RootId(ctypes.Structure):
+    _fields_ = [("sz", ctypes.c_size_t), ("data", ctypes.c_char_p)]
+
+
+def plugin():
+    # the plugin paddle has loaded
+    with open("/proc/self/maps") as f:
+        path = next(line.split()[-1] for line in f if "custom-cpu" in line)
+    return ctypes.CDLL(path)
+
+
+class Xccl:
+    """
+    The xccl entry points of the plugin paddle has loaded, on a communicator
+    of their own, for what paddle does not pass on to a custom device.
+    """
+
+    # the entry points keep their C++ names
+    SYMBOLS = {
+        "get_unique_id": "_Z15XcclGetUniqueIdP11C_CCLRootId",
+        "comm_init_rank": "_Z16XcclCommInitRankmP11C_CCLRootIdmPP12C_CCLComm_st",
+        "destroy_comm": "_Z15XcclDestroyCommP12C_CCLComm_st",
+        "all_reduce": "_Z13XcclAllReducePvS_m10C_DataType13C_CCLReduceOp"
+        "P12C_CCLComm_stP11C_Stream_st",
+        "group_start": "_Z14XcclGroupStartv",
+        "group_end": "_Z12XcclGroupEndv",
+        "send": "_Z8XcclSendPvm10C_DataTypemP12C_CCLComm_stP11C_Stream_st",
+        "recv": "_Z8XcclRecvPvm10C_DataTypemP12C_CCLComm_stP11C_Stream_st",
+    }
+
+    def __init__(self, unique_id, rank, nranks):
+        lib = plugin()
+        for name, symbol in self.SYMBOLS.items():
+            setattr(self, "_" + name, getattr(lib, symbol))
+        root_id = RootId(16, unique_id)
+        self.comm = ctypes.c_void_p()
+        self._check(
+            self._comm_init_rank(
+                ctypes.c_size_t(nranks),
+                ctypes.byref(root_id),
+                ctypes.c_size_t(rank),
+                ctypes.byref(self.comm),
+            )
+        )
+
+    @classmethod
+    def unique_id(cls):
+        root_id = RootId(16, bytes(16))
+        get_unique_id = getattr(plugin(), cls.SYMBOLS["get_unique_id"])
+        cls._check(get_unique_id(ctypes.byref(root_id)))
+        return ctypes.string_at(root_id.data, 16)
+
+    @staticmethod
+    def _check(status):
+        if status != 0:
+            raise RuntimeError("xccl call failed")
+
+    def close(self):
+        self._check(self._destroy_comm(self.comm))
+
+    def all_reduce(self, array, dtype, op):
+        self._check(
+            self._all_reduce(
+                ctypes.c_void_p(array.ctypes.data),
+                ctypes.c_void_p(array.ctypes.data),
+                ctypes.c_size_t(array.size),
+                C_DTYPES[dtype],
+                op,
+                self.comm,
+                None,
+            )
+        )
+
+    def group_start(self):
+        self._check(self._group_start())
+
+    def group_end(self):
+        self._check(self._group_end())
+
+    def send(self, array, dtype, peer):
+        self._p2p(self._send, array, dtype, peer)
+
+    def recv(self, array, dtype, peer):
+        self._p2p(self._recv, array, dtype, peer)
+
+    def _p2p(self, fn, array, dtype, peer):
+        self._check(
+            fn(
+                ctypes.c_void_p(array.ctypes.data),
+                ctypes.c_size_t(array.size),
+                C_DTYPES[dtype],
+                ctypes.c_size_t(peer),
+                self.comm,
+                None,
+            )
+        )
+
+
+def check_all_reduce(rank, nranks, xccl):
+    inputs = np.stack([rank_input(r, LARGE) for r in range(nranks)])
+    expected = {
+        dist.ReduceOp.SUM: inputs.sum(0),
+        dist.ReduceOp.MAX: inputs.max(0),
+        dist.ReduceOp.MIN: inputs.min(0),
+        dist.ReduceOp.PROD: inputs.prod(0),
+    }
+    for dtype in DTYPES:
+        for numel in (SMALL, LARGE):
+            for op, result in expected.items():
+                x = to_tensor(rank_input(rank, numel), dtype)
+                dist.all_reduce(x, op=op)
+                np.testing.assert_array_equal(
+                    to_numpy(x), result[:numel], err_msg=f"{dtype} {op} {numel}"
+                )
+
+            # paddle takes no AVG to a custom device, ask the plugin; the
+            # integer average truncates
+            x = to_array(rank_input(rank, numel), dtype)
+            xccl.all_reduce(x, dtype, C_AVG)
+            result = inputs.sum(0)[:numel] / nranks
+            if dtype == "int64":
+                result = np.trunc(result)
+            np.testing.assert_array_equal(
+                from_array(x, dtype), result, err_msg=f"{dtype} AVG {numel}"
+            )
+
+
+def check_rooted(rank, nranks):
+    root = nranks - 1
+    for numel in (SMALL, LARGE):
+        x = to_tensor(rank_input(rank, numel), "float32")
+        dist.broadcast(x, src=root)
+        np.testing.assert_array_equal(to_numpy(x), rank_input(root, numel))
+
+        x = to_tensor(rank_input(rank, numel), "float32")
+        dist.reduce(x, dst=root, op=dist.ReduceOp.SUM)
+        if rank == root:
+            np.testing.assert_array_equal(
+                to_numpy(x), sum(rank_input(r, numel) for r in range(nranks))
+            )
+
+
+def check_gather_scatter(rank, nranks):
+    for numel in (SMALL, LARGE):
+        out = []
+        dist.all_gather(out, to_tensor(rank_input(rank, numel), "float16"))
+        for r in range(nranks):
+            np.testing.assert_array_equal(to_numpy(out[r]), rank_input(r, numel))
+
+        # the block j of rank r holds input(r) + 10 * j
+        blocks = [
+            to_tensor(rank_input(rank, numel) + 10 * j, "int64") for j in range(nranks)
+        ]
+        out = paddle.zeros([numel], "int64")
+        dist.reduce_scatter(out, blocks)
+        np.testing.assert_array_equal(
+            to_numpy(out),
+            sum(rank_input(r, numel) + 10 * rank for r in range(nranks)),
+        )
+
+
+def check_send_recv(rank, nranks, xccl):
+    # paddle issues batch_isend_irecv on a custom device op by op, so the
+    # group is opened on the plugin. Every rank sends to the next and
+    # receives from the previous one at once, which only completes inside
+    # a group once a message outgrows the channel
+    for numel in (SMALL, LARGE):
+        send = to_array(rank_input(rank, numel), "float32")
+        recv = np.zeros([numel], "float32")
+        xccl.group_start()
+        xccl.send(send, "float32", (rank + 1) % nranks)
+        xccl.recv(recv, "float32", (rank - 1) % nranks)
+        xccl.group_end()
+        np.testing.assert_array_equal(recv, rank_input((rank - 1) % nranks, numel))
+
+
+def check_missing_peer():
+    # with a short CUSTOM_CPU_CCL_TIMEOUT, the calls waiting on a peer that
+    # is not there fail rather than hang
+    try:
+        Xccl(Xccl.unique_id(), 0, 2)
+        raise AssertionError("joined a communicator without its peer")
+    except RuntimeError:
+        pass
+
+    # both ranks join from threads of this process, then rank 1 receives
+    # nothing while rank 0 sends more than the channel holds
+    unique_id = Xccl.unique_id()
+    xccls = [None, None]
+
+    def join(rank):
+        xccls[rank] = Xccl(unique_id, rank, 2)
+
+    threads = [threading.Thread(target=join, args=(r,)) for r in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    try:
+        xccls[0].send(to_array(rank_input(0, LARGE), "float32"), "float32", 1)
+        raise AssertionError("sent to a peer that does not receive")
+    except RuntimeError:
+        pass
+    for xccl in xccls:
+        xccl.close()
+    print("missing peer ok")
+
+
+def main():
+    if "--missing-peer" in sys.argv:
+        paddle.set_device("custom_cpu")
+        check_missing_peer()
+        return
+    dist.init_parallel_env()
+    rank, nranks = dist.get_rank(), dist.get_world_size()
+    ids = [Xccl.unique_id() if rank == 0 else None]
+    dist.broadcast_object_list(ids, src=0)
+    xccl = Xccl(ids[0], rank, nranks)
+    check_all_reduce(rank, nranks, xccl)
+    check_rooted(rank, nranks)
+    check_gather_scatter(rank, nranks)
+    check_send_recv(rank, nranks, xccl)
+    xccl.close()
+    print(f"rank {rank} of {nranks} ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#   Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import subprocess
+import sys
+import textwrap
+import unittest
+
+MB = 1 << 20
+LIMIT_MB = 64
+ARENA_SIZE = 8 * MB
+
+STATS = re.compile(
+    r"custom_cpu memory: limit (?P<limit>\d+) B, allocated (?P<allocated>\d+) B "
+    r"\(peak (?P<peak_allocated>\d+) B\), reserved (?P<reserved>\d+) B "
+    r"\(peak (?P<peak_reserved>\d+) B\), cached (?P<cached>\d+) B, "
+    r"available (?P<available>\d+) B, fragmentation \S+, "
+    r"(?P<num_allocs>\d+) allocations, (?P<num_cache_hits>\d+) cache hits"
+)
+
+
+def run(script):
+    """
+    Run script on custom_cpu under a LIMIT_MB memory limit, and return its
+    output and the allocator counters printed at exit.
+    """
+    env = dict(os.environ)
+    env.update(
+        CUSTOM_CPU_MEMORY_LIMIT_MB=str(LIMIT_MB),
+        CUSTOM_CPU_MEMORY_STATS="1",
+        # pass the tensors straight to the plugin allocator, and fail at once
+        FLAGS_free_idle_chunk="1",
+        FLAGS_gpu_allocator_retry_time="0",
+    )
+    script = (
+        "import paddle\n"
+        "paddle.set_device('custom_cpu')\n"
+        f"MB = {MB}\n" + textwrap.dedent(script)
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    if result.returncode != 0:
+        raise AssertionError(result.stderr)
+    match = STATS.search(result.stdout)
+    if match is None:
+        raise AssertionError(result.stdout + result.stderr)
+    return result.stdout, {key: int(value) for key, value in match.groupdict().items()}
+
+
+class TestAllocator(unittest.TestCase):
+    def check_stats(self, stats):
+        self.assertEqual(stats["limit"], LIMIT_MB * MB)
+        self.assertLessEqual(stats["peak_reserved"], stats["limit"])
+        self.assertLessEqual(stats["cached"], stats["reserved"])
+        # what is left under the limit, and the cached blocks
+        self.assertEqual(
+            stats["available"], stats["limit"] - stats["reserved"] + stats["cached"]
+        )
+
+    def test_limit(self):
+        out, stats = run(
+            """
+            x = paddle.empty([40 * MB], "uint8")
+            try:
+                paddle.empty([40 * MB], "uint8")
+            except Exception:
+                print("over the limit")
+            del x
+            """
+        )
+        self.assertIn("over the limit", out)
+        self.check_stats(stats)
+        self.assertEqual(stats["allocated"], 0)
+        self.assertGreaterEqual(stats["peak_allocated"], 40 * MB)
+        self.assertLess(stats["peak_allocated"], 80 * MB)
+        # the freed block is cached, and counted as available
+        self.assertGreaterEqual(stats["cached"], 40 * MB)
+        self.assertGreaterEqual(stats["available"], LIMIT_MB * MB - ARENA_SIZE)
+
+    def test_size_class_reuse(self):
+        _, stats = run(
+            """
+            for i in range(1000):
+                x = paddle.empty([100 + i % 50], "float32")
+                del x
+            """
+        )
+        self.check_stats(stats)
+        # every small block comes from one arena, and is reused
+        self.assertEqual(stats["reserved"], ARENA_SIZE)
+        self.assertGreaterEqual(stats["num_allocs"], 1000)
+        self.assertGreaterEqual(stats["num_cache_hits"], stats["num_allocs"] - 10)
+        self.assertGreaterEqual(stats["available"], LIMIT_MB * MB - ARENA_SIZE)
+
+    def test_large_block_release(self):
+        out, stats = run(
+            """
+            xs = [paddle.empty([20 * MB], "uint8") for _ in range(3)]
+            del xs
+            # needs the cached blocks unmapped
+            y = paddle.empty([50 * MB], "uint8")
+            print("reused")
+            del y
+            """
+        )
+        self.assertIn("reused", out)
+        self.check_stats(stats)
+        self.assertGreaterEqual(stats["peak_allocated"], 60 * MB)
+        self.assertGreaterEqual(stats["cached"], 50 * MB)
+        self.assertLess(stats["reserved"], 60 * MB)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+#   Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+class TestCollective(unittest.TestCase):
+    def test_collectives(self):
+        # both custom_cpu devices, one process each
+        script = os.path.join(os.path.dirname(__file__), "collective_dist.py")
+        with tempfile.TemporaryDirectory() as log_dir:
+            result = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "paddle.distributed.launch",
+                    "--devices",
+                    "0,1",
+                    "--log_dir",
+                    log_dir,
+                    script,
+                ],
+                capture_output=True,
+                text=True,
+                timeout=600,
+            )
+            logs = {}
+            for rank in range(2):
+                path = os.path.join(log_dir, f"workerlog.{rank}")
+                if os.path.exists(path):
+                    with open(path) as f:
+                        logs[rank] = f.read()
+        self.assertEqual(result.returncode, 0, result.stderr + "".join(logs.values()))
+        for rank in range(2):
+            self.assertIn(f"rank {rank} of 2 ok", logs[rank])
+
+    def test_missing_peer(self):
+        # one process on its own, every wait on the absent rank times out
+        script = os.path.join(os.path.dirname(__file__), "collective_dist.py")
+        result = subprocess.run(
+            [sys.executable, script, "--missing-peer"],
+            env=dict(os.environ, CUSTOM_CPU_CCL_TIMEOUT="1"),
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("missing peer ok", result.stdout)
+
+
+if __name__ == "__main__":
+    unittest.main()
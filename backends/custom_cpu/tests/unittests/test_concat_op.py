@@ -14,9 +14,13 @@
 
 from __future__ import print_function
 
+import os
 import unittest
 import numpy as np
 
+# large concats are split over the thread pool even on a single core
+os.environ.setdefault("CUSTOM_CPU_NUM_THREADS", "4")
+
 import paddle
 from op_test import OpTest
 
@@ -74,5 +78,59 @@ class TestConcatOp2(TestConcatOp):
         self.axis = 1
 
 
+class TestConcatStridedCopy(unittest.TestCase):
+    # Every input is copied into its band of the output by funcs::StridedCopy,
+    # after the views among them are made contiguous.
+    def check(self, inputs, axis):
+        with paddle.base.dygraph.guard(paddle.CustomPlace("custom_cpu", 0)):
+            out = paddle.concat([x() for x, _ in inputs], axis).numpy()
+        np.testing.assert_array_equal(out, np.concatenate([x for _, x in inputs], axis))
+
+    def view(self, data, fn):
+        # the view fn(data) of the tensor, with its numpy counterpart
+        return (lambda: fn(paddle.to_tensor(data)), fn(data))
+
+    def test_negative_steps(self):
+        x = np.random.random((4, 3, 5)).astype("float32")
+        y = np.random.random((4, 2, 5)).astype("float32")
+        inputs = [
+            self.view(x, lambda t: t[:, ::-1]),
+            self.view(y, lambda t: t[::-1, :, ::-1]),
+        ]
+        self.check(inputs, 1)
+
+    def test_non_contiguous(self):
+        x = np.random.random((5, 3, 4)).astype("float32")
+        y = np.random.random((3, 4, 2)).astype("float32")
+        inputs = [
+            self.view(x, lambda t: t.transpose([1, 2, 0])),
+            self.view(y, lambda t: t[:, :, ::2]),
+            self.view(y, lambda t: t),
+        ]
+        self.check(inputs, 2)
+        self.check([self.view(x, lambda t: t.transpose([0, 2, 1]))] * 2, 0)
+
+    def test_rank1(self):
+        x = np.random.random(10).astype("float32")
+        inputs = [
+            self.view(x, lambda t: t),
+            self.view(x, lambda t: t[::-2]),
+            self.view(x, lambda t: t[2:7]),
+        ]
+        self.check(inputs, 0)
+
+    def test_threaded(self):
+        # 8 MiB of short rows, well above the per thread grain
+        x = np.random.random((1024, 512)).astype("float32")
+        y = np.random.random((1536, 1024)).astype("float32")
+        inputs = [
+            self.view(x, lambda t: t),
+            self.view(y, lambda t: t.transpose([1, 0])),
+            self.view(y, lambda t: t[:1024, ::-2]),
+        ]
+        self.check(inputs, 1)
+        self.check(inputs, -1)
+
+
 if __name__ == "__main__":
     unittest.main()
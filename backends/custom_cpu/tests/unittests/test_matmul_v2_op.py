@@ -268,6 +268,37 @@ class TestMatMul2Dx3D_TransXY(TestMatMulOp):
         self.trans_y = True
 
 
+class TestMatMulLarge2Dx2D(TestMatMulOp):
+    """
+    shapes crossing the cache blocking tiles of the gemm engine
+    """
+
+    def config(self):
+        self.x_shape = (70, 260)
+        self.y_shape = (260, 530)
+        self.trans_x = False
+        self.trans_y = False
+
+    def test_check_grad(self):
+        pass
+
+
+class TestMatMulLarge2Dx2D_TransXY(TestMatMulLarge2Dx2D):
+    def config(self):
+        self.x_shape = (260, 70)
+        self.y_shape = (530, 260)
+        self.trans_x = True
+        self.trans_y = True
+
+
+class TestMatMulLarge3Dx2D_TransY(TestMatMulLarge2Dx2D):
+    def config(self):
+        self.x_shape = (3, 70, 260)
+        self.y_shape = (130, 260)
+        self.trans_x = False
+        self.trans_y = True
+
+
 if __name__ == "__main__":
     paddle.enable_static()
     unittest.main()
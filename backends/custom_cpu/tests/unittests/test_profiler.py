@@ -0,0 +1,57 @@
+#   Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import unittest
+
+import paddle
+import paddle.profiler as profiler
+
+paddle.set_device("custom_cpu")
+
+
+class TestProfiler(unittest.TestCase):
+    def test_device_trace(self):
+        x = paddle.rand([32, 32])
+        with tempfile.TemporaryDirectory() as tmp:
+            # without on_trace_ready every step is dumped to ./profiler_log
+            prof = profiler.Profiler(
+                targets=[
+                    profiler.ProfilerTarget.CPU,
+                    profiler.ProfilerTarget.CUSTOM_DEVICE,
+                ],
+                custom_device_types=["custom_cpu"],
+                on_trace_ready=profiler.export_chrome_tracing(tmp),
+            )
+            prof.start()
+            y = paddle.matmul(x, x)
+            y.numpy()
+            prof.step()
+            prof.stop()
+
+            path = os.path.join(tmp, "trace.json")
+            prof.export(path, format="json")
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+
+        kernels = [e["name"] for e in events if e.get("cat") == "Kernel"]
+        copies = [e["name"] for e in events if e.get("cat") == "Memcpy"]
+        self.assertTrue(any(n.startswith("MatmulKernel") for n in kernels))
+        self.assertTrue(any(n.startswith("MEMCPY_DtoH") for n in copies))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,8 +14,13 @@
 
 from __future__ import print_function
 
+import os
 import unittest
 import numpy as np
+
+# large slices are split over the thread pool even on a single core
+os.environ.setdefault("CUSTOM_CPU_NUM_THREADS", "4")
+
 import paddle.base.core as core
 from op_test import OpTest
 import paddle.base as base
@@ -647,6 +652,43 @@ class TestImperativeVarBaseGetItem(unittest.TestCase):
         self.assertRaises(Exception, test_float_in_index)
 
 
+class TestSliceStridedCopy(unittest.TestCase):
+    # The slice kernel and the contiguous copy of a slice view both run
+    # funcs::StridedCopy; check either against numpy.
+    def check(self, data, fn):
+        for use_stride_kernel in (True, False):
+            paddle.set_flags({"FLAGS_use_stride_kernel": use_stride_kernel})
+            try:
+                with base.dygraph.guard(paddle.CustomPlace("custom_cpu", 0)):
+                    out = fn(paddle.to_tensor(data)).contiguous().numpy()
+            finally:
+                paddle.set_flags({"FLAGS_use_stride_kernel": True})
+            np.testing.assert_array_equal(out, fn(data))
+
+    def test_negative_steps(self):
+        data = np.random.random((4, 5, 6)).astype("float32")
+        self.check(data, lambda x: x[:, ::-1])
+        self.check(data, lambda x: x[::-2, 1:4, 5:0:-2])
+
+    def test_non_contiguous_input(self):
+        data = np.random.random((4, 5, 6)).astype("float32")
+        self.check(data, lambda x: x.transpose([2, 0, 1])[1:5, :, 2:])
+        self.check(data, lambda x: x.transpose([1, 0, 2])[::2, 1:3])
+
+    def test_rank1(self):
+        data = np.random.random(50).astype("float32")
+        self.check(data, lambda x: x[3:40])
+        self.check(data, lambda x: x[3:40:4])
+        self.check(data, lambda x: x[40:3:-3])
+
+    def test_threaded(self):
+        # 4 MiB, well above the per thread grain
+        data = np.random.random((512, 2048)).astype("float32")
+        self.check(data, lambda x: x[1:-1, 5:-5])
+        self.check(data, lambda x: x[:, ::-2])
+        self.check(data, lambda x: x.transpose([1, 0])[::2, 1:])
+
+
 # class TestInferShape(unittest.TestCase):
 #     def test(self):
 #         x = paddle.ones(shape=[3, 4, 5])
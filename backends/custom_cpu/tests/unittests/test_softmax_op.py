@@ -186,5 +186,32 @@ class TestSoftmaxAPI(unittest.TestCase):
         paddle.enable_static()
 
 
+class TestSoftmaxLongAxis(unittest.TestCase):
+    # millions of terms per sum, which drift without compensation
+    def check(self, shape, axis):
+        paddle.disable_static(paddle.CustomPlace("custom_cpu", 0))
+        x_np = np.random.uniform(-1.0, 1.0, shape).astype("float32")
+        grad_np = np.random.uniform(-1.0, 1.0, shape).astype("float32")
+        x = paddle.to_tensor(x_np, stop_gradient=False)
+        out = F.softmax(x, axis=axis)
+        (out * paddle.to_tensor(grad_np)).sum().backward()
+
+        x64 = x_np.astype("float64")
+        e = np.exp(x64 - x64.max(axis, keepdims=True))
+        out_ref = e / e.sum(axis, keepdims=True)
+        grad_ref = (grad_np - (grad_np * out_ref).sum(axis, keepdims=True)) * out_ref
+        np.testing.assert_allclose(out.numpy(), out_ref, rtol=1e-5)
+        np.testing.assert_allclose(
+            x.grad.numpy(), grad_ref, rtol=1e-5, atol=1e-5 * np.abs(grad_ref).max()
+        )
+        paddle.enable_static()
+
+    def test_last_axis(self):
+        self.check([2, 1 << 22], -1)
+
+    def test_strided_axis(self):
+        self.check([1 << 20, 3], 0)
+
+
 if __name__ == "__main__":
     unittest.main()
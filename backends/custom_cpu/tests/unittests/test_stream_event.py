@@ -0,0 +1,66 @@
+#   Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import paddle
+import numpy as np
+import unittest
+
+paddle.set_device("custom_cpu")
+
+
+class TestStreamEvent(unittest.TestCase):
+    def test_cross_stream_dependency(self):
+        x_np = np.random.random([64, 32]).astype("float32")
+        x = paddle.to_tensor(x_np)
+        s1 = paddle.device.Stream()
+        s2 = paddle.device.Stream()
+        event = paddle.device.Event()
+
+        with paddle.device.stream_guard(s1):
+            y = paddle.matmul(x, x, transpose_y=True)
+            event.record(s1)
+        s2.wait_event(event)
+        with paddle.device.stream_guard(s2):
+            z = y + 1.0
+        s2.synchronize()
+
+        self.assertTrue(event.query())
+        self.assertTrue(s1.query())
+        self.assertTrue(s2.query())
+        np.testing.assert_allclose(
+            z.numpy(), np.matmul(x_np, x_np.T) + 1.0, rtol=1e-5
+        )
+
+    def test_event_synchronize(self):
+        s = paddle.device.Stream()
+        event = paddle.device.Event()
+        with paddle.device.stream_guard(s):
+            x = paddle.ones([128, 128])
+            y = paddle.sum(x * 2.0)
+            event.record(s)
+        event.synchronize()
+        self.assertTrue(event.query())
+        self.assertEqual(float(y), 2.0 * 128 * 128)
+
+    def test_device_synchronize(self):
+        s = paddle.device.Stream()
+        with paddle.device.stream_guard(s):
+            x = paddle.full([256], 3.0)
+        paddle.device.synchronize()
+        self.assertTrue(s.query())
+        np.testing.assert_allclose(x.numpy(), np.full([256], 3.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
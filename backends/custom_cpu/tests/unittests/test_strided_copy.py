@@ -0,0 +1,89 @@
+#   Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+
+import numpy as np
+
+# large copies are split over the thread pool even on a single core
+os.environ.setdefault("CUSTOM_CPU_NUM_THREADS", "4")
+
+import paddle  # noqa: E402
+
+paddle.set_device("custom_cpu")
+
+
+class TestStridedCopy(unittest.TestCase):
+    def check(self, shape, index, src, dtype="float32"):
+        """
+        Copy the tensor src into the view x[index] of an arange tensor x,
+        which runs the strided_copy kernel, and compare with numpy.
+        """
+        x = np.arange(np.prod(shape)).reshape(shape).astype(dtype)
+        out = paddle.to_tensor(x)
+        out[index].copy_(src, False)
+        expected = x.copy()
+        expected[index] = src.numpy().reshape(expected[index].shape)
+        np.testing.assert_array_equal(out.numpy(), expected)
+
+    def random(self, shape, dtype="float32"):
+        return paddle.to_tensor(np.random.uniform(-10, 10, shape).astype(dtype))
+
+    def test_negative_steps(self):
+        self.check(
+            [2, 3, 4], (slice(None), slice(None, None, -1)), self.random([2, 3, 4])
+        )
+        self.check(
+            [6, 5], (slice(None, None, -2), slice(4, 0, -3)), self.random([3, 2])
+        )
+
+    def test_non_contiguous(self):
+        # a transposed source into a stepped and a reversed destination
+        src = self.random([4, 3, 2]).transpose([2, 1, 0])
+        self.assertFalse(src.is_contiguous())
+        self.check([2, 6, 4], (slice(None), slice(None, None, 2)), src)
+        self.check(
+            [2, 3, 4], (slice(None, None, -1), slice(None), slice(None, None, -1)), src
+        )
+
+    def test_rank1(self):
+        self.check([10], slice(None, None, 3), self.random([4]))
+        self.check([10], slice(None, None, -3), self.random([4]))
+        self.check([10], slice(7, 2, -2), self.random([3]))
+        self.check([10], slice(2, 8), self.random([6]))
+
+    def test_reshaped_source(self):
+        # the shapes differ, the elements pair up in row-major order
+        self.check(
+            [2, 3, 4], (slice(None), slice(None, None, 2)), self.random([2, 4, 2])
+        )
+        self.check([4, 6], (slice(None, None, -1), slice(1, 5)), self.random([8, 2]))
+
+    def test_bool(self):
+        src = paddle.to_tensor(np.random.rand(2, 4, 2) > 0.5)
+        self.check([2, 3, 4], (slice(None), slice(None, None, 2)), src, "bool")
+        src = paddle.to_tensor(np.random.rand(2, 2, 4) > 0.5)
+        self.check([2, 3, 4], (slice(None), slice(None, None, -2)), src, "bool")
+
+    def test_threaded(self):
+        # 8 MiB with short rows, well above the per thread grain
+        index = (slice(None), slice(None, None, -2))
+        self.check([1024, 2048], index, self.random([1024, 1024]))
+        self.check([1024, 2048], index, self.random([1024, 1024]).transpose([1, 0]))
+        self.check([1024, 2048], index, self.random([2048, 512]))
+
+
+if __name__ == "__main__":
+    unittest.main()
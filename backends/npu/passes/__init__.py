@@ -14,3 +14,7 @@
 
 from .common import setUp
 from .common import addPasses
+from .common import applyPasses
+from .common import formatPassReport
+from .common import getOptimizedModel
+from .common import getPasses
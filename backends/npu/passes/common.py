@@ -14,8 +14,15 @@
 
 from __future__ import print_function, division
 
+import collections
+import hashlib
+import json
 import os
+import time
+
 import paddle
+from paddle.base.proto import pass_desc_pb2
+from paddle.incubate.passes import ir
 
 from . import llama  # noqa: F401
 from . import chatglm  # noqa: F401
@@ -34,42 +41,362 @@ def register_pass(pass_builder, pass_name):
     paddle.base.core.register_subgraph_pass(pass_name)
 
 
-def addPasses(pass_builder, model_type, quant_type):
+_COMMON_PASSES = [
+    "remove_residual_in_fused_bias_residual_layernorm",
+    "remove_residual_in_rms_norm",
+    "remove_blha_get_max_len",
+]
+_LLAMA_PASSES = [
+    "llama_fuse_attention_layer_begin",
+    "llama_fuse_attention_layer_end",
+    "llama_fuse_attention_layer",
+]
+_LLAMA_A8W8_PASSES = [
+    "llama_fuse_attention_smooth_quant_layer_begin",
+    "llama_fuse_attention_smooth_quant_layer_end",
+    "llama_fuse_attention_smooth_quant_layer",
+]
+_CHATGLM_PASSES = [
+    "chatglm_fuse_attention_layer_begin",
+    "chatglm_fuse_attention_layer_end",
+    "chatglm_fuse_attention_layer",
+]
+_HEAD_PASSES = [
+    "llama_fuse_lm_head_with_slice",
+    "llama_fuse_lm_head",
+    "llama_fuse_get_padding_offset",
+    "replace_top_p_sampling_by_top_k_v2",
+]
+
+# the (pattern op types, replace op types) of every pattern of every pass
+_pass_patterns = {}
+
+
+def getPasses(model_type, quant_type):
+    """The NPU passes of model_type, in the order they are applied."""
     if model_type == "llama" and quant_type == "a8w8":
-        register_pass(pass_builder, "remove_residual_in_fused_bias_residual_layernorm")
-        register_pass(pass_builder, "remove_residual_in_rms_norm")
-        register_pass(pass_builder, "remove_blha_get_max_len")
-        register_pass(pass_builder, "llama_fuse_attention_smooth_quant_layer_begin")
-        register_pass(pass_builder, "llama_fuse_attention_smooth_quant_layer_end")
-        register_pass(pass_builder, "llama_fuse_attention_smooth_quant_layer")
-        register_pass(pass_builder, "llama_fuse_lm_head_with_slice")
-        register_pass(pass_builder, "llama_fuse_lm_head")
-        register_pass(pass_builder, "llama_fuse_get_padding_offset")
-        register_pass(pass_builder, "replace_top_p_sampling_by_top_k_v2")
+        return _COMMON_PASSES + _LLAMA_A8W8_PASSES + _HEAD_PASSES
     elif model_type == "llama":
-        register_pass(pass_builder, "remove_residual_in_fused_bias_residual_layernorm")
-        register_pass(pass_builder, "remove_residual_in_rms_norm")
-        register_pass(pass_builder, "remove_blha_get_max_len")
-        register_pass(pass_builder, "llama_fuse_attention_layer_begin")
-        register_pass(pass_builder, "llama_fuse_attention_layer_end")
-        register_pass(pass_builder, "llama_fuse_attention_layer")
-        register_pass(pass_builder, "llama_fuse_lm_head_with_slice")
-        register_pass(pass_builder, "llama_fuse_lm_head")
-        register_pass(pass_builder, "llama_fuse_get_padding_offset")
-        register_pass(pass_builder, "replace_top_p_sampling_by_top_k_v2")
+        return _COMMON_PASSES + _LLAMA_PASSES + _HEAD_PASSES
     elif model_type.startswith("chatglm"):
-        register_pass(pass_builder, "remove_residual_in_fused_bias_residual_layernorm")
-        register_pass(pass_builder, "remove_residual_in_rms_norm")
-        register_pass(pass_builder, "remove_blha_get_max_len")
-        register_pass(pass_builder, "chatglm_fuse_attention_layer_begin")
-        register_pass(pass_builder, "chatglm_fuse_attention_layer_end")
-        register_pass(pass_builder, "chatglm_fuse_attention_layer")
-        register_pass(pass_builder, "llama_fuse_attention_layer_begin")
-        register_pass(pass_builder, "llama_fuse_attention_layer_end")
-        register_pass(pass_builder, "llama_fuse_attention_layer")
-        register_pass(pass_builder, "llama_fuse_lm_head_with_slice")
-        register_pass(pass_builder, "llama_fuse_lm_head")
-        register_pass(pass_builder, "llama_fuse_get_padding_offset")
-        register_pass(pass_builder, "replace_top_p_sampling_by_top_k_v2")
-    else:
+        return _COMMON_PASSES + _CHATGLM_PASSES + _LLAMA_PASSES + _HEAD_PASSES
+    return []
+
+
+def addPasses(pass_builder, model_type, quant_type, program=None):
+    """
+    Register the NPU passes of model_type to pass_builder.
+
+    If program, the inference program as a Program, a ProgramDesc or the path of
+    a .pdmodel file, is given, the passes whose pattern has an op type absent
+    from it, and not created by an earlier pass, are not registered, saving
+    their pattern matching at predictor creation.
+
+    Returns:
+        list: the names of the registered passes
+    """
+    pass_names = getPasses(model_type, quant_type)
+    if not pass_names:
+        print("NPU pass not support")
+        return []
+    op_types = None if program is None else set(_op_type_counts(_program_desc(program)))
+    registered = []
+    for pass_name in pass_names:
+        if op_types is not None:
+            if not _has_pattern_ops(pass_name, op_types):
+                continue
+            op_types.update(
+                op_type
+                for _, replace in _pass_pattern(pass_name) or ()
+                for op_type in replace
+            )
+        register_pass(pass_builder, pass_name)
+        registered.append(pass_name)
+    return registered
+
+
+def applyPasses(program, model_type, quant_type):
+    """
+    Apply the NPU passes of model_type to program, the inference program as a
+    Program, a ProgramDesc or the path of a .pdmodel file, and report on every
+    pass.
+
+    A pass whose pattern has an op type absent from the program is skipped. For
+    the others the report gives the number of subgraphs matched, the number of
+    ops before and after, and the time taken, see formatPassReport.
+
+    Returns:
+        tuple: the ProgramDesc with the passes applied, and the report, a list
+        of dicts with the keys "pass", "applied", "matches", "ops_before",
+        "ops_after" and "time_ms", one per pass; matches is None when the
+        pattern of the pass cannot be built
+    """
+    desc = _program_desc(program)
+    startup = paddle.base.core.ProgramDesc()
+    counts = _op_type_counts(desc)
+    report = []
+    for pass_name in getPasses(model_type, quant_type):
+        ops = sum(counts.values())
+        entry = {
+            "pass": pass_name,
+            "applied": False,
+            "matches": 0,
+            "ops_before": ops,
+            "ops_after": ops,
+            "time_ms": 0.0,
+        }
+        report.append(entry)
+        if not _has_pattern_ops(pass_name, counts):
+            continue
+
+        patterns = _pass_pattern(pass_name)
+        replace_types = {
+            op_type for _, replace in patterns or () for op_type in replace
+        }
+        before = _op_descs(desc, replace_types)
+        paddle.base.core.register_subgraph_pass(pass_name)
+        start = time.perf_counter()
+        paddle.base.core.apply_pass(desc, startup, [pass_name], {}, {})
+        entry["time_ms"] = (time.perf_counter() - start) * 1000
+        removed = counts
+        counts = _op_type_counts(desc)
+        removed.subtract(counts)
+
+        added = collections.Counter()
+        for (op_type, _), count in (_op_descs(desc, replace_types) - before).items():
+            added[op_type] += count
+        entry["applied"] = True
+        entry["matches"] = (
+            _count_matches(patterns, added, removed) if patterns else None
+        )
+        entry["ops_after"] = sum(counts.values())
+    return desc, report
+
+
+def getOptimizedModel(model_file, model_type, quant_type, cache_dir=None):
+    """
+    Get the path of a .pdmodel holding model_file with the NPU passes of
+    model_type applied, from an on-disk cache, so that replicas of a model skip
+    the passes.
+
+    The cache is keyed by the hash of model_file, the pass list, quant_type and
+    the version of the plugin and of its passes. A cached program is checked
+    against its manifest and loaded; otherwise the passes are applied by
+    applyPasses and the result is cached. The cache lives in cache_dir, by
+    default $NPU_PASS_CACHE_DIR or ~/.cache/paddle_custom_device/npu_passes.
+
+    Create the predictor with the returned program and the params of
+    model_file; addPasses given that program registers no pass. Call setUp
+    first, as for addPasses.
+
+    Returns:
+        str: the path of the optimized program, model_file itself if the passes
+        change the parameters of the program and it cannot be cached
+    """
+    pass_names = getPasses(model_type, quant_type)
+    if not pass_names:
         print("NPU pass not support")
+        return model_file
+    if cache_dir is None:
+        cache_dir = os.getenv(
+            "NPU_PASS_CACHE_DIR",
+            os.path.join(
+                os.path.expanduser("~"), ".cache", "paddle_custom_device", "npu_passes"
+            ),
+        )
+    key = {
+        "model": _file_sha256(model_file),
+        "passes": pass_names,
+        "quant_type": quant_type,
+        "plugin": _plugin_version(),
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    cached_model = os.path.join(cache_dir, digest + ".pdmodel")
+    manifest_path = os.path.join(cache_dir, digest + ".json")
+
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["key"] == key and manifest["sha256"] == _file_sha256(cached_model):
+            return cached_model
+        print(f"Ignoring invalid NPU pass cache {cached_model}.")
+    except (OSError, ValueError, KeyError):
+        pass
+
+    desc, report = applyPasses(model_file, model_type, quant_type)
+    # the params file holds the persistable vars of the original program
+    if _persistable_vars(desc) != _persistable_vars(_program_desc(model_file)):
+        print("NPU passes change the parameters of the program, not caching it.")
+        return model_file
+
+    os.makedirs(cache_dir, exist_ok=True)
+    program = desc.serialize_to_string()
+    manifest = {
+        "key": key,
+        "sha256": hashlib.sha256(program).hexdigest(),
+        "report": report,
+    }
+    # replicas may fill the cache together, the manifest is written last
+    for path, data in (
+        (cached_model, program),
+        (manifest_path, json.dumps(manifest, indent=2).encode()),
+    ):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return cached_model
+
+
+def formatPassReport(report):
+    """Format the report of applyPasses as a table."""
+    lines = [
+        f"{'Pass':<50} {'Matches':>8} {'Ops before':>11} {'Ops after':>10} {'Time(ms)':>10}"
+    ]
+    for entry in report:
+        matches = entry["matches"] if entry["applied"] else "skipped"
+        if matches is None:
+            matches = "?"
+        lines.append(
+            f"{entry['pass']:<50} {matches:>8} {entry['ops_before']:>11} "
+            f"{entry['ops_after']:>10} {entry['time_ms']:>10.3f}"
+        )
+    return "\n".join(lines)
+
+
+def _pass_pattern(pass_name):
+    """
+    The (pattern op types, replace op types) of every pattern of a pass, None
+    when they cannot be built, like before setUp registers the custom ops.
+    """
+    if pass_name not in _pass_patterns:
+        helper = next(
+            (
+                h
+                for h in ir.RegisterPassHelper._register_helpers
+                if h._pass_type == pass_name
+            ),
+            None,
+        )
+        # serializing switches to static mode and only switches back on success
+        dynamic_mode = paddle.in_dynamic_mode()
+        try:
+            multi_pass_desc = pass_desc_pb2.MultiPassDesc()
+            multi_pass_desc.ParseFromString(helper.SerializeMultiPassDesc())
+        except Exception:
+            # not cached, the custom ops may be registered later
+            return None
+        finally:
+            if dynamic_mode and not paddle.in_dynamic_mode():
+                paddle.disable_static()
+        _pass_patterns[pass_name] = [
+            ([op.type for op in desc.pattern], [op.type for op in desc.replace])
+            for desc in multi_pass_desc.pass_descs
+        ]
+    return _pass_patterns[pass_name]
+
+
+def _has_pattern_ops(pass_name, op_types):
+    patterns = _pass_pattern(pass_name)
+    return patterns is None or any(
+        all(op_type in op_types for op_type in pattern) for pattern, _ in patterns
+    )
+
+
+def _count_matches(patterns, added, removed):
+    """
+    The number of matches of a pass, from the ops of every type it added and the
+    net number of ops of every type it removed. A match adds the ops of the
+    replacement of its pattern and removes those of the pattern; the patterns
+    replaced by no op are counted from the ops left removed.
+    """
+    added = collections.Counter(added)
+    removed = collections.Counter(removed)
+    matches = 0
+    for pattern, replace in sorted(patterns, key=lambda p: not p[1]):
+        pattern = collections.Counter(pattern)
+        replace = collections.Counter(replace)
+        if replace:
+            count = min(added[op_type] // n for op_type, n in replace.items())
+        elif pattern:
+            count = max(0, min(removed[op_type] // n for op_type, n in pattern.items()))
+        else:
+            continue
+        for op_type, n in replace.items():
+            added[op_type] -= count * n
+            removed[op_type] += count * n
+        for op_type, n in pattern.items():
+            removed[op_type] -= count * n
+        matches += count
+    return matches
+
+
+def _program_desc(program):
+    if isinstance(program, str):
+        with open(program, "rb") as f:
+            return paddle.base.core.ProgramDesc(f.read())
+    if isinstance(program, paddle.static.Program):
+        program = program.desc
+    return paddle.base.core.ProgramDesc(program)
+
+
+def _persistable_vars(desc):
+    block = desc.block(0)
+    return sorted(
+        var.name()
+        for var in block.all_vars()
+        if var.persistable() and var.name() not in ("feed", "fetch")
+    )
+
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _plugin_version():
+    """The versions of Paddle and of the plugin, and the hash of the passes."""
+    sha256 = hashlib.sha256()
+    for module in sorted(("common.py", "llama.py", "chatglm.py")):
+        with open(os.path.join(os.path.dirname(__file__), module), "rb") as f:
+            sha256.update(f.read())
+    version = {
+        "paddle": paddle.version.full_version,
+        "paddle_commit": paddle.version.commit,
+        "passes": sha256.hexdigest(),
+    }
+    try:
+        from .. import full_version, git_commit_id, custom_op_git_commit_id
+    except ImportError:
+        # the passes are used from the source tree
+        return version
+    version.update(
+        plugin=full_version,
+        plugin_commit=git_commit_id,
+        custom_op_commit=custom_op_git_commit_id,
+    )
+    return version
+
+
+def _op_type_counts(desc):
+    counts = collections.Counter()
+    for i in range(desc.num_blocks()):
+        block = desc.block(i)
+        for j in range(block.op_size()):
+            counts[block.op(j).type()] += 1
+    return counts
+
+
+def _op_descs(desc, op_types):
+    """The (type, serialized op) of the ops of the given types."""
+    ops = collections.Counter()
+    for i in range(desc.num_blocks()):
+        block = desc.block(i)
+        for j in range(block.op_size()):
+            op = block.op(j)
+            if op.type() in op_types:
+                ops[(op.type(), op.serialize_to_string())] += 1
+    return ops
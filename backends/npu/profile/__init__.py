@@ -13,3 +13,5 @@
 # limitations under the License.
 
 from .cann_export import cann_parse_enabled as cann_parse_enabled
+from .timeline import find_rank_traces as find_rank_traces
+from .timeline import fuse_rank_timelines as fuse_rank_timelines
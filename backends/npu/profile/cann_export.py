@@ -25,33 +25,196 @@
 # limitations under the License.
 
 
+import atexit
 import datetime
+import glob
+import gzip
+import itertools
 import json
+import multiprocessing
 import os
+import re
 import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import paddle
 
 
-def cann_parse_enabled(profiler_output_dir: str):
+def cann_parse_enabled(
+    profiler_output_dir: str,
+    session_id: str = None,
+    wait: bool = False,
+    compress: bool = False,
+):
     """
     Automatically parse profiling data for NPU devices using CANN tools.
+
+    The PROF_* directories msprof recorded for this process since the previous
+    call make up the profiler session session_id, by default "<pid>_<n>" for the
+    n-th session of the process. They are exported and merged with the Paddle
+    trace in the background, see CannExportPipeline, and the merged traces are
+    named trace_view_<session_id>.json, or .json.gz if compress is set. Set wait
+    to block until they are done. Returns the session id.
     """
     prof_root_dir = os.getenv(
         "PROFILER_OUTPUT_DIR", os.path.join(os.getcwd(), "ascend_profiling")
     )
 
     if not is_npu_device():
-        return
+        return None
 
-    latest_prof_dir = find_latest_prof_directory(prof_root_dir)
-    if not latest_prof_dir:
-        print(f"No PROF directories found in {prof_root_dir}.")
-        return
+    return get_cann_export_pipeline().submit(
+        profiler_output_dir,
+        prof_root_dir,
+        session_id=session_id,
+        wait=wait,
+        compress=compress,
+    )
 
-    latest_prof_path = os.path.join(prof_root_dir, latest_prof_dir)
-    run_msprof_command(latest_prof_path)
-    merge_json_files(profiler_output_dir, latest_prof_path)
+
+class CannExportPipeline:
+    """
+    Exports and merges the CANN profiling data of profiler sessions while the job
+    goes on. Every PROF_* directory of a session is exported by msprof in a
+    worker thread, then merged with the Paddle trace in a worker process, so
+    that the directories of a session, and the sessions, are processed
+    concurrently. Pending work is finished when the process exits.
+
+    Use get_cann_export_pipeline() rather than creating one.
+    """
+
+    def __init__(self, max_workers=None):
+        self._max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self._exporter = ThreadPoolExecutor(
+            self._max_workers, thread_name_prefix="cann_export"
+        )
+        self._parser = None
+        self._lock = threading.Lock()
+        self._session_ids = itertools.count()
+        self._sessions = {}
+        self._claimed = set()
+        self._prof_pids = {}
+
+    def submit(
+        self,
+        profiler_output_dir: str,
+        prof_root_dir: str,
+        session_id: str = None,
+        wait: bool = False,
+        compress: bool = False,
+    ):
+        """
+        Claim the PROF_* directories of prof_root_dir recorded for this process
+        and not claimed yet for session_id, and export and merge them in the
+        background. Returns the session id.
+        """
+        pid = os.getpid()
+        with self._lock:
+            if session_id is None:
+                session_id = f"{pid}_{next(self._session_ids)}"
+            prof_paths = self._claim_prof_directories(prof_root_dir, pid)
+            if not prof_paths:
+                print(f"No PROF directories found in {prof_root_dir}.")
+                return session_id
+            self._sessions.setdefault(session_id, []).extend(
+                self._exporter.submit(
+                    self._export_and_merge,
+                    profiler_output_dir,
+                    prof_path,
+                    session_id,
+                    pid,
+                    compress,
+                )
+                for prof_path in prof_paths
+            )
+        if wait:
+            self.wait(session_id)
+        return session_id
+
+    def wait(self, session_id: str = None):
+        """
+        Wait for the exports of session_id, or of every session. Returns the
+        paths of the merged traces, None for a directory that failed.
+        """
+        with self._lock:
+            if session_id is None:
+                futures = [f for fs in self._sessions.values() for f in fs]
+                self._sessions = {}
+            else:
+                futures = self._sessions.pop(session_id, [])
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        """Finish the pending exports and stop the workers."""
+        self.wait()
+        self._exporter.shutdown()
+        if self._parser is not None:
+            self._parser.shutdown()
+
+    def _claim_prof_directories(self, prof_root_dir, pid):
+        try:
+            prof_paths = [
+                os.path.join(prof_root_dir, d)
+                for d in os.listdir(prof_root_dir)
+                if d.startswith("PROF_")
+            ]
+        except (FileNotFoundError, PermissionError) as e:
+            print(f"Error accessing {prof_root_dir}: {e!s}")
+            return []
+        prof_paths = [path for path in prof_paths if path not in self._claimed]
+        for path in prof_paths:
+            if path not in self._prof_pids:
+                prof_pid, _ = _prof_process(path)
+                if prof_pid is not None:
+                    self._prof_pids[path] = prof_pid
+        owned = [path for path in prof_paths if self._prof_pids.get(path) == pid]
+        if not owned and not any(path in self._prof_pids for path in prof_paths):
+            # msprof recorded no pid, the latest directory is this session's
+            latest_prof_dir = find_latest_prof_directory(prof_root_dir)
+            if latest_prof_dir:
+                latest_prof_path = os.path.join(prof_root_dir, latest_prof_dir)
+                if latest_prof_path not in self._claimed:
+                    owned = [latest_prof_path]
+        self._claimed.update(owned)
+        return sorted(owned)
+
+    def _export_and_merge(
+        self, profiler_output_dir, prof_path, session_id, pid, compress
+    ):
+        if not run_msprof_command(prof_path):
+            return None
+        with self._lock:
+            if self._parser is None:
+                # parsing holds the GIL, and forking would copy the device runtime
+                self._parser = ProcessPoolExecutor(
+                    self._max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            parser = self._parser
+        args = (profiler_output_dir, prof_path, compress, session_id, pid)
+        try:
+            future = parser.submit(merge_json_files, *args)
+        except RuntimeError:
+            # concurrent.futures takes no new work once the interpreter exits,
+            # the sessions still exporting then are merged in this thread
+            return merge_json_files(*args)
+        return future.result()
+
+
+_cann_export_pipeline = None
+_cann_export_pipeline_lock = threading.Lock()
+
+
+def get_cann_export_pipeline():
+    """
+    Get the CannExportPipeline of this process, created on first use.
+    """
+    global _cann_export_pipeline
+    with _cann_export_pipeline_lock:
+        if _cann_export_pipeline is None:
+            _cann_export_pipeline = CannExportPipeline()
+            atexit.register(_cann_export_pipeline.shutdown)
+        return _cann_export_pipeline
 
 
 def is_npu_device():
@@ -82,18 +245,31 @@ def run_msprof_command(prof_dir):
     """
     Run the msprof command to export profiling data.
     """
-    msprof_command = f"msprof --export=on --output={prof_dir}"
-    print(f"Running msprof command: {msprof_command}")
+    msprof_command = ["msprof", "--export=on", f"--output={prof_dir}"]
+    print(f"Running msprof command: {' '.join(msprof_command)}")
     try:
-        subprocess.run(msprof_command, shell=True, check=True)
+        subprocess.run(msprof_command, check=True)
         print("Profiling data parsed successfully.")
-    except subprocess.CalledProcessError as e:
+        return True
+    except (subprocess.CalledProcessError, OSError) as e:
         print(f"Error running msprof command: {e!s}")
+        return False
 
 
-def merge_json_files(profiler_output_dir: str, latest_prof_path: str):
+def merge_json_files(
+    profiler_output_dir: str,
+    latest_prof_path: str,
+    compress: bool = False,
+    session_id: str = None,
+    pid: int = None,
+):
     """
     Merge the JSON files from msprof and paddle, adjusting sort_index to ensure correct event order.
+
+    The traces are streamed event by event, see merge_trace_files, and the
+    merged trace is written compact, gzipped when compress is set. It is named
+    after session_id if given, and merges the Paddle trace of process pid if
+    given. Returns the path of the merged trace, or None.
     """
     try:
         msprof_json_path = find_latest_msprof_json(latest_prof_path)
@@ -101,42 +277,182 @@ def merge_json_files(profiler_output_dir: str, latest_prof_path: str):
             print(
                 f"No msprof JSON files found in {os.path.join(latest_prof_path, 'mindstudio_profiler_output')}."
             )
-            return
+            return None
 
-        paddle_json_path = find_latest_paddle_json(profiler_output_dir)
+        paddle_json_path = find_latest_paddle_json(profiler_output_dir, pid)
         if not paddle_json_path:
             print(f"No Paddle JSON files found in {profiler_output_dir}.")
-            return
-
-        msprof_data = load_json(msprof_json_path)
-        if not msprof_data:
-            print(f"msprof JSON file {msprof_json_path} is empty or invalid.")
-            return
-
-        paddle_data = load_json(paddle_json_path)
-        if not paddle_data:
-            print(f"Paddle JSON file {paddle_json_path} is empty or invalid.")
-            return
-
-        paddle_events = paddle_data.get("traceEvents", [])
-        msprof_events = msprof_data if isinstance(msprof_data, list) else []
-
-        adjust_paddle_sort_index(paddle_events, msprof_events)
-
-        merged_data = {"traceEvents": paddle_events + msprof_events}
+            return None
 
-        now = datetime.datetime.now()
-        file_name = f'trace_view_{now.strftime("%Y_%m_%d_%H_%M_%S")}.json'
+        if session_id is not None:
+            file_name = f"trace_view_{session_id}.json"
+        else:
+            now = datetime.datetime.now()
+            file_name = f'trace_view_{now.strftime("%Y_%m_%d_%H_%M_%S")}.json'
+        if compress:
+            file_name += ".gz"
         msprof_output_dir = os.path.join(latest_prof_path, "mindstudio_profiler_output")
         output_json_path = os.path.join(msprof_output_dir, file_name)
 
         os.makedirs(msprof_output_dir, exist_ok=True)
 
-        save_json(merged_data, output_json_path)
+        merge_trace_files(paddle_json_path, msprof_json_path, output_json_path)
         print(f"Merged JSON file saved to {output_json_path}")
+        return output_json_path
 
     except Exception as e:
         print(f"Error during JSON merge: {e!s}")
+        return None
+
+
+def merge_trace_files(paddle_json_path, msprof_json_path, output_json_path):
+    """
+    Merge the events of the Paddle and msprof traces into output_json_path
+    without loading either trace. Events are written as they are parsed, except
+    the few carrying a sort_index: those of Paddle are kept until the smallest
+    sort_index of both traces is known and written last, shifted to appear
+    before the msprof ones. Paths ending in .gz are read and written gzipped.
+    Returns the number of events written.
+    """
+    count = 0
+    sorted_events = []
+    min_sort_index_msprof = None
+    tmp_path = output_json_path + ".tmp"
+    with _open_trace(tmp_path, "wt", output_json_path.endswith(".gz")) as out:
+        out.write('{"traceEvents":[')
+
+        def write(event):
+            nonlocal count
+            if count:
+                out.write(",")
+            out.write(json.dumps(event, separators=(",", ":")))
+            count += 1
+
+        for event in iter_trace_events(paddle_json_path):
+            if "sort_index" in event.get("args", {}):
+                sorted_events.append(event)
+            else:
+                write(event)
+        for event in iter_trace_events(msprof_json_path):
+            sort_index = event.get("args", {}).get("sort_index")
+            if sort_index is not None and (
+                min_sort_index_msprof is None or sort_index < min_sort_index_msprof
+            ):
+                min_sort_index_msprof = sort_index
+            write(event)
+        min_sort_index_paddle = min(
+            (event["args"]["sort_index"] for event in sorted_events), default=0
+        )
+        adjustment_value = (min_sort_index_msprof or 0) - min_sort_index_paddle - 1
+        for event in sorted_events:
+            event["args"]["sort_index"] += adjustment_value
+            write(event)
+        out.write("]}")
+    os.replace(tmp_path, output_json_path)
+    return count
+
+
+_TRACE_READ_SIZE = 1 << 20
+_WHITESPACE = re.compile(r"\s*")
+
+
+def _open_trace(file_path, mode, compressed=None):
+    if compressed is None:
+        compressed = file_path.endswith(".gz")
+    if compressed:
+        return gzip.open(file_path, mode, encoding="utf-8")
+    return open(file_path, mode, encoding="utf-8")
+
+
+class _JsonStream:
+    """
+    Reads JSON values one at a time from a text file, holding no more than a
+    read buffer and the value being parsed.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self._f.read(_TRACE_READ_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos :] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next character that is not whitespace, "" at the end."""
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def take(self, expected):
+        """Consumes the next character, which must be one of expected."""
+        char = self.peek()
+        if not char or char not in expected:
+            raise ValueError(f"Expected one of {expected!r} in trace, got {char!r}")
+        self._pos += 1
+        return char
+
+    def value(self):
+        """Parses the next value, reading until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number may go on in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def array(self):
+        """Yields the values of the next array."""
+        self.take("[")
+        if self.peek() == "]":
+            self.take("]")
+            return
+        while True:
+            yield self.value()
+            if self.take(",]") == "]":
+                return
+
+
+def iter_trace_events(file_path):
+    """
+    Yield the events of a Chrome trace file one at a time: either a JSON array of
+    events, as msprof writes, or an object with a traceEvents array, as Paddle
+    writes. The other members of the object are skipped.
+    """
+    with _open_trace(file_path, "rt") as f:
+        stream = _JsonStream(f)
+        if stream.peek() == "[":
+            yield from stream.array()
+            return
+        stream.take("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.take(":")
+            if key == "traceEvents":
+                yield from stream.array()
+            else:
+                stream.value()
+            if stream.take(",}") == "}":
+                return
 
 
 def find_latest_msprof_json(prof_dir):
@@ -164,15 +480,17 @@ def find_latest_msprof_json(prof_dir):
         return None
 
 
-def find_latest_paddle_json(profiler_output_dir: str) -> str:
+def find_latest_paddle_json(profiler_output_dir: str, pid: int = None) -> str:
     """
-    Find the latest Paddle JSON file in the current working directory.
+    Find the latest Paddle JSON file in the current working directory, of process
+    pid if given.
     """
     try:
         paddle_json_files = [
             f
             for f in os.listdir(profiler_output_dir)
             if f.endswith(".paddle_trace.json")
+            and (pid is None or trace_pid(os.path.join(profiler_output_dir, f)) == pid)
         ]
         if not paddle_json_files:
             return None
@@ -188,56 +506,29 @@ def find_latest_paddle_json(profiler_output_dir: str) -> str:
         return None
 
 
-def load_json(file_path):
+def trace_pid(file_path):
     """
-    Load a JSON file from the specified path.
+    Get the pid of the first event of a trace, the process a Paddle trace was
+    recorded in.
     """
+    events = iter_trace_events(file_path)
     try:
-        with open(file_path, "r") as f:
-            return json.load(f)
-    except json.JSONDecodeError as e:
-        print(f"Error loading JSON file {file_path}: {e!s}")
-        return None
-    except (FileNotFoundError, PermissionError) as e:
-        print(f"Error opening JSON file {file_path}: {e!s}")
-        return None
-
-
-def save_json(data, file_path):
-    """
-    Save the given data to a JSON file at the specified path.
-    """
-    try:
-        with open(file_path, "w") as f:
-            json.dump(data, f, indent=2)
-    except (OSError, PermissionError) as e:
-        print(f"Error saving JSON file {file_path}: {e!s}")
-
-
-def adjust_paddle_sort_index(paddle_events, msprof_events):
-    """
-    Adjust the sort_index of Paddle events to ensure they appear before MSProf events.
-    """
-    min_sort_index_msprof = min(
-        (
-            event.get("args", {}).get("sort_index", float("inf"))
-            for event in msprof_events
-            if "args" in event
-        ),
-        default=0,
-    )
-
-    min_sort_index_paddle = min(
-        (
-            event.get("args", {}).get("sort_index", float("inf"))
-            for event in paddle_events
-            if "args" in event
-        ),
-        default=0,
-    )
-
-    adjustment_value = min_sort_index_msprof - min_sort_index_paddle - 1
-
-    for event in paddle_events:
-        if "args" in event and "sort_index" in event["args"]:
-            event["args"]["sort_index"] += adjustment_value
+        return next((event["pid"] for event in events if "pid" in event), None)
+    finally:
+        events.close()
+
+
+def _prof_process(prof_path):
+    """The pid and the device id msprof recorded a PROF_* directory for."""
+    pid = None
+    device = None
+    for info_path in sorted(glob.glob(os.path.join(prof_path, "*", "info.json*"))):
+        sub_dir = os.path.basename(os.path.dirname(info_path))
+        if sub_dir.startswith("device_") and sub_dir[len("device_") :].isdigit():
+            device = int(sub_dir[len("device_") :])
+        try:
+            with open(info_path, encoding="utf-8") as f:
+                pid = int(json.load(f).get("pid", pid))
+        except (OSError, ValueError, TypeError):
+            continue
+    return pid, device
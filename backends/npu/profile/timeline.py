@@ -0,0 +1,611 @@
+#   Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import bisect
+import decimal
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .cann_export import (
+    _open_trace,
+    _prof_process,
+    find_latest_msprof_json,
+    iter_trace_events,
+    run_msprof_command,
+    trace_pid,
+)
+
+# msprof processes of the CANN calls of the host, of the device tasks and of
+# the collectives
+_HOST_PROCESSES = ("CANN", "AscendCL")
+_DEVICE_PROCESSES = ("Ascend Hardware",)
+_COMMUNICATION_PROCESSES = ("HCCL", "Communication")
+# Paddle spans the CANN calls of a kernel are made in, the first found is used
+_LAUNCH_CATEGORIES = (
+    "DygraphKernelLaunch",
+    "StaticKernelLaunch",
+    "OperatorInner",
+    "Operator",
+)
+# the processes of rank r get the pids and sort indexes from r * _RANK_STRIDE
+_RANK_STRIDE = 1000
+_FLOW_PHASES = ("s", "t", "f")
+
+
+def find_rank_traces(profiler_output_dir: str, prof_root_dir: str):
+    """
+    Pair the latest Paddle trace of every process in profiler_output_dir with the
+    latest PROF_* directory msprof recorded for the same process in prof_root_dir.
+
+    Returns a (paddle_json_path, prof_path) pair for every rank, ordered by the
+    device of the PROF_* directory, which is the rank order of one node. Pass the
+    pairs in rank order to fuse_rank_timelines otherwise.
+    """
+    traces = {}
+    for file_name in os.listdir(profiler_output_dir):
+        if not file_name.endswith(".paddle_trace.json"):
+            continue
+        path = os.path.join(profiler_output_dir, file_name)
+        pid = trace_pid(path)
+        if pid is not None and (
+            pid not in traces or os.path.getctime(path) > os.path.getctime(traces[pid])
+        ):
+            traces[pid] = path
+
+    profs = {}
+    for dir_name in os.listdir(prof_root_dir):
+        path = os.path.join(prof_root_dir, dir_name)
+        if not dir_name.startswith("PROF_") or not os.path.isdir(path):
+            continue
+        pid, device = _prof_process(path)
+        if pid is not None and (
+            pid not in profs or os.path.getctime(path) > os.path.getctime(profs[pid][1])
+        ):
+            profs[pid] = (device, path)
+
+    ranks = []
+    for pid, paddle_json_path in traces.items():
+        if pid not in profs:
+            print(f"No PROF directory found for Paddle trace {paddle_json_path}.")
+            continue
+        device, prof_path = profs[pid]
+        ranks.append((device, pid, paddle_json_path, prof_path))
+    ranks.sort(key=lambda rank: (rank[0] is None, rank[0] or 0, rank[1]))
+    return [
+        (paddle_json_path, prof_path) for _, _, paddle_json_path, prof_path in ranks
+    ]
+
+
+def fuse_rank_timelines(
+    ranks,
+    output_path: str,
+    top: int = 20,
+    max_offset: float = 5e4,
+    max_workers=None,
+):
+    """
+    Fuse the Paddle and msprof traces of every rank into one timeline.
+
+    The msprof timestamps of every rank are moved onto the clock of its Paddle
+    trace by estimate_clock_offset, the processes of rank r are renamed
+    "Rank r ..." and sorted together, and flow ids are made unique across ranks.
+    The ranks are processed in parallel, each in a spawned process writing its
+    events to a fragment that is appended to output_path, gzipped if it ends in
+    .gz.
+
+    Besides the timeline, a summary of every rank is written next to it as
+    <output_path>.summary.json, and printed, see format_summary: the device time
+    of the top kernels, the idle gaps between the tasks of every stream, and how
+    much of the communication overlaps computation.
+
+    Args:
+        ranks (list): the (paddle_json_path, prof_path) of every rank, in rank
+            order, see find_rank_traces
+        output_path (str): the fused trace
+        top (int): the number of kernels and gaps of the summary
+        max_offset (float): the largest clock offset in us, see
+            estimate_clock_offset
+        max_workers (int): the number of processes, one per rank by default
+
+    Returns:
+        dict: the summary
+    """
+    jobs = []
+    for paddle_json_path, prof_path in ranks:
+        msprof_json_path = find_latest_msprof_json(prof_path)
+        if not msprof_json_path:
+            run_msprof_command(prof_path)
+            msprof_json_path = find_latest_msprof_json(prof_path)
+        if not msprof_json_path:
+            raise FileNotFoundError(f"No msprof JSON files found in {prof_path}.")
+        jobs.append((paddle_json_path, msprof_json_path))
+
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(output_dir, exist_ok=True)
+    fragment_dir = tempfile.mkdtemp(prefix=".fragments_", dir=output_dir)
+    try:
+        args = [
+            (
+                rank,
+                paddle_json_path,
+                msprof_json_path,
+                os.path.join(fragment_dir, f"rank{rank}.json"),
+                top,
+                max_offset,
+            )
+            for rank, (paddle_json_path, msprof_json_path) in enumerate(jobs)
+        ]
+        if len(args) <= 1 or max_workers == 1:
+            summaries = [_fuse_rank(*arg) for arg in args]
+        else:
+            # parsing holds the GIL, and forking would copy the device runtime
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(
+                max_workers or min(len(args), os.cpu_count() or 1),
+                mp_context=context,
+            ) as pool:
+                futures = [pool.submit(_fuse_rank, *arg) for arg in args]
+                summaries = [future.result() for future in futures]
+
+        tmp_path = output_path + ".tmp"
+        with _open_trace(tmp_path, "wt", output_path.endswith(".gz")) as out:
+            out.write('{"traceEvents":[')
+            written = False
+            for arg, summary in zip(args, summaries):
+                if not summary["events"]:
+                    continue
+                if written:
+                    out.write(",")
+                with open(arg[3], encoding="utf-8") as fragment:
+                    shutil.copyfileobj(fragment, out)
+                written = True
+            out.write("]}")
+        os.replace(tmp_path, output_path)
+    finally:
+        shutil.rmtree(fragment_dir, ignore_errors=True)
+
+    summary = {"trace": output_path, "ranks": summaries}
+    with open(output_path + ".summary.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print(format_summary(summary))
+    print(f"Fused trace of {len(summaries)} ranks saved to {output_path}")
+    return summary
+
+
+def estimate_clock_offset(spans, calls, max_offset: float = 5e4, samples: int = 512):
+    """
+    Estimate the offset to add to the msprof timestamps of a rank to put them on
+    the clock of its Paddle trace.
+
+    A thread makes its CANN calls while Paddle launches a kernel on it, so the
+    offset is taken in the middle of the range of offsets that puts the most
+    calls inside a launch span of their thread. Up to `samples` calls spread over
+    the trace are used, and offsets within max_offset us only.
+
+    Args:
+        spans (dict): the sorted (start, end) launch spans of every thread id,
+            from the Paddle trace
+        calls (dict): the (start, end) CANN calls of every thread id, from the
+            msprof trace
+
+    Returns:
+        float: the offset in us, 0 when no offset puts a call in a launch span
+    """
+    calls = sorted(
+        (start, end, tid)
+        for tid, thread_calls in calls.items()
+        if spans.get(tid)
+        for start, end in thread_calls
+    )
+    if not calls:
+        return 0.0
+    starts = {
+        tid: [start for start, _ in thread_spans] for tid, thread_spans in spans.items()
+    }
+    longest = {
+        tid: max(end - start for start, end in thread_spans)
+        for tid, thread_spans in spans.items()
+        if thread_spans
+    }
+
+    bounds = []
+    for start, end, tid in calls[:: max(1, len(calls) // samples)]:
+        # the offsets putting the call in every launch span that can hold it
+        ranges = []
+        lo = bisect.bisect_left(starts[tid], start - max_offset - longest[tid])
+        hi = bisect.bisect_right(starts[tid], start + max_offset)
+        for span_start, span_end in spans[tid][lo:hi]:
+            low = max(span_start - start, -max_offset)
+            high = min(span_end - end, max_offset)
+            if low <= high:
+                ranges.append((low, high))
+        # count every call once, even in nested spans
+        for low, high in _union(ranges):
+            bounds.append((low, 0))
+            bounds.append((high, 1))
+    if not bounds:
+        return 0.0
+
+    bounds.sort()
+    best, best_offset, count = 0, 0.0, 0
+    for i, (value, kind) in enumerate(bounds):
+        if kind == 0:
+            count += 1
+            # a range of offsets starts, up to the next bound
+            offset = (value + bounds[i + 1][0]) / 2
+            if count > best or (count == best and abs(offset) < abs(best_offset)):
+                best, best_offset = count, offset
+        else:
+            count -= 1
+    return best_offset
+
+
+def format_summary(summary, top: int = 10):
+    """
+    Format the summary of fuse_rank_timelines as text tables: one line per rank
+    with its clock offset, device busy and idle time and communication overlap,
+    then the top kernels by device time and the largest gaps of every rank.
+    """
+    lines = [
+        f"{'Rank':>4} {'Offset(us)':>12} {'Tasks':>9} {'Busy(us)':>14} "
+        f"{'Idle(us)':>14} {'Comm(us)':>14} {'Exposed(us)':>14} {'Overlap':>8}"
+    ]
+    for rank in summary["ranks"]:
+        gaps, comm = rank["launch_gaps"], rank["communication"]
+        lines.append(
+            f"{rank['rank']:>4} {rank['clock_offset_us']:>12.3f} {gaps['tasks']:>9} "
+            f"{gaps['busy_us']:>14.3f} {gaps['idle_us']:>14.3f} "
+            f"{comm['comm_us']:>14.3f} {comm['exposed_us']:>14.3f} "
+            f"{comm['overlap_ratio']:>8.2%}"
+        )
+    for rank in summary["ranks"]:
+        lines.append("")
+        lines.append(f"Rank {rank['rank']} device time")
+        lines.append(
+            f"{'Count':>8} {'Total(us)':>14} {'Avg(us)':>12} {'Max(us)':>12}  Name"
+        )
+        for op in rank["device_ops"][:top]:
+            lines.append(
+                f"{op['count']:>8} {op['total_us']:>14.3f} {op['avg_us']:>12.3f} "
+                f"{op['max_us']:>12.3f}  {op['name']}"
+            )
+        lines.append(f"Rank {rank['rank']} launch gaps")
+        lines.append(f"{'Stream':>8} {'Gap(us)':>14}  After -> Before")
+        for gap in rank["launch_gaps"]["largest"][:top]:
+            lines.append(
+                f"{gap['stream']!s:>8} {gap['gap_us']:>14.3f}  "
+                f"{gap['after']} -> {gap['before']}"
+            )
+    return "\n".join(lines)
+
+
+def _fuse_rank(
+    rank, paddle_json_path, msprof_json_path, fragment_path, top, max_offset
+):
+    """
+    Write the events of one rank to fragment_path, comma separated, and return
+    its summary. The traces are read twice: for the processes and the clock
+    offset first, then to write the events and gather the summary.
+    """
+    spans = {}
+    paddle_pids = {}
+    for event in iter_trace_events(paddle_json_path):
+        if "pid" not in event:
+            continue
+        paddle_pids.setdefault(event["pid"], event["pid"])
+        if event.get("ph") == "M" and event.get("name") == "process_sort_index":
+            paddle_pids[event["pid"]] = event["args"]["sort_index"]
+        elif event.get("ph") == "X" and event.get("cat") in _LAUNCH_CATEGORIES:
+            start = float(event["ts"])
+            spans.setdefault(event["cat"], {}).setdefault(
+                _thread_id(event.get("tid")), []
+            ).append((start, start + float(event.get("dur", 0))))
+    spans = next((spans[c] for c in _LAUNCH_CATEGORIES if c in spans), {})
+    for thread_spans in spans.values():
+        thread_spans.sort()
+
+    names = {}
+    msprof_pids = {}
+    calls = {}
+    for event in iter_trace_events(msprof_json_path):
+        if "pid" not in event:
+            continue
+        pid = event["pid"]
+        msprof_pids.setdefault(pid, float("inf"))
+        if event.get("ph") == "M":
+            if event.get("name") == "process_name":
+                names[pid] = event["args"]["name"]
+            elif event.get("name") == "process_sort_index":
+                msprof_pids[pid] = event["args"]["sort_index"]
+        elif event.get("ph") == "X":
+            tid = _thread_id(event.get("tid"))
+            if tid in spans:
+                start = float(event["ts"])
+                calls.setdefault(pid, {}).setdefault(tid, []).append(
+                    (start, start + float(event.get("dur", 0)))
+                )
+    host_calls = {}
+    for pid, threads in calls.items():
+        if names.get(pid) in _HOST_PROCESSES:
+            for tid, thread_calls in threads.items():
+                host_calls.setdefault(tid, []).extend(thread_calls)
+    offset = estimate_clock_offset(spans, host_calls, max_offset)
+
+    # the Paddle processes first, then msprof's in its order
+    processes = [("paddle", pid) for pid in sorted(paddle_pids, key=paddle_pids.get)]
+    processes += [
+        ("msprof", pid)
+        for pid in sorted(msprof_pids, key=lambda pid: (msprof_pids[pid], str(pid)))
+    ]
+    if len(processes) > _RANK_STRIDE:
+        raise ValueError(
+            f"Rank {rank} has {len(processes)} processes, more than {_RANK_STRIDE}."
+        )
+    pid_map = {process: rank * _RANK_STRIDE + i for i, process in enumerate(processes)}
+    ts_offset = decimal.Decimal(offset)
+
+    count = 0
+    ops = {}
+    streams = {}
+    compute = []
+    comm = []
+    with open(fragment_path, "w", encoding="utf-8") as out:
+
+        def write(event):
+            nonlocal count
+            if count:
+                out.write(",")
+            out.write(json.dumps(event, separators=(",", ":")))
+            count += 1
+
+        for pid in pid_map.values():
+            write(
+                {
+                    "name": "process_sort_index",
+                    "ph": "M",
+                    "pid": pid,
+                    "args": {"sort_index": pid},
+                }
+            )
+            write(
+                {
+                    "name": "process_labels",
+                    "ph": "M",
+                    "pid": pid,
+                    "args": {"labels": f"rank {rank}"},
+                }
+            )
+        for source, path in (
+            ("paddle", paddle_json_path),
+            ("msprof", msprof_json_path),
+        ):
+            for event in iter_trace_events(path):
+                if not event:
+                    continue
+                pid = event.get("pid")
+                if event.get("ph") == "M":
+                    if event.get("name") == "process_sort_index":
+                        continue
+                    if event.get("name") == "process_name":
+                        event["args"]["name"] = f"Rank {rank} {event['args']['name']}"
+                if pid is not None:
+                    event["pid"] = pid_map[(source, pid)]
+                if source == "msprof":
+                    if "ts" in event:
+                        event["ts"] = _shift_ts(event["ts"], ts_offset)
+                    if event.get("ph") in _FLOW_PHASES and "id" in event:
+                        event["id"] = f"{rank}:{event['id']}"
+                    if event.get("ph") == "X":
+                        process = names.get(pid)
+                        start = float(event["ts"])
+                        end = start + float(event.get("dur", 0))
+                        is_comm = process in _COMMUNICATION_PROCESSES or str(
+                            event.get("name", "")
+                        ).startswith("hcom")
+                        if process in _DEVICE_PROCESSES:
+                            op = ops.setdefault(event.get("name", ""), [0, 0.0, 0.0])
+                            op[0] += 1
+                            op[1] += end - start
+                            op[2] = max(op[2], end - start)
+                            streams.setdefault(event.get("tid"), []).append(
+                                (start, end, event.get("name", ""))
+                            )
+                            if not is_comm:
+                                compute.append((start, end))
+                        if is_comm:
+                            comm.append((start, end))
+                write(event)
+
+    return {
+        "rank": rank,
+        "paddle_trace": paddle_json_path,
+        "msprof_trace": msprof_json_path,
+        "clock_offset_us": offset,
+        "events": count,
+        "device_ops": _device_ops(ops, top),
+        "launch_gaps": _launch_gaps(streams, top),
+        "communication": _communication(compute, comm),
+    }
+
+
+def _device_ops(ops, top):
+    """The kernels with the most device time."""
+    return [
+        {
+            "name": name,
+            "count": count,
+            "total_us": total,
+            "avg_us": total / count,
+            "max_us": longest,
+        }
+        for name, (count, total, longest) in sorted(
+            ops.items(), key=lambda item: item[1][1], reverse=True
+        )[:top]
+    ]
+
+
+def _launch_gaps(streams, top):
+    """The time the device is idle, and the largest gaps between tasks of a stream."""
+    gaps = []
+    tasks = []
+    for stream, stream_tasks in streams.items():
+        stream_tasks.sort()
+        end, name = None, None
+        for task_start, task_end, task_name in stream_tasks:
+            if end is not None and task_start > end:
+                gaps.append((task_start - end, stream, end, name, task_name))
+            if end is None or task_end > end:
+                end, name = task_end, task_name
+        tasks.extend((start, end) for start, end, _ in stream_tasks)
+    busy = _union(tasks)
+    busy_us = _length(busy)
+    gaps.sort(key=lambda gap: gap[0], reverse=True)
+    return {
+        "streams": len(streams),
+        "tasks": len(tasks),
+        "busy_us": busy_us,
+        "idle_us": busy[-1][1] - busy[0][0] - busy_us if busy else 0.0,
+        "gaps": len(gaps),
+        "gap_us": sum(gap[0] for gap in gaps),
+        "largest": [
+            {
+                "stream": stream,
+                "start": start,
+                "gap_us": gap,
+                "after": after,
+                "before": before,
+            }
+            for gap, stream, start, after, before in gaps[:top]
+        ],
+    }
+
+
+def _communication(compute, comm):
+    """The communication time, and how much of it overlaps computation."""
+    comm = _union(comm)
+    comm_us = _length(comm)
+    overlapped_us = _overlap(_union(compute), comm)
+    return {
+        "comm_us": comm_us,
+        "overlapped_us": overlapped_us,
+        "exposed_us": comm_us - overlapped_us,
+        "overlap_ratio": overlapped_us / comm_us if comm_us else 0.0,
+    }
+
+
+def _shift_ts(ts, offset):
+    """
+    ts + offset in the format of ts. msprof writes timestamps as strings of us
+    with ns digits, which a float of the epoch time cannot hold, so those are
+    shifted exactly and keep their decimals.
+    """
+    if not isinstance(ts, str):
+        return round(float(ts) + float(offset), 3)
+    value = decimal.Decimal(ts)
+    return str((value + offset).quantize(value))
+
+
+def _thread_id(tid):
+    """The thread id of a tid, which Paddle writes like "1234(C++)"."""
+    if isinstance(tid, int):
+        return tid
+    tid = str(tid).split("(", 1)[0]
+    return int(tid) if tid.isdigit() else None
+
+
+def _union(intervals):
+    """The sorted, disjoint intervals covering `intervals`."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _length(intervals):
+    return sum(end - start for start, end in intervals)
+
+
+def _overlap(first, second):
+    """The length of the intersection of two unions of intervals."""
+    i = j = 0
+    length = 0.0
+    while i < len(first) and j < len(second):
+        length += max(
+            0.0, min(first[i][1], second[j][1]) - max(first[i][0], second[j][0])
+        )
+        if first[i][1] < second[j][1]:
+            i += 1
+        else:
+            j += 1
+    return length
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fuse the Paddle and CANN traces of every rank into one timeline."
+    )
+    parser.add_argument(
+        "--paddle_dir",
+        type=str,
+        required=True,
+        help="The directory of the Paddle traces of every rank.",
+    )
+    parser.add_argument(
+        "--prof_dir",
+        type=str,
+        default=os.getenv(
+            "PROFILER_OUTPUT_DIR", os.path.join(os.getcwd(), "ascend_profiling")
+        ),
+        help="The directory of the PROF_* directories of every rank, default is "
+        "$PROFILER_OUTPUT_DIR or ./ascend_profiling.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="trace_view_ranks.json.gz",
+        help="The fused trace, gzipped if it ends in .gz, default is "
+        "trace_view_ranks.json.gz.",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="The number of kernels and gaps of the summary, default is 20.",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=None,
+        help="The number of processes, default is one per rank.",
+    )
+    args = parser.parse_args()
+
+    ranks = find_rank_traces(args.paddle_dir, args.prof_dir)
+    if not ranks:
+        print(f"No ranks found in {args.paddle_dir} and {args.prof_dir}.")
+        return
+    fuse_rank_timelines(ranks, args.output, top=args.top, max_workers=args.max_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from paddle_custom_device.npu.profile import cann_export
+
+PADDLE_EVENTS = [
+    {"name": "process_sort_index", "ph": "M", "pid": 7, "args": {"sort_index": 3}},
+    {"name": "matmul", "ph": "X", "pid": 7, "ts": 1792357167212185, "dur": 1.5},
+    {"name": "thread_sort_index", "ph": "M", "pid": 7, "args": {"sort_index": 5}},
+    {"name": 'add é\\"', "ph": "X", "pid": 7, "ts": -2.5e-3, "args": {}},
+    {},
+]
+MSPROF_EVENTS = [
+    {"name": "process_sort_index", "ph": "M", "pid": 1, "args": {"sort_index": 10}},
+    {"name": "aclnnAdd", "ph": "X", "pid": 1, "ts": "1792357167212185.123"},
+    {"name": "process_sort_index", "ph": "M", "pid": 2, "args": {"sort_index": 8}},
+    {"name": "hcom", "ph": "X", "pid": 2, "ts": 12345678901234567890, "dur": 0},
+]
+
+
+class TestCannExport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.read_size = cann_export._TRACE_READ_SIZE
+
+    def tearDown(self):
+        cann_export._TRACE_READ_SIZE = self.read_size
+        self.dir.cleanup()
+
+    def write(self, name, data, text=None):
+        path = os.path.join(self.dir.name, name)
+        with cann_export._open_trace(path, "wt") as f:
+            f.write(json.dumps(data, indent=1) if text is None else text)
+        return path
+
+    def events(self, path):
+        with cann_export._open_trace(path, "rt") as f:
+            return json.load(f)["traceEvents"]
+
+    def test_values_split_across_reads(self):
+        paddle_path = self.write(
+            "a.paddle_trace.json",
+            {
+                "schemaVersion": "1.0.2",
+                "ExtraInfo": {"1": [1, 2.5, None, True]},
+                "traceEvents": PADDLE_EVENTS,
+                "span_index": 0,
+            },
+        )
+        msprof_path = self.write("msprof_1.json", MSPROF_EVENTS)
+        for read_size in (1, 2, 3, 7, 64, 1 << 20):
+            cann_export._TRACE_READ_SIZE = read_size
+            self.assertEqual(
+                list(cann_export.iter_trace_events(paddle_path)), PADDLE_EVENTS
+            )
+            self.assertEqual(
+                list(cann_export.iter_trace_events(msprof_path)), MSPROF_EVENTS
+            )
+
+    def test_empty_traces(self):
+        cann_export._TRACE_READ_SIZE = 1
+        for text in ("[]", " [ ] ", "{}", '{"traceEvents": []}', '{"a": {}}'):
+            path = self.write("empty.json", None, text)
+            self.assertEqual(list(cann_export.iter_trace_events(path)), [])
+        path = self.write("bad.json", None, '{"traceEvents": [1 2]}')
+        with self.assertRaises(ValueError):
+            list(cann_export.iter_trace_events(path))
+
+    def test_sort_index_shift(self):
+        cann_export._TRACE_READ_SIZE = 7
+        paddle_path = self.write("a.paddle_trace.json", {"traceEvents": PADDLE_EVENTS})
+        msprof_path = self.write("msprof_1.json", MSPROF_EVENTS)
+        output_path = os.path.join(self.dir.name, "merged.json")
+        count = cann_export.merge_trace_files(paddle_path, msprof_path, output_path)
+        events = self.events(output_path)
+        self.assertEqual(count, len(PADDLE_EVENTS) + len(MSPROF_EVENTS))
+        self.assertEqual(len(events), count)
+        # smallest msprof sort_index 8, smallest Paddle one 3
+        sort_indexes = [
+            e["args"]["sort_index"] for e in events if "sort_index" in e.get("args", {})
+        ]
+        self.assertEqual(sort_indexes, [10, 8, 7, 9])
+        self.assertIn(MSPROF_EVENTS[3], events)
+        self.assertIn(PADDLE_EVENTS[3], events)
+        self.assertFalse(os.path.exists(output_path + ".tmp"))
+
+    def test_gzip(self):
+        paddle_path = self.write(
+            "a.paddle_trace.json.gz", {"traceEvents": PADDLE_EVENTS}
+        )
+        msprof_path = self.write("msprof_1.json", MSPROF_EVENTS)
+        output_path = os.path.join(self.dir.name, "merged.json.gz")
+        cann_export.merge_trace_files(paddle_path, msprof_path, output_path)
+        with open(output_path, "rb") as f:
+            self.assertEqual(f.read(2), b"\x1f\x8b")
+        with gzip.open(output_path, "rt", encoding="utf-8") as f:
+            self.assertEqual(len(json.load(f)["traceEvents"]), 9)
+
+    def test_merge_json_files_compress(self):
+        prof_path = os.path.join(self.dir.name, "PROF_1")
+        os.makedirs(os.path.join(prof_path, "mindstudio_profiler_output"))
+        self.write(
+            os.path.join("PROF_1", "mindstudio_profiler_output", "msprof_1.json"),
+            MSPROF_EVENTS,
+        )
+        self.write("a.paddle_trace.json", {"traceEvents": PADDLE_EVENTS})
+        output_path = cann_export.merge_json_files(
+            self.dir.name, prof_path, compress=True, session_id="s0"
+        )
+        self.assertEqual(
+            output_path,
+            os.path.join(
+                prof_path, "mindstudio_profiler_output", "trace_view_s0.json.gz"
+            ),
+        )
+        self.assertEqual(len(self.events(output_path)), 9)
+
+    def test_exit_with_pending_session(self):
+        # msprof takes a while, the session is still exporting at exit
+        bin_dir = os.path.join(self.dir.name, "bin")
+        os.makedirs(bin_dir)
+        msprof_path = os.path.join(bin_dir, "msprof")
+        with open(msprof_path, "w") as f:
+            f.write(
+                textwrap.dedent(
+                    """\
+                    #!/bin/sh
+                    sleep 1
+                    out="${2#--output=}/mindstudio_profiler_output"
+                    mkdir -p "$out"
+                    echo '[{"name": "aclnnAdd", "ph": "X", "pid": 1}]' > "$out/msprof_1.json"
+                    """
+                )
+            )
+        os.chmod(msprof_path, 0o755)
+        script = textwrap.dedent(
+            """\
+            import json, os, sys
+            # the order that stops the process pool before the export threads
+            import concurrent.futures.thread
+            import concurrent.futures.process
+            from paddle_custom_device.npu.profile import cann_export
+
+            root = sys.argv[1]
+            os.makedirs(os.path.join(root, "PROF_1", "host"))
+            with open(os.path.join(root, "PROF_1", "host", "info.json"), "w") as f:
+                json.dump({"pid": os.getpid()}, f)
+            with open(os.path.join(root, "a.paddle_trace.json"), "w") as f:
+                json.dump({"traceEvents": [{"name": "add", "pid": os.getpid()}]}, f)
+            cann_export.get_cann_export_pipeline().submit(root, root, "s0")
+            """
+        )
+        env = dict(os.environ)
+        env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+        result = subprocess.run(
+            [sys.executable, "-c", script, self.dir.name],
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertNotIn("cannot schedule new futures", result.stdout + result.stderr)
+        output_path = os.path.join(
+            self.dir.name, "PROF_1", "mindstudio_profiler_output", "trace_view_s0.json"
+        )
+        self.assertEqual(len(self.events(output_path)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
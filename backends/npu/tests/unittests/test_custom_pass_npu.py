@@ -14,10 +14,16 @@
 
 from __future__ import print_function, division
 
+import json
 import os
+import tempfile
 import numpy as np
 import unittest
+from unittest import mock
 import paddle
+from paddle.incubate.passes import ir
+
+from paddle_custom_device.npu.passes import common
 
 paddle.enable_static()
 
@@ -86,5 +92,223 @@ class TestCustomPass(unittest.TestCase):
         np.testing.assert_allclose(results[0], np.sum(np_inputs, axis=0), rtol=1e-2)
 
 
+@ir.RegisterPass
+def fold_unary_pass():
+    def relu_pattern(x):
+        return ir.PassDesc.OP.relu(X=ir.PassDesc.OP.relu(X=x).Output("Out"))
+
+    def relu_replace(x):
+        return ir.PassDesc.OP.relu(X=x)
+
+    def tanh_pattern(x):
+        return ir.PassDesc.OP.tanh(X=ir.PassDesc.OP.tanh(X=x).Output("Out"))
+
+    def tanh_replace(x):
+        return ir.PassDesc.OP.tanh(X=x)
+
+    return [(relu_pattern, relu_replace), (tanh_pattern, tanh_replace)]
+
+
+@ir.RegisterPass
+def remove_scale_pass():
+    def pattern(x):
+        return ir.PassDesc.OP.scale(X=x)
+
+    def replace(x):
+        return x
+
+    return pattern, replace
+
+
+@ir.RegisterPass
+def fold_exp_pass():
+    def pattern(x):
+        return ir.PassDesc.OP.exp(X=ir.PassDesc.OP.exp(X=x).Output("Out"))
+
+    def replace(x):
+        return ir.PassDesc.OP.exp(X=x)
+
+    return pattern, replace
+
+
+@ir.RegisterPass
+def broken_pattern_pass():
+    def pattern(x):
+        raise RuntimeError("pattern cannot be built")
+
+    def replace(x):
+        return x
+
+    return pattern, replace
+
+
+TEST_PASSES = ["fold_unary_pass", "remove_scale_pass", "fold_exp_pass"]
+
+
+def append_op(block, op_type, **inputs):
+    out = block.create_var(dtype="float32", shape=[-1, 32])
+    block.append_op(
+        type=op_type,
+        inputs={name: [var] for name, var in inputs.items()},
+        outputs={"Out": [out]},
+    )
+    return out
+
+
+def build_program():
+    main = paddle.static.Program()
+    startup = paddle.static.Program()
+    with paddle.static.program_guard(main, startup):
+        x = paddle.static.data("x", [-1, 32], "float32")
+    block = main.global_block()
+    a = append_op(block, "relu", X=append_op(block, "relu", X=x))
+    b = append_op(block, "tanh", X=append_op(block, "tanh", X=x))
+    c = append_op(block, "tanh", X=append_op(block, "tanh", X=a))
+    out = append_op(block, "elementwise_add", X=append_op(block, "scale", X=b), Y=c)
+    return main, startup, x, out
+
+
+class TestApplyPasses(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(common, "getPasses", return_value=TEST_PASSES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_apply_passes(self):
+        main, _, _, _ = build_program()
+        desc, report = common.applyPasses(main, "llama", None)
+        self.assertEqual(
+            [(e["pass"], e["applied"], e["matches"]) for e in report],
+            [
+                ("fold_unary_pass", True, 3),
+                ("remove_scale_pass", True, 1),
+                ("fold_exp_pass", False, 0),
+            ],
+        )
+        self.assertEqual(
+            [(e["ops_before"], e["ops_after"]) for e in report],
+            [(8, 5), (5, 4), (4, 4)],
+        )
+        self.assertEqual(
+            common._op_type_counts(desc),
+            {"relu": 1, "tanh": 2, "elementwise_add": 1},
+        )
+        # the program given is not changed
+        self.assertEqual(len(main.global_block().ops), 8)
+        self.assertIn("skipped", common.formatPassReport(report))
+
+    def test_add_passes(self):
+        main = paddle.static.Program()
+        with paddle.static.program_guard(main, paddle.static.Program()):
+            x = paddle.static.data("x", [-1, 32], "float32")
+        block = main.global_block()
+        append_op(block, "scale", X=append_op(block, "relu", X=x))
+        # the pass builder belongs to the config
+        config = paddle.inference.Config()
+        registered = common.addPasses(
+            config.pass_builder(), "llama", None, program=main
+        )
+        self.assertEqual(registered, ["fold_unary_pass", "remove_scale_pass"])
+        self.assertEqual(config.pass_builder().all_passes()[-2:], registered)
+        config = paddle.inference.Config()
+        self.assertEqual(
+            common.addPasses(config.pass_builder(), "llama", None), TEST_PASSES
+        )
+
+    def test_pass_pattern(self):
+        self.assertEqual(
+            common._pass_pattern("fold_unary_pass"),
+            [(["relu", "relu"], ["relu"]), (["tanh", "tanh"], ["tanh"])],
+        )
+        self.assertEqual(common._pass_pattern("remove_scale_pass"), [(["scale"], [])])
+        paddle.disable_static()
+        try:
+            self.assertIsNone(common._pass_pattern("broken_pattern_pass"))
+            self.assertTrue(paddle.in_dynamic_mode())
+        finally:
+            paddle.enable_static()
+        self.assertNotIn("broken_pattern_pass", common._pass_patterns)
+        self.assertTrue(common._has_pattern_ops("broken_pattern_pass", set()))
+
+
+class TestGetOptimizedModel(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(common, "getPasses", return_value=TEST_PASSES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.cache_dir = os.path.join(self.dir.name, "cache")
+        self.model_file = os.path.join(self.dir.name, "model.pdmodel")
+        main, _, _, _ = build_program()
+        with open(self.model_file, "wb") as f:
+            f.write(main.desc.serialize_to_string())
+
+    def test_cache(self):
+        cached_model = common.getOptimizedModel(
+            self.model_file, "llama", None, self.cache_dir
+        )
+        self.assertEqual(os.path.dirname(cached_model), self.cache_dir)
+        self.assertEqual(
+            common._op_type_counts(common._program_desc(cached_model)),
+            {"relu": 1, "tanh": 2, "elementwise_add": 1},
+        )
+        manifest_path = cached_model[: -len(".pdmodel")] + ".json"
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["key"]["passes"], TEST_PASSES)
+        self.assertEqual([entry["matches"] for entry in manifest["report"]], [3, 1, 0])
+        self.assertEqual(
+            sorted(os.listdir(self.cache_dir)),
+            sorted(os.path.basename(p) for p in (cached_model, manifest_path)),
+        )
+
+        # replicas load the cached program
+        with mock.patch.object(common, "applyPasses") as apply_passes:
+            self.assertEqual(
+                common.getOptimizedModel(
+                    self.model_file, "llama", None, self.cache_dir
+                ),
+                cached_model,
+            )
+            apply_passes.assert_not_called()
+
+        # a changed cached program, or pass list, is not used
+        with open(cached_model, "ab") as f:
+            f.write(b"\0")
+        self.assertEqual(
+            common.getOptimizedModel(self.model_file, "llama", None, self.cache_dir),
+            cached_model,
+        )
+        self.assertEqual(
+            common._op_type_counts(common._program_desc(cached_model))["tanh"], 2
+        )
+        with mock.patch.object(common, "getPasses", return_value=TEST_PASSES[:1]):
+            self.assertNotEqual(
+                common.getOptimizedModel(
+                    self.model_file, "llama", None, self.cache_dir
+                ),
+                cached_model,
+            )
+
+    def test_not_cached(self):
+        with mock.patch.object(common, "getPasses", return_value=[]):
+            self.assertEqual(
+                common.getOptimizedModel(self.model_file, "bert", None, self.cache_dir),
+                self.model_file,
+            )
+        # the params file would not match the optimized program
+        with mock.patch.object(
+            common, "_persistable_vars", side_effect=[["w_fused"], ["w"]]
+        ):
+            self.assertEqual(
+                common.getOptimizedModel(
+                    self.model_file, "llama", None, self.cache_dir
+                ),
+                self.model_file,
+            )
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
 if __name__ == "__main__":
     unittest.main()
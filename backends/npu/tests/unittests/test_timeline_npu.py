@@ -0,0 +1,288 @@
+# Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import decimal
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+from paddle_custom_device.npu.profile import timeline
+
+OFFSETS = [1234.5, -321.25]
+TASKS = 10
+
+
+def launch_start(k):
+    # irregular spans, so that only the true offset fits every call
+    return 1000.0 + 100 * k + 7 * k * k
+
+
+def write_rank(root, rank, offset):
+    """
+    Write the Paddle trace and the PROF_* directory of a rank whose msprof clock
+    is offset us behind its Paddle clock. Kernel k is launched in a 20us span,
+    makes a 10us CANN call 5us into it and runs 40us on the device 30us after
+    the launch; one collective runs 50us after the last launch.
+    """
+    pid = 4242 + rank
+    paddle_events = [
+        {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "Paddle"}},
+        {
+            "name": "process_sort_index",
+            "ph": "M",
+            "pid": pid,
+            "args": {"sort_index": 3},
+        },
+    ]
+    msprof_events = []
+    for msprof_pid, name in enumerate(("CANN", "Ascend Hardware", "HCCL"), 1):
+        msprof_events.append(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": msprof_pid,
+                "args": {"name": name},
+            }
+        )
+        msprof_events.append(
+            {
+                "name": "process_sort_index",
+                "ph": "M",
+                "pid": msprof_pid,
+                "args": {"sort_index": msprof_pid},
+            }
+        )
+    for k in range(TASKS):
+        start = launch_start(k)
+        name = "MatMul" if k % 2 == 0 else "Add"
+        paddle_events.append(
+            {
+                "name": name,
+                "cat": "DygraphKernelLaunch",
+                "ph": "X",
+                "pid": pid,
+                "tid": "100(C++)",
+                "ts": start,
+                "dur": 20,
+            }
+        )
+        msprof_events.append(
+            {
+                "name": "aclnn" + name,
+                "ph": "X",
+                "pid": 1,
+                "tid": 100,
+                "ts": str(start + 5 - offset),
+                "dur": 10,
+            }
+        )
+        msprof_events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "pid": 2,
+                "tid": 7,
+                "ts": start + 30 - offset,
+                "dur": 40,
+            }
+        )
+    start = launch_start(TASKS - 1)
+    msprof_events += [
+        {
+            "name": "hcom_allReduce_",
+            "ph": "X",
+            "pid": 3,
+            "tid": 8,
+            "ts": start + 50 - offset,
+            "dur": 40,
+        },
+        {"name": "HostToDevice", "ph": "s", "id": 1, "pid": 1, "tid": 100, "ts": 0},
+        {"name": "HostToDevice", "ph": "f", "id": 1, "pid": 2, "tid": 7, "ts": 1},
+    ]
+
+    paddle_json_path = os.path.join(root, f"rank{rank}.paddle_trace.json")
+    with open(paddle_json_path, "w") as f:
+        json.dump({"traceEvents": paddle_events}, f)
+    prof_path = os.path.join(root, f"PROF_{rank}")
+    os.makedirs(os.path.join(prof_path, "mindstudio_profiler_output"))
+    os.makedirs(os.path.join(prof_path, f"device_{rank}"))
+    with open(os.path.join(prof_path, f"device_{rank}", "info.json"), "w") as f:
+        json.dump({"pid": pid}, f)
+    with open(
+        os.path.join(prof_path, "mindstudio_profiler_output", "msprof_1.json"), "w"
+    ) as f:
+        json.dump(msprof_events, f)
+    return paddle_json_path, prof_path
+
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_estimate_clock_offset(self):
+        spans = {100: [(launch_start(k), launch_start(k) + 20) for k in range(TASKS)]}
+        for offset in OFFSETS + [0.0]:
+            calls = {
+                100: [
+                    (launch_start(k) + 5 - offset, launch_start(k) + 15 - offset)
+                    for k in range(TASKS)
+                ]
+            }
+            self.assertAlmostEqual(timeline.estimate_clock_offset(spans, calls), offset)
+            self.assertLessEqual(
+                abs(timeline.estimate_clock_offset(spans, calls, max_offset=1.0)), 1.0
+            )
+        self.assertEqual(timeline.estimate_clock_offset(spans, {101: [(0, 1)]}), 0.0)
+
+    def test_shift_ts(self):
+        # a float of the epoch time in us keeps no ns
+        ts = "1700000000123456.789"
+        offset = decimal.Decimal(-321.25)
+        self.assertEqual(timeline._shift_ts(ts, offset), "1700000000123135.539")
+        self.assertEqual(timeline._shift_ts("100", offset), "-221")
+        self.assertEqual(timeline._shift_ts(100.5, offset), -220.75)
+
+    def test_launch_gaps(self):
+        streams = {
+            0: [(15, 20, "b"), (0, 10, "a"), (18, 30, "c"), (38, 39, "e")],
+            1: [(40, 50, "d")],
+        }
+        gaps = timeline._launch_gaps(streams, top=1)
+        self.assertEqual(
+            gaps,
+            {
+                "streams": 2,
+                "tasks": 5,
+                "busy_us": 36,
+                "idle_us": 14,
+                "gaps": 2,
+                "gap_us": 13,
+                "largest": [
+                    {"stream": 0, "start": 30, "gap_us": 8, "after": "c", "before": "e"}
+                ],
+            },
+        )
+        self.assertEqual(timeline._launch_gaps({}, top=1)["idle_us"], 0.0)
+
+    def test_communication(self):
+        comm = timeline._communication(
+            [(0, 10), (5, 20)], [(15, 25), (30, 40), (18, 22)]
+        )
+        self.assertEqual(
+            comm,
+            {
+                "comm_us": 20,
+                "overlapped_us": 5,
+                "exposed_us": 15,
+                "overlap_ratio": 0.25,
+            },
+        )
+        self.assertEqual(timeline._communication([(0, 1)], [])["overlap_ratio"], 0.0)
+
+    def test_fuse_rank(self):
+        paddle_json_path, prof_path = write_rank(self.dir.name, 1, OFFSETS[1])
+        fragment_path = os.path.join(self.dir.name, "rank1.json")
+        summary = timeline._fuse_rank(
+            1,
+            paddle_json_path,
+            timeline.find_latest_msprof_json(prof_path),
+            fragment_path,
+            5,
+            5e4,
+        )
+        with open(fragment_path) as f:
+            events = json.loads("[" + f.read() + "]")
+        self.assertEqual(summary["events"], len(events))
+        self.assertAlmostEqual(summary["clock_offset_us"], OFFSETS[1])
+        self.assertEqual({e["pid"] for e in events}, {1000, 1001, 1002, 1003})
+        device = [e for e in events if e["pid"] == 1002 and e["ph"] == "X"]
+        self.assertEqual(
+            [e["ts"] for e in device], [launch_start(k) + 30 for k in range(TASKS)]
+        )
+        calls = [e for e in events if e["pid"] == 1001 and e["ph"] == "X"]
+        self.assertEqual(
+            [e["ts"] for e in calls],
+            [f"{launch_start(k) + 5:.2f}" for k in range(TASKS)],
+        )
+        self.assertEqual(
+            [op["name"] for op in summary["device_ops"]], ["MatMul", "Add"]
+        )
+        self.assertEqual(summary["device_ops"][0]["count"], TASKS // 2)
+        self.assertAlmostEqual(summary["device_ops"][0]["total_us"], 40 * TASKS / 2)
+
+    def test_fuse_rank_timelines(self):
+        ranks = [
+            write_rank(self.dir.name, rank, offset)
+            for rank, offset in enumerate(OFFSETS)
+        ]
+        self.assertEqual(timeline.find_rank_traces(self.dir.name, self.dir.name), ranks)
+        output_path = os.path.join(self.dir.name, "fused.json.gz")
+        summary = timeline.fuse_rank_timelines(ranks, output_path, top=3)
+        with gzip.open(output_path, "rt") as f:
+            events = json.load(f)["traceEvents"]
+        with open(output_path + ".summary.json") as f:
+            self.assertEqual(json.load(f), summary)
+
+        self.assertEqual(sum(r["events"] for r in summary["ranks"]), len(events))
+        sort_indexes = [
+            e["pid"] for e in events if e.get("name") == "process_sort_index"
+        ]
+        self.assertEqual(sort_indexes, [0, 1, 2, 3, 1000, 1001, 1002, 1003])
+        self.assertEqual(
+            sorted(
+                e["args"]["name"] for e in events if e.get("name") == "process_name"
+            ),
+            [
+                f"Rank {rank} {name}"
+                for rank in range(2)
+                for name in ("Ascend Hardware", "CANN", "HCCL", "Paddle")
+            ],
+        )
+        flows = [(e["pid"], e["id"]) for e in events if e["ph"] in ("s", "f")]
+        self.assertEqual(flows, [(1, "0:1"), (2, "0:1"), (1001, "1:1"), (1002, "1:1")])
+
+        # 10 tasks of 40us, 67 + 14k us apart
+        gap_us = sum(67 + 14 * k for k in range(TASKS - 1))
+        for rank, offset in enumerate(OFFSETS):
+            rank_summary = summary["ranks"][rank]
+            self.assertEqual(rank_summary["rank"], rank)
+            self.assertAlmostEqual(rank_summary["clock_offset_us"], offset)
+            gaps = rank_summary["launch_gaps"]
+            self.assertEqual((gaps["streams"], gaps["tasks"]), (1, TASKS))
+            self.assertAlmostEqual(gaps["busy_us"], 40 * TASKS)
+            self.assertAlmostEqual(gaps["idle_us"], gap_us)
+            self.assertAlmostEqual(gaps["gap_us"], gap_us)
+            self.assertEqual(gaps["gaps"], TASKS - 1)
+            self.assertEqual(len(gaps["largest"]), 3)
+            self.assertAlmostEqual(gaps["largest"][0]["gap_us"], 67 + 14 * (TASKS - 2))
+            self.assertEqual(
+                (gaps["largest"][0]["after"], gaps["largest"][0]["before"]),
+                ("MatMul", "Add"),
+            )
+            comm = rank_summary["communication"]
+            self.assertAlmostEqual(comm["comm_us"], 40)
+            self.assertAlmostEqual(comm["overlapped_us"], 20)
+            self.assertAlmostEqual(comm["exposed_us"], 20)
+            self.assertAlmostEqual(comm["overlap_ratio"], 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
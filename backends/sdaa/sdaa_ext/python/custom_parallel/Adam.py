@@ -23,14 +23,9 @@
 # STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
 # WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
-import warnings
 from paddle_sdaa.sdaa_ext import *  # noqa
 import paddle
 from paddle.optimizer import Adam
-from paddle.base import framework
-import numpy as np
-import paddle.profiler as profiler
-from paddle.base.layer_helper import LayerHelper
 from ..utils import *  # noqa
 from .device_map import *  # noqa
 from ..storage import *  # noqa
@@ -38,125 +33,17 @@ from .distributed_optimizer import DistributeOptimizer
 
 
 class DistributeAdam(Adam, DistributeOptimizer):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, sharding_scope=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.flat_param = None
-        self.rank_flat_param = None
-        self._rank_param_group = None
-        self.amp_o2 = False
-        self.clipped_param = {}
-        self.flat_accum = {}
-        self.flatten_params = []
-        self._already_flat_acc = set()
         self.beta1_tensor = paddle.to_tensor(self._beta1)
         self.beta2_tensor = paddle.to_tensor(self._beta2)
         self.update_times = 0
-        # all groups
-        self.groups = []
-        self.t_block = framework.default_main_program().global_block()
-        # my group
-        self.group = None
-        self.total_rank = None
-        self.helper = LayerHelper(self.__class__.__name__)
-        self.HIGH_PERFORMANCE_CONV = int(os.environ.get("HIGH_PERFORMANCE_CONV", "0"))
-        self.need_append_all_param = True
-        if self.HIGH_PERFORMANCE_CONV:
-            warnings.warn(
-                "DistributeOptimizer Now Not Support HIGH_PERFORMANCE_CONV , Distrbuteoptimizer would work as origin optimizer"
-            )
-            return
-        if (
-            self._grad_clip is None
-            or isinstance(self._grad_clip, paddle.nn.ClipGradByValue)
-            or isinstance(self._grad_clip, paddle.nn.ClipGradByNorm)
-        ):
-            self.need_append_all_param = False
-        if paddle.in_dynamic_mode():
-            # The strategy only supports in_card sharding
-            self.re_distribution()
-            if self.group is not None and not isinstance(self._parameter_list[0], dict):
-                self.re_flatten()
-            # optimizer len(accmulaters) = len(self._param_list trainable)
-            self._create_accumulators(
-                self.t_block,
-                [
-                    param
-                    for param in self.flatten_params
-                    if "eager_tmp" not in param.name
-                ],
-            )
-            self._flatten_accumulators()
-            warnings.warn(
-                "DistributeOptimizer would add all trainable param to accumulators"
-            )
-            warnings.warn(
-                "DistributeOptimizer Now Not Support HIGH_PERFORMANCE_CONV , Only Support Param^dtype = Fp32 and Param^shape = NCHW,Please Check Amp Level and Param^shape"
-            )
+        self._init_sharding(sharding_scope)
 
     # def set_state_dict(self, state_dict):
     #     super().set_state_dict(state_dict)
     #     self.re_flatten()
 
-    def _allgather_accumulators(self):
-        if self.HIGH_PERFORMANCE_CONV:
-            return
-        for k, _ in self.flat_accum.items():
-            self.group.process_group.all_gather_partial_on_calc_stream(
-                self.flat_accum[k], self.flat_accum[k], self.group.world_size, self.rank
-            )
-
-    def _need_flatten(self):
-        if self.HIGH_PERFORMANCE_CONV:
-            return False
-        if not self.flat_accum:
-            return True
-
-    def _flatten_accumulators(self):
-        if self.HIGH_PERFORMANCE_CONV:
-            return
-        for k, _ in self._accumulators.items():
-            # only flatten moment
-            if "beta" in k:
-                continue
-            flatacc_list = []
-            total_num = 0
-
-            for param in self.flatten_params:
-                if "eager_tmp" in param.name:
-                    continue
-                flatacc_list.append(self._accumulators[k][param.name])
-                self._already_flat_acc.add(param.name)
-                # padding align to 128B, now we assume param is float32, this should change
-                numel = (
-                    (np.prod(self._accumulators[k][param.name].shape) + 31) // 32 * 32
-                )
-                total_num += numel
-
-            # for all_gather, every rank allocate_flatten_tensor should align 128B, assume param is float32,is 128/4 =32
-            align_size = 32 * self.total_rank
-            if total_num % align_size != 0:
-                total_num_ = (total_num + align_size - 1) // align_size * align_size
-                # print(total_num_, total_num, flush=True)
-                flatacc_list.append(
-                    paddle.empty([total_num_ - total_num], dtype=paddle.float32)
-                )
-                total_num = total_num_
-
-            self.flat_accum[k] = paddle.empty(shape=[total_num], dtype=paddle.float32)
-            paddle._legacy_C_ops.coalesce_tensor(
-                flatacc_list,
-                flatacc_list,
-                self.flat_accum[k],
-                "copy_data",
-                True,
-                "use_align",
-                True,
-                "align_size",
-                128,
-                "dtype",
-                flatacc_list[0].dtype,
-            )
-
     def _update_beta(self, name, param):
         if self._name is not None:
             name = self._name + "_" + name
@@ -203,8 +90,12 @@ class DistributeAdam(Adam, DistributeOptimizer):
             return
         if self._rank_param_group[self.rank].get(param_and_grad[0].name) is None:
             return
+        if self._defer_update(block, param_and_grad):
+            return None
+        return self._append_param_update_op(block, param_and_grad)
+
+    def _append_param_update_op(self, block, param_and_grad):
         param, grad = param_and_grad
-        should_clip, start, end = self._rank_param_group[self.rank][param.name]
 
         moment1 = self._get_accumulator_master(self._moment1_acc_str, param)
         moment2 = self._get_accumulator_master(self._moment2_acc_str, param)
@@ -225,72 +116,17 @@ class DistributeAdam(Adam, DistributeOptimizer):
             else self._beta2.item(0)
         )
 
-        if (
-            should_clip
-            and tensor_storage_format(param) == "NCHW"
-            and tensor_storage_format(grad) == "NCHW"
-        ):
-            if self.clipped_param.get(param.name) is None:
-                param_ = self.helper.create_global_variable(
-                    name=f"{param.name}_clip_{self.rank}_param",
-                    persistable=False,
-                    dtype=param.dtype,
-                    shape=[end - start],
-                    belong_to_optimizer=True,
-                )
-
-                grad_ = self.helper.create_global_variable(
-                    name=f"{param.name}_clip_{self.rank}_grad",
-                    persistable=False,
-                    dtype=grad.dtype,
-                    shape=[end - start],
-                    belong_to_optimizer=True,
-                )
-
-                moment1_ = self.helper.create_global_variable(
-                    name=f"{param.name}_clip_{self.rank}_moment1",
-                    persistable=False,
-                    dtype=moment1.dtype,
-                    shape=[end - start],
-                    belong_to_optimizer=True,
-                )
-
-                moment2_ = self.helper.create_global_variable(
-                    name=f"{param.name}_clip_{self.rank}_moment2",
-                    persistable=False,
-                    dtype=moment2.dtype,
-                    shape=[end - start],
-                    belong_to_optimizer=True,
-                )
-                temp = paddle.empty([])
-                shape = param.shape
-                temp.get_tensor()._share_data_with(param.get_tensor())
-                param_ = temp.reshape_([-1])._slice(start, end)
-                temp.get_tensor()._share_data_with(param_and_grad[1].get_tensor())
-                grad_ = temp.reshape_([-1])._slice(start, end)
-                # if 'linear_5.w_0' in param.name:
-                #     print(" linear_5.w_0 before ",moment1,flush=True)
-                #     print(" linear_5.w_0 before ",moment2,flush=True)
-                moment1_ = moment1.reshape_([-1])._slice(start, end)
-                moment2_ = moment2.reshape_([-1])._slice(start, end)
-
-                moment1.reshape_(shape)
-                moment2.reshape_(shape)
-                param_.stop_gradient = True
-                grad_.stop_gradient = True
-                moment1_.stop_gradient = True
-                moment2_.stop_gradient = True
-                self.clipped_param[param.name] = (param_, moment1_, moment2_)
-            else:
-                param_, moment1_, moment2_ = self.clipped_param[param.name]
-                temp = paddle.empty([])
-                temp.get_tensor()._share_data_with(param_and_grad[1].get_tensor())
-                grad_ = temp.reshape_([-1])._slice(start, end)
+        views = self._clipped_views(param, grad)
+        if views is not None:
+            param_, grad_, accums, master_weight_ = views
+            moment1_ = accums[moment1.name]
+            moment2_ = accums[moment2.name]
         else:
             param_ = param
-            grad_ = param_and_grad[1]
+            grad_ = grad
             moment1_ = moment1
             moment2_ = moment2
+            master_weight_ = master_weight
 
         _, _, _, _, _, *_ = paddle._C_ops.adam_(
             param_,
@@ -300,7 +136,7 @@ class DistributeAdam(Adam, DistributeOptimizer):
             moment2_,
             beta1_pow_acc,
             beta2_pow_acc,
-            master_weight,
+            master_weight_,
             None,
             _beta1,
             _beta2,
@@ -310,125 +146,90 @@ class DistributeAdam(Adam, DistributeOptimizer):
             find_master,
             False,
         )
+        self._gather_updated(param)
 
         return None
 
-    def step(self):
-        record_event = profiler.RecordEvent("optimizer_step")
-        record_event.begin()
-        found_inf = self._get_auxiliary_var("found_inf")
-        if self.HIGH_PERFORMANCE_CONV:
-            super().step()
-        elif (
-            self.group is not None
-            and not isinstance(self._parameter_list[0], dict)
-            and self._rank_param_group is not None
-        ):
-            params_grads = []
-            # In origin optimizer , this is do in _create_optimization_pass after grad_clip and regulation
-            for param in self._parameter_list:
-                if self.amp_o2 is False:
-                    assert (
-                        param.dtype == paddle.float32
-                    ), "distributed optimizer only support amp level1"
-                if param.stop_gradient or param._grad_ivar() is None:
-                    continue
-                if (
-                    self._rank_param_group[self.rank].get(param.name) is None
-                    and not found_inf
-                ):
-                    self._update_beta(self._beta2_pow_acc_str, param)
-                    self._update_beta(self._beta1_pow_acc_str, param)
-                grad_var = param._grad_ivar()
-                if paddle.in_dynamic_mode():
-                    if (
-                        hasattr(grad_var, "is_selected_rows")
-                        and grad_var.is_selected_rows()
-                        and self.regularization is not None
-                    ):
-                        raise RuntimeError(
-                            "AdamW don't support weight_decay with sparse parameters, please set it to None."
-                        )
-                else:
-                    if (
-                        hasattr(grad_var, "_is_sparse")
-                        and grad_var._is_sparse()
-                        and self.regularization is not None
-                    ):
-                        raise RuntimeError(
-                            "AdamW don't support weight_decay with sparse parameters, please set it to None."
-                        )
-                if (
-                    self.need_append_all_param
-                    or self._rank_param_group[self.rank].get(param.name) is not None
-                ):
-                    params_grads.append((param, grad_var))
-                self.amp_o2 = True
-            optimize_ops = self._apply_optimize(
-                loss=None, startup_program=None, params_grads=params_grads
-            )
-            self.update_times += 1
-            self.group.process_group.all_gather_partial_on_calc_stream(
-                self.flat_param, self.flat_param, self.group.world_size, self.rank
-            )
-            if self._need_flatten():
-                self._flatten_accumulators()
-        else:
-            super().step()
-        record_event.end()
+    def _append_fused_update_op(self, run, params_grads, grad):
+        param = params_grads[0][0]
+        moment1 = self._get_accumulator_master(self._moment1_acc_str, param)
+        moment2 = self._get_accumulator_master(self._moment2_acc_str, param)
+        beta1_pow_acc, beta2_pow_acc = run.get("beta_pows") or (
+            self._get_accumulator_master(self._beta1_pow_acc_str, param),
+            self._get_accumulator_master(self._beta2_pow_acc_str, param),
+        )
+        find_master = run["master_weight"] is not None
+        lr = self._fused_lr(run, params_grads[0])
 
-    def minimize(self, loss, startup_program=None, parameters=None, no_grad_set=None):
-        record_event = profiler.RecordEvent("optimizer_minimize")
-        record_event.begin()
-        found_inf = self._get_auxiliary_var("found_inf")
-        if self.HIGH_PERFORMANCE_CONV:
-            return super().minimize(loss, startup_program, parameters, no_grad_set)
-        if (
-            self.group is not None
-            and not isinstance(self._parameter_list[0], dict)
-            and self._rank_param_group is not None
-        ):
-            assert isinstance(
-                loss, paddle.static.Variable
-            ), "The loss should be an Tensor."
+        _beta1 = (
+            self._beta1
+            if not isinstance(self._beta1, paddle.static.Variable)
+            else self._beta1.item(0)
+        )
+        _beta2 = (
+            self._beta2
+            if not isinstance(self._beta2, paddle.static.Variable)
+            else self._beta2.item(0)
+        )
 
-            parameter_list = parameters if parameters else self._parameter_list
+        _, _, _, _, _, *_ = paddle._C_ops.adam_(
+            run["param"],
+            grad,
+            lr,
+            run["accums"][moment1.name],
+            run["accums"][moment2.name],
+            beta1_pow_acc,
+            beta2_pow_acc,
+            run["master_weight"],
+            None,
+            _beta1,
+            _beta2,
+            self._epsilon,
+            self._lazy_mode,
+            1000,
+            find_master,
+            False,
+        )
+        if "beta_pows" in run:
+            return
+        # the op only advanced the beta pows of the first param
+        for param, _ in params_grads[1:]:
+            self._update_beta(self._beta2_pow_acc_str, param)
+            self._update_beta(self._beta1_pow_acc_str, param)
+
+    def _prepare_host_run(self, run, params_grads):
+        # the host kernel advances copies of the beta pows of the first
+        # param, the device ones of every param are advanced here
+        param = params_grads[0][0]
+        run["beta_pows"] = (
+            self._get_accumulator_master(self._beta1_pow_acc_str, param).cpu(),
+            self._get_accumulator_master(self._beta2_pow_acc_str, param).cpu(),
+        )
+        for param, _ in params_grads:
+            self._update_beta(self._beta2_pow_acc_str, param)
+            self._update_beta(self._beta1_pow_acc_str, param)
+
+    def _finish_sharded_update(self, unowned):
+        # found_inf is read once the update is issued, the beta pows of the
+        # params of the other ranks advance with the ones of this rank
+        found_inf = self._wait_found_inf()
+        if unowned and not found_inf:
+            for param in unowned:
+                self._update_beta(self._beta2_pow_acc_str, param)
+                self._update_beta(self._beta1_pow_acc_str, param)
+        self.update_times += 1
+
+    def clear_grad(self, set_to_zero=True):
+        if self.flat_grads:
+            # the grads stay in flat_grads, whatever set_to_zero
+            self._clear_flat_grads()
+        else:
+            super().clear_grad(set_to_zero)
 
-            params_grads = self.backward(
-                loss,
-                startup_program=startup_program,
-                parameters=parameter_list,
-                no_grad_set=no_grad_set,
-            )
+    def step(self):
+        self._step(super().step)
 
-            new_params_grads = []
-            for param, grad in params_grads:
-                if param.stop_gradient or grad is None:
-                    continue
-                if (
-                    self._rank_param_group[self.rank].get(param.name) is None
-                    and not found_inf
-                ):
-                    self._update_beta(self._beta2_pow_acc_str, param)
-                    self._update_beta(self._beta1_pow_acc_str, param)
-                if (
-                    self.need_append_all_param
-                    or self._rank_param_group[self.rank].get(param.name) is not None
-                ):
-                    new_params_grads.append((param, grad))
-            optimize_ops = self._apply_optimize(
-                loss, startup_program=startup_program, params_grads=new_params_grads
-            )
-            self.group.process_group.all_gather_partial_on_calc_stream(
-                self.flat_param, self.flat_param, self.group.world_size, self.rank
-            )
-            self.update_times += 1
-            if self._need_flatten():
-                self._flatten_accumulators()
-            else:
-                pass
-            record_event.end()
-            return optimize_ops, params_grads
-        else:
-            record_event.end()
-            return super().minimize(loss, startup_program, parameters, no_grad_set)
+    def minimize(self, loss, startup_program=None, parameters=None, no_grad_set=None):
+        return self._minimize(
+            super().minimize, loss, startup_program, parameters, no_grad_set
+        )
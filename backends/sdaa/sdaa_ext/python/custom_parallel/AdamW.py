@@ -23,14 +23,10 @@
 # STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
 # WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
-import warnings
 from paddle_sdaa.sdaa_ext import *  # noqa
 import paddle
 from paddle.optimizer import AdamW
-from paddle.base import framework
 import numpy as np
-import paddle.profiler as profiler
-from paddle.base.layer_helper import LayerHelper
 from ..utils import *  # noqa
 from .device_map import *  # noqa
 from ..storage import *  # noqa
@@ -38,115 +34,9 @@ from .distributed_optimizer import DistributeOptimizer
 
 
 class DistributeAdamW(AdamW, DistributeOptimizer):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, sharding_scope=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.flat_param = None
-        self.rank_flat_param = None
-        self._rank_param_group = None
-        self.clipped_param = {}
-        self.flat_accum = {}
-        self.flatten_params = []
-        self._already_flat_acc = set()
-        self.amp_o2 = False  # if traversed
-        # all groups
-        self.groups = []
-        self.t_block = framework.default_main_program().global_block()
-        # my group
-        self.group = None
-        self.total_rank = None
-        self.helper = LayerHelper(self.__class__.__name__)
-        self.HIGH_PERFORMANCE_CONV = int(os.environ.get("HIGH_PERFORMANCE_CONV", "0"))
-        self.need_append_all_param = True
-        if self.HIGH_PERFORMANCE_CONV:
-            warnings.warn(
-                "DistributeOptimizer Now Not Support HIGH_PERFORMANCE_CONV , Distrbuteoptimizer would work as origin optimizer"
-            )
-            return
-        if (
-            self._grad_clip is None
-            or isinstance(self._grad_clip, paddle.nn.ClipGradByValue)
-            or isinstance(self._grad_clip, paddle.nn.ClipGradByNorm)
-        ):
-            self.need_append_all_param = False
-        if paddle.in_dynamic_mode():
-            self.re_distribution()
-            if self.group is not None and not isinstance(self._parameter_list[0], dict):
-                self.re_flatten()
-            self._create_accumulators(
-                self.t_block,
-                [
-                    param
-                    for param in self.flatten_params
-                    if "eager_tmp" not in param.name
-                ],
-            )
-            self._flatten_accumulators()
-            warnings.warn(
-                "DistributeOptimizer would add all trainable param to accumulators"
-            )
-            warnings.warn(
-                "DistributeOptimizer Now Not Support HIGH_PERFORMANCE_CONV , Only Support Param^dtype = Fp32 and Param^shape = NCHW,Please Check Amp Level and Param^shape"
-            )
-
-    def _allgather_accumulators(self):
-        if self.HIGH_PERFORMANCE_CONV:
-            return
-        for k, _ in self.flat_accum.items():
-            self.group.process_group.all_gather_partial_on_calc_stream(
-                self.flat_accum[k], self.flat_accum[k], self.group.world_size, self.rank
-            )
-
-    def _need_flatten(self):
-        if self.HIGH_PERFORMANCE_CONV:
-            return
-        if not self.flat_accum:
-            return True
-
-    def _flatten_accumulators(self):
-        if self.HIGH_PERFORMANCE_CONV:
-            return
-        for k, _ in self._accumulators.items():
-            # only flatten moment
-            if "beta" in k:
-                continue
-            flatacc_list = []
-            total_num = 0
-
-            for param in self.flatten_params:
-                if "eager_tmp" in param.name:
-                    continue
-                flatacc_list.append(self._accumulators[k][param.name])
-                self._already_flat_acc.add(param.name)
-                # padding align to 128B, now we assume param is float32, this should change
-                numel = (
-                    (np.prod(self._accumulators[k][param.name].shape) + 31) // 32 * 32
-                )
-                total_num += numel
-
-            # for all_gather, every rank allocate_flatten_tensor should align 128B, assume param is float32,is 128/4 =32
-            align_size = 32 * self.total_rank
-            if total_num % align_size != 0:
-                total_num_ = (total_num + align_size - 1) // align_size * align_size
-                # print(total_num_, total_num, flush=True)
-                flatacc_list.append(
-                    paddle.empty([total_num_ - total_num], dtype=paddle.float32)
-                )
-                total_num = total_num_
-
-            self.flat_accum[k] = paddle.empty(shape=[total_num], dtype=paddle.float32)
-            paddle._legacy_C_ops.coalesce_tensor(
-                flatacc_list,
-                flatacc_list,
-                self.flat_accum[k],
-                "copy_data",
-                True,
-                "use_align",
-                True,
-                "align_size",
-                128,
-                "dtype",
-                flatacc_list[0].dtype,
-            )
+        self._init_sharding(sharding_scope)
 
     def _update_beta(self, name, param):
         if self._name is not None:
@@ -193,8 +83,12 @@ class DistributeAdamW(AdamW, DistributeOptimizer):
             return super()._append_optimize_op(block, param_and_grad)
         if self._rank_param_group[self.rank].get(param_and_grad[0].name) is None:
             return
+        if self._defer_update(block, param_and_grad):
+            return None
+        return self._append_param_update_op(block, param_and_grad)
+
+    def _append_param_update_op(self, block, param_and_grad):
         param, grad = param_and_grad
-        should_clip, start, end = self._rank_param_group[self.rank][param.name]
         # Whether we should do weight decay for the parameter.
         with_decay = True
         if self._apply_decay_param_fun is not None and not self._apply_decay_param_fun(
@@ -231,68 +125,17 @@ class DistributeAdamW(AdamW, DistributeOptimizer):
             else self._beta2.item(0)
         )
 
-        if (
-            should_clip
-            and tensor_storage_format(param) == "NCHW"
-            and tensor_storage_format(grad) == "NCHW"
-        ):
-            if self.clipped_param.get(param.name) is None:
-                param_ = self.helper.create_global_variable(
-                    name=f"{param.name}_clip_{self.rank}_param",
-                    persistable=False,
-                    dtype=param.dtype,
-                    shape=[end - start],
-                    belong_to_optimizer=True,
-                )
-
-                grad_ = self.helper.create_global_variable(
-                    name=f"{param.name}_clip_{self.rank}_grad",
-                    persistable=False,
-                    dtype=grad.dtype,
-                    shape=[end - start],
-                    belong_to_optimizer=True,
-                )
-
-                moment1_ = self.helper.create_global_variable(
-                    name=f"{param.name}_clip_{self.rank}_moment1",
-                    persistable=False,
-                    dtype=moment1.dtype,
-                    shape=[end - start],
-                    belong_to_optimizer=True,
-                )
-
-                moment2_ = self.helper.create_global_variable(
-                    name=f"{param.name}_clip_{self.rank}_moment2",
-                    persistable=False,
-                    dtype=moment2.dtype,
-                    shape=[end - start],
-                    belong_to_optimizer=True,
-                )
-                temp = paddle.empty([])
-                shape = param.shape
-                temp.get_tensor()._share_data_with(param_and_grad[0].get_tensor())
-                param_ = temp.reshape_([-1])._slice(start, end)
-                temp.get_tensor()._share_data_with(param_and_grad[1].get_tensor())
-                grad_ = temp.reshape_([-1])._slice(start, end)
-                moment1_ = moment1.reshape_([-1])._slice(start, end)
-                moment2_ = moment2.reshape_([-1])._slice(start, end)
-                moment1.reshape_(shape)
-                moment2.reshape_(shape)
-                param_.stop_gradient = True
-                grad_.stop_gradient = True
-                moment1_.stop_gradient = True
-                moment2_.stop_gradient = True
-                self.clipped_param[param.name] = (param_, moment1_, moment2_)
-            else:
-                param_, moment1_, moment2_ = self.clipped_param[param.name]
-                temp = paddle.empty([])
-                temp.get_tensor()._share_data_with(param_and_grad[1].get_tensor())
-                grad_ = temp.reshape_([-1])._slice(start, end)
+        views = self._clipped_views(param, grad)
+        if views is not None:
+            param_, grad_, accums, master_weight_ = views
+            moment1_ = accums[moment1.name]
+            moment2_ = accums[moment2.name]
         else:
-            param_ = param_and_grad[0]
-            grad_ = param_and_grad[1]
+            param_ = param
+            grad_ = grad
             moment1_ = moment1
             moment2_ = moment2
+            master_weight_ = master_weight
 
         _, _, _, _, _, *_ = paddle._C_ops.adamw_(
             param_,
@@ -302,7 +145,7 @@ class DistributeAdamW(AdamW, DistributeOptimizer):
             moment2_,
             beta1_pow_acc,
             beta2_pow_acc,
-            master_weight,
+            master_weight_,
             None,
             _beta1,
             _beta2,
@@ -315,120 +158,128 @@ class DistributeAdamW(AdamW, DistributeOptimizer):
             find_master,
             False,
         )
+        self._gather_updated(param)
         return None
 
-    def step(self):
-        record_event = profiler.RecordEvent("optimizer_step")
-        record_event.begin()
-        found_inf = self._get_auxiliary_var("found_inf")
-        if self.HIGH_PERFORMANCE_CONV:
-            super().step()
-        elif (
-            self.group is not None
-            and not isinstance(self._parameter_list[0], dict)
-            and self._rank_param_group is not None
-        ):
-            params_grads = []
-            for param in self._parameter_list:
-                if self.amp_o2 is False:
-                    assert (
-                        param.dtype == paddle.float32
-                    ), "distributed optimizer only support amp level1"
-                if param.stop_gradient or param._grad_ivar() is None:
-                    continue
-                if (
-                    self._rank_param_group[self.rank].get(param.name) is None
-                    and not found_inf
-                ):
-                    self._update_beta(self._beta2_pow_acc_str, param)
-                    self._update_beta(self._beta1_pow_acc_str, param)
-                grad_var = param._grad_ivar()
-                if paddle.in_dynamic_mode():
-                    if (
-                        hasattr(grad_var, "is_selected_rows")
-                        and grad_var.is_selected_rows()
-                        and self.regularization is not None
-                    ):
-                        raise RuntimeError(
-                            "AdamW don't support weight_decay with sparse parameters, please set it to None."
-                        )
-                else:
-                    if (
-                        hasattr(grad_var, "_is_sparse")
-                        and grad_var._is_sparse()
-                        and self.regularization is not None
-                    ):
-                        raise RuntimeError(
-                            "AdamW don't support weight_decay with sparse parameters, please set it to None."
-                        )
-                if (
-                    self.need_append_all_param
-                    or self._rank_param_group[self.rank].get(param.name) is not None
-                ):
-                    params_grads.append((param, grad_var))
-            self.amp_o2 = True
-            optimize_ops = self._apply_optimize(
-                loss=None, startup_program=None, params_grads=params_grads
-            )
-            # Because some param is clip , so need all_gather
-            self.group.process_group.all_gather_partial_on_calc_stream(
-                self.flat_param, self.flat_param, self.group.world_size, self.rank
-            )
-            if self._need_flatten():
-                self._flatten_accumulators()
-            else:
-                pass
-        else:
-            super().step()
-        record_event.end()
+    def _fused_run_key(self, param):
+        lr_ratio_ = 1.0 if self._lr_ratio is None else self._lr_ratio(param)
+        return (param.optimize_attr["learning_rate"], lr_ratio_)
 
-    def minimize(self, loss, startup_program=None, parameters=None, no_grad_set=None):
-        found_inf = self._get_auxiliary_var("found_inf")
-        if self.HIGH_PERFORMANCE_CONV:
-            return super().minimize(loss, startup_program, parameters, no_grad_set)
-        elif (
-            self.group is not None
-            and not isinstance(self._parameter_list[0], dict)
-            and self._rank_param_group is not None
-        ):
-            assert isinstance(
-                loss, paddle.static.Variable
-            ), "The loss should be an Tensor."
+    def _append_fused_update_op(self, run, params_grads, grad):
+        param = params_grads[0][0]
+        moment1 = self._get_accumulator_master(self._moment1_acc_str, param)
+        moment2 = self._get_accumulator_master(self._moment2_acc_str, param)
+        beta1_pow_acc, beta2_pow_acc = run.get("beta_pows") or (
+            self._get_accumulator_master(self._beta1_pow_acc_str, param),
+            self._get_accumulator_master(self._beta2_pow_acc_str, param),
+        )
+        find_master = run["master_weight"] is not None
+        lr = self._fused_lr(run, params_grads[0])
+        lr_ratio_ = run["key"][1]
 
-            parameter_list = parameters if parameters else self._parameter_list
+        _beta1 = (
+            self._beta1
+            if not isinstance(self._beta1, paddle.static.Variable)
+            else self._beta1.item(0)
+        )
+        _beta2 = (
+            self._beta2
+            if not isinstance(self._beta2, paddle.static.Variable)
+            else self._beta2.item(0)
+        )
 
-            params_grads = self.backward(
-                loss,
-                startup_program=startup_program,
-                parameters=parameter_list,
-                no_grad_set=no_grad_set,
+        target = run["master_weight"] if find_master else run["param"]
+        self._fused_decay(run, params_grads)
+        with_decay = run["decay"] is True
+        if not isinstance(run["decay"], bool):
+            # the decoupled weight decay of adamw_, through the mask
+            decay_lr = (lr * (lr_ratio_ * self._weight_decay)).astype(target.dtype)
+            target.multiply_(
+                paddle._C_ops.scale(run["decay"] * decay_lr, -1.0, 1.0, True)
             )
 
-            new_params_grads = []
-            for param, grad in params_grads:
-                if param.stop_gradient or grad is None:
-                    continue
-                if (
-                    self._rank_param_group[self.rank].get(param.name) is None
-                    and not found_inf
-                ):
-                    self._update_beta(self._beta2_pow_acc_str, param)
-                    self._update_beta(self._beta1_pow_acc_str, param)
-                if (
-                    self.need_append_all_param
-                    or self._rank_param_group[self.rank].get(param.name) is not None
-                ):
-                    new_params_grads.append((param, grad))
-            optimize_ops = self._apply_optimize(
-                loss, startup_program=startup_program, params_grads=new_params_grads
-            )
-            self.group.process_group.all_gather_partial_on_calc_stream(
-                self.flat_param, self.flat_param, self.group.world_size, self.rank
-            )
-            if self._need_flatten():
-                self._flatten_accumulators()
-            else:
-                pass
-            return optimize_ops, params_grads
+        _, _, _, _, _, *_ = paddle._C_ops.adamw_(
+            run["param"],
+            grad,
+            lr,
+            run["accums"][moment1.name],
+            run["accums"][moment2.name],
+            beta1_pow_acc,
+            beta2_pow_acc,
+            run["master_weight"],
+            None,
+            _beta1,
+            _beta2,
+            self._epsilon,
+            lr_ratio_,
+            self._weight_decay,
+            with_decay,
+            self._lazy_mode,
+            1000,
+            find_master,
+            False,
+        )
+        if "beta_pows" in run:
+            return
+        # the op only advanced the beta pows of the first param
+        for param, _ in params_grads[1:]:
+            self._update_beta(self._beta2_pow_acc_str, param)
+            self._update_beta(self._beta1_pow_acc_str, param)
+
+    def _fused_decay(self, run, params_grads):
+        # run["decay"] is whether all the params of the run take weight decay,
+        # or the mask of those that do when only some of them do
+        if "decay" in run:
+            return
+        decay = [
+            self._apply_decay_param_fun is None
+            or self._apply_decay_param_fun(param.name)
+            for param, _ in params_grads
+        ]
+        if all(decay) or not any(decay):
+            run["decay"] = all(decay)
+            return
+        # 1 over the params that take weight decay
+        target = run["param"] if run["master_weight"] is None else run["master_weight"]
+        base = run["segments"][0][1]
+        mask = np.zeros([run["segments"][-1][2] - base], dtype="float32")
+        for (_, lo, hi), decay_ in zip(run["segments"], decay):
+            mask[lo - base : hi - base] = decay_
+        run["decay"] = paddle.to_tensor(mask, dtype=target.dtype, place=target.place)
+
+    def _prepare_host_run(self, run, params_grads):
+        # the host kernel advances copies of the beta pows of the first
+        # param, the device ones of every param are advanced here
+        param = params_grads[0][0]
+        run["beta_pows"] = (
+            self._get_accumulator_master(self._beta1_pow_acc_str, param).cpu(),
+            self._get_accumulator_master(self._beta2_pow_acc_str, param).cpu(),
+        )
+        for param, _ in params_grads:
+            self._update_beta(self._beta2_pow_acc_str, param)
+            self._update_beta(self._beta1_pow_acc_str, param)
+        self._fused_decay(run, params_grads)
+
+    def _finish_sharded_update(self, unowned):
+        # found_inf is read once the update is issued, the beta pows of the
+        # params of the other ranks advance with the ones of this rank
+        found_inf = self._wait_found_inf()
+        if unowned and not found_inf:
+            for param in unowned:
+                self._update_beta(self._beta2_pow_acc_str, param)
+                self._update_beta(self._beta1_pow_acc_str, param)
+
+    def clear_grad(self, set_to_zero=True):
+        if self.flat_grads:
+            # the grads stay in flat_grads, whatever set_to_zero
+            self._clear_flat_grads()
         else:
-            return super().minimize(loss, startup_program, parameters, no_grad_set)
+            super().clear_grad(set_to_zero)
+
+    def step(self):
+        self._step(super().step)
+
+    def minimize(self, loss, startup_program=None, parameters=None, no_grad_set=None):
+        return self._minimize(
+            super().minimize, loss, startup_program, parameters, no_grad_set
+        )
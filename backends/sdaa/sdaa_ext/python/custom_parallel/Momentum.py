@@ -23,15 +23,12 @@
 # STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
 # WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
-import warnings
 from paddle_sdaa.sdaa_ext import *  # noqa
 import paddle
 from paddle.optimizer import Momentum
 from paddle.regularizer import L2Decay
 from paddle.framework import in_dynamic_mode
 from paddle.base import framework
-import numpy as np
-import paddle.profiler as profiler
 from ..utils import *  # noqa
 from .device_map import *  # noqa
 from ..storage import *  # noqa
@@ -39,116 +36,10 @@ from .distributed_optimizer import DistributeOptimizer
 
 
 class DistributeMom(Momentum, DistributeOptimizer):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, sharding_scope=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.flat_param = None
-        self.rank_flat_param = None
-        self._rank_param_group = None
-        self.amp_o2 = False
-        self.clipped_param = {}
-        self.flat_accum = {}
         self.param_sort = {}
-        self.flatten_params = []
-        self._already_flat_acc = set()
-        # all groups
-        self.groups = []
-        self.t_block = framework.default_main_program().global_block()
-        # my group
-        self.group = None
-        self.total_rank = None
-        self.helper = LayerHelper(self.__class__.__name__)
-        self.HIGH_PERFORMANCE_CONV = int(os.environ.get("HIGH_PERFORMANCE_CONV", "0"))
-        self.need_append_all_param = True
-        if self.HIGH_PERFORMANCE_CONV:
-            warnings.warn(
-                "DistributeOptimizer Now Not Support HIGH_PERFORMANCE_CONV , Distrbuteoptimizer would work as origin optimizer"
-            )
-            return
-        if (
-            self._grad_clip is None
-            or isinstance(self._grad_clip, paddle.nn.ClipGradByValue)
-            or isinstance(self._grad_clip, paddle.nn.ClipGradByNorm)
-        ):
-            self.need_append_all_param = False
-        if paddle.in_dynamic_mode():
-            # The strategy only supports in_card sharding
-            self.re_distribution()
-            if self.group is not None and not isinstance(self._parameter_list[0], dict):
-                self.re_flatten()
-            self._create_accumulators(
-                self.t_block,
-                [
-                    param
-                    for param in self.flatten_params
-                    if "eager_tmp" not in param.name
-                ],
-            )
-            self._flatten_accumulators()
-            warnings.warn(
-                "DistributeOptimizer would add all trainable param to accumulators"
-            )
-            warnings.warn(
-                "DistributeOptimizer Now Not Support HIGH_PERFORMANCE_CONV , Only Support Param^dtype = Fp32 and Param^shape = NCHW,Please Check Amp Level and Param^shape"
-            )
-
-    def _allgather_accumulators(self):
-        if self.HIGH_PERFORMANCE_CONV:
-            return
-        for k, _ in self.flat_accum.items():
-            self.group.process_group.all_gather_partial_on_calc_stream(
-                self.flat_accum[k], self.flat_accum[k], self.group.world_size, self.rank
-            )
-
-    def _need_flatten(self):
-        if self.HIGH_PERFORMANCE_CONV:
-            return False
-        if not self.flat_accum:
-            return True
-
-    def _flatten_accumulators(self):
-        if self.HIGH_PERFORMANCE_CONV:
-            return
-        for k, _ in self._accumulators.items():
-            # only flatten moment
-            if "beta" in k:
-                continue
-            flatacc_list = []
-            total_num = 0
-
-            for param in self.flatten_params:
-                if "eager_tmp" in param.name:
-                    continue
-                flatacc_list.append(self._accumulators[k][param.name])
-                self._already_flat_acc.add(param.name)
-                # padding align to 128B, now we assume param is float32, this should change
-                numel = (
-                    (np.prod(self._accumulators[k][param.name].shape) + 31) // 32 * 32
-                )
-                total_num += numel
-            # for all_gather, every rank allocate_flatten_tensor should align 128B, assume param is float32,is 128/4 =32
-            align_size = 32 * self.total_rank
-            if total_num % align_size != 0:
-                total_num_ = (total_num + align_size - 1) // align_size * align_size
-                # print(total_num_, total_num, flush=True)
-                flatacc_list.append(
-                    paddle.empty([total_num_ - total_num], dtype=paddle.float32)
-                )
-                total_num = total_num_
-
-            self.flat_accum[k] = paddle.empty(shape=[total_num], dtype=paddle.float32)
-            paddle._legacy_C_ops.coalesce_tensor(
-                flatacc_list,
-                flatacc_list,
-                self.flat_accum[k],
-                "copy_data",
-                True,
-                "use_align",
-                True,
-                "align_size",
-                128,
-                "dtype",
-                flatacc_list[0].dtype,
-            )
+        self._init_sharding(sharding_scope)
 
     def _append_optimize_op(self, block, param_and_grad):
         if self.HIGH_PERFORMANCE_CONV:
@@ -158,13 +49,12 @@ class DistributeMom(Momentum, DistributeOptimizer):
             param_and_grad = self._update_param_group(param_and_grad)
         if self._rank_param_group[self.rank].get(param_and_grad[0].name) is None:
             return
-        velocity_acc = self._get_accumulator_master(
-            self._velocity_acc_str, param_and_grad[0]
-        )
-        lr = self._create_param_lr(param_and_grad)
+        if self._defer_update(block, param_and_grad):
+            return None
+        return self._append_param_update_op(block, param_and_grad)
 
+    def _regularization(self, param):
         # For fusion of momentum and l2decay
-        param = param_and_grad[0]
         regularization_method = self._regularization_method
         regularization_coeff = self._regularization_coeff
         if hasattr(param, "regularizer"):
@@ -176,8 +66,40 @@ class DistributeMom(Momentum, DistributeOptimizer):
             elif param.regularizer is not None:
                 regularization_method = ""
                 regularization_coeff = 0.0
+        return regularization_method, regularization_coeff
+
+    def _fused_run_key(self, param):
+        return (param.optimize_attr["learning_rate"],) + self._regularization(param)
+
+    def _append_fused_update_op(self, run, params_grads, grad):
+        param = params_grads[0][0]
+        velocity_acc = self._get_accumulator_master(self._velocity_acc_str, param)
+        lr = self._fused_lr(run, params_grads[0])
+        regularization_method, regularization_coeff = run["key"][1:]
+        paddle._C_ops.momentum_(
+            run["param"],
+            grad,
+            run["accums"][velocity_acc.name],
+            lr,
+            run["master_weight"],
+            self._momentum,
+            self._use_nesterov,
+            regularization_method,
+            regularization_coeff,
+            run["master_weight"] is not None,
+            self._rescale_grad,
+        )
+
+    def _append_param_update_op(self, block, param_and_grad):
+        velocity_acc = self._get_accumulator_master(
+            self._velocity_acc_str, param_and_grad[0]
+        )
+        lr = self._create_param_lr(param_and_grad)
+
+        regularization_method, regularization_coeff = self._regularization(
+            param_and_grad[0]
+        )
         param, grad = param_and_grad
-        should_clip, start, end = self._rank_param_group[self.rank][param.name]
 
         find_master = self._multi_precision and self._is_dtype_fp16_or_bf16(
             param_and_grad[0].dtype
@@ -189,65 +111,22 @@ class DistributeMom(Momentum, DistributeOptimizer):
         if in_dynamic_mode():
             if isinstance(param_and_grad, dict):
                 self._update_regularization(param_and_grad["weight_decay"])
-            if (
-                should_clip
-                and tensor_storage_format(param) == "NCHW"
-                and tensor_storage_format(grad) == "NCHW"
-            ):
-                if self.clipped_param.get(param.name) is None:
-                    param_ = self.helper.create_global_variable(
-                        name=f"{param.name}_clip_{self.rank}_param",
-                        persistable=False,
-                        dtype=param.dtype,
-                        shape=[end - start],
-                        belong_to_optimizer=True,
-                    )
-
-                    grad_ = self.helper.create_global_variable(
-                        name=f"{param.name}_clip_{self.rank}_grad",
-                        persistable=False,
-                        dtype=grad.dtype,
-                        shape=[end - start],
-                        belong_to_optimizer=True,
-                    )
-
-                    velocity_acc_ = self.helper.create_global_variable(
-                        name=f"{param.name}_clip_{self.rank}_velocity_acc",
-                        persistable=False,
-                        dtype=velocity_acc.dtype,
-                        shape=[end - start],
-                        belong_to_optimizer=True,
-                    )
-
-                    temp = paddle.empty([])
-                    shape = param.shape
-                    temp.get_tensor()._share_data_with(param.get_tensor())
-                    param_ = temp.reshape_([-1])._slice(start, end)
-                    temp.get_tensor()._share_data_with(param_and_grad[1].get_tensor())
-                    grad_ = temp.reshape_([-1])._slice(start, end)
-                    velocity_acc_ = velocity_acc.reshape_([-1])._slice(start, end)
-
-                    velocity_acc.reshape_(shape)
-                    param_.stop_gradient = True
-                    grad_.stop_gradient = True
-                    velocity_acc_.stop_gradient = True
-                    self.clipped_param[param.name] = (param_, velocity_acc_)
-                else:
-                    param_, velocity_acc_ = self.clipped_param[param.name]
-                    temp = paddle.empty([])
-                    temp.get_tensor()._share_data_with(param_and_grad[1].get_tensor())
-                    grad_ = temp.reshape_([-1])._slice(start, end)
+            views = self._clipped_views(param, grad)
+            if views is not None:
+                param_, grad_, accums, master_weight_ = views
+                velocity_acc_ = accums[velocity_acc.name]
             else:
                 param_ = param
-                grad_ = param_and_grad[1]
+                grad_ = grad
                 velocity_acc_ = velocity_acc
+                master_weight_ = master_weight
 
-            return paddle._C_ops.momentum_(
+            out = paddle._C_ops.momentum_(
                 param_,
                 grad_,
                 velocity_acc_,
                 lr,
-                master_weight,
+                master_weight_,
                 self._momentum,
                 self._use_nesterov,
                 regularization_method,
@@ -255,6 +134,8 @@ class DistributeMom(Momentum, DistributeOptimizer):
                 find_master,
                 self._rescale_grad,
             )
+            self._gather_updated(param)
+            return out
         else:
             attrs = {
                 "mu": self._momentum,
@@ -292,105 +173,17 @@ class DistributeMom(Momentum, DistributeOptimizer):
 
             return momentum_op
 
-    def step(self):
-        record_event = profiler.RecordEvent("optimizer_step")
-        record_event.begin()
-        if self.HIGH_PERFORMANCE_CONV:
-            super().step()
-        elif (
-            self.group is not None
-            and not isinstance(self._parameter_list[0], dict)
-            and self._rank_param_group is not None
-        ):
-            params_grads = []
-            for param in self._parameter_list:
-                if self.amp_o2 is False:
-                    assert (
-                        param.dtype == paddle.float32
-                    ), "distributed optimizer only support amp level1"
-                if param.stop_gradient is True or param._grad_ivar() is None:
-                    continue
-                grad_var = param._grad_ivar()
-                if paddle.in_dynamic_mode():
-                    if (
-                        hasattr(grad_var, "is_selected_rows")
-                        and grad_var.is_selected_rows()
-                        and self.regularization is not None
-                    ):
-                        raise RuntimeError(
-                            "AdamW don't support weight_decay with sparse parameters, please set it to None."
-                        )
-                else:
-                    if (
-                        hasattr(grad_var, "_is_sparse")
-                        and grad_var._is_sparse()
-                        and self.regularization is not None
-                    ):
-                        raise RuntimeError(
-                            "AdamW don't support weight_decay with sparse parameters, please set it to None."
-                        )
-                if (
-                    self.need_append_all_param
-                    or self._rank_param_group[self.rank].get(param.name) is not None
-                ):
-                    params_grads.append((param, grad_var))
-                self.amp_o2 = True
-            optimize_ops = self._apply_optimize(
-                loss=None, startup_program=None, params_grads=params_grads
-            )
-            # print(self.flat_param.shape)
-            # print(self.group)
-            self.group.process_group.all_gather_partial_on_calc_stream(
-                self.flat_param, self.flat_param, self.group.world_size, self.rank
-            )
-            if self._need_flatten():
-                self._flatten_accumulators()
-            else:
-                pass
+    def clear_grad(self, set_to_zero=True):
+        if self.flat_grads:
+            # the grads stay in flat_grads, whatever set_to_zero
+            self._clear_flat_grads()
         else:
-            super().step()
-        record_event.end()
+            super().clear_grad(set_to_zero)
 
-    def minimize(self, loss, startup_program=None, parameters=None, no_grad_set=None):
-        if self.HIGH_PERFORMANCE_CONV:
-            return super().minimize(loss, startup_program, parameters, no_grad_set)
-        elif (
-            self.group is not None
-            and not isinstance(self._parameter_list[0], dict)
-            and self._rank_param_group is not None
-        ):
-            assert isinstance(
-                loss, paddle.static.Variable
-            ), "The loss should be an Tensor."
-
-            parameter_list = parameters if parameters else self._parameter_list
-
-            params_grads = self.backward(
-                loss,
-                startup_program=startup_program,
-                parameters=parameter_list,
-                no_grad_set=no_grad_set,
-            )
+    def step(self):
+        self._step(super().step)
 
-            new_params_grads = []
-            for param, grad in params_grads:
-                if param.stop_gradient or param._grad_ivar() is None:
-                    continue
-                if (
-                    self.need_append_all_param
-                    or self._rank_param_group[self.rank].get(param.name) is not None
-                ):
-                    new_params_grads.append((param, grad))
-            optimize_ops = self._apply_optimize(
-                loss, startup_program=startup_program, params_grads=new_params_grads
-            )
-            self.group.process_group.all_gather_partial_on_calc_stream(
-                self.flat_param, self.flat_param, self.group.world_size, self.rank
-            )
-            if self._need_flatten():
-                self._flatten_accumulators()
-            else:
-                pass
-            return optimize_ops, params_grads
-        else:
-            return super().minimize(loss, startup_program, parameters, no_grad_set)
+    def minimize(self, loss, startup_program=None, parameters=None, no_grad_set=None):
+        return self._minimize(
+            super().minimize, loss, startup_program, parameters, no_grad_set
+        )
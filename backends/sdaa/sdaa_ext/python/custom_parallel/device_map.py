@@ -26,6 +26,10 @@
 from paddle_sdaa.sdaa_ext import *  # noqa
 import paddle
 import os
+import socket
+
+# cores of one card, cards of one node, or every rank
+SHARDING_SCOPES = ("in_card", "in_node", "global")
 
 
 def device_core_map():
@@ -50,7 +54,7 @@ def device_core_map():
     return card_core_map
 
 
-def get_cur_process_device_list():
+def _get_cur_device_id():
     device_list = None
     if os.environ.get("SDAA_VISIBLE_DEVICES"):
         device_list = os.environ.get("SDAA_VISIBLE_DEVICES").split(",")
@@ -58,17 +62,227 @@ def get_cur_process_device_list():
         device_list = paddle.device.get_available_device()
         device_list = [dev.split(":")[-1] for dev in device_list]
     mapped_device_id = os.environ.get("FLAGS_selected_sdaas")
-    cur_device_id = int(device_list[int(mapped_device_id)])
-    # get all physical device ids
-    all_device_ids = []
-    data = paddle.to_tensor([cur_device_id])
-    task = paddle.distributed.stream.all_gather(all_device_ids, data, sync_op=False)
-    task.wait()
-    all_device_ids = [int(i) for i in all_device_ids]  # --devices, physical ids
-    device_core_dict = device_core_map()
+    return int(device_list[int(mapped_device_id)])
+
+
+class DeviceTopology:
+    """
+    The aicards and nodes of the ranks, discovered once per process.
+
+    Discovery runs the rank_ids op and an all_gather over every rank, and the
+    sharding groups of a scope are created with new_group on every rank, so
+    both are done on first use only: the optimizers and scalers built later
+    read the cache and reuse the same communication groups. The topology is
+    discovered again if the number of ranks changes.
+
+    Use get_device_topology() rather than creating one.
+    """
+
+    def __init__(self):
+        self._core_map = None
+        self._device_id = None
+        self._ranks = None
+        self._sharding_groups = {}
+        self._groups = {}
+
+    @property
+    def core_map(self):
+        """The core ids of every aicard, see device_core_map."""
+        if self._core_map is None:
+            self._core_map = device_core_map()
+        return self._core_map
+
+    @property
+    def device_id(self):
+        """The physical core id of this process."""
+        if self._device_id is None:
+            self._device_id = _get_cur_device_id()
+        return self._device_id
+
+    @property
+    def ranks(self):
+        """The (node, aicard, core id) of every rank, indexed by rank."""
+        if (
+            self._ranks is None
+            or len(self._ranks) != paddle.distributed.get_world_size()
+        ):
+            card = next(
+                card
+                for card, core_ids in self.core_map.items()
+                if self.device_id in core_ids
+            )
+            ranks = []
+            paddle.distributed.all_gather_object(
+                ranks, (socket.gethostname(), card, self.device_id)
+            )
+            self._ranks = ranks
+            self._sharding_groups = {}
+            self._groups = {}
+        return self._ranks
+
+    def rank_topology(self):
+        """The (node, aicard) of every rank, see get_rank_topology."""
+        return [(node, card) for node, card, _ in self.ranks]
+
+    def group_ranks(self, scope, rank=None):
+        """The ranks sharding with `rank`, this one by default, for `scope`."""
+        if rank is None:
+            rank = paddle.distributed.get_rank()
+        for ranks, _ in get_sharding_groups(scope, self.rank_topology()):
+            if rank in ranks:
+                return ranks
+        return []
+
+    def new_group(self, ranks):
+        """The communication group of `ranks`, created on first use."""
+        key = tuple(ranks)
+        if key not in self._groups:
+            self._groups[key] = paddle.distributed.new_group(list(ranks))
+        return self._groups[key]
+
+    def sharding_groups(self, scope):
+        """
+        The communication groups that shard optimizer state for `scope`,
+        created on first use. Scopes that split the ranks alike, like
+        in_node and global on one node, share their groups.
+
+        Returns:
+
+            list: a (group, ranks, levels) tuple for every group of
+            get_sharding_groups, where levels lists the (group, ranks) of
+            every subgroup of every level
+        """
+        topology = self.rank_topology()
+        if scope not in self._sharding_groups:
+            # every rank creates every group, in the same order
+            groups = []
+            for ranks, levels in get_sharding_groups(scope, topology):
+                groups.append(
+                    (
+                        self.new_group(ranks),
+                        ranks,
+                        [
+                            [(self.new_group(sub), sub) for sub in subgroups]
+                            for subgroups in levels
+                        ],
+                    )
+                )
+            self._sharding_groups[scope] = groups
+        return self._sharding_groups[scope]
+
+
+_device_topology = DeviceTopology()
+
+
+def get_device_topology():
+    """
+    This function will get the DeviceTopology of this process, shared by
+    every optimizer and scaler.
+
+    Returns:
+
+        DeviceTopology: the cached topology of the ranks
+    """
+
+    return _device_topology
+
+
+def get_cur_process_device_list():
+    topology = get_device_topology()
+    cur_device_id = topology.device_id
+    # physical ids of all ranks, --devices
+    all_device_ids = [device_id for _, _, device_id in topology.ranks]
     devices_list = []
-    for key, val in device_core_dict.items():
+    for key, val in topology.core_map.items():
         cur_list = list(set(all_device_ids) & set(val))  # one physical card ids
         if cur_list != []:
             devices_list.append((all_device_ids, cur_list, cur_device_id))
     return devices_list
+
+
+def get_rank_topology():
+    """
+    This function will get the node and the aicard of every rank.
+
+    For example, it will get [("host0", 0), ("host0", 0), ("host0", 1), ("host0", 1)]
+    for four ranks on the first two cores of two aicards of one node.
+
+    The topology is discovered once per process, see DeviceTopology.
+
+    Returns:
+
+        list: the (node, aicard) of every rank, indexed by rank
+    """
+
+    return get_device_topology().rank_topology()
+
+
+def get_sharding_groups(scope, topology):
+    """
+    This function will split the ranks into the groups that shard optimizer state
+    for `scope`, and lay out the hierarchical all_gather of every group.
+
+    A group spanning several aicards gathers in levels: among the cores of an
+    aicard first, then among the same cores of the aicards of a node, then among
+    the same cores of every node, so that each level only crosses one kind of
+    link. This needs every aicard of the group to run the same number of
+    ranks, every node the same number of aicards, and the ranks to be numbered
+    node by node and aicard by aicard; otherwise the group gathers in one level.
+
+    Args:
+
+        scope (str): one of SHARDING_SCOPES
+        topology (list): the (node, aicard) of every rank, see get_rank_topology
+
+    Returns:
+
+        list: a (ranks, levels) pair for every group, where levels lists, from the
+        innermost level, the subgroups of ranks that gather together; levels is
+        empty when the group gathers in one level
+    """
+
+    if scope not in SHARDING_SCOPES:
+        raise ValueError(
+            f"sharding scope should be one of {SHARDING_SCOPES}, but got {scope}"
+        )
+    group_keys = {
+        "in_card": lambda node, card: (node, card),
+        "in_node": lambda node, card: node,
+        "global": lambda node, card: None,
+    }[scope]
+    groups = {}
+    for rank, (node, card) in enumerate(topology):
+        groups.setdefault(group_keys(node, card), []).append(rank)
+
+    sharding_groups = []
+    for ranks in groups.values():
+        # the ranks of every aicard of every node, in order of appearance
+        nodes = {}
+        for rank in ranks:
+            nodes.setdefault(topology[rank][0], {}).setdefault(
+                topology[rank][1], []
+            ).append(rank)
+        cards = [card for node in nodes.values() for card in node.values()]
+        sizes = [len(cards[0]), len(next(iter(nodes.values()))), len(nodes)]
+        uniform = (
+            all(len(node) == sizes[1] for node in nodes.values())
+            and all(len(card) == sizes[0] for card in cards)
+            and [rank for card in cards for rank in card] == ranks
+        )
+        levels = []
+        if uniform and sum(size > 1 for size in sizes) > 1:
+            # (node, aicard in node, core in aicard) of every rank
+            coords = [
+                (i // (sizes[0] * sizes[1]), i // sizes[0] % sizes[1], i % sizes[0])
+                for i in range(len(ranks))
+            ]
+            for level in (2, 1, 0):
+                if sizes[2 - level] == 1:
+                    continue
+                subgroups = {}
+                for rank, coord in zip(ranks, coords):
+                    key = coord[:level] + coord[level + 1 :]
+                    subgroups.setdefault(key, []).append(rank)
+                levels.append(list(subgroups.values()))
+        sharding_groups.append((ranks, levels))
+    return sharding_groups
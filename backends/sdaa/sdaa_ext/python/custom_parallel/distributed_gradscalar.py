@@ -52,21 +52,25 @@ class CustomGradScaler(paddle.amp.GradScaler):
             decr_every_n_nan_or_inf,
             use_dynamic_loss_scaling,
         )
-        avaliable_device_list = get_cur_process_device_list()
-        group_ranks = [
-            avaliable_device_list[0].index(i) for i in avaliable_device_list[1]
-        ]
-        total_rank = len(group_ranks)
-        if paddle.distributed.get_world_size() > 1:
-            self.group = paddle.distributed.new_group(group_ranks)
-        else:
-            self.group = None
-        rank = paddle.distributed.get_rank(self.group)
-        if rank < 0:
-            self.rank = 0
-        else:
-            self.rank = rank
         self.flatten_grad = None
+        self._optimizer = None
+
+    def _shard_grads(self, optimizer):
+        # the part of every grad the optimizer updates on this rank
+        indices = optimizer._rank_param_group[optimizer.rank]
+        param_grads = []
+        for param in optimizer._parameter_list:
+            if param.stop_gradient or indices.get(param.name) is None:
+                continue
+            grad = param._grad_ivar()
+            if grad is None:
+                continue
+            # reuse the optimizer's shard views of clipped grads
+            grad_ = (
+                optimizer._grad_view(param, grad) if indices[param.name][0] else None
+            )
+            param_grads.append(grad if grad_ is None else grad_)
+        return param_grads
 
     def _unscale(self, optimizer):
         if not self._enable:
@@ -78,45 +82,53 @@ class CustomGradScaler(paddle.amp.GradScaler):
             )
         elif optimizer_state["state"] is OptimizerState.STEPPED:
             raise RuntimeError("unscale_() is being called after step().")
+        # found_inf is reduced over the ranks the optimizer shards its state with
         if (
-            self.group is not None
+            getattr(optimizer, "group", None) is not None
             and getattr(optimizer, "_rank_param_group", None)
             and in_dynamic_mode()
         ):
-            indices = optimizer._rank_param_group[self.rank]
-            param_grads_fp32 = []
-            temp_tensor = paddle.empty([])
-            for param in optimizer._parameter_list:
-                if param.stop_gradient or indices.get(param.name) is None:
+            optimizer._reflatten_if_cast()
+            grad_shards = optimizer._bound_grad_shards()
+            if grad_shards is not None:
+                # one slice of the flat grads of each bucket
+                param_grads = list(grad_shards.values())
+            else:
+                param_grads = self._shard_grads(optimizer)
+            self._found_inf = self._temp_found_inf_value_false
+            # check_finite_and_unscale takes grads of a single dtype
+            for dtype, found_inf in [
+                (paddle.float16, self._temp_found_inf_fp16),
+                (paddle.bfloat16, self._temp_found_inf_bf16),
+                (paddle.float32, self._temp_found_inf_fp32),
+            ]:
+                grads = [grad for grad in param_grads if grad.dtype == dtype]
+                if not grads:
                     continue
-                should_clip, start, end = indices[param.name]
-                if param._grad_ivar() is not None:
-                    if should_clip:
-                        print(self.rank, param.name, start, end)
-                        temp_tensor.get_tensor()._share_data_with(
-                            param._grad_ivar().get_tensor()
-                        )
-                        param_grads_fp32.append(
-                            temp_tensor.reshape_([-1])._slice(int(start), int(end))
-                        )
-                    else:
-                        param_grads_fp32.append(param._grad_ivar())
-            _legacy_C_ops.check_finite_and_unscale(
-                param_grads_fp32,
-                self._scale,
-                param_grads_fp32,
-                self._temp_found_inf_fp32,
-            )
-            self._found_inf = _C_ops.bitwise_or(
-                self._found_inf, self._temp_found_inf_fp32
-            )
-            temp_found_inf = paddle.cast(self._found_inf, dtype=paddle.int32)
-            dist.stream.all_reduce(
-                temp_found_inf,
+                _legacy_C_ops.check_finite_and_unscale(
+                    grads,
+                    self._scale,
+                    grads,
+                    found_inf,
+                )
+                self._found_inf = _C_ops.bitwise_or(self._found_inf, found_inf)
+            # reduced on the communication stream while the optimizer issues the
+            # update; it waits for the result where it reads found_inf
+            self._found_inf = paddle.cast(self._found_inf, dtype=paddle.int32)
+            optimizer._found_inf_task = dist.stream.all_reduce(
+                self._found_inf,
                 op=dist.ReduceOp.MAX,
-                group=self.group,
-                use_calc_stream=True,
+                group=optimizer.group,
+                sync_op=False,
             )
-            self._found_inf = paddle.cast(temp_found_inf, dtype=paddle.bool)
+            self._optimizer = optimizer
+            optimizer_state["state"] = OptimizerState.UNSCALED
         else:
             super()._unscale(optimizer)
+
+    def _update(self):
+        if self._optimizer is not None:
+            self._optimizer._wait_found_inf()
+            self._found_inf = paddle.cast(self._found_inf, dtype=paddle.bool)
+            self._optimizer = None
+        super()._update()
@@ -23,38 +23,266 @@
 # STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
 # WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
+import os
 import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from paddle_sdaa.sdaa_ext import *  # noqa
 import paddle
+from paddle.optimizer.lr import LRScheduler
+from paddle.base import framework
+import paddle.profiler as profiler
+from paddle.base.layer_helper import LayerHelper
+import numpy as np
 from ..utils import *  # noqa
 from .device_map import *  # noqa
 from ..storage import *  # noqa
 
 
+# coalesce_tensor starts every tensor on this boundary, and all_gather_partial
+# needs the share of every rank to be aligned the same way
+_FLATTEN_ALIGN_BYTES = 128
+
+
+def _align_numel(dtype):
+    return _FLATTEN_ALIGN_BYTES // paddle.base.core.size_of_dtype(dtype)
+
+
+def _round_up(num, align):
+    return (num + align - 1) // align * align
+
+
+def _flat_view(tensor, start, end):
+    # a view of elements [start, end) of tensor, whatever its shape
+    temp = paddle.empty([])
+    temp.get_tensor()._share_data_with(tensor.get_tensor())
+    view = temp.reshape_([-1])._slice(start, end)
+    view.stop_gradient = True
+    return view
+
+
 class DistributeOptimizer:
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.flat_param = None
+    def _init_sharding(self, sharding_scope):
+        # paddle's optimizers do not call super().__init__(), the subclasses
+        # call this once theirs has run
+        self.flat_params = {}
+        self.rank_flat_params = {}
+        self.rank_num = {}
+        self.flat_master_weights = {}
+        self._flatten_buckets = {}
         self._rank_param_group = None
-        self.clipped_param = {}
         self.amp_o2 = False  # if traversed
+        self.clipped_param = {}
+        self._grad_views = {}
+        self.flat_accum = {}
+        self.flatten_params = []
+        self._already_flat_acc = set()
+        # all groups
         self.groups = []
-        self.flatten_params_name = []
+        self.t_block = framework.default_main_program().global_block()
+        # my group
         self.group = None
         self.total_rank = None
         self.rank = None
-        self.rank_flat_param = None
-        self.rank_num = None
+        self._gather_levels = []
+        self._set_sharding_scope(sharding_scope)
+        self.balance_plans = {}
+        # 0 keeps one gather bucket per dtype
+        self.gather_bucket_size = (
+            int(os.environ.get("SDAA_GATHER_BUCKET_MB", "25")) << 20
+        )
+        self.overlap_gather = False
+        self._gather_tasks = {}
+        self._gather_pending = []
+        self._bucket_of = {}
+        self._bucket_owned = {}
+        self._gather_waits = {}
+        self._gather_ready = set()
+        # update the shard of a bucket with a few ops over the flat buffers
+        self.fused_update = bool(int(os.environ.get("SDAA_FUSED_OPTIMIZER", "0")))
+        # keep the state of the shard on the host, 2 with the master weights
+        self.offload_state = int(os.environ.get("SDAA_OFFLOAD_OPTIMIZER", "0"))
+        self.fused_update = self.fused_update or self.offload_state > 0
+        self._fused_segments = {}
+        self._fused_runs = {}
+        self._fused_pending = {}
+        self.flat_grads = {}
+        self._bound_grads = {}
+        self._grad_shards = {}
+        self._found_inf_task = None
+        self._param_offsets = {}
+        self._host_state = {}
+        self._host_queue = []
+        self._host_lrs = {}
+        self._offload_pool = None
+        self.helper = LayerHelper(self.__class__.__name__)
+        self.HIGH_PERFORMANCE_CONV = int(os.environ.get("HIGH_PERFORMANCE_CONV", "0"))
+        self.need_append_all_param = True
+        if self.HIGH_PERFORMANCE_CONV:
+            warnings.warn(
+                "DistributeOptimizer Now Not Support HIGH_PERFORMANCE_CONV , Distrbuteoptimizer would work as origin optimizer"
+            )
+            return
+        if (
+            self._grad_clip is None
+            or isinstance(self._grad_clip, paddle.nn.ClipGradByValue)
+            or isinstance(self._grad_clip, paddle.nn.ClipGradByNorm)
+        ):
+            self.need_append_all_param = False
+        if paddle.in_dynamic_mode():
+            self.re_distribution()
+            if self.group is not None and not isinstance(self._parameter_list[0], dict):
+                self.re_flatten()
+            # optimizer len(accmulaters) = len(self._param_list trainable)
+            self._create_accumulators(
+                self.t_block,
+                self.flatten_params,
+            )
+            self._flatten_accumulators()
+            warnings.warn(
+                "DistributeOptimizer would add all trainable param to accumulators"
+            )
+            warnings.warn(
+                "DistributeOptimizer Now Not Support HIGH_PERFORMANCE_CONV , Only Support Param^shape = NCHW,Please Check Param^shape"
+            )
+
+    def _need_flatten(self):
+        if self.HIGH_PERFORMANCE_CONV:
+            return False
+        if not self.flat_accum:
+            return True
+
+    def _is_sharded(self):
+        return (
+            not self.HIGH_PERFORMANCE_CONV
+            and self.group is not None
+            and not isinstance(self._parameter_list[0], dict)
+            and self._rank_param_group is not None
+        )
+
+    def _step(self, step):
+        # step is the step of the paddle optimizer, taken when not sharded
+        record_event = profiler.RecordEvent("optimizer_step")
+        record_event.begin()
+        if not self._is_sharded():
+            step()
+            record_event.end()
+            return
+        self._prepare_step()
+        params_grads = []
+        # In origin optimizer , this is do in _create_optimization_pass after grad_clip and regulation
+        for param in self._parameter_list:
+            if param.stop_gradient or param._grad_ivar() is None:
+                continue
+            grad_var = param._grad_ivar()
+            if paddle.in_dynamic_mode():
+                if (
+                    hasattr(grad_var, "is_selected_rows")
+                    and grad_var.is_selected_rows()
+                    and self.regularization is not None
+                ):
+                    raise RuntimeError(
+                        "AdamW don't support weight_decay with sparse parameters, please set it to None."
+                    )
+            else:
+                if (
+                    hasattr(grad_var, "_is_sparse")
+                    and grad_var._is_sparse()
+                    and self.regularization is not None
+                ):
+                    raise RuntimeError(
+                        "AdamW don't support weight_decay with sparse parameters, please set it to None."
+                    )
+            params_grads.append((param, grad_var))
+            self.amp_o2 = True
+        self._sharded_update(params_grads)
+        record_event.end()
+
+    def _minimize(self, minimize, loss, startup_program, parameters, no_grad_set):
+        # minimize is the minimize of the paddle optimizer, taken when not
+        # sharded
+        record_event = profiler.RecordEvent("optimizer_minimize")
+        record_event.begin()
+        if not self._is_sharded():
+            record_event.end()
+            return minimize(loss, startup_program, parameters, no_grad_set)
+        assert isinstance(loss, paddle.static.Variable), "The loss should be an Tensor."
+
+        parameter_list = parameters if parameters else self._parameter_list
+
+        params_grads = self.backward(
+            loss,
+            startup_program=startup_program,
+            parameters=parameter_list,
+            no_grad_set=no_grad_set,
+        )
+
+        self._prepare_step()
+        optimize_ops = self._sharded_update(
+            [
+                (param, grad)
+                for param, grad in params_grads
+                if not param.stop_gradient and grad is not None
+            ],
+            loss,
+            startup_program,
+        )
+        record_event.end()
+        return optimize_ops, params_grads
+
+    def _sharded_update(self, params_grads, loss=None, startup_program=None):
+        # update the params of this rank, or all of them when the grads are
+        # clipped globally, and gather the updated params of every rank
+        owned = self._rank_param_group[self.rank]
+        unowned = [param for param, _ in params_grads if owned.get(param.name) is None]
+        if not self.need_append_all_param:
+            params_grads = [
+                (param, grad)
+                for param, grad in params_grads
+                if owned.get(param.name) is not None
+            ]
+        optimize_ops = self._apply_optimize(
+            loss, startup_program=startup_program, params_grads=params_grads
+        )
+        self._allgather_params()
+        self._finish_sharded_update(unowned)
+        if self._need_flatten():
+            self._flatten_accumulators()
+        return optimize_ops
+
+    def _finish_sharded_update(self, unowned):
+        """
+        Called once the update of a sharded step is issued, with the params
+        this rank left to the others. The state every rank keeps for every
+        param, such as beta pows, is advanced here.
+        """
+
+    def _set_sharding_scope(self, sharding_scope):
+        if sharding_scope is None:
+            sharding_scope = os.environ.get("SDAA_SHARDING_SCOPE", "in_card")
+        if sharding_scope not in SHARDING_SCOPES:
+            raise ValueError(
+                f"sharding_scope should be one of {SHARDING_SCOPES}, but got {sharding_scope}"
+            )
+        self.sharding_scope = sharding_scope
 
     def re_distribution(self):
-        avaliable_device_list = get_cur_process_device_list()
-        # The strategy only supports in_card sharding
-        for devices_list, cur_group_devices, cur_device_id in avaliable_device_list:
-            cur_group_ranks = [devices_list.index(i) for i in cur_group_devices]
-            self.groups.append(paddle.distributed.new_group(cur_group_ranks))
-            if cur_device_id in cur_group_devices:
-                self.group = self.groups[-1]
-                self.total_rank = len(cur_group_devices)
+        cur_rank = paddle.distributed.get_rank()
+        self._gather_levels = []
+        # the groups are created once per process and shared by optimizers
+        for group, ranks, level_groups in get_device_topology().sharding_groups(
+            self.sharding_scope
+        ):
+            self.groups.append(group)
+            if cur_rank in ranks:
+                self.group = group
+                self.total_rank = len(ranks)
+                for subgroups in level_groups:
+                    for group, sub in subgroups:
+                        if cur_rank in sub:
+                            self._gather_levels.append(
+                                (group, len(sub), sub.index(cur_rank))
+                            )
         rank = paddle.distributed.get_rank(self.group)
         if rank < 0:
             self.rank = 0
@@ -68,68 +296,200 @@ class DistributeOptimizer:
         if isinstance(self._parameter_list[0], dict):
             warnings.warn("_parameter_list^type is dict , donnot support flatten")
             return
+        # coalesce_tensor takes a single dtype, so every dtype gets its own
+        # flat buffers. Each is cut into buckets of about gather_bucket_size
+        # bytes in declaration order, so the first layers are gathered first,
+        # and every bucket is sharded over the ranks on its own.
+        buckets = {}
+        filled = {}
+        for param in self._parameter_list:
+            if not param.trainable:
+                continue
+            index, used = filled.get(param.dtype, (0, 0))
+            if used and 0 < self.gather_bucket_size < used + param_bytes(param):
+                index, used = index + 1, 0
+            filled[param.dtype] = (index, used + param_bytes(param))
+            buckets.setdefault((param.dtype, index), []).append(param)
+
         self.flatten_params = []
-        index_and_padding = {}
-        total_num = 0
-        # flatten_params = list(
-        #     filter(lambda param: param.dtype == "float32",
-        #             self._parameter_list))
-        self.flatten_params = balance(self._parameter_list)
-        for param in self.flatten_params:
-            # padding align to 128B, now we assume param is float32, this should change
-            numel = (np.prod(param.shape) + 31) // 32 * 32
-            index_and_padding[param.name] = (total_num, numel, np.prod(param.shape))
-            total_num += numel
-        # for all_gather, every rank allocate_flatten_tensor should align 128B, assume param is float32,is 128/4 =32
-        align_size = 32 * self.total_rank  # np.lcm(32, self.total_rank)
-        if total_num % align_size != 0:
-            total_num_ = (total_num + align_size - 1) // align_size * align_size
-
-            self.flatten_params.append(
-                paddle.full(
-                    shape=[total_num_ - total_num], fill_value=0.0, dtype=paddle.float32
+        self._flatten_buckets = {}
+        self.flat_params = {}
+        self.rank_flat_params = {}
+        self.rank_num = {}
+        self._param_offsets = {}
+        self._fused_segments = {}
+        self._rank_param_group = {}
+        self._rank_pram_gap = {}
+        for i in range(self.total_rank):
+            self._rank_param_group[i] = {}
+            self._rank_pram_gap[i] = {}
+        self._rank_pram_gap[self.total_rank] = {}
+        self.balance_plans = {}
+        for key, params in buckets.items():
+            # every rank gets an equal share for all_gather_partial, the
+            # plan only orders the params so that few of them are split
+            plan = balance(params, self.total_rank, _FLATTEN_ALIGN_BYTES)
+            self.balance_plans[key] = plan
+            params = plan.order(params)
+            align = _align_numel(key[0])
+            index_and_padding = {}
+            total_num = 0
+            for param in params:
+                numel = _round_up(np.prod(param.shape), align)
+                index_and_padding[param.name] = (total_num, numel, np.prod(param.shape))
+                total_num += numel
+            # for all_gather, the share of every rank should be aligned too
+            total_num_ = _round_up(total_num, align * self.total_rank)
+            if total_num_ != total_num:
+                index_and_padding[f"align_gap_tensor_{len(self.flat_params)}"] = (
+                    total_num,
+                    total_num_ - total_num,
+                    total_num_ - total_num,
                 )
+                total_num = total_num_
+            self.flatten_params.extend(params)
+            self._param_offsets[key] = {
+                param.name: (
+                    int(index_and_padding[param.name][0]),
+                    int(index_and_padding[param.name][2]),
+                )
+                for param in params
+            }
+            self._flatten_buckets[key] = params
+            self.flat_params[key] = self._coalesce_bucket(params, align, total_num)
+
+            rank_num = total_num // self.total_rank
+            self.rank_num[key] = rank_num
+            rank_offset = rank_num * self.rank
+            self.rank_flat_params[key] = self.flat_params[key]._slice(
+                rank_offset, rank_offset + rank_num
             )
-            index_and_padding["align_gap_tensor"] = (
-                total_num,
-                total_num_ - total_num,
-                total_num_ - total_num,
-            )
-            total_num = total_num_
-        self.flat_param = paddle.full(
-            shape=[total_num], fill_value=0.0, dtype=paddle.float32
-        )
+            self._shard_bucket(index_and_padding, rank_num)
+            # the spans of its shard this rank updates, one per param
+            shard_end = rank_offset + rank_num
+            segments = []
+            for param in params:
+                offset, _, numel = index_and_padding[param.name]
+                if offset < shard_end and offset + numel > rank_offset:
+                    segments.append(
+                        (
+                            param.name,
+                            int(max(offset, rank_offset) - rank_offset),
+                            int(min(offset + numel, shard_end) - rank_offset),
+                        )
+                    )
+            self._fused_segments[key] = segments
+
+        # a bucket can be gathered once this rank updated the params it owns
+        # in it
+        self._bucket_of = {}
+        self._bucket_owned = {}
+        for key, params in buckets.items():
+            self._bucket_owned[key] = set()
+            for param in params:
+                self._bucket_of[param.name] = key
+                if param.name in self._rank_param_group[self.rank]:
+                    self._bucket_owned[key].add(param.name)
+        self._gather_tasks = {}
+        self._reset_gathers()
+        self._fused_pending = {}
+        self._bind_flat_grads()
+
+    def _coalesce_bucket(self, tensors, align, total_num):
+        """Copies `tensors` into one flat buffer of `total_num` elements that
+        they share from then on. Every tensor starts on a multiple of `align`
+        elements, whatever its own dtype, so the buffers of a param and of its
+        accumulators and master weight have the same layout."""
+        tensors = list(tensors)
+        dtype = tensors[0].dtype
+        used = sum(_round_up(np.prod(t.shape), align) for t in tensors)
+        if used < total_num:
+            tensors.append(paddle.zeros([total_num - used], dtype=dtype))
+        flat = paddle.zeros([total_num], dtype=dtype)
         paddle._legacy_C_ops.coalesce_tensor(
-            self.flatten_params,
-            self.flatten_params,
-            self.flat_param,
+            tensors,
+            tensors,
+            flat,
             "copy_data",
             True,
             "use_align",
             True,
             "align_size",
-            128,
+            align * paddle.base.core.size_of_dtype(dtype),
             "dtype",
-            self.flatten_params[0].dtype,
+            dtype,
         )
-        # print(self.flat_param.shape, flush=True)
+        return flat
 
-        self._rank_param_group = {}
-        self._rank_pram_gap = {}
-        for i in range(self.total_rank):
-            self._rank_param_group[i] = {}
-            self._rank_pram_gap[i] = {}
-        self._rank_pram_gap[self.total_rank] = {}
-        rank_num = total_num // self.total_rank
-        self.rank_num = rank_num
+    def _bind_flat_grads(self):
+        # With fused_update, the grads live in flat buffers laid out as
+        # flat_params, so the grad shard of this rank is a single slice.
+        # clear_grad() zeroes the buffers instead of the grads: a grad that
+        # is cleared to zero is replaced by the next backward.
+        self.flat_grads = {}
+        self._bound_grads = {}
+        self._grad_shards = {}
+        if not self.fused_update:
+            return
+        for key, params in self._flatten_buckets.items():
+            # grads already there, e.g. when re-flattened after backward, are
+            # carried over
+            grads = [
+                param._grad_ivar()
+                if param._grad_ivar() is not None
+                else paddle.zeros(param.shape, dtype=param.dtype)
+                for param in params
+            ]
+            self.flat_grads[key] = self._coalesce_bucket(
+                grads, _align_numel(key[0]), self.flat_params[key].shape[0]
+            )
+            for param, grad in zip(params, grads):
+                param._copy_gradient_from(grad)
+                self._bound_grads[param.name] = (param, grad)
+            rank_offset = self.rank_num[key] * self.rank
+            self._grad_shards[key] = self.flat_grads[key]._slice(
+                rank_offset, rank_offset + self.rank_num[key]
+            )
+
+    def _clear_flat_grads(self):
+        for flat in self.flat_grads.values():
+            flat.zero_()
+        # grads cleared by the layers were replaced, and are bound again
+        for param, grad in self._bound_grads.values():
+            grad_ = param._grad_ivar()
+            if grad_ is None or grad_.data_ptr() != grad.data_ptr():
+                param.clear_gradient(False)
+                param._copy_gradient_from(grad)
+
+    def _bound_grad_shards(self):
+        """Returns the grad shards of this rank in flat_grads, or None when a
+        grad is not in them."""
+        if not self.flat_grads:
+            return None
+        for param, grad in self._bound_grads.values():
+            grad_ = param._grad_ivar()
+            if grad_ is None or grad_.data_ptr() != grad.data_ptr():
+                return None
+        return self._grad_shards
+
+    def _wait_found_inf(self):
+        # CustomGradScaler reduces found_inf over the ranks on the
+        # communication stream, while the update is issued. It is reduced
+        # as int32 and read back as bool.
+        found_inf = self._get_auxiliary_var("found_inf")
+        if self._found_inf_task is not None:
+            self._found_inf_task.wait()
+            self._found_inf_task = None
+            if found_inf is not None:
+                found_inf = paddle.cast(found_inf, dtype=paddle.bool)
+                self._set_auxiliary_var("found_inf", found_inf)
+        return found_inf
+
+    def _shard_bucket(self, index_and_padding, rank_num):
         # private layout should not be cliped
         should_clip = True
         cur_rank = 0
         cur_rank_allocate_num = 0
-        rank_offset = rank_num * self.rank
-        self.rank_flat_param = self.flat_param._slice(
-            rank_offset, rank_offset + rank_num
-        )
         for name, (_, length, numel_) in index_and_padding.items():
             # while True until no params to alloc
             remaining_num = length
@@ -208,3 +568,714 @@ class DistributeOptimizer:
                     )
                     cur_rank_allocate_num += remaining_num
                     remaining_num = 0
+
+    def _find_master(self, param):
+        return self._multi_precision and self._is_dtype_fp16_or_bf16(param.dtype)
+
+    def _state_of(self, param):
+        # the tensor the accumulators of `param` are kept for
+        return self._master_weights[param.name] if self._find_master(param) else param
+
+    def _flatten_accumulators(self):
+        if self.HIGH_PERFORMANCE_CONV:
+            return
+        for k, _ in self._accumulators.items():
+            # only flatten moment
+            if "beta" in k:
+                continue
+            self.flat_accum[k] = {}
+            for key, params in self._flatten_buckets.items():
+                # accumulators of a low precision param are kept for its master
+                # weight, and may be wider than the param itself
+                accs = [
+                    self._accumulators[k][self._state_of(param).name]
+                    for param in params
+                ]
+                self._already_flat_acc.update(param.name for param in params)
+                self.flat_accum[k][key] = self._coalesce_bucket(
+                    accs, _align_numel(key[0]), self.flat_params[key].shape[0]
+                )
+        self._flatten_master_weights()
+        self._build_clipped_views()
+        self._build_fused_runs()
+        self._offload_flat_state()
+
+    def _flatten_master_weights(self):
+        self.flat_master_weights = {}
+        for key, params in self._flatten_buckets.items():
+            if not self._find_master(params[0]):
+                continue
+            self.flat_master_weights[key] = self._coalesce_bucket(
+                [self._master_weights[param.name] for param in params],
+                _align_numel(key[0]),
+                self.flat_params[key].shape[0],
+            )
+
+    def _build_clipped_views(self):
+        # The views of the shards of clipped params, built once so that the
+        # update neither allocates tensors nor reads storage formats back.
+        # Only NCHW params are updated in shards.
+        self.clipped_param = {}
+        self._grad_views = {}
+        params = {param.name: param for param in self.flatten_params}
+        for name, (should_clip, start, end) in self._rank_param_group[
+            self.rank
+        ].items():
+            param = params.get(name)
+            if (
+                param is None
+                or not should_clip
+                or tensor_storage_format(param) != "NCHW"
+            ):
+                continue
+            state = param
+            master_weight_ = None
+            if self._find_master(param):
+                state = self._master_weights[name]
+                master_weight_ = _flat_view(state, start, end)
+            accums = {
+                self._accumulators[k][state.name].name: _flat_view(
+                    self._accumulators[k][state.name], start, end
+                )
+                for k in self._accumulators
+                if "beta" not in k and state.name in self._accumulators[k]
+            }
+            self.clipped_param[name] = (
+                _flat_view(param, start, end),
+                accums,
+                master_weight_,
+            )
+
+    def _grad_view(self, param, grad):
+        """Returns a flat view of the part of `grad` this rank updates, or None
+        when the grad is not NCHW and the param is updated whole."""
+        # grads are usually zeroed in place and keep their memory, so the view
+        # is only built again when the grad moves
+        cached = self._grad_views.get(param.name)
+        if cached is None or cached[0] != grad.data_ptr():
+            should_clip, start, end = self._rank_param_group[self.rank][param.name]
+            if not should_clip:
+                start, end = 0, int(np.prod(grad.shape))
+            grad_ = None
+            if tensor_storage_format(grad) == "NCHW":
+                grad_ = _flat_view(grad, start, end)
+            cached = (grad.data_ptr(), grad_)
+            self._grad_views[param.name] = cached
+        return cached[1]
+
+    def _clipped_views(self, param, grad):
+        """Returns the param, grad, accumulator and master weight views of the
+        shard of `param` this rank updates, or None to update it whole."""
+        views = self.clipped_param.get(param.name)
+        if views is None:
+            return None
+        grad_ = self._grad_view(param, grad)
+        if grad_ is None:
+            return None
+        param_, accums, master_weight_ = views
+        return param_, grad_, accums, master_weight_
+
+    def _fused_run_key(self, param):
+        # params of the same key next to each other are updated by one op
+        return (param.optimize_attr["learning_rate"],)
+
+    def _build_fused_runs(self):
+        # With fused_update, the shard of a bucket is updated over the flat
+        # buffers by one op per run of params with the same _fused_run_key,
+        # instead of one op per param. Grads that are not in flat_grads, e.g.
+        # clipped copies, are copied into one flat grad, with zeros for the
+        # padding between the params.
+        self._fused_runs = {}
+        self._fused_pending = {}
+        if not self.fused_update:
+            return
+        params = {param.name: param for param in self.flatten_params}
+        fillers = {}
+        for key, segments in self._fused_segments.items():
+            if not segments or any(
+                tensor_storage_format(params[name]) != "NCHW" for name, _, _ in segments
+            ):
+                continue
+            rank_offset = self.rank_num[key] * self.rank
+            base = segments[0][1]
+            pieces = []
+            runs = []
+            end = base
+            for name, lo, hi in segments:
+                if lo > end:
+                    if lo - end not in fillers:
+                        fillers[lo - end] = paddle.zeros([lo - end], dtype=key[0])
+                    pieces.append(fillers[lo - end])
+                pieces.append(name)
+                end = hi
+                run_key = self._fused_run_key(params[name])
+                if runs and runs[-1]["key"] == run_key:
+                    runs[-1]["segments"].append((name, lo, hi))
+                else:
+                    runs.append({"key": run_key, "segments": [(name, lo, hi)]})
+            flat_grad = None
+            if key in self.flat_grads:
+                flat_grad = self.flat_grads[key]._slice(
+                    rank_offset + base, rank_offset + end
+                )
+            for run in runs:
+                lo, hi = run["segments"][0][1], run["segments"][-1][2]
+                state = params[run["segments"][0][0]]
+                if self._find_master(state):
+                    state = self._master_weights[state.name]
+                run["grad"] = (lo - base, hi - base)
+                run["param"] = self.flat_params[key]._slice(
+                    rank_offset + lo, rank_offset + hi
+                )
+                # keyed by the accumulators of the first param, as in clipped_param
+                run["accums"] = {
+                    self._accumulators[k][state.name]
+                    .name: flat[key]
+                    ._slice(rank_offset + lo, rank_offset + hi)
+                    for k, flat in self.flat_accum.items()
+                }
+                run["master_weight"] = (
+                    self.flat_master_weights[key]._slice(
+                        rank_offset + lo, rank_offset + hi
+                    )
+                    if key in self.flat_master_weights
+                    else None
+                )
+            self._fused_runs[key] = (pieces, runs, flat_grad)
+
+    def _defer_update(self, block, param_and_grad):
+        """Returns True when the update of the param is left to the fused
+        update of its bucket, which runs as soon as every param of the bucket
+        this rank updates has its grad."""
+        key = self._bucket_of.get(param_and_grad[0].name)
+        if key not in self._fused_runs:
+            return False
+        pending = self._fused_pending.setdefault(key, {})
+        pending[param_and_grad[0].name] = (block, param_and_grad)
+        if len(pending) == len(self._fused_segments[key]):
+            self._flush_fused(key)
+        return True
+
+    def _flush_fused(self, key):
+        pending = self._fused_pending.pop(key)
+        pieces, runs, flat_grad = self._fused_runs[key]
+        if (
+            flat_grad is not None
+            and len(pending) == len(self._fused_segments[key])
+            and all(
+                grad.data_ptr() == self._bound_grads[name][1].data_ptr()
+                for name, (_, (_, grad)) in pending.items()
+            )
+        ):
+            # the grads are still those in flat_grads, not clipped copies
+            self._append_fused_update_ops(key, runs, pending, flat_grad)
+            return
+        grads = {
+            name: self._grad_view(*param_and_grad)
+            for name, (_, param_and_grad) in pending.items()
+        }
+        if len(pending) < len(self._fused_segments[key]) or any(
+            grad is None for grad in grads.values()
+        ):
+            if key in self._host_state:
+                self._update_params_on_host(key, pending, grads)
+                return
+            # a param without grad, or a grad in another layout, leaves the
+            # bucket to the update of one param at a time
+            for name, _, _ in self._fused_segments[key]:
+                if name in pending:
+                    self._append_param_update_op(*pending[name])
+            return
+        if len(pieces) == 1:
+            grad = grads[pieces[0]]
+        else:
+            grad = paddle.concat(
+                [grads[piece] if isinstance(piece, str) else piece for piece in pieces]
+            )
+        self._append_fused_update_ops(key, runs, pending, grad)
+
+    def _append_fused_update_ops(self, key, runs, pending, grad):
+        if key in self._host_state:
+            self._update_on_host(
+                key, runs, pending, [(self._host_state[key]["grad"], grad)]
+            )
+            return
+        for run in runs:
+            self._append_fused_update_op(
+                run,
+                [pending[name][1] for name, _, _ in run["segments"]],
+                grad._slice(*run["grad"]),
+            )
+        self._gather_bucket(key)
+
+    def _shard_slice(self, flat, key, lo, hi):
+        # flat buffers offloaded to the host only hold the shard of this rank
+        if flat.shape[0] != self.rank_num[key]:
+            lo += self.rank_num[key] * self.rank
+            hi += self.rank_num[key] * self.rank
+        return flat._slice(lo, hi)
+
+    def _rank_slice(self, flat, key):
+        return self._shard_slice(flat, key, 0, self.rank_num[key])
+
+    def _offload_flat_state(self):
+        # With offload_state, the buckets updated by fused runs keep the
+        # accumulators of the shard of this rank on the host, and with 2 its
+        # master weights too. The runs are split at params into about one
+        # per thread and updated there, see _update_on_host. The device keeps
+        # the params, and with 1 the master weights, which are fetched for
+        # the update and stored back after it.
+        self._host_state = {}
+        self._host_queue = []
+        if not self.offload_state or not self._fused_runs:
+            return
+        # the cores of the node are shared by its ranks
+        topology = get_device_topology().rank_topology()
+        node = topology[paddle.distributed.get_rank()][0]
+        nthreads = max(
+            1, (os.cpu_count() or 1) // sum(node_ == node for node_, _ in topology)
+        )
+        if self._offload_pool is None:
+            self._offload_pool = ThreadPoolExecutor(nthreads)
+        cpu = paddle.CPUPlace()
+        for key, (_, runs, _) in self._fused_runs.items():
+            segments = self._fused_segments[key]
+            base, end = segments[0][1], segments[-1][2]
+            device_param = self._shard_slice(self.flat_params[key], key, base, end)
+            host = {
+                "base": base,
+                "grad": paddle.empty([end - base], dtype=key[0]).cpu(),
+                "param": device_param._copy_to(cpu, True),
+                "fetch": [],
+                "store": [],
+            }
+            for k, flats in self.flat_accum.items():
+                flats[key] = self._rank_slice(flats[key], key)._copy_to(cpu, True)
+            device_master = self.flat_master_weights.get(key)
+            if device_master is not None and self.offload_state > 1:
+                self.flat_master_weights[key] = self._rank_slice(
+                    device_master, key
+                )._copy_to(cpu, True)
+            elif device_master is not None:
+                device_master = self._shard_slice(device_master, key, base, end)
+                host["master_weight"] = device_master._copy_to(cpu, True)
+                host["fetch"].append((host["master_weight"], device_master))
+                host["store"].append((device_master, host["master_weight"]))
+            else:
+                host["fetch"].append((host["param"], device_param))
+            host["store"].append((device_param, host["param"]))
+            self._host_state[key] = host
+            # the per param state of the bucket becomes views of the host
+            # shard, empty for the params of other ranks, so that nothing
+            # holds the device buffers any more
+            owned = {name: (lo, hi) for name, lo, hi in segments}
+            for param in self._flatten_buckets[key]:
+                self.clipped_param.pop(param.name, None)
+                state = self._state_of(param)
+                lo, hi = owned.get(param.name, (0, 0))
+                for k, flats in self.flat_accum.items():
+                    view = self._shard_slice(flats[key], key, lo, hi)
+                    view.name = self._accumulators[k][state.name].name
+                    self._accumulators[k][state.name] = view
+                if device_master is not None and self.offload_state > 1:
+                    view = self._shard_slice(self.flat_master_weights[key], key, lo, hi)
+                    view.name = state.name
+                    self._master_weights[param.name] = view
+            # runs of about equal size, one per thread
+            chunk = -(-(end - base) // nthreads)
+            host_runs = []
+            for run in runs:
+                start = 0
+                for i, (_, _, hi) in enumerate(run["segments"]):
+                    if i + 1 == len(run["segments"]) or (
+                        hi - run["segments"][start][1] >= chunk
+                    ):
+                        host_runs.append(
+                            self._host_run(key, run["segments"][start : i + 1])
+                        )
+                        start = i + 1
+            pieces, _, flat_grad = self._fused_runs[key]
+            self._fused_runs[key] = (pieces, host_runs, flat_grad)
+
+    def _host_run(self, key, segments):
+        """Returns the run over `segments` of bucket `key` on its host state."""
+        host = self._host_state[key]
+        lo, hi = segments[0][1], segments[-1][2]
+        param = {param.name: param for param in self._flatten_buckets[key]}[
+            segments[0][0]
+        ]
+        state = self._state_of(param)
+        span = (lo - host["base"], hi - host["base"])
+        run = {
+            "key": self._fused_run_key(param),
+            "segments": list(segments),
+            "grad": span,
+            "param": host["param"]._slice(*span),
+            "accums": {
+                self._accumulators[k][state.name].name: self._shard_slice(
+                    flats[key], key, lo, hi
+                )
+                for k, flats in self.flat_accum.items()
+            },
+            "master_weight": None,
+        }
+        if "master_weight" in host:
+            master_weight = host["master_weight"]._slice(*span)
+        elif key in self.flat_master_weights:
+            master_weight = self._shard_slice(
+                self.flat_master_weights[key], key, lo, hi
+            )
+        else:
+            return run
+        # the host kernels are float only, so the master weight is updated as
+        # the param, and cast to the param after
+        run["cast_to"] = run["param"]
+        run["param"] = master_weight
+        return run
+
+    def _update_host_run(self, run, params_grads, grad):
+        self._append_fused_update_op(run, params_grads, grad)
+        if "cast_to" in run:
+            run["cast_to"].copy_(run["param"].astype(run["cast_to"].dtype), False)
+
+    def _update_params_on_host(self, key, pending, grads):
+        # without the grads of some params, the others of the bucket are
+        # updated one at a time, still on the host
+        host = self._host_state[key]
+        runs = []
+        fetch = []
+        for segment in self._fused_segments[key]:
+            name, lo, hi = segment
+            if name not in pending:
+                continue
+            if grads[name] is None:
+                raise RuntimeError(
+                    f"the optimizer state of {name} is offloaded and needs an NCHW grad"
+                )
+            run = self._host_run(key, [segment])
+            runs.append(run)
+            fetch.append((host["grad"]._slice(*run["grad"]), grads[name]))
+        self._update_on_host(key, runs, pending, fetch)
+
+    def _update_on_host(self, key, runs, pending, grads):
+        """Fetches the (host, device) pairs of `grads` and the shard state of
+        bucket `key` kept on the device to the host, and queues its runs. The
+        bucket queued before is updated meanwhile, so that the copies of one
+        bucket overlap the update of the other."""
+        for dst, src in grads + self._host_state[key]["fetch"]:
+            dst.copy_(src, False)
+        event = paddle.device.current_stream().record_event()
+        self._flush_host_updates()
+        self._host_queue.append((key, runs, pending, event))
+
+    def _flush_host_updates(self):
+        queued, self._host_queue = self._host_queue, []
+        for key, runs, pending, event in queued:
+            host = self._host_state[key]
+            event.synchronize()
+            # the workers only run the host kernels, what touches the device
+            # is done here
+            run_params_grads = []
+            for run in runs:
+                params_grads = [pending[name][1] for name, _, _ in run["segments"]]
+                lr_key = run["key"][0]
+                if lr_key not in self._host_lrs:
+                    self._host_lrs[lr_key] = self._create_param_lr(
+                        params_grads[0]
+                    ).cpu()
+                run["lr"] = self._host_lrs[lr_key]
+                self._prepare_host_run(run, params_grads)
+                run_params_grads.append(params_grads)
+            tasks = [
+                self._offload_pool.submit(
+                    self._update_host_run,
+                    run,
+                    params_grads,
+                    host["grad"]._slice(*run["grad"]),
+                )
+                for run, params_grads in zip(runs, run_params_grads)
+            ]
+            for task in tasks:
+                task.result()
+            for dst, src in host["store"]:
+                dst.copy_(src, False)
+            self._gather_bucket(key)
+
+    def _prepare_host_run(self, run, params_grads):
+        """Gives `run` host copies of the state its update reads from the
+        device, before a worker thread updates it on the host."""
+
+    def _fused_lr(self, run, param_and_grad):
+        # runs updated on the host take a host copy of the lr
+        if "lr" in run:
+            return run["lr"]
+        return self._create_param_lr(param_and_grad)
+
+    def save_sharded_state(self, path):
+        """
+        Saves the state of the optimizer to the directory `path` without
+        gathering it. Every rank of the sharding group of rank 0 writes the
+        shard it updates, and rank 0 a manifest with the layout and the
+        state that is kept whole, like the beta pows and the lr scheduler.
+        The other groups hold the same state and write nothing.
+
+        Args:
+
+            path (str): the directory to write to, shared by the ranks
+        """
+        if not self.flat_accum:
+            raise RuntimeError(
+                "save_sharded_state() needs the flattened state of the distributed optimizer"
+            )
+        if self.group is not None and 0 not in self.group.ranks:
+            return
+        os.makedirs(path, exist_ok=True)
+        shard = {
+            "accumulators": {
+                k: [self._rank_slice(flats[key], key) for key in self.flat_params]
+                for k, flats in self.flat_accum.items()
+            },
+            "master_weights": [
+                self._rank_slice(self.flat_master_weights[key], key)
+                if key in self.flat_master_weights
+                else None
+                for key in self.flat_params
+            ],
+        }
+        paddle.save(shard, os.path.join(path, f"rank{self.rank}.pdopt"))
+        if self.rank != 0:
+            return
+        # the state kept whole is keyed by param, whatever its master weight
+        states = {param.name: self._state_of(param) for param in self.flatten_params}
+        manifest = {
+            "nranks": self.total_rank,
+            "buckets": [
+                {"rank_num": self.rank_num[key], "params": self._param_offsets[key]}
+                for key in self.flat_params
+            ],
+            "accumulators": {
+                k: {
+                    name: accs[state.name]
+                    for name, state in states.items()
+                    if state.name in accs
+                }
+                for k, accs in self._accumulators.items()
+                if k not in self.flat_accum
+            },
+        }
+        if isinstance(self._learning_rate, LRScheduler):
+            manifest["LR_Scheduler"] = self._learning_rate.state_dict()
+        paddle.save(manifest, os.path.join(path, "manifest.pdopt"))
+
+    def load_sharded_state(self, path):
+        """
+        Restores the state saved by save_sharded_state() from the directory
+        `path`. The number of ranks and the bucket size may have changed
+        since: every rank reads the elements of the params it updates from
+        the saved shards that hold them, and no other shard.
+
+        Args:
+
+            path (str): the directory save_sharded_state() wrote to
+        """
+        if not self.flat_accum:
+            raise RuntimeError(
+                "load_sharded_state() needs the flattened state of the distributed optimizer"
+            )
+        manifest = paddle.load(os.path.join(path, "manifest.pdopt"))
+        saved = {}
+        for index, bucket in enumerate(manifest["buckets"]):
+            for name, (offset, _) in bucket["params"].items():
+                saved[name] = (index, offset, bucket["rank_num"])
+        shards = {}
+
+        def copy(dst, src):
+            dst.copy_(src if src.dtype == dst.dtype else src.astype(dst.dtype), False)
+
+        for key, segments in self._fused_segments.items():
+            rank_offset = self.rank_num[key] * self.rank
+            for name, lo, hi in segments:
+                index, offset, rank_num = saved[name]
+                # where the elements of the param this rank updates were saved
+                start = offset + rank_offset + lo - self._param_offsets[key][name][0]
+                end = start + hi - lo
+                dst = lo
+                while start < end:
+                    rank = start // rank_num
+                    stop = min(end, (rank + 1) * rank_num)
+                    if rank not in shards:
+                        shards[rank] = paddle.load(
+                            os.path.join(path, f"rank{rank}.pdopt")
+                        )
+                    src = (start - rank * rank_num, stop - rank * rank_num)
+                    for k, flats in self.flat_accum.items():
+                        copy(
+                            self._shard_slice(flats[key], key, dst, dst + stop - start),
+                            shards[rank]["accumulators"][k][index]._slice(*src),
+                        )
+                    master_weight = shards[rank]["master_weights"][index]
+                    if key in self.flat_master_weights and master_weight is not None:
+                        copy(
+                            self._shard_slice(
+                                self.flat_master_weights[key],
+                                key,
+                                dst,
+                                dst + stop - start,
+                            ),
+                            master_weight._slice(*src),
+                        )
+                    dst += stop - start
+                    start = stop
+        for param in self.flatten_params:
+            state = self._state_of(param)
+            for k, values in manifest["accumulators"].items():
+                if param.name in values and state.name in self._accumulators[k]:
+                    self._accumulators[k][state.name].set_value(values[param.name])
+        if "LR_Scheduler" in manifest and isinstance(self._learning_rate, LRScheduler):
+            self._learning_rate.set_state_dict(manifest["LR_Scheduler"])
+
+    def _allgather_flat(self, flat, sync_op=True):
+        """Gathers the shards of `flat` from every rank. Unless `sync_op`, the
+        last level runs on the communication stream and its task is returned."""
+        levels = self._gather_levels or [(self.group, self.total_rank, self.rank)]
+        # each level gathers the span of shares the next level sends on
+        part = flat.shape[0] // self.total_rank
+        span = 1
+        task = None
+        for i, (group, nranks, index) in enumerate(levels):
+            span *= nranks
+            start = self.rank // span * span * part
+            flat_ = flat._slice(start, start + span * part)
+            if sync_op or i + 1 < len(levels):
+                group.process_group.all_gather_partial_on_calc_stream(
+                    flat_, flat_, nranks, index
+                )
+                continue
+            chunk = span // nranks * part
+            task = group.process_group.all_gather_into_tensor(
+                flat_, flat_._slice(index * chunk, (index + 1) * chunk), False
+            )
+        return task
+
+    def _start_gather(self, key):
+        self._gather_tasks[key] = self._allgather_flat(
+            self.flat_params[key], sync_op=False
+        )
+
+    def _reset_gathers(self):
+        self._gather_pending = list(self.flat_params)
+        self._gather_waits = {
+            key: set(names) for key, names in self._bucket_owned.items()
+        }
+        self._gather_ready = {
+            key for key in self.flat_params if not self._bucket_owned.get(key)
+        }
+
+    def _gather_updated(self, param):
+        key = self._bucket_of.get(param.name)
+        waits = self._gather_waits.get(key, set())
+        if param.name in waits:
+            waits.discard(param.name)
+            if not waits:
+                self._gather_bucket(key)
+
+    def _gather_bucket(self, key):
+        """Marks bucket `key` as updated by this rank and starts the gathers
+        it unblocks. Every rank has to start the gathers in the same order, so
+        a bucket is only gathered once the buckets before it are updated."""
+        self._gather_ready.add(key)
+        if key in self._gather_pending and self._host_queue:
+            # buckets updated on the host are gathered once stored back
+            started = self._gather_pending[: self._gather_pending.index(key) + 1]
+            if any(queued[0] in started for queued in self._host_queue):
+                self._flush_host_updates()
+        while self._gather_pending and self._gather_pending[0] in self._gather_ready:
+            self._start_gather(self._gather_pending.pop(0))
+
+    def _allgather_params(self):
+        # buckets where some param got no grad are still to be updated
+        for key in list(self._fused_pending):
+            self._flush_fused(key)
+        self._flush_host_updates()
+        # Because some param is clip , so need all_gather
+        while self._gather_pending:
+            self._start_gather(self._gather_pending.pop(0))
+        self._reset_gathers()
+        if not self.overlap_gather:
+            self.wait_gather()
+
+    def wait_gather(self, keys=None):
+        """Makes the calc stream wait for the gather of the buckets `keys`, of
+        every bucket by default."""
+        for key in list(self._gather_tasks) if keys is None else keys:
+            task = self._gather_tasks.pop(key, None)
+            if task is not None:
+                task.wait()
+
+    def register_gather_hooks(self, layers):
+        """
+        Lets the next forward of `layers` overlap the gather of the params
+        updated by step(). step() then leaves the gathers running, and every
+        sublayer waits for the buckets of its own params before it runs. Call
+        wait_gather() before reading the params outside of the forward.
+
+        Returns:
+
+            list: the handles of the forward pre hooks
+        """
+
+        def wait_params(names):
+            keys = {self._bucket_of[name] for name in names if name in self._bucket_of}
+            self.wait_gather([key for key in self.flat_params if key in keys])
+
+        handles = []
+        for layer in layers.sublayers(include_self=True):
+            names = [param.name for param in layer.parameters(include_sublayers=False)]
+            if names:
+                handles.append(
+                    layer.register_forward_pre_hook(
+                        lambda layer, inputs, names=names: wait_params(names)
+                    )
+                )
+        self.overlap_gather = True
+        return handles
+
+    def _prepare_step(self):
+        # params must not be updated while the last gather still writes them
+        self.wait_gather()
+        self._host_lrs = {}
+        self._reflatten_if_cast()
+
+    def _allgather_accumulators(self):
+        if self.HIGH_PERFORMANCE_CONV:
+            return
+        self.wait_gather()
+        # the state offloaded to the host only holds the shard of this rank
+        for k, _ in self.flat_accum.items():
+            for key, flat in self.flat_accum[k].items():
+                if key not in self._host_state:
+                    self._allgather_flat(flat)
+        for key, flat in self.flat_master_weights.items():
+            if key not in self._host_state or self.offload_state < 2:
+                self._allgather_flat(flat)
+
+    def _reflatten_if_cast(self):
+        # paddle.amp.decorate(level="O2") casts the params after the optimizer
+        # is built, which moves them out of the flat buffers. Nothing has been
+        # updated before the first step, so the state is laid out again.
+        if self.amp_o2 or all(
+            param.dtype == key[0]
+            for key, params in self._flatten_buckets.items()
+            for param in params
+        ):
+            return
+        self._accumulators = defaultdict(lambda: {})
+        self._already_create_accumulator = set()
+        self._master_weights = {}
+        self._already_flat_acc = set()
+        self.clipped_param = {}
+        self._grad_views = {}
+        self.flat_accum = {}
+        self.re_flatten()
+        self._create_accumulators(self.t_block, self.flatten_params)
+        self._flatten_accumulators()
@@ -23,43 +23,117 @@
 # STRICT LIABILITY,OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)  ARISING IN ANY
 # WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
+import heapq
+
 import numpy as np
+import paddle
 
 
-def balance(param_list: list):
-    flatten_params = list(filter(lambda param: param.trainable, param_list))
-    descend_params = list(
-        sorted(flatten_params, key=lambda param: np.prod(param.shape), reverse=True)
-    )
-    # rank_groups[]
-    rank_groups = [[[], 0], [[], 0], [[], 0], [[], 0]]
+class BalancePlan:
+    """
+    The layout of params over ranks made by balance().
 
-    def get_smallest_group():
-        small_group = (
-            rank_groups[0] if rank_groups[0][1] < rank_groups[1][1] else rank_groups[1]
-        )
-        small_group = (
-            rank_groups[2] if rank_groups[2][1] < small_group[1] else small_group
-        )
-        small_group = (
-            rank_groups[3] if rank_groups[3][1] < small_group[1] else small_group
+    all_gather_partial gathers the same number of elements from every rank, so
+    the flattened params are cut into equal shares whatever the plan. The plan
+    orders the params so that the shares split as few of them as possible, and
+    reports what every rank ends up with. It only keeps param names, so it can
+    be cached and applied again to the same params.
+
+    Attributes:
+
+        rank_names (list): the names of the params starting in the share of
+            every rank, in flatten order
+        rank_loads (list): the param bytes in the share of every rank, padding
+            excluded
+        split_names (list): the names of the params spread over several shares
+    """
+
+    def __init__(self, rank_names, rank_loads, split_names):
+        self.rank_names = rank_names
+        self.rank_loads = rank_loads
+        self.split_names = split_names
+
+    @property
+    def nranks(self):
+        return len(self.rank_names)
+
+    @property
+    def imbalance(self):
+        """The largest rank load over the mean one, 1.0 when even."""
+        mean = sum(self.rank_loads) / self.nranks
+        return max(self.rank_loads) / mean if mean else 1.0
+
+    def order(self, param_list):
+        """Returns the params of `param_list` named by the plan, in plan order."""
+        params = {param.name: param for param in param_list}
+        return [params[name] for names in self.rank_names for name in names]
+
+    def __repr__(self):
+        return (
+            "BalancePlan(nranks={}, rank_loads={}, imbalance={:.3f}, "
+            "split={})".format(
+                self.nranks, self.rank_loads, self.imbalance, len(self.split_names)
+            )
         )
-        return small_group
-
-    for param in descend_params:
-        group = get_smallest_group()
-        group[0].append(param)
-        group[1] = group[1] + np.prod(param.shape)
-
-    print(rank_groups[0][1])
-    print("+++++" * 5)
-    print(rank_groups[1][1])
-    print("+++++" * 5)
-    print(rank_groups[2][1])
-    print("+++++" * 5)
-    print(rank_groups[3][1])
-    print("+++++" * 5)
-    flatten_params = (
-        rank_groups[0][0] + rank_groups[1][0] + rank_groups[2][0] + rank_groups[3][0]
-    )
-    return flatten_params
+
+
+def param_bytes(param):
+    return int(np.prod(param.shape)) * paddle.base.core.size_of_dtype(param.dtype)
+
+
+def _round_up(num, align):
+    return (num + align - 1) // align * align
+
+
+def balance(param_list: list, nranks: int = 4, align: int = 128):
+    """
+    Orders the trainable params of `param_list` for flattening into `nranks`
+    equal shares, as DistributeOptimizer does, so that the shares split as few
+    params as possible.
+
+    The params are grouped with the longest processing time rule, from the
+    largest to the smallest each going to the group with the fewest bytes so
+    far, and the groups are laid out one after the other, so that the share
+    boundaries mostly fall between params. Every param starts on an `align`
+    bytes boundary and the flattened params are padded to a multiple of
+    `align` bytes per rank.
+
+    Args:
+
+        param_list (list): the params to spread
+        nranks (int): the number of ranks
+        align (int): the alignment of every param and share, in bytes
+
+    Returns:
+
+        BalancePlan: the order of the params and the shares of every rank
+    """
+
+    params = [param for param in param_list if param.trainable]
+    sizes = [_round_up(param_bytes(param), align) for param in params]
+    # sorted() is stable, so equal params keep their order and ranks agree
+    descend = sorted(range(len(params)), key=lambda i: sizes[i], reverse=True)
+
+    groups = [[] for _ in range(nranks)]
+    heap = [(0, rank) for rank in range(nranks)]
+    for i in descend:
+        load, rank = heapq.heappop(heap)
+        groups[rank].append(i)
+        heapq.heappush(heap, (load + sizes[i], rank))
+
+    share = _round_up(sum(sizes), align * nranks) // nranks
+    rank_names = [[] for _ in range(nranks)]
+    rank_loads = [0] * nranks
+    split_names = []
+    offset = 0
+    for i in (i for group in groups for i in group):
+        start, end = offset, offset + param_bytes(params[i])
+        first = min(start // share, nranks - 1) if share else 0
+        last = (end - 1) // share if end > start else first
+        rank_names[first].append(params[i].name)
+        for rank in range(first, last + 1):
+            rank_loads[rank] += min(end, (rank + 1) * share) - max(start, rank * share)
+        if last > first:
+            split_names.append(params[i].name)
+        offset += sizes[i]
+    return BalancePlan(rank_names, rank_loads, split_names)
@@ -72,6 +72,10 @@ def start_local_trainers(
     training_script,
     HIGH_PERFORMANCE_CONV,
     TEST_DDP_OPTIMIZER_LAYERSIZE,
+    SDAA_SHARDING_SCOPE,
+    SDAA_FUSED_OPTIMIZER,
+    TEST_DDP_GRAD_SCALER,
+    SDAA_OFFLOAD_OPTIMIZER,
     training_script_args,
     device_type,
     allocator_strategy="auto_growth",
@@ -93,6 +97,10 @@ def start_local_trainers(
             "PADDLE_XCCL_BACKEND": device_type,
             "HIGH_PERFORMANCE_CONV": HIGH_PERFORMANCE_CONV,
             "TEST_DDP_OPTIMIZER_LAYERSIZE": TEST_DDP_OPTIMIZER_LAYERSIZE,
+            "SDAA_SHARDING_SCOPE": SDAA_SHARDING_SCOPE,
+            "SDAA_FUSED_OPTIMIZER": SDAA_FUSED_OPTIMIZER,
+            "TEST_DDP_GRAD_SCALER": TEST_DDP_GRAD_SCALER,
+            "SDAA_OFFLOAD_OPTIMIZER": SDAA_OFFLOAD_OPTIMIZER,
             "PADDLE_TRAINER_ID": "%d" % t.rank,
             "PADDLE_CURRENT_ENDPOINT": "%s" % t.endpoint,
             "PADDLE_TRAINERS_NUM": "%d" % cluster.trainers_nranks(),
@@ -137,6 +145,10 @@ class TestMultipleCustomDevices(unittest.TestCase):
         device_type,
         TEST_DDP_OPTIMIZER_LAYERSIZE="10",
         HIGH_PERFORMANCE_CONV="0",
+        SDAA_SHARDING_SCOPE="in_card",
+        SDAA_FUSED_OPTIMIZER="0",
+        TEST_DDP_GRAD_SCALER="0",
+        SDAA_OFFLOAD_OPTIMIZER="0",
         allocator_strategy="naive_best_fit",
         selected_gpus=["0", "1"],
     ):
@@ -144,8 +156,10 @@ class TestMultipleCustomDevices(unittest.TestCase):
             dev.split(":")[0] == device_type
             for dev in paddle.device.get_available_device()
         ].count(True)
-        if dev_cnt < 2:
-            return
+        if dev_cnt < max(2, len(selected_gpus)):
+            self.skipTest(
+                f"needs {max(2, len(selected_gpus))} {device_type} devices, found {dev_cnt}"
+            )
 
         cluster = None
         pod = None
@@ -159,6 +173,10 @@ class TestMultipleCustomDevices(unittest.TestCase):
             training_script=target_file_name,
             HIGH_PERFORMANCE_CONV=HIGH_PERFORMANCE_CONV,
             TEST_DDP_OPTIMIZER_LAYERSIZE=TEST_DDP_OPTIMIZER_LAYERSIZE,
+            SDAA_SHARDING_SCOPE=SDAA_SHARDING_SCOPE,
+            SDAA_FUSED_OPTIMIZER=SDAA_FUSED_OPTIMIZER,
+            TEST_DDP_GRAD_SCALER=TEST_DDP_GRAD_SCALER,
+            SDAA_OFFLOAD_OPTIMIZER=SDAA_OFFLOAD_OPTIMIZER,
             training_script_args=[],
             device_type=device_type,
         )
@@ -201,6 +219,59 @@ class TestModelParallelLayer(TestMultipleCustomDevices):
                 HIGH_PERFORMANCE_CONV="1",
             )
 
+    def test_ddp_in_node(self):
+        for i in range(10, 13):
+            self.run_mnist_2_custom_devices(
+                "ddp_optimizer.py",
+                "sdaa",
+                selected_gpus=[str(d) for d in range(8)],
+                TEST_DDP_OPTIMIZER_LAYERSIZE=str(i),
+                SDAA_SHARDING_SCOPE="in_node",
+            )
+
+    def test_ddp_global(self):
+        for i in range(10, 13):
+            self.run_mnist_2_custom_devices(
+                "ddp_optimizer.py",
+                "sdaa",
+                selected_gpus=["0", "1", "4", "5"],
+                TEST_DDP_OPTIMIZER_LAYERSIZE=str(i),
+                SDAA_SHARDING_SCOPE="global",
+            )
+
+    def test_ddp_fused(self):
+        for i in range(10, 13):
+            self.run_mnist_2_custom_devices(
+                "ddp_optimizer.py",
+                "sdaa",
+                selected_gpus=["0", "1", "2"],
+                TEST_DDP_OPTIMIZER_LAYERSIZE=str(i),
+                SDAA_FUSED_OPTIMIZER="1",
+            )
+
+    def test_ddp_grad_scaler(self):
+        # even layer sizes train without auto_cast, where the scalers are used
+        for i in [10, 12]:
+            for fused in ["0", "1"]:
+                self.run_mnist_2_custom_devices(
+                    "ddp_optimizer.py",
+                    "sdaa",
+                    TEST_DDP_OPTIMIZER_LAYERSIZE=str(i),
+                    SDAA_FUSED_OPTIMIZER=fused,
+                    TEST_DDP_GRAD_SCALER="1",
+                )
+
+    def test_ddp_offload(self):
+        for i in range(10, 13):
+            for offload in ["1", "2"]:
+                self.run_mnist_2_custom_devices(
+                    "ddp_optimizer.py",
+                    "sdaa",
+                    selected_gpus=["0", "1", "2"],
+                    TEST_DDP_OPTIMIZER_LAYERSIZE=str(i),
+                    SDAA_OFFLOAD_OPTIMIZER=offload,
+                )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,71 @@
+#   Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import unittest
+from types import SimpleNamespace
+
+import paddle
+from paddle_sdaa.utils import balance
+
+
+def param(name, shape, dtype, trainable=True):
+    # balance() only reads these, no device is needed
+    return SimpleNamespace(name=name, shape=shape, dtype=dtype, trainable=trainable)
+
+
+class TestBalance(unittest.TestCase):
+    def test_mixed_dtypes(self):
+        params = [
+            param("a", [64, 64], paddle.float32),
+            param("b", [64, 64], paddle.float16),
+            param("c", [100], paddle.float32),
+            param("frozen", [1000], paddle.float32, trainable=False),
+            param("d", [3000], paddle.bfloat16),
+            param("e", [32, 32], paddle.float32),
+            param("g", [10], paddle.float16),
+        ]
+        plan = balance(params, 3)
+        # aligned sizes 16384, 8192, 512, 6016, 4096 and 128 bytes make equal
+        # shares of 11776 bytes; the groups are [a], [b, c, g] and [d, e]
+        self.assertEqual(
+            [p.name for p in plan.order(params)], ["a", "b", "c", "g", "d", "e"]
+        )
+        self.assertEqual(plan.rank_names, [["a"], ["b"], ["c", "g", "d", "e"]])
+        self.assertEqual(plan.rank_loads, [11776, 4608 + 7168, 1024 + 10516])
+        self.assertEqual(sum(plan.rank_loads), 16384 + 8192 + 400 + 6000 + 4096 + 20)
+        self.assertEqual(plan.split_names, ["a", "b"])
+        self.assertAlmostEqual(plan.imbalance, 11776 * 3 / 35092)
+
+    def test_even(self):
+        params = [param(f"p{i}", [32], paddle.float32) for i in range(6)]
+        plan = balance(params, 3)
+        self.assertEqual(plan.rank_names, [["p0", "p3"], ["p1", "p4"], ["p2", "p5"]])
+        self.assertEqual(plan.rank_loads, [256, 256, 256])
+        self.assertEqual(plan.split_names, [])
+        self.assertEqual(plan.imbalance, 1.0)
+
+    def test_padding(self):
+        # one 128 bytes param, the shares are padded to 128 bytes each
+        plan = balance([param("p", [8], paddle.float16)], 4)
+        self.assertEqual(plan.rank_names, [["p"], [], [], []])
+        self.assertEqual(plan.rank_loads, [16, 0, 0, 0])
+        self.assertEqual(plan.imbalance, 4.0)
+        self.assertEqual(balance([], 2).rank_loads, [0, 0])
+        self.assertEqual(balance([], 2).imbalance, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()